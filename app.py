@@ -4,14 +4,45 @@ God Agent - Личный AI-помощник
 Chainlit + OpenRouter (Claude 3.5 Sonnet)
 """
 
-from typing import List, Dict
+import asyncio
+import functools
+import os
+import time
+from pathlib import Path
+from typing import List, Dict, Optional, Tuple
 
 import chainlit as cl
 from dotenv import load_dotenv
 
-from lib.openrouter_client import OpenRouterClient, build_messages
-from lib.analytics import Analytics
-from lib.profile import load_profile, extract_name, get_profile_summary, truncate_preview
+from lib.openrouter_client import (
+    GenerationCancelled,
+    MessageSequence,
+    OpenRouterClient,
+    get_admission_controller,
+)
+from lib.analytics import Analytics, UsageSummary
+from lib.cassette import get_cassette
+from lib.compress import summarize_history
+from lib.export import export_usage
+from lib.ingest import IngestStore, split_question
+from lib.loop_monitor import get_loop_monitor
+from lib.offload import get_cpu_offload
+from lib.output_guard import REASON_LABELS, GenerationAborted, make_output_guard
+from lib.pipeline import ReplyStream, build_system_prompt, record_turn
+from lib.memory import ConversationMemory, get_memory
+from lib.router import (
+    ROUTE_AUTO,
+    ROUTE_CLOUD,
+    ROUTE_LOCAL,
+    choose_route,
+    estimate_prompt_tokens,
+    get_route_metrics,
+    make_local_client,
+)
+from lib.semantic_cache import get_semantic_cache, make_scope
+from lib.sessions import get_session_registry
+from lib.profile import get_profile_summary
+from lib.profile_registry import DEFAULT_PROFILE_USER, ProfileView, get_profile_registry
 
 # Загружаем переменные окружения
 load_dotenv(override=True)
@@ -19,66 +50,109 @@ load_dotenv(override=True)
 
 # ========================== ПЕРСОНАЛИЗАЦИЯ ==========================
 
-# Загрузка профиля при старте
-USER_PROFILE = load_profile()
-USER_NAME = extract_name(USER_PROFILE)
+# Профили грузятся лениво через реестр — у каждого пользователя свой.
+# В промпт идут только релевантные секции профиля в пределах бюджета.
+PROFILE_BUDGET_TOKENS = int(os.getenv("PROFILE_BUDGET_TOKENS", "400"))
 
 
-# ========================== SYSTEM PROMPT ==========================
+def session_user_id() -> str:
+    """Идентификатор аутентифицированного пользователя сессии (или общий default)."""
+    user = cl.user_session.get("user")
+    return getattr(user, "identifier", None) or DEFAULT_PROFILE_USER
 
-def get_system_prompt() -> str:
-    """Формирует system prompt с учетом профиля."""
-    base_prompt = """Ты — God Agent, личный AI-помощник. Твоя задача — помогать пользователю, поддерживать и мотивировать.
 
-Отвечай:
-- По-русски
-- Дружелюбно и с заботой
-- Кратко (5-7 предложений, если не нужен код)
-- С учетом контекста о пользователе
-"""
+async def get_session_profile() -> ProfileView:
+    """Профиль пользователя текущей сессии (из кэша реестра, с учётом правок файла)."""
+    profile = await get_profile_registry().get(session_user_id())
+    cl.user_session.set("profile", profile)
+    return profile
+
+
+# Пометка в истории для ответа, оборванного стопом или новым сообщением.
+CANCELLED_MARKER = "[ответ прерван]"
+# Пометка для ответа, остановленного стражем вывода (причина — REASON_LABELS).
+ABORTED_MARKER = "[ответ остановлен: {}]"
+
+# /export: каталог выгрузок; выгрузка всех сессий процесса — только явно включённая.
+EXPORT_DIR = Path(__file__).parent / "data" / "exports"
+EXPORT_SERVER_WIDE = os.getenv("EXPORT_SERVER_WIDE", "0") == "1"
+EXPORT_FORMATS = {"csv": ".csv", "parquet": ".parquet", "arrow": ".arrow"}
+
+# Большие вставки и файлы из сообщений: в истории — ссылка, в промпте — фрагменты.
+INGEST_ENABLED = os.getenv("INGEST", "1") == "1"
+INGEST_DIR = Path(__file__).parent / "data" / "ingest"
+INGEST_MIN_CHARS = int(os.getenv("INGEST_MIN_CHARS", "20000"))
+INGEST_CHUNK_TOKENS = int(os.getenv("INGEST_CHUNK_TOKENS", "200"))
+INGEST_BUDGET_TOKENS = int(os.getenv("INGEST_BUDGET_TOKENS", "1500"))
+INGEST_TOP_K = int(os.getenv("INGEST_TOP_K", "6"))
+INGEST_MAX_MB = int(os.getenv("INGEST_MAX_MB", "50"))
+
+# /compress: размер куска истории (токены) и число параллельных запросов map-фазы.
+COMPRESS_CHUNK_TOKENS = int(os.getenv("COMPRESS_CHUNK_TOKENS", "1500"))
+COMPRESS_PARALLELISM = int(os.getenv("COMPRESS_PARALLELISM", "3"))
 
-    if USER_PROFILE:
-        base_prompt += f"""
+# Сколько кусков долгосрочной памяти и в каком бюджете токенов подмешивать в промпт.
+MEMORY_TOP_K = 5
+MEMORY_BUDGET_TOKENS = 300
 
-## КОНТЕКСТ О ПОЛЬЗОВАТЕЛЕ:
-{USER_PROFILE}
+# Прогрев при открытии чата: сколько держать соединение тёплым до первого
+# сообщения и как часто (пул HTTP закрывает простаивающие соединения через ~5 с).
+WARMUP_ENABLED = os.getenv("WARMUP", "1") == "1"
+WARMUP_HOLD_S = float(os.getenv("WARMUP_HOLD_S", "30"))
+WARMUP_KEEPALIVE_S = float(os.getenv("WARMUP_KEEPALIVE_S", "4"))
 
-Обращайся к пользователю по имени: {USER_NAME}."""
 
-    return base_prompt
+# ========================== SYSTEM PROMPT ==========================
+
+def get_system_prompt(profile: ProfileView, user_text: Optional[str] = None) -> str:
+    """Формирует system prompt с учетом профиля.
+
+    Если передан ``user_text``, из профиля берутся только обязательные секции
+    и секции, релевантные сообщению (BM25), в пределах ``PROFILE_BUDGET_TOKENS``.
+    Без ``user_text`` профиль вставляется целиком.
+    """
+    return build_system_prompt(profile, user_text, PROFILE_BUDGET_TOKENS)
 
 
 # ========================== КОМАНДЫ ==========================
 
-async def handle_compress_command(client: OpenRouterClient, history: List[Dict]):
-    """Сжимает историю диалога."""
+async def handle_compress_command(
+    client: OpenRouterClient,
+    history: List[Dict],
+    memory: Optional[ConversationMemory] = None,
+):
+    """Сжимает историю диалога (длинную — map-reduce, с прогрессом в сообщении)."""
     if not history:
         await cl.Message(content="История пуста — сжимать нечего.").send()
         return []
 
-    await cl.Message(content="Сжимаю историю диалога...").send()
+    progress = cl.Message(content="Сжимаю историю диалога...")
+    await progress.send()
 
-    formatted = []
-    for idx, item in enumerate(history, 1):
-        role = "Пользователь" if item["role"] == "user" else "Ассистент"
-        formatted.append(f"{idx}. {role}: {truncate_preview(item['content'])}")
-
-    compression_prompt = (
-        "Сделай краткую сводку диалога ниже в 5-7 предложений. "
-        "Сохрани ключевые факты, вопросы и решения.\n\n"
-        + "\n".join(formatted)
-    )
-
-    messages = [{"role": "user", "content": compression_prompt}]
+    async def report(step: str) -> None:
+        await progress.stream_token(f"\n- {step}")
 
     try:
-        summary = await client.get_completion_text(messages, temperature=0.2)
+        summary = await summarize_history(
+            client,
+            history,
+            chunk_tokens=COMPRESS_CHUNK_TOKENS,
+            parallelism=COMPRESS_PARALLELISM,
+            on_progress=report,
+        )
 
         compressed = [{
             "role": "assistant",
             "content": f"[Сводка предыдущего диалога] {summary.strip()}"
         }]
 
+        # Полные реплики уходят из промпта — сохраняем их и сводку в долгосрочную память.
+        # Сводка в новой истории уже в архиве: on_chat_end допишет только то, что после неё.
+        if memory is not None:
+            await asyncio.to_thread(memory.archive_turns, unarchived_turns(history))
+            await asyncio.to_thread(memory.archive_summary, summary.strip())
+            cl.user_session.set("memory_archived", len(compressed))
+
         await cl.Message(
             content=f"История сжата!\n\n**Сводка:**\n{summary}"
         ).send()
@@ -90,39 +164,179 @@ async def handle_compress_command(client: OpenRouterClient, history: List[Dict])
         return history
 
 
-async def handle_summary_command(usage_history: List[Dict]):
-    """Выводит статистику токенов."""
+def unarchived_turns(history: List[Dict]) -> List[Dict]:
+    """Реплики истории, которых ещё нет в долгосрочной памяти."""
+    return history[cl.user_session.get("memory_archived", 0):]
+
+
+async def handle_summary_command(
+    usage_history: List[Dict],
+    user_text: str = "/summary",
+    summary: Optional[UsageSummary] = None,
+):
+    """Выводит статистику токенов: /summary [страница] (без аргумента — последняя)."""
     if not usage_history:
         await cl.Message(content="Пока нет данных по токенам.").send()
         return
 
-    total = sum(item.get("total_tokens", 0) for item in usage_history)
-
-    lines = [
-        "**Статистика токенов:**\n",
-        "| # | Сообщение | Токены |",
-        "|---|-----------|--------|"
-    ]
+    summary = summary if summary is not None else UsageSummary()
+    summary.update(usage_history)
+    parts = user_text.split()
+    page = None
+    if len(parts) > 1:
+        if not parts[1].isdigit() or not 1 <= int(parts[1]) <= summary.pages:
+            await cl.Message(content=f"Использование: `/summary [1–{summary.pages}]`").send()
+            return
+        page = int(parts[1])
 
-    for idx, item in enumerate(usage_history, 1):
-        preview = item.get("message", "")[:30]
-        tokens = item.get("total_tokens", 0)
-        lines.append(f"| {idx} | {preview}... | {tokens} |")
+    await cl.Message(content=summary.render(usage_history, page)).send()
 
-    lines.append(f"\n**Всего:** {total} токенов")
 
-    await cl.Message(content="\n".join(lines)).send()
+def get_usage_summary() -> UsageSummary:
+    """Итоги /summary текущей сессии (создаются при первом обращении)."""
+    summary = cl.user_session.get("usage_summary")
+    if summary is None:
+        summary = UsageSummary()
+        cl.user_session.set("usage_summary", summary)
+    return summary
 
 
 async def handle_dashboard_command(analytics_list: List[Dict]):
     """Выводит дашборд статистики."""
-    dashboard_content = Analytics.format_dashboard(analytics_list)
+    # Строка строится по всему списку — длинная аналитика в потоке, не в event loop.
+    # Не в процессе: pickle тысяч записей дороже самого рендера.
+    dashboard_content = await get_cpu_offload().run(
+        Analytics.format_dashboard, analytics_list, size=len(analytics_list), process=False
+    )
     await cl.Message(content=dashboard_content).send()
 
 
-async def handle_profile_command():
+async def handle_metrics_command(client: OpenRouterClient):
+    """Выводит технические метрики: очередь и лимиты LLM, повторы и fallback сессии."""
+    sections = {
+        "Очередь запросов к LLM": get_admission_controller().snapshot(),
+        "Повторы и fallback (сессия)": {**client.stats, "last_model": client.last_model},
+    }
+    cache = get_semantic_cache()
+    if cache is not None:
+        sections["Семантический кэш"] = cache.snapshot()
+    sections["Маршруты (local/cloud)"] = get_route_metrics().snapshot()
+    monitor = get_loop_monitor()
+    if monitor is not None:
+        sections["Event loop"] = monitor.snapshot()
+    sections["Сессии (память процесса)"] = get_session_registry().snapshot()
+    sections["Вынос CPU-задач"] = get_cpu_offload().snapshot()
+    cassette = get_cassette()
+    if cassette is not None:
+        sections["Кассета стримов LLM"] = cassette.snapshot()
+    await cl.Message(content=Analytics.format_metrics(sections)).send()
+
+
+async def handle_route_command(user_text: str):
+    """Ручной выбор маршрута: /route local|cloud|auto (без аргумента — текущий режим)."""
+    parts = user_text.split()
+    if cl.user_session.get("local_client") is None:
+        await cl.Message(content="Локальная маршрутизация выключена (`LOCAL_ROUTING=1`).").send()
+        return
+    if len(parts) > 1:
+        mode = parts[1].lower()
+        if mode not in (ROUTE_AUTO, ROUTE_LOCAL, ROUTE_CLOUD):
+            await cl.Message(content="Использование: `/route local|cloud|auto`").send()
+            return
+        cl.user_session.set("route_override", mode)
+    mode = cl.user_session.get("route_override", ROUTE_AUTO)
+    await cl.Message(content=f"**Маршрут:** `{mode}`").send()
+
+
+async def handle_export_command(usage_history: List[Dict], user_text: str):
+    """Выгрузка аналитики в файл: /export [csv|parquet|arrow] [all]."""
+    parts = [part.lower() for part in user_text.split()[1:]]
+    server_wide = "all" in parts
+    formats = [part for part in parts if part != "all"]
+    fmt = formats[0] if formats else "csv"
+    if fmt not in EXPORT_FORMATS or len(formats) > 1:
+        await cl.Message(content="Использование: `/export [csv|parquet|arrow] [all]`").send()
+        return
+    if server_wide and not EXPORT_SERVER_WIDE:
+        await cl.Message(content="Выгрузка всех сессий выключена (`EXPORT_SERVER_WIDE=1`).").send()
+        return
+
+    session_id = cl.user_session.get("id") or "session"
+    if server_wide:
+        records = get_session_registry().iter_usage()
+    else:
+        records = ((session_id, record) for record in list(usage_history))
+    name = "all" if server_wide else session_id
+    path = EXPORT_DIR / f"{name}-{time.strftime('%Y%m%d-%H%M%S')}{EXPORT_FORMATS[fmt]}"
+    try:
+        # Запись пачками — в пуле потоков, event loop не ждёт диск
+        rows = await asyncio.to_thread(export_usage, records, path, fmt)
+    except RuntimeError as e:
+        await cl.Message(content=f"Ошибка выгрузки: {e}").send()
+        return
+    await cl.Message(content=f"**Выгружено:** `{rows}` записей в `{path}`").send()
+
+
+def get_ingest_store() -> IngestStore:
+    """Вложения текущей сессии (создаются при первом обращении)."""
+    store = cl.user_session.get("ingest")
+    if store is None:
+        store = IngestStore(
+            INGEST_DIR / (cl.user_session.get("id") or "default"),
+            chunk_tokens=INGEST_CHUNK_TOKENS,
+            max_bytes=INGEST_MAX_MB * 1024 * 1024,
+        )
+        cl.user_session.set("ingest", store)
+    return store
+
+
+async def ingest_message(message: cl.Message, user_text: str) -> Tuple[str, str]:
+    """Большая вставка и файлы сообщения — во вложения сессии.
+
+    Возвращает текст хода для истории (вопрос и ссылки на вложения) и вопрос
+    для выбора фрагментов.
+    """
+    files = [e for e in getattr(message, "elements", None) or [] if getattr(e, "path", None)]
+    oversized = len(user_text) >= INGEST_MIN_CHARS
+    if not oversized and not files:
+        return user_text, user_text
+
+    store = get_ingest_store()
+    question, references = user_text, []
+    # Чтение, нарезка и индекс — в потоке: мегабайты текста не держат event loop
+    if oversized:
+        question, body = split_question(user_text)
+        attachment = await asyncio.to_thread(store.ingest_text, "вставка", body)
+        references.append(attachment.reference())
+    for element in files:
+        name = getattr(element, "name", None) or Path(element.path).name
+        try:
+            attachment = await asyncio.to_thread(store.ingest_file, name, element.path)
+        except (OSError, ValueError) as e:
+            references.append(f"[вложение «{name}» не прочитано: {e}]")
+            continue
+        references.append(attachment.reference())
+    return "\n".join(filter(None, [question, *references])), question
+
+
+async def handle_more_command(user_text: str):
+    """Ещё фрагменты вложений: /more — следующие по порядку, /more <запрос> — по запросу."""
+    store = cl.user_session.get("ingest")
+    if store is None or not len(store):
+        await cl.Message(content="Вложений нет — приложите файл или вставьте длинный текст.").send()
+        return
+    query = user_text[len("/more"):].strip()
+    keys = await asyncio.to_thread(store.more, query, INGEST_BUDGET_TOKENS)
+    if not keys:
+        await cl.Message(content="Ничего не найдено." if query else "Вложение показано до конца.").send()
+        return
+    fragments = await asyncio.to_thread(store.render, keys)
+    await cl.Message(content=f"{fragments}\n\n_Фрагменты добавлены к следующему вопросу._").send()
+
+
+async def handle_profile_command(profile: ProfileView):
     """Показывает саммари загруженного профиля."""
-    summary = get_profile_summary(USER_PROFILE)
+    summary = get_profile_summary(profile.content)
     await cl.Message(content=summary).send()
 
 
@@ -130,6 +344,11 @@ async def handle_reset_command():
     """Сбрасывает историю диалога и аналитику."""
     cl.user_session.set("history", [])
     cl.user_session.set("usage_history", [])
+    cl.user_session.set("memory_archived", 0)
+    store = cl.user_session.get("ingest")
+    if store is not None:
+        await asyncio.to_thread(store.close)
+        cl.user_session.set("ingest", None)
     await cl.Message(content="**Сброшено.** История и статистика очищены.").send()
 
 
@@ -141,8 +360,12 @@ def format_help() -> str:
         "|---------|------------|\n"
         "| `/help` | показать эту справку |\n"
         "| `/compress` | сжать историю диалога |\n"
-        "| `/summary` | статистика токенов |\n"
+        "| `/summary` | статистика токенов; `/summary N` — страница N |\n"
         "| `/dashboard` | дашборд полной статистики |\n"
+        "| `/metrics` | технические метрики: очередь LLM, повторы, fallback |\n"
+        "| `/export` | выгрузка статистики: `csv`, `parquet` или `arrow` |\n"
+        "| `/more` | ещё фрагменты вложений; `/more запрос` — по запросу |\n"
+        "| `/route` | маршрут: `local`, `cloud` или `auto` |\n"
         "| `/profile` | саммари загруженного профиля |\n"
         "| `/reset` | очистить историю и статистику |\n"
         "| `/clear` | алиас для `/reset` |\n"
@@ -156,7 +379,6 @@ async def handle_help_command():
 
 async def handle_version_command():
     """Возвращает имя модели из OPENROUTER_MODEL (fallback: anthropic/claude-3.5-sonnet)."""
-    import os
     model = os.getenv("OPENROUTER_MODEL", "anthropic/claude-3.5-sonnet")
     await cl.Message(content=f"**Модель:** `{model}`").send()
 
@@ -172,6 +394,7 @@ def build_welcome_message(user_name: str, profile_loaded: bool) -> str:
 - `/summary` — статистика токенов
 - `/dashboard` — дашборд полной статистики
 - `/profile` — саммари загруженного профиля
+- `/more` — ещё фрагменты приложенного файла или длинной вставки
 - `/reset` — очистить историю и статистику
 
 Чем могу помочь?"""
@@ -182,6 +405,14 @@ def build_welcome_message(user_name: str, profile_loaded: bool) -> str:
 @cl.on_chat_start
 async def on_chat_start():
     """Инициализация чата."""
+    monitor = get_loop_monitor()
+    if monitor is not None:
+        monitor.start()
+    offload = get_cpu_offload()
+    if offload.workers and not offload.started:
+        # Воркеры пула процессов стартуют в фоне (сотни мс), не в первом разборе
+        cl.user_session.set("offload_start", asyncio.create_task(offload.start()))
+
     try:
         client = OpenRouterClient()
         cl.user_session.set("client", client)
@@ -189,14 +420,82 @@ async def on_chat_start():
         await cl.Message(content=f"Ошибка OpenRouter: {e}").send()
         return
 
+    local_client = make_local_client(client)
+    cl.user_session.set("local_client", local_client)
+    start_warmup([c for c in (client, local_client) if c is not None])
     cl.user_session.set("history", [])
     cl.user_session.set("usage_history", [])
 
-    welcome = build_welcome_message(USER_NAME, bool(USER_PROFILE))
+    track_session()
+
+    profile = await get_session_profile()
+    welcome = build_welcome_message(profile.name, profile.loaded)
     await cl.Message(content=welcome).send()
 
 
+async def warmup_session(clients: List[OpenRouterClient], stop: asyncio.Event) -> None:
+    """Фоновый прогрев сессии: соединения и локальная модель, пока рендерится приветствие.
+
+    Результат (время прогрева) сохраняется в сессии и попадает в аналитику
+    первого сообщения. Потом, до первого сообщения (``stop``) или
+    ``WARMUP_HOLD_S``, соединения освежаются раз в ``WARMUP_KEEPALIVE_S``.
+    """
+    started = time.perf_counter()
+    results = await asyncio.gather(*(client.warmup() for client in clients))
+    warmup = {
+        "warmup_ms": round((time.perf_counter() - started) * 1000, 1),
+        "routes": {model: ms for result in results for model, ms in result["routes"].items()},
+        "failed": [model for result in results for model in result["failed"]],
+    }
+    cl.user_session.set("warmup", warmup)
+
+    deadline = started + WARMUP_HOLD_S
+    while time.perf_counter() + WARMUP_KEEPALIVE_S < deadline:
+        try:
+            await asyncio.wait_for(stop.wait(), timeout=WARMUP_KEEPALIVE_S)
+            return
+        except asyncio.TimeoutError:
+            await asyncio.gather(*(client.warmup(preload=False) for client in clients))
+
+
+def start_warmup(clients: List[OpenRouterClient]) -> None:
+    """Запускает прогрев в фоне (задача хранится в сессии, чтобы её не собрал GC)."""
+    if not WARMUP_ENABLED:
+        return
+    stop = asyncio.Event()
+    cl.user_session.set("warmup_stop", stop)
+    cl.user_session.set("warmup_task", asyncio.create_task(warmup_session(clients, stop)))
+
+
+def track_session():
+    """Обновляет учёт памяти текущей сессии (id есть только у настоящей сессии Chainlit)."""
+    session_id = cl.user_session.get("id")
+    if session_id:
+        sequence = cl.user_session.get("message_sequence")
+        get_session_registry().touch(
+            session_id,
+            cl.user_session.get("history", []),
+            cl.user_session.get("usage_history", []),
+            (sequence,) if sequence is not None else (),
+        )
+
+
+def session_tracked(handler):
+    """Обёртка хендлера сообщений: возврат выгруженной истории сессии и учёт памяти."""
+    @functools.wraps(handler)
+    async def wrapper(message: cl.Message):
+        session_id = cl.user_session.get("id")
+        if session_id:
+            await get_session_registry().resume(session_id)
+        try:
+            await handler(message)
+        finally:
+            track_session()
+    return wrapper
+
+
 @cl.on_message
+@session_tracked
 async def on_message(message: cl.Message):
     """Обработка сообщений."""
     client = cl.user_session.get("client")
@@ -209,13 +508,22 @@ async def on_message(message: cl.Message):
 
     user_text = message.content.strip()
 
+    # Первое сообщение пришло — держать соединения тёплыми больше не нужно
+    warmup_stop = cl.user_session.get("warmup_stop")
+    if warmup_stop is not None:
+        warmup_stop.set()
+
+    profile = await get_session_profile()
+    # Первое обращение к памяти читает и индексирует архив с диска — не в event loop
+    memory = await asyncio.to_thread(get_memory, make_scope(profile.user_id))
+
     # Обработка команд
     if user_text.startswith("/"):
         cmd = user_text.split()[0].lower()
 
         # /compress — особый случай: нужен client и мутация history в сессии.
         if cmd == "/compress":
-            new_history = await handle_compress_command(client, history)
+            new_history = await handle_compress_command(client, history, memory)
             cl.user_session.set("history", new_history)
             return
 
@@ -223,9 +531,13 @@ async def on_message(message: cl.Message):
         simple_commands = {
             "/help": (handle_help_command, ()),
             "/version": (handle_version_command, ()),
-            "/summary": (handle_summary_command, (usage_history,)),
+            "/summary": (handle_summary_command, (usage_history, user_text, get_usage_summary())),
             "/dashboard": (handle_dashboard_command, (usage_history,)),
-            "/profile": (handle_profile_command, ()),
+            "/metrics": (handle_metrics_command, (client,)),
+            "/profile": (handle_profile_command, (profile,)),
+            "/export": (handle_export_command, (usage_history, user_text)),
+            "/more": (handle_more_command, (user_text,)),
+            "/route": (handle_route_command, (user_text,)),
             "/reset": (handle_reset_command, ()),
             "/clear": (handle_reset_command, ()),
         }
@@ -235,37 +547,187 @@ async def on_message(message: cl.Message):
             await handler(*args)
             return
 
+    # Большие вставки и файлы — во вложения: в истории и аналитике только ссылка
+    query = user_text
+    if INGEST_ENABLED:
+        user_text, query = await ingest_message(message, user_text)
+    ingest = cl.user_session.get("ingest")
+    has_attachments = ingest is not None and len(ingest) > 0
+
+    # Простые реплики — в локальную модель, сложные — в облако (если включено).
+    # Маршрут выбирается до кэша: ответы локальной и облачной модели не смешиваются.
+    route = ROUTE_CLOUD
+    local_client = cl.user_session.get("local_client")
+    if local_client is not None:
+        route = choose_route(
+            user_text,
+            len(history),
+            cl.user_session.get("route_override", ROUTE_AUTO),
+        )
+        if route == ROUTE_LOCAL:
+            client = local_client
+
+    # Семантический кэш: близкий независимый вопрос — готовый ответ без LLM.
+    # С вложениями ответ зависит от их содержимого — кэш не используется.
+    cache = get_semantic_cache()
+    use_cache = cache is not None and cache.is_cacheable(history) and not has_attachments
+    if use_cache:
+        cached_answer = await asyncio.to_thread(
+            cache.lookup, user_text, make_scope(profile.content, client.model)
+        )
+        if cached_answer is not None:
+            await cl.Message(content=cached_answer).send()
+            history.append({"role": "user", "content": user_text})
+            history.append({"role": "assistant", "content": cached_answer})
+            cl.user_session.set("history", history)
+            usage_history = Analytics.record_usage(
+                user_text,
+                cached_answer,
+                {"prompt_tokens": 0, "completion_tokens": 0},
+                usage_history
+            )
+            usage_history[-1]["cached"] = True
+            cl.user_session.set("usage_history", usage_history)
+            return
+
+    # Новое сообщение обрывает предыдущую генерацию этой сессии.
+    previous_cancel = cl.user_session.get("cancel_event")
+    if previous_cancel is not None:
+        previous_cancel.set()
+    cancel_event = asyncio.Event()
+    cl.user_session.set("cancel_event", cancel_event)
+
     # Формируем промпт и отправляем запрос
-    system_prompt = get_system_prompt()
-    messages = build_messages(user_text, history, system_prompt)
+    system_prompt = get_system_prompt(profile, user_text)
+    memory_snippets = None
+    if memory is not None:
+        memory_snippets = await asyncio.to_thread(
+            memory.select_snippets,
+            user_text,
+            MEMORY_TOP_K,
+            MEMORY_BUDGET_TOKENS,
+        )
+    # Сообщения сессии конвертируются в объекты LangChain один раз, а не каждый ход
+    sequence = cl.user_session.get("message_sequence")
+    if sequence is None:
+        sequence = MessageSequence()
+        cl.user_session.set("message_sequence", sequence)
+    # Фрагменты вложений — только в промпт этого хода, не в историю
+    prompt_text = user_text
+    if has_attachments:
+        context = await asyncio.to_thread(ingest.context, query, INGEST_BUDGET_TOKENS, INGEST_TOP_K)
+        if context:
+            prompt_text = f"{context}\n\n{user_text}"
+    messages = sequence.prepare(prompt_text, history, system_prompt, memory_snippets)
 
     msg = cl.Message(content="")
     await msg.send()
 
-    full_response = ""
-
+    # Страж вывода обрывает зациклившуюся или бесконечную генерацию
+    reply = ReplyStream(client, messages, cancel_event, make_output_guard())
+    aborted = None
     try:
-        async for chunk in client.stream_completion(messages):
-            full_response += chunk
-            await msg.stream_token(chunk)
+        await reply.run(msg.stream_token)
+    except GenerationAborted as e:
+        aborted = e.reason
+        await msg.stream_token(f"\n\n{ABORTED_MARKER.format(REASON_LABELS[aborted])}")
+    except asyncio.CancelledError:
+        save_cancelled_turn(user_text, reply.text, history, usage_history)
+        raise
+    except GenerationCancelled:
+        save_cancelled_turn(user_text, reply.text, history, usage_history)
+        await msg.stream_token(f"\n\n{CANCELLED_MARKER}")
+        return
     except Exception as e:
         await msg.stream_token(f"\n\nОшибка: {e}")
         return
+    finally:
+        if cl.user_session.get("cancel_event") is cancel_event:
+            cl.user_session.set("cancel_event", None)
+
+    full_response = reply.text
+    if aborted is not None:
+        full_response = f"{full_response}\n\n{ABORTED_MARKER.format(REASON_LABELS[aborted])}".lstrip()
+    # Маршрут, который ответил на самом деле: без Ollama локальный клиент
+    # уходит по цепочке в облако, и это облачные траты, а не локальные
+    answered_local = getattr(client, "last_local", route == ROUTE_LOCAL)
+    answered_route = ROUTE_LOCAL if answered_local else ROUTE_CLOUD
+    if local_client is not None:
+        get_route_metrics().record(
+            answered_route,
+            reply.ttft_s,
+            reply.latency_s,
+            estimate_prompt_tokens(messages) + len(full_response) // 4,
+        )
+
+    if use_cache and aborted is None:
+        # Ответ кэшируется под модель, которая ответила на самом деле (после fallback)
+        answered_by = getattr(client, "last_model", None) or client.model
+        await asyncio.to_thread(
+            cache.store, user_text, full_response, make_scope(profile.content, answered_by)
+        )
+
+    # Сохраняем историю и статистику через Analytics
+    record = record_turn(user_text, full_response, history, usage_history, reply.ttft_s, reply.latency_s)
+    cl.user_session.set("history", history)
+    warmup = cl.user_session.get("warmup")
+    if aborted is not None:
+        record["aborted"] = aborted
+    if warmup is not None and len(usage_history) == 1:
+        record["warmup_ms"] = warmup["warmup_ms"]
+    # Модель, ответившая на самом деле (после fallback), — для /dashboard и выгрузки
+    record["model"] = getattr(client, "last_model", None)
+    if local_client is not None:
+        record["route"] = answered_route
+    cl.user_session.set("usage_history", usage_history)
 
-    # Сохраняем историю
+
+def save_cancelled_turn(
+    user_text: str,
+    partial_response: str,
+    history: List[Dict],
+    usage_history: List[Dict],
+) -> None:
+    """Сохраняет оборванный ответ в историю с пометкой и учитывает его в аналитике.
+
+    Синхронная: вызывается из уже отменённой задачи, где await небезопасен.
+    """
     history.append({"role": "user", "content": user_text})
-    history.append({"role": "assistant", "content": full_response})
+    history.append({
+        "role": "assistant",
+        "content": f"{partial_response}\n\n{CANCELLED_MARKER}".lstrip(),
+    })
     cl.user_session.set("history", history)
 
-    # Сохраняем статистику через Analytics
-    usage_history = Analytics.record_usage(
-        user_text,
-        full_response,
-        None,
-        usage_history
-    )
+    usage_history = Analytics.record_cancelled(user_text, partial_response, usage_history)
     cl.user_session.set("usage_history", usage_history)
 
 
+@cl.on_chat_end
+async def on_chat_end():
+    """Конец сессии: несжатая история уходит в долгосрочную память, куски вложений удаляются."""
+    memory = await asyncio.to_thread(get_memory, make_scope(session_user_id()))
+    history = cl.user_session.get("history", [])
+    session_id = cl.user_session.get("id")
+    if session_id:
+        # Выгруженная на диск часть истории тоже должна попасть в архив
+        await get_session_registry().restore(session_id)
+        get_session_registry().forget(session_id)
+    turns = unarchived_turns(history)
+    if memory is not None and turns:
+        await asyncio.to_thread(memory.archive_turns, turns)
+    store = cl.user_session.get("ingest")
+    if store is not None:
+        await asyncio.to_thread(store.close)
+
+
+@cl.on_stop
+async def on_stop():
+    """Стоп в UI: Chainlit отменяет задачу сам, event — для генерации вне этой задачи."""
+    cancel_event = cl.user_session.get("cancel_event")
+    if cancel_event is not None:
+        cancel_event.set()
+
+
 if __name__ == "__main__":
     print("Запустите: chainlit run app.py")
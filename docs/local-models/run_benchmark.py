@@ -13,22 +13,44 @@
 При указании моделей через argv stats.json мержится, а не перезаписывается —
 можно добавить результаты новой модели, не теряя уже прогнанные.
 
-Требует запущенную Ollama (`ollama serve`).
+Размер контекста (``num_ctx``) подбирается по промптам прогона
+(``lib/ollama.py``), один на весь прогон; в лог пишется размер и KV-кэш.
+
+Порядок прогона — ``ResidencyScheduler``: все задачи одной модели подряд,
+модель загружается до задач (``load_s`` отдельно от ``wall_s``), следующая
+подгружается в фоне, если загруженные модели и она помещаются в
+``OLLAMA_MEMORY_BUDGET_GB`` (0 — без подгрузки). В stats.json["schedule"] —
+загрузки по моделям и выигрыш против наивного порядка.
+
+С ``LLM_CASSETTE`` стримы пишутся в кассету (``LLM_CASSETTE_MODE=record``)
+или воспроизводятся из неё без Ollama (``lib/cassette.py``).
+
+Требует запущенную Ollama (`ollama serve`, адрес — ``OLLAMA_BASE_URL``).
 """
 
 import json
+import logging
+import os
 import sys
 import time
-import urllib.request
 from pathlib import Path
 
-OLLAMA_URL = "http://localhost:11434/api/chat"
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent.parent))
+
+from lib.ollama import ContextSizer, ResidencyScheduler, chat_request, chat_stream  # noqa: E402
+from lib.output_guard import OutputGuard  # noqa: E402
+
 OUT_DIR = Path(__file__).parent / "task-runs"
 OUT_DIR.mkdir(exist_ok=True)
 STATS_PATH = OUT_DIR / "stats.json"
 
 MODELS = ["qwen2.5:3b", "gemma3:1b", "qwen2.5:0.5b", "gemma4:e4b"]
 
+# Бюджет ответа: нормальные ответы укладываются в ~1000 токенов, без
+# ограничения зациклившаяся модель генерирует до конца контекста.
+MAX_OUTPUT_TOKENS = 2048
+SIZER = ContextSizer(max_output_tokens=MAX_OUTPUT_TOKENS)
+
 SYSTEM_PROMPT_CHAT = """# lardis — правила проекта
 
 Персональный AI-помощник. Chainlit чат-бот + OpenRouter LLM + профиль.
@@ -128,23 +150,27 @@ TASK2_PROMPT = f"""Пользователь жалуется: команда `/s
 """
 
 
+# task -> (префикс файла, описание, system prompt, промпт)
+TASKS = {
+    "task1": ("day1", "feature", SYSTEM_PROMPT_CHAT, TASK1_PROMPT),
+    "task2": ("day2", "bug-fix", SYSTEM_PROMPT_BUGFIX, TASK2_PROMPT),
+}
+
+
+def _messages(system: str, user: str) -> list[dict]:
+    return [
+        {"role": "system", "content": system},
+        {"role": "user", "content": user},
+    ]
+
+
 def ask(model: str, system: str, user: str) -> dict:
-    payload = {
-        "model": model,
-        "messages": [
-            {"role": "system", "content": system},
-            {"role": "user", "content": user},
-        ],
-        "stream": False,
-        "options": {"temperature": 0.2, "top_p": 0.9, "num_ctx": 8192},
-    }
-    data = json.dumps(payload).encode("utf-8")
-    req = urllib.request.Request(
-        OLLAMA_URL, data=data, headers={"Content-Type": "application/json"}
-    )
+    messages = _messages(system, user)
+    num_ctx = SIZER.fit(model, messages)
+    payload = chat_request(model, messages, num_ctx, MAX_OUTPUT_TOKENS)
     t0 = time.time()
-    with urllib.request.urlopen(req, timeout=600) as resp:
-        body = json.loads(resp.read().decode("utf-8"))
+    # Стрим под стражем: зациклившийся ответ обрывается, а не крутится до num_predict
+    body = chat_stream(payload, OutputGuard(max_tokens=MAX_OUTPUT_TOKENS), timeout=600)
     wall = time.time() - t0
     content = body["message"]["content"]
     eval_count = body.get("eval_count", 0)
@@ -155,17 +181,26 @@ def ask(model: str, system: str, user: str) -> dict:
         "wall_s": round(wall, 2),
         "eval_count": eval_count,
         "tok_per_s": round(tok_per_s, 1),
+        "num_ctx": num_ctx,
+        "prompt_eval_count": body.get("prompt_eval_count", 0),
+        # Модель пришлось (пере)загрузить внутри запроса — это время не инференс
+        "load_s": round(body.get("load_duration", 0) / 1e9, 2),
+        # Страж вывода оборвал генерацию (repetition / max_tokens / stall)
+        **({"aborted": body["aborted"]} if "aborted" in body else {}),
     }
 
 
 def save(task: str, model: str, out: dict, prompt: str) -> None:
     safe_model = model.replace(":", "_").replace("/", "_")
     path = OUT_DIR / f"{task}-{safe_model}.md"
+    aborted = f"- **Остановлен стражем вывода:** {out['aborted']}\n" if out.get("aborted") else ""
     path.write_text(
         f"# {task} — {model}\n\n"
         f"- Время (wall): **{out['wall_s']}s**\n"
         f"- Токенов в ответе: **{out['eval_count']}**\n"
-        f"- Скорость: **{out['tok_per_s']} tok/s**\n\n"
+        f"- Скорость: **{out['tok_per_s']} tok/s**\n"
+        f"- Контекст: **num_ctx {out['num_ctx']}**\n"
+        f"{aborted}\n"
         f"## Промпт\n\n```\n{prompt.strip()}\n```\n\n"
         f"## Ответ модели\n\n{out['content']}\n",
         encoding="utf-8",
@@ -173,6 +208,7 @@ def save(task: str, model: str, out: dict, prompt: str) -> None:
 
 
 def main() -> None:
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
     argv_models = sys.argv[1:]
     models = argv_models or MODELS
 
@@ -181,18 +217,31 @@ def main() -> None:
     else:
         stats = {"task1": {}, "task2": {}}
 
-    for model in models:
-        print(f"[{model}] task1 (feature)...", flush=True)
-        r1 = ask(model, SYSTEM_PROMPT_CHAT, TASK1_PROMPT)
-        save("day1", model, r1, TASK1_PROMPT)
-        stats["task1"][model] = {k: v for k, v in r1.items() if k != "content"}
-        print(f"  -> {r1['wall_s']}s, {r1['tok_per_s']} tok/s", flush=True)
-
-        print(f"[{model}] task2 (bug-fix)...", flush=True)
-        r2 = ask(model, SYSTEM_PROMPT_BUGFIX, TASK2_PROMPT)
-        save("day2", model, r2, TASK2_PROMPT)
-        stats["task2"][model] = {k: v for k, v in r2.items() if k != "content"}
-        print(f"  -> {r2['wall_s']}s, {r2['tok_per_s']} tok/s", flush=True)
+    num_ctx = SIZER.reserve(_messages(system, prompt) for _, _, system, prompt in TASKS.values())
+    print(f"num_ctx {num_ctx} на весь прогон", flush=True)
+
+    def run_task(model: str, task: str) -> dict:
+        name, label, system, prompt = TASKS[task]
+        print(f"[{model}] {task} ({label})...", flush=True)
+        result = ask(model, system, prompt)
+        save(name, model, result, prompt)
+        stats[task][model] = {k: v for k, v in result.items() if k != "content"}
+        aborted = f", остановлен: {result['aborted']}" if result.get("aborted") else ""
+        print(f"  -> {result['wall_s']}s, {result['tok_per_s']} tok/s{aborted}", flush=True)
+        return result
+
+    scheduler = ResidencyScheduler(
+        memory_budget_bytes=int(float(os.getenv("OLLAMA_MEMORY_BUDGET_GB", "0")) * 1024 ** 3),
+        options={"num_ctx": num_ctx},
+    )
+    # Задачи в порядке таблицы (задача x модель); планировщик сам сгруппирует по моделям
+    schedule = scheduler.run([(model, task) for task in TASKS for model in models], run_task)
+    stats["schedule"] = schedule
+    print(
+        f"\nЗагрузка моделей: {schedule['load_s']}s, всего {schedule['wall_s']}s; "
+        f"наивный порядок ~{schedule['naive_s']}s (выигрыш {schedule['saved_s']}s)",
+        flush=True,
+    )
 
     STATS_PATH.write_text(json.dumps(stats, indent=2), encoding="utf-8")
     print(f"\nСохранено в {OUT_DIR}")
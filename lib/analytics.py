@@ -1,6 +1,7 @@
 """Модуль для трекинга использования токенов и статистики."""
 
-from typing import List, Dict, Any, Optional
+from array import array
+from typing import List, Dict, Any, Optional, Tuple
 from datetime import datetime
 
 
@@ -38,6 +39,33 @@ class Analytics:
         analytics_list.append(record)
         return analytics_list
 
+    @staticmethod
+    def record_cancelled(
+        user_input: str,
+        partial_response: str,
+        analytics_list: Optional[List[Dict]] = None
+    ) -> List[Dict]:
+        """Записывает прерванную генерацию (стоп или новое сообщение).
+
+        ``tokens_saved`` — оценка несгенерированных токенов: средний completion
+        завершённых ответов сессии минус уже полученная часть (не меньше 0).
+        """
+        if analytics_list is None:
+            analytics_list = []
+
+        completed = [
+            item.get("completion_tokens", 0)
+            for item in analytics_list
+            if not item.get("cancelled")
+        ]
+        expected = sum(completed) // len(completed) if completed else 0
+
+        Analytics.record_usage(user_input, partial_response, None, analytics_list)
+        record = analytics_list[-1]
+        record["cancelled"] = True
+        record["tokens_saved"] = max(0, expected - record["completion_tokens"])
+        return analytics_list
+
     @staticmethod
     def format_dashboard(analytics_list: List[Dict]) -> str:
         """Формирует дашборд статистики."""
@@ -52,6 +80,7 @@ class Analytics:
         avg_tokens = total_tokens // message_count if message_count > 0 else 0
         avg_response_length = total_response_length // message_count if message_count > 0 else 0
         longest_msg = max(analytics_list, key=lambda x: x.get("total_tokens", 0))
+        cancelled = [item for item in analytics_list if item.get("cancelled")]
 
         lines = [
             "**Дашборд статистики использования**\n",
@@ -63,6 +92,27 @@ class Analytics:
             f"  - Исходящие (completion): `{total_completion}`",
             f"- Среднее на сообщение: `{avg_tokens}` токенов",
             f"- Средняя длина ответа (символов): `{avg_response_length}`",
+        ]
+
+        if cancelled:
+            tokens_saved = sum(item.get("tokens_saved", 0) for item in cancelled)
+            lines.append(f"- Прервано генераций: `{len(cancelled)}` (сэкономлено ~`{tokens_saved}` токенов)")
+
+        aborted = [item["aborted"] for item in analytics_list if item.get("aborted")]
+        if aborted:
+            reasons = ", ".join(f"{reason}: {aborted.count(reason)}" for reason in sorted(set(aborted)))
+            lines.append(f"- Остановлено стражем вывода: `{len(aborted)}` ({reasons})")
+
+        ttft = [item["ttft_ms"] for item in analytics_list if "ttft_ms" in item]
+        if ttft:
+            rest = ttft[1:]
+            steady = f", остальные в среднем `{round(sum(rest) / len(rest))}` мс" if rest else ""
+            lines.append(f"- Время до первого токена: первое сообщение `{round(ttft[0])}` мс{steady}")
+        warmup_ms = analytics_list[0].get("warmup_ms")
+        if warmup_ms is not None:
+            lines.append(f"- Прогрев при открытии чата: `{round(warmup_ms)}` мс")
+
+        lines += [
             "",
             f"**Рекорды:**",
             f"- Самое длинное сообщение: `{longest_msg['total_tokens']}` токенов",
@@ -92,6 +142,8 @@ class Analytics:
                 "total_completion_tokens": 0,
                 "avg_tokens": 0,
                 "max_tokens": 0,
+                "cancelled_count": 0,
+                "tokens_saved": 0,
             }
 
         total_tokens = sum(item.get("total_tokens", 0) for item in analytics_list)
@@ -99,6 +151,7 @@ class Analytics:
         total_completion = sum(item.get("completion_tokens", 0) for item in analytics_list)
         message_count = len(analytics_list)
         max_tokens = max(item.get("total_tokens", 0) for item in analytics_list)
+        cancelled = [item for item in analytics_list if item.get("cancelled")]
 
         return {
             "message_count": message_count,
@@ -107,4 +160,111 @@ class Analytics:
             "total_completion_tokens": total_completion,
             "avg_tokens": total_tokens // message_count if message_count > 0 else 0,
             "max_tokens": max_tokens,
+            "cancelled_count": len(cancelled),
+            "tokens_saved": sum(item.get("tokens_saved", 0) for item in cancelled),
         }
+
+    @staticmethod
+    def format_metrics(sections: Dict[str, Dict[str, Any]]) -> str:
+        """Формирует markdown с техническими метриками процесса (очередь LLM и т.п.).
+
+        ``sections`` — {заголовок: плоский или вложенный dict метрик}.
+        Вложенные dict выводятся отдельным списком с отступом.
+        """
+        lines = ["**Метрики процесса**"]
+        for title, metrics in sections.items():
+            lines.append("")
+            lines.append(f"**{title}:**")
+            if not metrics:
+                lines.append("- нет данных")
+                continue
+            for key, value in metrics.items():
+                if isinstance(value, dict):
+                    lines.append(f"- {key}:")
+                    for sub_key, sub_value in value.items():
+                        if isinstance(sub_value, dict):
+                            inner = ", ".join(f"{k}=`{v}`" for k, v in sub_value.items())
+                            lines.append(f"  - {sub_key}: {inner}")
+                        else:
+                            lines.append(f"  - {sub_key}: `{sub_value}`")
+                else:
+                    lines.append(f"- {key}: `{value}`")
+        return "\n".join(lines)
+
+
+class UsageSummary:
+    """Нарастающие итоги ``usage_history`` и страница для ``/summary``.
+
+    Записи только дописываются в конец, поэтому при каждом вызове досчитываются
+    лишь новые; префиксные суммы дают нарастающий итог любой строки сразу.
+    Рендер — одна страница из ``page_size`` строк, последняя отрендеренная
+    страница кэшируется до появления новых записей. Если список подменили
+    (``/reset``) или переписали (выгрузка и восстановление сессии) — пересчёт
+    с нуля.
+    """
+
+    def __init__(self, page_size: int = 20):
+        self.page_size = max(1, page_size)
+        self._records: Optional[List[Dict]] = None
+        self._first: Optional[Dict] = None
+        self._cumulative = array("q")
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+        self._page_cache: Optional[Tuple[int, int, str]] = None  # (страница, записей, текст)
+
+    @property
+    def count(self) -> int:
+        return len(self._cumulative)
+
+    @property
+    def total_tokens(self) -> int:
+        return self._cumulative[-1] if self._cumulative else 0
+
+    @property
+    def pages(self) -> int:
+        return max(1, -(-self.count // self.page_size))
+
+    def update(self, records: List[Dict]) -> None:
+        """Досчитывает итоги по записям, появившимся с прошлого вызова."""
+        first = records[0] if records else None
+        if records is not self._records or len(records) < self.count or first is not self._first:
+            self._records, self._first = records, first
+            self._cumulative = array("q")
+            self.prompt_tokens = self.completion_tokens = 0
+            self._page_cache = None
+        total = self.total_tokens
+        for item in records[self.count:]:
+            total += int(item.get("total_tokens", 0))
+            self._cumulative.append(total)
+            self.prompt_tokens += int(item.get("prompt_tokens", 0))
+            self.completion_tokens += int(item.get("completion_tokens", 0))
+
+    def render(self, records: List[Dict], page: Optional[int] = None) -> str:
+        """Страница ``page`` (с 1, по умолчанию последняя) с итогами по всей сессии."""
+        self.update(records)
+        page = self.pages if page is None else page
+        if self._page_cache is not None and self._page_cache[:2] == (page, self.count):
+            return self._page_cache[2]
+
+        start = (page - 1) * self.page_size
+        end = min(start + self.page_size, self.count)
+        lines = [
+            f"**Статистика токенов** (страница {page} из {self.pages}, сообщения {start + 1}–{end} из {self.count}):\n",
+            "| # | Сообщение | Токены | Нарастающий итог |",
+            "|---|-----------|--------|------------------|",
+        ]
+        for idx in range(start, end):
+            item = records[idx]
+            preview = item.get("input_preview") or item.get("message", "")[:30]
+            lines.append(f"| {idx + 1} | {preview} | {item.get('total_tokens', 0)} | {self._cumulative[idx]} |")
+
+        lines.append(
+            f"\n**Всего:** {self.total_tokens} токенов "
+            f"(prompt {self.prompt_tokens}, completion {self.completion_tokens})"
+        )
+        if self.pages > 1:
+            lines.append(f"Другие страницы: `/summary <1–{self.pages}>`")
+
+        text = "\n".join(lines)
+        self._page_cache = (page, self.count, text)
+        return text
@@ -0,0 +1,230 @@
+"""Пакетный режим: JSONL с промптами через конвейер чата, без Chainlit.
+
+Вход — JSONL, по промпту на строку::
+
+    {"id": "q1", "prompt": "Как дела?", "session": "s1", "user": "alice"}
+
+``id``, ``session`` и ``user`` необязательны. Строки с одним ``session`` — ходы
+одного диалога: выполняются по порядку файла и видят историю друг друга
+(перепрогон переписки на другой модели). Без ``session`` каждый промпт —
+отдельный диалог. ``user`` выбирает профиль для system prompt.
+
+Конвейер тот же, что у ``on_message``: system prompt с профилем,
+``MessageSequence``, стрим через ``ReplyStream``, запись в ``Analytics``.
+Долгосрочная память и семантический кэш не подключаются — прогон
+воспроизводим и не меняет данные пользователей.
+
+Файл читается построчно, в работе не больше ``concurrency`` промптов, поэтому
+размер входа не ограничен памятью (держится только история диалогов с
+``session``). Результаты пишутся в JSONL по мере готовности — порядок
+завершения, связь со входом по ``line``/``id``.
+
+Запуск:
+    python3 -m lib.batch prompts.jsonl -o results.jsonl --concurrency 8
+    python3 -m lib.batch transcript.jsonl -o rerun.jsonl --model openai/gpt-4o-mini
+"""
+
+import argparse
+import asyncio
+import json
+import time
+from array import array
+from pathlib import Path
+from typing import Any, Dict, Iterable, Iterator, List, Optional, TextIO, Tuple
+
+from lib.openrouter_client import MessageSequence
+from lib.output_guard import GenerationAborted, make_output_guard
+from lib.pipeline import ReplyStream, build_system_prompt, record_turn
+from lib.profile_registry import DEFAULT_PROFILE_USER, get_profile_registry
+
+# (номер строки, промпт или None, ошибка разбора или None)
+BatchItem = Tuple[int, Optional[Dict[str, Any]], Optional[str]]
+
+
+def iter_jsonl(path: Path) -> Iterator[BatchItem]:
+    """Построчно читает JSONL; битая строка не останавливает прогон, а даёт ошибку."""
+    with open(path, encoding="utf-8") as f:
+        for line_no, line in enumerate(f, 1):
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                item = json.loads(line)
+            except ValueError as exc:
+                yield line_no, None, f"invalid JSON: {exc}"
+                continue
+            if not isinstance(item, dict) or not str(item.get("prompt", "")).strip():
+                yield line_no, None, "no prompt"
+                continue
+            yield line_no, item, None
+
+
+class _Dialog:
+    """Состояние диалога ``session``: то же, что держит ``cl.user_session``."""
+
+    def __init__(self):
+        self.history: List[Dict] = []
+        self.usage_history: List[Dict] = []
+        self.sequence = MessageSequence()
+        self.lock = asyncio.Lock()
+
+
+def _percentile_ms(samples: array, q: float) -> float:
+    if not samples:
+        return 0.0
+    ordered = sorted(samples)
+    return round(ordered[min(len(ordered) - 1, int(len(ordered) * q))] * 1000, 1)
+
+
+class BatchRunner:
+    """Прогон промптов с ограниченной конкурентностью и записью результатов в JSONL."""
+
+    def __init__(
+        self,
+        client: Any,
+        concurrency: int = 4,
+        default_user: str = DEFAULT_PROFILE_USER,
+        profile_budget_tokens: int = 400,
+        max_output_tokens: Optional[int] = None,
+    ):
+        self.client = client
+        self.max_output_tokens = max_output_tokens
+        self.concurrency = max(1, concurrency)
+        self.default_user = default_user
+        self.profile_budget_tokens = profile_budget_tokens
+
+        self._dialogs: Dict[str, _Dialog] = {}
+        self._latency = array("d")
+        self._ttft = array("d")
+        self.items = 0
+        self.errors = 0
+        self.aborted = 0
+        self.total_tokens = 0
+
+    async def _run_item(self, line_no: int, item: Dict[str, Any]) -> Dict[str, Any]:
+        prompt = str(item["prompt"]).strip()
+        session = item.get("session")
+        dialog = self._dialogs.setdefault(str(session), _Dialog()) if session is not None else _Dialog()
+        result: Dict[str, Any] = {"line": line_no, "id": item.get("id"), "session": session}
+
+        # Ходы одного диалога — строго по порядку файла (Lock отдаёт очередь FIFO)
+        async with dialog.lock:
+            profile = await get_profile_registry().get(item.get("user") or self.default_user)
+            system_prompt = build_system_prompt(profile, prompt, self.profile_budget_tokens)
+            messages = dialog.sequence.prepare(prompt, dialog.history, system_prompt)
+            reply = ReplyStream(self.client, messages, guard=make_output_guard(self.max_output_tokens))
+            try:
+                await reply.run()
+            except GenerationAborted as exc:
+                # Вырожденный ответ — результат с пометкой, а не ошибка прогона
+                result["aborted"] = exc.reason
+            except Exception as exc:
+                result.update({"error": str(exc), "partial": reply.text})
+                return result
+            record = record_turn(
+                prompt, reply.text, dialog.history, dialog.usage_history, reply.ttft_s, reply.latency_s
+            )
+            if "aborted" in result:
+                record["aborted"] = result["aborted"]
+
+        result.update({
+            "response": reply.text,
+            "usage": {key: record[key] for key in ("prompt_tokens", "completion_tokens", "total_tokens")},
+            "ttft_ms": record.get("ttft_ms"),
+            "latency_ms": record["latency_ms"],
+        })
+        return result
+
+    def _write(self, out: TextIO, result: Dict[str, Any]) -> None:
+        self.items += 1
+        if "error" in result:
+            self.errors += 1
+        else:
+            self.aborted += "aborted" in result
+            self.total_tokens += result["usage"]["total_tokens"]
+            self._latency.append(result["latency_ms"] / 1000)
+            if result["ttft_ms"] is not None:
+                self._ttft.append(result["ttft_ms"] / 1000)
+        out.write(json.dumps(result, ensure_ascii=False) + "\n")
+
+    async def run(self, items: Iterable[BatchItem], out: TextIO) -> Dict[str, Any]:
+        """Прогоняет промпты из ``items`` и пишет результаты в ``out``; возвращает сводку."""
+        started = time.perf_counter()
+        pending: set = set()
+
+        def flush(done) -> None:
+            for task in done:
+                self._write(out, task.result())
+
+        for line_no, item, error in items:
+            if error is not None:
+                self._write(out, {"line": line_no, "error": error})
+                continue
+            # Backpressure: новая строка читается, только когда освободилось место
+            while len(pending) >= self.concurrency:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                flush(done)
+            pending.add(asyncio.create_task(self._run_item(line_no, item)))
+        if pending:
+            done, _ = await asyncio.wait(pending)
+            flush(done)
+        out.flush()
+
+        wall_s = time.perf_counter() - started
+        return {
+            "items": self.items,
+            "errors": self.errors,
+            "aborted": self.aborted,
+            "model": getattr(self.client, "model", None),
+            "concurrency": self.concurrency,
+            "wall_s": round(wall_s, 2),
+            "throughput_items_s": round(self.items / wall_s, 2) if wall_s else 0.0,
+            "latency_p50_ms": _percentile_ms(self._latency, 0.5),
+            "latency_p99_ms": _percentile_ms(self._latency, 0.99),
+            "ttft_p50_ms": _percentile_ms(self._ttft, 0.5),
+            "total_tokens": self.total_tokens,
+        }
+
+
+async def run_batch(
+    input_path: Path,
+    output_path: Path,
+    client: Any,
+    concurrency: int = 4,
+    default_user: str = DEFAULT_PROFILE_USER,
+    max_output_tokens: Optional[int] = None,
+) -> Dict[str, Any]:
+    """Прогон файла ``input_path`` в ``output_path`` (JSONL); возвращает сводку."""
+    output_path.parent.mkdir(parents=True, exist_ok=True)
+    runner = BatchRunner(
+        client, concurrency=concurrency, default_user=default_user, max_output_tokens=max_output_tokens
+    )
+    with open(output_path, "w", encoding="utf-8") as out:
+        return await runner.run(iter_jsonl(input_path), out)
+
+
+def main() -> None:
+    from dotenv import load_dotenv
+
+    from lib.openrouter_client import OpenRouterClient
+
+    parser = argparse.ArgumentParser(description="Пакетный прогон JSONL с промптами через конвейер чата")
+    parser.add_argument("input", type=Path, help="JSONL: {\"prompt\": ..., \"id\"?, \"session\"?, \"user\"?}")
+    parser.add_argument("-o", "--output", type=Path, required=True, help="JSONL с ответами и метриками")
+    parser.add_argument("--concurrency", type=int, default=4)
+    parser.add_argument("--model", default=None, help="модель вместо OPENROUTER_MODEL (без fallback-цепочки)")
+    parser.add_argument("--base-url", default=None)
+    parser.add_argument("--user", default=DEFAULT_PROFILE_USER, help="профиль для строк без user")
+    parser.add_argument("--max-tokens", type=int, default=None, help="лимит ответа (иначе OUTPUT_MAX_TOKENS)")
+    args = parser.parse_args()
+
+    load_dotenv(override=True)
+    client = OpenRouterClient(model=args.model, base_url=args.base_url)
+    summary = asyncio.run(run_batch(
+        args.input, args.output, client, args.concurrency, args.user, args.max_tokens
+    ))
+    print(json.dumps(summary, indent=2, ensure_ascii=False))
+
+
+if __name__ == "__main__":
+    main()
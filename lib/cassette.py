@@ -0,0 +1,223 @@
+"""Кассеты стримов провайдера: запись и воспроизведение с исходными таймингами.
+
+Медленный ответ из продакшена не воспроизвести: форма стрима (TTFT, паузы
+между чанками, размер чанков) нигде не сохраняется. В режиме записи
+``OpenRouterClient.stream_completion`` и ``lib.ollama.chat_stream`` (путь
+``ask()`` бенчмарков) пишут на каждый стрим строку кассеты:
+
+- ``key`` — хеш запроса (модель, сообщения, параметры);
+- ``chunks`` — тексты чанков как их отдал провайдер;
+- ``gaps_ms`` — паузы: первая от отправки запроса до первого чанка, дальше —
+  между чанками;
+- ``model`` — ответившая модель, ``final`` — финальный чанк Ollama
+  (``eval_count``, ``load_duration``...), ``complete`` — стрим дочитан до
+  конца, а не оборван (стоп, страж вывода).
+
+В режиме воспроизведения запрос к провайдеру не уходит: чанки отдаются с
+теми же паузами, делёнными на ``speed`` (``0`` — без пауз). Несколько
+записей одного запроса воспроизводятся по кругу, запрос без записи —
+``CassetteMiss``. Так стриминг UI и изменения пайплайна меряются офлайн на
+форме реального трафика.
+
+Формат — JSONL, ``.gz`` в имени файла — со сжатием (дописывается отдельными
+gzip-членами, читается целиком при первом ``play``/``append``, а не в
+конструкторе: async-клиент зовёт их через ``asyncio.to_thread``). Включается env ``LLM_CASSETTE=<путь>`` и
+``LLM_CASSETTE_MODE=record|replay`` (``LLM_CASSETTE_SPEED`` — ускорение).
+
+Только стандартная библиотека: модуль импортирует ``lib/ollama.py``.
+"""
+
+import asyncio
+import gzip
+import hashlib
+import json
+import os
+import threading
+import time
+from pathlib import Path
+from typing import Any, AsyncIterator, Dict, Iterable, Iterator, List, Optional
+
+MODE_RECORD = "record"
+MODE_REPLAY = "replay"
+
+
+class CassetteMiss(KeyError):
+    """В кассете нет записи для запроса."""
+
+
+def request_key(model: str, messages: Iterable[Dict[str, Any]], **params: Any) -> str:
+    """Стабильный хеш запроса: модель, роли и тексты сообщений, параметры генерации."""
+    canonical = json.dumps(
+        {
+            "model": model,
+            "messages": [[m.get("role"), m.get("content")] for m in messages],
+            "params": params,
+        },
+        ensure_ascii=False,
+        sort_keys=True,
+    )
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()[:16]
+
+
+def _open(path: Path, mode: str):
+    if path.suffix == ".gz":
+        return gzip.open(path, mode + "t", encoding="utf-8")
+    return path.open(mode, encoding="utf-8")
+
+
+class Recording:
+    """Запись одного стрима: время каждого чанка от отправки запроса."""
+
+    def __init__(self, cassette: "Cassette", key: str):
+        self.cassette = cassette
+        self.key = key
+        self.chunks: List[str] = []
+        self.gaps_ms: List[float] = []
+        self._last = time.perf_counter()
+        self._saved = False
+
+    def chunk(self, text: str) -> None:
+        now = time.perf_counter()
+        self.gaps_ms.append(round((now - self._last) * 1000, 1))
+        self._last = now
+        self.chunks.append(text)
+
+    def save(
+        self,
+        model: Optional[str] = None,
+        final: Optional[Dict[str, Any]] = None,
+        complete: bool = True,
+    ) -> None:
+        """Дописывает запись в кассету (один раз; повторный вызов ничего не делает)."""
+        if self._saved:
+            return
+        self._saved = True
+        entry: Dict[str, Any] = {
+            "key": self.key,
+            "model": model,
+            "chunks": self.chunks,
+            "gaps_ms": self.gaps_ms,
+            "complete": complete,
+        }
+        if final is not None:
+            entry["final"] = final
+        self.cassette.append(entry)
+
+
+class Cassette:
+    """Файл записанных стримов и воспроизведение их с исходными паузами."""
+
+    def __init__(self, path, mode: str = MODE_REPLAY, speed: float = 1.0):
+        if mode not in (MODE_RECORD, MODE_REPLAY):
+            raise ValueError(f"Режим кассеты: {MODE_RECORD} или {MODE_REPLAY}, не {mode!r}")
+        self.path = Path(path)
+        self.mode = mode
+        self.speed = speed
+
+        self._entries: Dict[str, List[Dict[str, Any]]] = {}
+        self._plays: Dict[str, int] = {}
+        self._lock = threading.Lock()
+        self.recorded = 0
+        self.replayed = 0
+        self._loaded = False
+
+    def _ensure_loaded(self) -> None:
+        # Вызывается под self._lock
+        if self._loaded:
+            return
+        self._loaded = True
+        if self.path.exists():
+            with _open(self.path, "r") as f:
+                for line in f:
+                    if line.strip():
+                        entry = json.loads(line)
+                        self._entries.setdefault(entry["key"], []).append(entry)
+
+    @property
+    def recording(self) -> bool:
+        return self.mode == MODE_RECORD
+
+    @property
+    def replaying(self) -> bool:
+        return self.mode == MODE_REPLAY
+
+    def __len__(self) -> int:
+        with self._lock:
+            self._ensure_loaded()
+            return sum(len(entries) for entries in self._entries.values())
+
+    def record(self, key: str) -> Recording:
+        """Начало записи стрима — вызывать до отправки запроса (в паузу входит TTFT)."""
+        return Recording(self, key)
+
+    def append(self, entry: Dict[str, Any]) -> None:
+        line = json.dumps(entry, ensure_ascii=False, separators=(",", ":")) + "\n"
+        with self._lock:
+            self._ensure_loaded()
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            # Строка дописывается сразу: запись переживает падение прогона
+            with _open(self.path, "a") as f:
+                f.write(line)
+            self._entries.setdefault(entry["key"], []).append(entry)
+            self.recorded += 1
+
+    def play(self, key: str) -> Dict[str, Any]:
+        """Запись для запроса; записи одного запроса — по кругу."""
+        with self._lock:
+            self._ensure_loaded()
+            entries = self._entries.get(key)
+            if not entries:
+                raise CassetteMiss(f"нет записи для запроса {key} в {self.path}")
+            turn = self._plays.get(key, 0)
+            self._plays[key] = turn + 1
+            self.replayed += 1
+            return entries[turn % len(entries)]
+
+    def _delays(self, entry: Dict[str, Any]) -> List[float]:
+        if self.speed <= 0:
+            return [0.0] * len(entry["chunks"])
+        return [gap / 1000 / self.speed for gap in entry["gaps_ms"]]
+
+    async def replay(self, entry: Dict[str, Any]) -> AsyncIterator[str]:
+        """Чанки записи с паузами (для async-стрима клиента)."""
+        for chunk, delay in zip(entry["chunks"], self._delays(entry)):
+            if delay > 0:
+                await asyncio.sleep(delay)
+            yield chunk
+
+    def replay_sync(self, entry: Dict[str, Any]) -> Iterator[str]:
+        """То же для синхронного пути (``lib.ollama.chat_stream``)."""
+        for chunk, delay in zip(entry["chunks"], self._delays(entry)):
+            if delay > 0:
+                time.sleep(delay)
+            yield chunk
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {
+            "path": str(self.path),
+            "mode": self.mode,
+            "speed": self.speed,
+            "entries": len(self),
+            "recorded": self.recorded,
+            "replayed": self.replayed,
+        }
+
+
+_cassette: Optional[Cassette] = None
+_cassette_lock = threading.Lock()
+
+
+def get_cassette() -> Optional[Cassette]:
+    """Общая на процесс кассета из ``LLM_CASSETTE`` (без неё — ``None``)."""
+    global _cassette
+    path = os.getenv("LLM_CASSETTE", "")
+    if not path:
+        return None
+    with _cassette_lock:
+        if _cassette is None:
+            _cassette = Cassette(
+                path,
+                mode=os.getenv("LLM_CASSETTE_MODE", MODE_REPLAY),
+                speed=float(os.getenv("LLM_CASSETTE_SPEED", "1")),
+            )
+        return _cassette
@@ -0,0 +1,147 @@
+"""Сжатие истории диалога: одна сводка или map-reduce для длинных историй.
+
+Короткая история (один кусок) сжимается одним запросом, как раньше.
+Длинная делится на куски по токенам; куски сводятся параллельно
+(не больше ``parallelism`` запросов одновременно, фоновый приоритет),
+затем частичные сводки сводятся в итоговую — при необходимости в несколько
+уровней, чтобы ни один промпт не переполнил контекст модели.
+"""
+
+import asyncio
+from typing import Awaitable, Callable, Dict, List, Optional
+
+from lib.history import chunk_history, estimate_tokens
+from lib.offload import get_cpu_offload
+from lib.openrouter_client import PRIORITY_BACKGROUND, OpenRouterClient
+from lib.profile import truncate_preview
+
+FINAL_PROMPT = (
+    "Сделай краткую сводку диалога ниже в 5-7 предложений. "
+    "Сохрани ключевые факты, вопросы и решения.\n\n"
+)
+MAP_PROMPT = (
+    "Ниже фрагмент длинного диалога. Перечисли кратко ключевые факты, "
+    "вопросы и решения из него (3-5 предложений).\n\n"
+)
+REDUCE_PROMPT = (
+    "Ниже частичные сводки последовательных фрагментов одного диалога. "
+    "Объедини их в одну сводку в 5-7 предложений, сохрани ключевые факты, "
+    "вопросы и решения.\n\n"
+)
+
+ProgressCallback = Callable[[str], Awaitable[None]]
+
+# Сколько символов каждой реплики попадает в промпт сжатия.
+PREVIEW_LIMIT = 200
+
+
+def format_history(history: List[Dict], start: int = 1, preview_limit: int = PREVIEW_LIMIT) -> str:
+    """Нумерованный текст реплик для промпта сжатия."""
+    lines = []
+    for idx, item in enumerate(history, start):
+        role = "Пользователь" if item["role"] == "user" else "Ассистент"
+        lines.append(f"{idx}. {role}: {truncate_preview(item['content'], preview_limit)}")
+    return "\n".join(lines)
+
+
+def _chunk_as_sent(history: List[Dict], chunk_tokens: int) -> List[List[Dict]]:
+    """Режет историю по токенам того текста, что уйдёт в промпт (реплики уже обрезаны)."""
+    previews = [
+        {**item, "content": truncate_preview(item.get("content", ""), PREVIEW_LIMIT)}
+        for item in history
+    ]
+    return chunk_history(previews, chunk_tokens)
+
+
+async def _ask(client: OpenRouterClient, prompt: str) -> str:
+    text = await client.get_completion_text(
+        [{"role": "user", "content": prompt}],
+        temperature=0.2,
+        priority=PRIORITY_BACKGROUND,
+    )
+    return text.strip()
+
+
+async def summarize_history(
+    client: OpenRouterClient,
+    history: List[Dict],
+    chunk_tokens: int = 1500,
+    parallelism: int = 3,
+    on_progress: Optional[ProgressCallback] = None,
+) -> str:
+    """Возвращает сводку истории; длинную историю сжимает map-reduce."""
+    # Длинная история режется вне event loop; в потоке — куски те же dict, пересылать их в процесс дороже.
+    # Размер куска считается по обрезанным репликам: иначе chunk_tokens не отражает размер промпта.
+    chunks = await get_cpu_offload().run(
+        _chunk_as_sent, history, chunk_tokens, size=len(history), process=False
+    )
+    if len(chunks) <= 1:
+        return await _ask(client, FINAL_PROMPT + format_history(history))
+
+    semaphore = asyncio.Semaphore(parallelism)
+    done = 0
+
+    async def summarize_chunk(chunk: List[Dict], start: int) -> str:
+        nonlocal done
+        async with semaphore:
+            partial = await _ask(client, MAP_PROMPT + format_history(chunk, start))
+        done += 1
+        if on_progress is not None:
+            await on_progress(f"Фрагмент {done}/{len(chunks)} сжат")
+        return partial
+
+    starts = []
+    position = 1
+    for chunk in chunks:
+        starts.append(position)
+        position += len(chunk)
+
+    partials = await asyncio.gather(
+        *(summarize_chunk(chunk, start) for chunk, start in zip(chunks, starts))
+    )
+    return await _reduce(client, list(partials), chunk_tokens, parallelism, on_progress)
+
+
+async def _reduce(
+    client: OpenRouterClient,
+    partials: List[str],
+    chunk_tokens: int,
+    parallelism: int,
+    on_progress: Optional[ProgressCallback],
+) -> str:
+    """Сводит частичные сводки; если они не влезают в один промпт — по уровням."""
+    level = 1
+    while True:
+        groups: List[List[str]] = [[]]
+        used = 0
+        for partial in partials:
+            cost = estimate_tokens(partial)
+            if groups[-1] and used + cost > chunk_tokens:
+                groups.append([])
+                used = 0
+            groups[-1].append(partial)
+            used += cost
+
+        if len(groups) == 1:
+            if on_progress is not None:
+                await on_progress("Собираю итоговую сводку")
+            return await _ask(client, REDUCE_PROMPT + _numbered(partials))
+
+        # Группа из одной сводки дальше не сжимается: иначе зациклимся на огромном куске.
+        if len(groups) == len(partials):
+            return await _ask(client, REDUCE_PROMPT + _numbered(partials))
+
+        if on_progress is not None:
+            await on_progress(f"Промежуточное объединение, уровень {level}: {len(groups)} групп")
+        semaphore = asyncio.Semaphore(parallelism)
+
+        async def reduce_group(group: List[str]) -> str:
+            async with semaphore:
+                return await _ask(client, REDUCE_PROMPT + _numbered(group))
+
+        partials = list(await asyncio.gather(*(reduce_group(g) for g in groups)))
+        level += 1
+
+
+def _numbered(partials: List[str]) -> str:
+    return "\n".join(f"Часть {i}. {text}" for i, text in enumerate(partials, 1))
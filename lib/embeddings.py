@@ -0,0 +1,91 @@
+"""Офлайн-эмбеддинги текста для семантического кэша и поиска по памяти.
+
+По умолчанию — ``HashingEmbedder``: feature hashing словесных и символьных
+n-грамм, без модели и сети, работает на CPU за микросекунды. Если задана
+``EMBEDDING_MODEL`` и установлен ``sentence-transformers``, используется
+настоящая модель (CPU-only, загружается лениво при первом вызове).
+"""
+
+import os
+import re
+import threading
+import zlib
+from typing import List, Optional
+
+import numpy as np
+
+_WORD_RE = re.compile(r"\w+", re.UNICODE)
+
+
+class HashingEmbedder:
+    """Эмбеддинг через хеширование n-грамм в вектор фиксированной размерности."""
+
+    name = "hashing"
+    # Близость по общим словам и n-граммам, а не по смыслу
+    lexical = True
+
+    def __init__(self, dim: int = 256):
+        self.dim = dim
+
+    def _features(self, text: str) -> List[str]:
+        words = _WORD_RE.findall(text.lower())
+        features = [f"w:{w}" for w in words]
+        features += [f"b:{a} {b}" for a, b in zip(words, words[1:])]
+        for w in words:
+            padded = f"<{w}>"
+            features += [f"c:{padded[i:i + 3]}" for i in range(len(padded) - 2)]
+        return features
+
+    def embed(self, text: str) -> np.ndarray:
+        """L2-нормированный вектор float32; для пустого текста — нулевой."""
+        vec = np.zeros(self.dim, dtype=np.float32)
+        for feature in self._features(text):
+            # crc32 стабилен между процессами, в отличие от hash().
+            h = zlib.crc32(feature.encode("utf-8"))
+            vec[h % self.dim] += 1.0 if (h >> 31) & 1 else -1.0
+        norm = float(np.linalg.norm(vec))
+        if norm > 0:
+            vec /= norm
+        return vec
+
+    def embed_many(self, texts: List[str]) -> np.ndarray:
+        return np.stack([self.embed(t) for t in texts]) if texts else np.zeros((0, self.dim), np.float32)
+
+
+class SentenceTransformerEmbedder:
+    """Небольшая sentence-transformers модель на CPU. Модель грузится при первом embed()."""
+
+    def __init__(self, model_name: str):
+        self.name = model_name
+        self._model = None
+        self._lock = threading.Lock()
+        self.dim: Optional[int] = None
+
+    def _load(self):
+        with self._lock:
+            if self._model is None:
+                from sentence_transformers import SentenceTransformer
+
+                self._model = SentenceTransformer(self.name, device="cpu")
+                self.dim = self._model.get_sentence_embedding_dimension()
+        return self._model
+
+    def embed(self, text: str) -> np.ndarray:
+        return self.embed_many([text])[0]
+
+    def embed_many(self, texts: List[str]) -> np.ndarray:
+        model = self._model or self._load()
+        vectors = model.encode(texts, normalize_embeddings=True, convert_to_numpy=True)
+        return vectors.astype(np.float32)
+
+
+def get_embedder():
+    """Эмбеддер из env ``EMBEDDING_MODEL``; без неё или без пакета — HashingEmbedder."""
+    model_name = os.getenv("EMBEDDING_MODEL", "")
+    if model_name:
+        try:
+            import sentence_transformers  # noqa: F401
+        except ImportError:
+            return HashingEmbedder()
+        return SentenceTransformerEmbedder(model_name)
+    return HashingEmbedder()
@@ -0,0 +1,212 @@
+"""Выгрузка аналитики для офлайн-анализа: CSV, Parquet и Arrow IPC.
+
+Записи ``usage_history`` приводятся к общей схеме ``COLUMNS`` (сессия, время,
+модель, маршрут, токены, TTFT, латентность, флаги) и пишутся потоком, пачками
+по ``batch_size`` строк — в памяти никогда не больше одной пачки и одной
+сессии, поэтому выгрузка миллионов записей не требует их материализации.
+
+Источники — итераторы пар ``(session, record)``:
+
+- ``usage_history`` текущей сессии (``/export`` в чате);
+- все сессии процесса, включая выгруженные на диск
+  (``SessionRegistry.iter_usage``, ``/export all`` при ``EXPORT_SERVER_WIDE=1``);
+- файлы: выгруженные сессии ``data/sessions/*.json`` и JSONL — результаты
+  ``lib.batch`` или записи аналитики по одной на строку (``iter_paths``).
+
+Формат выбирается по расширению: ``.csv``, ``.parquet``, ``.arrow``/``.feather``.
+CSV — только стандартная библиотека; для Parquet и Arrow нужен ``pyarrow``
+(необязательная зависимость: без неё — понятная ошибка, CSV работает).
+
+Запуск:
+    python3 -m lib.export -o usage.parquet                  # data/sessions
+    python3 -m lib.export results.jsonl data/sessions -o usage.csv
+"""
+
+import argparse
+import csv
+import json
+from pathlib import Path
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Sequence, Tuple
+
+from lib.sessions import DEFAULT_SESSIONS_DIR
+
+# (колонка, тип): string / int / float / bool
+COLUMNS: Sequence[Tuple[str, str]] = (
+    ("session", "string"),
+    ("timestamp", "string"),
+    ("model", "string"),
+    ("route", "string"),
+    ("prompt_tokens", "int"),
+    ("completion_tokens", "int"),
+    ("total_tokens", "int"),
+    ("ttft_ms", "float"),
+    ("latency_ms", "float"),
+    ("warmup_ms", "float"),
+    ("user_input_length", "int"),
+    ("response_length", "int"),
+    ("cached", "bool"),
+    ("cancelled", "bool"),
+    ("tokens_saved", "int"),
+    ("aborted", "string"),
+    ("input_preview", "string"),
+)
+
+FORMATS = {".csv": "csv", ".parquet": "parquet", ".arrow": "arrow", ".feather": "arrow", ".ipc": "arrow"}
+
+DEFAULT_BATCH_SIZE = 10_000
+
+UsageRow = Tuple[Any, ...]
+
+
+def _convert(value: Any, kind: str) -> Any:
+    if kind == "bool":
+        return bool(value)
+    if value is None or value == "":
+        return None
+    try:
+        if kind == "int":
+            return int(value)
+        if kind == "float":
+            return float(value)
+    except (TypeError, ValueError):
+        return None
+    return str(value)
+
+
+def to_row(session: Optional[str], record: Dict[str, Any]) -> UsageRow:
+    """Запись аналитики -> строка в порядке ``COLUMNS`` (нет поля — ``None``/``False``)."""
+    values = dict(record, session=session)
+    return tuple(_convert(values.get(name), kind) for name, kind in COLUMNS)
+
+
+def detect_format(path: Path) -> str:
+    try:
+        return FORMATS[path.suffix.lower()]
+    except KeyError:
+        raise ValueError(f"неизвестный формат выгрузки {path.suffix!r}: {', '.join(FORMATS)}") from None
+
+
+def _require_pyarrow():
+    try:
+        import pyarrow  # noqa: F401
+    except ImportError:
+        raise RuntimeError("для Parquet/Arrow нужен pyarrow (pip install pyarrow), либо выгружайте в .csv") from None
+    return pyarrow
+
+
+class _CsvSink:
+    def __init__(self, path: Path):
+        self._file = open(path, "w", encoding="utf-8", newline="")
+        self._writer = csv.writer(self._file)
+        self._writer.writerow(name for name, _ in COLUMNS)
+
+    def write(self, rows: List[UsageRow]) -> None:
+        self._writer.writerows(rows)
+
+    def close(self) -> None:
+        self._file.close()
+
+
+class _ArrowSink:
+    """Parquet (группа строк на пачку) или Arrow IPC (record batch на пачку)."""
+
+    def __init__(self, path: Path, fmt: str):
+        pa = self._pa = _require_pyarrow()
+        types = {"string": pa.string(), "int": pa.int64(), "float": pa.float64(), "bool": pa.bool_()}
+        self._schema = pa.schema([(name, types[kind]) for name, kind in COLUMNS])
+        if fmt == "parquet":
+            import pyarrow.parquet as pq
+
+            self._writer = pq.ParquetWriter(str(path), self._schema)
+        else:
+            self._writer = pa.ipc.new_file(str(path), self._schema)
+
+    def write(self, rows: List[UsageRow]) -> None:
+        columns = zip(*rows)
+        arrays = [self._pa.array(values, type=field.type) for values, field in zip(columns, self._schema)]
+        self._writer.write_batch(self._pa.RecordBatch.from_arrays(arrays, schema=self._schema))
+
+    def close(self) -> None:
+        self._writer.close()
+
+
+def export_usage(
+    records: Iterable[Tuple[Optional[str], Dict[str, Any]]],
+    path: Path,
+    fmt: Optional[str] = None,
+    batch_size: int = DEFAULT_BATCH_SIZE,
+) -> int:
+    """Пишет пары ``(session, record)`` в ``path`` пачками; возвращает число строк."""
+    fmt = fmt or detect_format(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    sink = _CsvSink(path) if fmt == "csv" else _ArrowSink(path, fmt)
+    written = 0
+    batch: List[UsageRow] = []
+    try:
+        for session, record in records:
+            batch.append(to_row(session, record))
+            if len(batch) >= batch_size:
+                sink.write(batch)
+                written += len(batch)
+                batch = []
+        if batch:
+            sink.write(batch)
+            written += len(batch)
+    finally:
+        sink.close()
+    return written
+
+
+def iter_session_file(path: Path) -> Iterator[Tuple[str, Dict[str, Any]]]:
+    """Аналитика выгруженной сессии (``data/sessions/<id>.json``)."""
+    try:
+        payload = json.loads(path.read_text(encoding="utf-8"))
+    except (OSError, ValueError):
+        return
+    for record in payload.get("usage_history", []):
+        yield path.stem, record
+
+
+def iter_jsonl_records(path: Path) -> Iterator[Tuple[Optional[str], Dict[str, Any]]]:
+    """Записи из JSONL: результаты ``lib.batch`` (``usage`` раскрывается) или записи аналитики."""
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                item = json.loads(line)
+            except ValueError:
+                continue
+            if not isinstance(item, dict) or "error" in item:
+                continue
+            if isinstance(item.get("usage"), dict):
+                item = {**item, **item["usage"], "response_length": len(item.get("response", ""))}
+            session = item.get("session")
+            yield (str(session) if session is not None else path.stem), item
+
+
+def iter_paths(paths: Iterable[Path]) -> Iterator[Tuple[Optional[str], Dict[str, Any]]]:
+    """Файлы по очереди; каталог — все ``*.json`` и ``*.jsonl`` в нём."""
+    for path in paths:
+        files = sorted(p for p in path.iterdir() if p.suffix in (".json", ".jsonl")) if path.is_dir() else [path]
+        for file in files:
+            yield from iter_session_file(file) if file.suffix == ".json" else iter_jsonl_records(file)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Выгрузка аналитики в CSV / Parquet / Arrow IPC")
+    parser.add_argument(
+        "inputs", nargs="*", type=Path, default=[DEFAULT_SESSIONS_DIR],
+        help="выгруженные сессии (*.json), JSONL или каталоги (по умолчанию data/sessions)",
+    )
+    parser.add_argument("-o", "--output", type=Path, required=True, help=".csv, .parquet или .arrow")
+    parser.add_argument("--batch-size", type=int, default=DEFAULT_BATCH_SIZE)
+    args = parser.parse_args()
+
+    rows = export_usage(iter_paths(args.inputs), args.output, batch_size=args.batch_size)
+    print(f"{rows} записей -> {args.output}")
+
+
+if __name__ == "__main__":
+    main()
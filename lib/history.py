@@ -31,3 +31,34 @@ def trim_history(messages: List[Dict], max_tokens: int) -> List[Dict]:
         total -= estimate_tokens(removed["content"])
 
     return messages
+
+
+def chunk_text(text: str, max_tokens: int) -> List[str]:
+    """Режет текст на куски не больше ``max_tokens`` (в единицах ``estimate_tokens``).
+
+    Границы — по словам; пробельные символы внутри куска нормализуются до одного пробела.
+    """
+    words = text.split()
+    if max_tokens <= 0:
+        return [" ".join(words)] if words else []
+    return [" ".join(words[i:i + max_tokens]) for i in range(0, len(words), max_tokens)]
+
+
+def chunk_history(messages: List[Dict], max_tokens: int) -> List[List[Dict]]:
+    """Делит историю на последовательные куски не больше ``max_tokens`` каждый.
+
+    Сообщения не режутся: слишком длинное сообщение становится отдельным куском.
+    """
+    chunks: List[List[Dict]] = []
+    current: List[Dict] = []
+    used = 0
+    for message in messages:
+        cost = estimate_tokens(message.get("content", ""))
+        if current and used + cost > max_tokens:
+            chunks.append(current)
+            current, used = [], 0
+        current.append(message)
+        used += cost
+    if current:
+        chunks.append(current)
+    return chunks
@@ -0,0 +1,368 @@
+"""Большие вставки и загруженные файлы: куски вне истории, в промпт — только нужное.
+
+Длинный лог или файл кода, вставленный в сообщение целиком, раньше навсегда
+оставался в истории и уезжал в каждый следующий промпт. Теперь такой текст
+(больше ``INGEST_MIN_CHARS`` символов) и файлы, приложенные к сообщению,
+уходят в ``IngestStore`` сессии:
+
+- текст читается построчно (файл — с диска, строками не длиннее куска),
+  режется на куски по ``chunk_tokens`` с сохранением переводов строк и
+  пишется в ``data/ingest/<сессия>/<N>.jsonl``; в памяти остаются только
+  смещения кусков, номера строк и постинги BM25 — сам текст в памяти не
+  держится, сколько бы мегабайт ни было во вложении;
+- в истории вместо текста — короткая ссылка ``[вложение №N «имя»: ...]``;
+- на каждый ход в промпт попадают куски, релевантные вопросу, в пределах
+  бюджета токенов (без вопроса — начало и конец последнего вложения);
+- ``/more`` — следующие куски по порядку, ``/more <запрос>`` — ещё куски по
+  запросу; они показываются пользователю и добавляются к следующему промпту.
+"""
+
+import io
+import json
+import math
+import re
+import shutil
+import threading
+from array import array
+from collections import Counter
+from pathlib import Path
+from typing import Dict, Iterable, Iterator, List, TextIO, Tuple
+
+import numpy as np
+
+from lib.history import chunk_text, estimate_tokens
+
+# Символов на единицу estimate_tokens в куске: строки без пробелов (base64,
+# минифицированный JSON) не должны давать куски неограниченной длины.
+CHARS_PER_TOKEN = 8
+# Число корзин хеша термов в индексе
+TERM_BUCKETS = 1 << 20
+# Нулевой байт в начале файла — двоичный файл, не текст
+SNIFF_BYTES = 8192
+
+# Ключ куска в индексе: (номер вложения, номер куска)
+ChunkKey = Tuple[int, int]
+
+# Слова от 3 символов
+_WORD_RE = re.compile(r"\w{3,}", re.UNICODE)
+
+
+def _term_counts(text: str) -> Counter:
+    """Частоты корзин термов текста (уникальные слова хешируются один раз)."""
+    counts: Counter = Counter()
+    for word, count in Counter(_WORD_RE.findall(text.lower())).items():
+        # Числа длиннее 4 цифр (id, время в мс) не ищут — они только забивают корзины
+        if len(word) > 4 and word.isdigit():
+            continue
+        counts[hash(word[:6]) % TERM_BUCKETS] += count
+    return counts
+
+
+def iter_lines(stream: TextIO, max_chars: int) -> Iterator[str]:
+    """Строки потока, длинные — частями не больше ``max_chars`` символов."""
+    while True:
+        piece = stream.readline(max_chars)
+        if not piece:
+            return
+        yield piece
+
+
+def iter_chunks(lines: Iterable[str], max_tokens: int) -> Iterator[Tuple[int, int, str]]:
+    """Куски ``(первая строка, последняя строка, текст)`` не больше ``max_tokens``.
+
+    Строки не режутся и переводы строк сохраняются (лог и код остаются
+    читаемыми); строка длиннее куска по словам режется ``chunk_text``.
+    """
+    max_chars = max_tokens * CHARS_PER_TOKEN
+    buffer: List[str] = []
+    used_tokens = used_chars = 0
+    first = line = 1
+    for piece in lines:
+        cost = estimate_tokens(piece)
+        if buffer and (used_tokens + cost > max_tokens or used_chars + len(piece) > max_chars):
+            yield first, line - (buffer[-1].endswith("\n")), "".join(buffer).rstrip("\n")
+            buffer, used_tokens, used_chars = [], 0, 0
+        if not buffer:
+            first = line
+        if cost > max_tokens:
+            for part in chunk_text(piece, max_tokens):
+                yield line, line, part
+        else:
+            buffer.append(piece)
+            used_tokens += cost
+            used_chars += len(piece)
+        if piece.endswith("\n"):
+            line += 1
+    if buffer:
+        yield first, line - (buffer[-1].endswith("\n")), "".join(buffer).rstrip("\n")
+
+
+def split_question(text: str, max_tokens: int = 100) -> Tuple[str, str]:
+    """Вопрос и тело большой вставки: короткий первый или последний абзац — вопрос."""
+    head_end = text.find("\n\n")
+    if head_end != -1 and estimate_tokens(text[:head_end]) <= max_tokens:
+        return text[:head_end].strip(), text[head_end + 2:]
+    tail_start = text.rfind("\n\n")
+    if tail_start != -1 and estimate_tokens(text[tail_start:]) <= max_tokens:
+        return text[tail_start:].strip(), text[:tail_start]
+    return "", text
+
+
+def _format_size(size_bytes: int) -> str:
+    if size_bytes >= 1024 * 1024:
+        return f"{size_bytes / 1024 / 1024:.1f} MB"
+    return f"{size_bytes / 1024:.0f} KB"
+
+
+class Attachment:
+    """Одно вложение: тексты кусков в файле, в памяти — смещения и номера строк."""
+
+    def __init__(self, number: int, name: str, path: Path):
+        self.number = number
+        self.name = name
+        self.path = path
+        # Сквозной номер первого куска в индексе хранилища
+        self.start = 0
+        self.size_bytes = 0
+        self.lines = 0
+        self.offsets = array("Q")
+        self.first_lines = array("I")
+        self.last_lines = array("I")
+        self.tokens = array("I")
+
+    def __len__(self) -> int:
+        return len(self.offsets)
+
+    def reference(self) -> str:
+        """Ссылка для истории вместо содержимого."""
+        return (
+            f"[вложение №{self.number} «{self.name}»: {_format_size(self.size_bytes)}, "
+            f"{self.lines} строк, {len(self)} фрагментов]"
+        )
+
+    def read(self, indices: Iterable[int]) -> Dict[int, str]:
+        """Тексты кусков по номерам (чтение по смещениям, без загрузки файла)."""
+        texts = {}
+        with self.path.open("rb") as f:
+            for i in sorted(set(indices)):
+                f.seek(self.offsets[i])
+                texts[i] = json.loads(f.readline())
+        return texts
+
+
+class IngestStore:
+    """Вложения одной сессии и BM25-индекс по их кускам.
+
+    Индекс лексический, а не векторный: в логе и коде ищут конкретные слова
+    (``ERROR``, имя функции), и он в десятки раз дешевле эмбеддингов на
+    мегабайтах текста. Термы — первые 6 символов слова (грубый стемминг, как
+    в профиле), ключ — хеш терма в ``TERM_BUCKETS`` корзинах: число ключей
+    ограничено, сколько бы уникальных id и чисел ни было в логе.
+    """
+
+    def __init__(
+        self,
+        directory: Path,
+        chunk_tokens: int = 200,
+        max_bytes: int = 50 * 1024 * 1024,
+    ):
+        self.directory = directory
+        self.chunk_tokens = chunk_tokens
+        self.max_bytes = max_bytes
+
+        self.attachments: List[Attachment] = []
+        # Сквозной номер куска -> (номер вложения, номер куска в нём) через owners
+        self._owners = array("I")
+        self._lengths = array("I")
+        # Корзина терма -> постинги (сквозной номер << 16 | tf)
+        self._postings: Dict[int, array] = {}
+        # /more: следующий кусок по порядку и куски для следующего промпта
+        self._cursor: Dict[int, int] = {}
+        self._pinned: List[ChunkKey] = []
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self.attachments)
+
+    def ingest_text(self, name: str, text: str) -> Attachment:
+        """Вставка из сообщения."""
+        return self._ingest(name, io.StringIO(text))
+
+    def ingest_file(self, name: str, path) -> Attachment:
+        """Файл с диска (загрузка Chainlit). Двоичный или больше ``max_bytes`` — ``ValueError``."""
+        path = Path(path)
+        size = path.stat().st_size
+        if size > self.max_bytes:
+            raise ValueError(f"файл больше {_format_size(self.max_bytes)}")
+        with path.open("rb") as f:
+            if b"\0" in f.read(SNIFF_BYTES):
+                raise ValueError("двоичный файл")
+        with path.open(encoding="utf-8", errors="replace", newline="") as stream:
+            return self._ingest(name, stream)
+
+    def _ingest(self, name: str, stream: TextIO) -> Attachment:
+        with self._lock:
+            number = len(self.attachments) + 1
+            attachment = Attachment(number, name, self.directory / f"{number}.jsonl")
+            attachment.start = len(self._owners)
+        self.directory.mkdir(parents=True, exist_ok=True)
+
+        counted = _ByteCounter(iter_lines(stream, self.chunk_tokens * CHARS_PER_TOKEN))
+        with attachment.path.open("wb") as out:
+            for first, last, text in iter_chunks(counted, self.chunk_tokens):
+                attachment.offsets.append(out.tell())
+                attachment.first_lines.append(first)
+                attachment.last_lines.append(last)
+                attachment.tokens.append(estimate_tokens(text))
+                out.write((json.dumps(text, ensure_ascii=False) + "\n").encode("utf-8"))
+                self._index_chunk(number, text)
+        attachment.size_bytes = counted.bytes
+        attachment.lines = attachment.last_lines[-1] if len(attachment) else 0
+
+        with self._lock:
+            self.attachments.append(attachment)
+        return attachment
+
+    def _index_chunk(self, number: int, text: str) -> None:
+        counts = _term_counts(text)
+        with self._lock:
+            chunk_id = len(self._owners)
+            self._owners.append(number)
+            self._lengths.append(sum(counts.values()))
+            for key, tf in counts.items():
+                postings = self._postings.get(key)
+                if postings is None:
+                    postings = self._postings[key] = array("Q")
+                postings.append(chunk_id << 16 | min(tf, 0xFFFF))
+
+    def _key(self, chunk_id: int) -> ChunkKey:
+        number = self._owners[chunk_id]
+        return number, chunk_id - self.attachments[number - 1].start
+
+    def _search(self, query: str, k: int, k1: float = 1.5, b: float = 0.75) -> List[ChunkKey]:
+        """Top-k кусков по BM25 (только с ненулевой оценкой)."""
+        with self._lock:
+            n = len(self._owners)
+            # Куски вложения, которое ещё читается, в поиск не попадают
+            done = self.attachments[-1].start + len(self.attachments[-1]) if self.attachments else 0
+            if not done:
+                return []
+            # Копии, а не np.frombuffer: представление держит буфер array, и
+            # параллельный _index_chunk падал бы на append (BufferError)
+            lengths = np.array(self._lengths, dtype=np.uint32)[:n]
+            norm = 1 - b + b * lengths / (lengths.mean() or 1)
+            scores = np.zeros(n)
+            for key in _term_counts(query):
+                postings = self._postings.get(key)
+                if postings is None:
+                    continue
+                packed = np.array(postings, dtype=np.uint64)
+                ids = (packed >> 16).astype(np.int64)
+                tf = (packed & 0xFFFF).astype(np.float64)
+                idf = math.log(1 + (n - len(ids) + 0.5) / (len(ids) + 0.5))
+                scores[ids] += idf * tf * (k1 + 1) / (tf + k1 * norm[ids])
+        scores = scores[:done]
+        k = min(k, done)
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+        return [self._key(int(i)) for i in top if scores[i] > 0]
+
+    def _fit(self, keys: Iterable[ChunkKey], budget_tokens: int) -> List[ChunkKey]:
+        """Куски без повторов в пределах бюджета, в порядке документа."""
+        selected: List[ChunkKey] = []
+        used = 0
+        for key in dict.fromkeys(keys):
+            cost = self.attachments[key[0] - 1].tokens[key[1]]
+            if used + cost > budget_tokens:
+                continue
+            selected.append(key)
+            used += cost
+        return sorted(selected)
+
+    def select(
+        self,
+        query: str,
+        budget_tokens: int = 1500,
+        k: int = 6,
+    ) -> List[ChunkKey]:
+        """Куски для промпта: запрошенные через /more, затем релевантные вопросу."""
+        if not self.attachments:
+            return []
+        pinned, self._pinned = self._pinned, []
+        keys = pinned + self._search(query, k)
+        if not keys:
+            # Вопрос ни о чём в файле (или его нет) — начало и конец последнего вложения
+            latest = self.attachments[-1]
+            keys = [(latest.number, 0), (latest.number, len(latest) - 1)] if len(latest) else []
+        return self._fit(keys, budget_tokens)
+
+    def more(self, query: str = "", budget_tokens: int = 1500, k: int = 20) -> List[ChunkKey]:
+        """Ещё куски по запросу или следующие по порядку; попадут и в следующий промпт."""
+        if not self.attachments:
+            return []
+        if query.split():
+            keys = self._fit(self._search(query, k), budget_tokens)
+        else:
+            latest = self.attachments[-1]
+            keys = []
+            used = 0
+            # Куски подряд с курсора, пока влезают в бюджет (хотя бы один)
+            for i in range(self._cursor.get(latest.number, 0), len(latest)):
+                cost = latest.tokens[i]
+                if keys and used + cost > budget_tokens:
+                    break
+                keys.append((latest.number, i))
+                used += cost
+            if keys:
+                self._cursor[latest.number] = keys[-1][1] + 1
+        self._pinned = keys
+        return keys
+
+    def render(self, keys: List[ChunkKey]) -> str:
+        """Куски с заголовками вложений и номерами строк."""
+        blocks = []
+        for number in dict.fromkeys(key[0] for key in keys):
+            attachment = self.attachments[number - 1]
+            indices = [i for n, i in keys if n == number]
+            texts = attachment.read(indices)
+            blocks.append(attachment.reference())
+            for i in indices:
+                blocks.append(
+                    f"Фрагмент {i + 1}/{len(attachment)}, строки "
+                    f"{attachment.first_lines[i]}–{attachment.last_lines[i]}:\n```\n{texts[i]}\n```"
+                )
+        return "\n".join(blocks)
+
+    def context(self, query: str, budget_tokens: int = 1500, k: int = 6) -> str:
+        """Блок вложений для текущего хода (пусто, если вложений нет)."""
+        keys = self.select(query, budget_tokens, k)
+        if not keys:
+            return ""
+        return (
+            "## Вложения пользователя (показаны только фрагменты, релевантные вопросу):\n"
+            + self.render(keys)
+        )
+
+    def close(self) -> None:
+        """Удаляет куски с диска (конец сессии, /reset)."""
+        with self._lock:
+            self.attachments = []
+            self._owners = array("I")
+            self._lengths = array("I")
+            self._postings = {}
+            self._cursor = {}
+            self._pinned = []
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+
+class _ByteCounter:
+    """Итератор строк, считающий их размер в UTF-8 (размер вставки без копии текста)."""
+
+    def __init__(self, lines: Iterator[str]):
+        self._lines = lines
+        self.bytes = 0
+
+    def __iter__(self) -> Iterator[str]:
+        for line in self._lines:
+            self.bytes += len(line.encode("utf-8"))
+            yield line
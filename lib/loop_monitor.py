@@ -0,0 +1,177 @@
+"""Мониторинг event loop: лаг планировщика и поиск блокирующих вызовов.
+
+Две части:
+
+- сэмплер — корутина, которая каждые ``interval_s`` засыпает и меряет, на
+  сколько позже запланированного проснулась (это и есть лаг event loop);
+- watchdog — фоновый поток: если сэмплер не отметился дольше ``threshold_s``,
+  loop занят синхронным кодом, и поток снимает стек потока loop через
+  ``sys._current_frames()`` — видно, какая функция блокирует все сессии.
+
+Накладные расходы — одно пробуждение корутины и потока на интервал, поэтому
+режим можно держать включённым в проде. Opt-in через env ``LOOP_MONITOR=1``.
+"""
+
+import asyncio
+import logging
+import os
+import sys
+import threading
+import time
+import traceback
+from collections import deque
+from typing import Any, Deque, Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+
+class LoopMonitor:
+    """Сэмплер лага event loop + watchdog со снимками стека при зависаниях."""
+
+    def __init__(
+        self,
+        interval_s: float = 0.1,
+        threshold_s: float = 0.1,
+        max_samples: int = 1024,
+        max_stalls: int = 20,
+        stack_limit: int = 12,
+    ):
+        self.interval_s = interval_s
+        self.threshold_s = threshold_s
+        self.stack_limit = stack_limit
+
+        self.samples = 0
+        self.slow = 0
+        self.lag_total_s = 0.0
+        self.lag_max_s = 0.0
+        self._recent: Deque[float] = deque(maxlen=max_samples)
+        self.stalls: Deque[Dict[str, Any]] = deque(maxlen=max_stalls)
+
+        self._heartbeat = time.monotonic()
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._loop_thread_id: Optional[int] = None
+        self._task: Optional[asyncio.Task] = None
+        self._watchdog: Optional[threading.Thread] = None
+        self._stop = threading.Event()
+        self._lock = threading.Lock()
+
+    @property
+    def running(self) -> bool:
+        return self._task is not None and not self._task.done()
+
+    def start(self) -> None:
+        """Запускает мониторинг на текущем (запущенном) event loop. Идемпотентно."""
+        if self.running:
+            return
+        self._loop = asyncio.get_running_loop()
+        self._loop_thread_id = threading.get_ident()
+        self._heartbeat = time.monotonic()
+        self._stop.clear()
+        self._task = self._loop.create_task(self._sample())
+        self._watchdog = threading.Thread(target=self._watch, name="loop-watchdog", daemon=True)
+        self._watchdog.start()
+
+    async def stop(self) -> None:
+        self._stop.set()
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        if self._watchdog is not None:
+            await asyncio.to_thread(self._watchdog.join)
+            self._watchdog = None
+
+    async def _sample(self) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            expected = loop.time() + self.interval_s
+            await asyncio.sleep(self.interval_s)
+            self._heartbeat = time.monotonic()
+            self.record(max(0.0, loop.time() - expected))
+
+    def record(self, lag_s: float) -> None:
+        with self._lock:
+            self.samples += 1
+            self.lag_total_s += lag_s
+            self.lag_max_s = max(self.lag_max_s, lag_s)
+            self._recent.append(lag_s)
+            if lag_s >= self.threshold_s:
+                self.slow += 1
+        if lag_s >= self.threshold_s:
+            logger.warning("event loop lag %.0f ms", lag_s * 1000)
+
+    def _watch(self) -> None:
+        """Поток watchdog: снимает стек loop, пока тот не отвечает дольше порога."""
+        captured_for = None
+        while not self._stop.wait(self.threshold_s / 2):
+            if self._loop is None or not self._loop.is_running():
+                continue
+            heartbeat = self._heartbeat
+            stalled_s = time.monotonic() - heartbeat - self.interval_s
+            if stalled_s < self.threshold_s:
+                continue
+            if captured_for == heartbeat:
+                continue
+            captured_for = heartbeat
+            stack = self._loop_stack()
+            if stack:
+                self._record_stall(stalled_s, stack)
+
+    def _loop_stack(self) -> List[str]:
+        frame = sys._current_frames().get(self._loop_thread_id)
+        if frame is None:
+            return []
+        lines = traceback.format_stack(frame)
+        return [line.rstrip() for line in lines[-self.stack_limit:]]
+
+    def _record_stall(self, stalled_s: float, stack: List[str]) -> None:
+        with self._lock:
+            self.stalls.append({
+                "ts": time.time(),
+                "stalled_ms": round(stalled_s * 1000, 1),
+                "stack": stack,
+            })
+        logger.warning(
+            "event loop blocked for %.0f ms, stack:\n%s", stalled_s * 1000, "\n".join(stack)
+        )
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._lock:
+            recent = sorted(self._recent)
+            p99 = recent[min(len(recent) - 1, int(len(recent) * 0.99))] if recent else 0.0
+            result: Dict[str, Any] = {
+                "samples": self.samples,
+                "lag_avg_ms": round(self.lag_total_s / (self.samples or 1) * 1000, 1),
+                "lag_p99_ms": round(p99 * 1000, 1),
+                "lag_max_ms": round(self.lag_max_s * 1000, 1),
+                "slow_samples": self.slow,
+                "stalls": len(self.stalls),
+            }
+            if self.stalls:
+                last = self.stalls[-1]
+                # Последний кадр стека — место, где loop стоял в момент снимка
+                result["last_stall"] = f"{last['stalled_ms']} ms: {last['stack'][-1].strip().splitlines()[0]}"
+            return result
+
+
+_loop_monitor: Optional[LoopMonitor] = None
+
+
+def get_loop_monitor() -> Optional[LoopMonitor]:
+    """Общий на процесс монитор, если включён ``LOOP_MONITOR=1``.
+
+    Порог — ``LOOP_LAG_THRESHOLD_MS`` (по умолчанию 100), интервал сэмплов —
+    ``LOOP_MONITOR_INTERVAL_MS`` (по умолчанию 100).
+    """
+    global _loop_monitor
+    if os.getenv("LOOP_MONITOR", "0") != "1":
+        return None
+    if _loop_monitor is None:
+        _loop_monitor = LoopMonitor(
+            interval_s=float(os.getenv("LOOP_MONITOR_INTERVAL_MS", "100")) / 1000,
+            threshold_s=float(os.getenv("LOOP_LAG_THRESHOLD_MS", "100")) / 1000,
+        )
+    return _loop_monitor
@@ -0,0 +1,205 @@
+"""Долгосрочная память: поиск по архиву прошлых диалогов и сводок.
+
+Когда история сжимается (/compress) или сессия заканчивается, реплики и
+сводки режутся на куски ограниченного размера и складываются в архив
+(``data/memory/<scope>.jsonl``, append-only) и векторный индекс. На каждый
+новый вопрос в промпт попадают только top-k релевантных кусков в пределах
+бюджета токенов — вместо того чтобы пользователь вставлял контекст заново.
+
+Векторы кусков лежат рядом с архивом (``<scope>.<эмбеддер>.f32``: размерность
+uint32, затем строки float32, тоже append-only), так что при старте
+эмбеддятся только куски, которых там ещё нет, а не весь архив.
+
+Opt-in через env ``LONG_TERM_MEMORY=1``.
+"""
+
+import json
+import os
+import re
+import threading
+import time
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Tuple
+
+import numpy as np
+
+from lib.embeddings import get_embedder
+from lib.history import chunk_text, estimate_tokens
+from lib.vector_index import IVFIndex, VectorIndex
+
+DEFAULT_MEMORY_DIR = Path(__file__).parent.parent / "data" / "memory"
+
+_SAFE_NAME_RE = re.compile(r"[^\w.-]+")
+_HEADER_BYTES = 4
+
+
+class ConversationMemory:
+    """Архив кусков диалога + векторный индекс по ним.
+
+    Пока кусков меньше ``ann_threshold`` — точный brute-force поиск; при
+    превышении индекс один раз перестраивается в ``IVFIndex``.
+    """
+
+    def __init__(
+        self,
+        path: Optional[Path] = None,
+        embedder=None,
+        chunk_tokens: int = 120,
+        ann_threshold: int = 50000,
+    ):
+        self.path = path
+        self.embedder = embedder or get_embedder()
+        self.chunk_tokens = chunk_tokens
+        self.ann_threshold = ann_threshold
+
+        self._chunks: List[Dict[str, Any]] = []
+        self._index = None
+        self._lock = threading.Lock()
+        # Архив и файл векторов дописываются в одном порядке
+        self._write_lock = threading.Lock()
+
+        if self.path is not None and self.path.exists():
+            self._load()
+
+    def __len__(self) -> int:
+        return len(self._chunks)
+
+    def _vectors_path(self) -> Path:
+        # Векторы другой модели эмбеддингов не подходят — у каждой свой файл
+        tag = _SAFE_NAME_RE.sub("_", self.embedder.name)
+        return self.path.with_name(f"{self.path.stem}.{tag}.f32")
+
+    def _read_vectors(self, limit: int) -> Optional[np.ndarray]:
+        """Сохранённые векторы (не больше ``limit`` строк); хвост без записи в архиве обрезается."""
+        path = self._vectors_path()
+        if not path.exists():
+            return None
+        with path.open("rb") as f:
+            header = f.read(_HEADER_BYTES)
+            data = np.fromfile(f, dtype=np.float32)
+        dim = int.from_bytes(header, "little") if len(header) == _HEADER_BYTES else 0
+        expected = getattr(self.embedder, "dim", None)
+        if not dim or (expected is not None and expected != dim):
+            path.unlink()
+            return None
+        rows = min(len(data) // dim, limit)
+        if len(data) != rows * dim:
+            # Недописанная строка или векторы без записей (сбой между записями)
+            os.truncate(path, _HEADER_BYTES + rows * dim * 4)
+        return data[:rows * dim].reshape(rows, dim)
+
+    def _append_vectors(self, vectors: np.ndarray) -> None:
+        with self._vectors_path().open("ab") as f:
+            if f.tell() == 0:
+                f.write(int(vectors.shape[1]).to_bytes(_HEADER_BYTES, "little"))
+            f.write(np.ascontiguousarray(vectors, dtype=np.float32).tobytes())
+
+    def _load(self) -> None:
+        with self.path.open(encoding="utf-8") as f:
+            records = [json.loads(line) for line in f if line.strip()]
+        if not records:
+            return
+        stored = self._read_vectors(len(records))
+        done = 0 if stored is None else len(stored)
+        if done < len(records):
+            fresh = self.embedder.embed_many([r["text"] for r in records[done:]])
+            self._append_vectors(fresh)
+            stored = fresh if stored is None else np.concatenate([stored, fresh])
+        self._add(records, stored, persist=False)
+
+    def _add(
+        self,
+        records: List[Dict[str, Any]],
+        vectors: Optional[np.ndarray] = None,
+        persist: bool = True,
+    ) -> None:
+        if not records:
+            return
+        if vectors is None:
+            vectors = self.embedder.embed_many([r["text"] for r in records])
+        with self._lock:
+            if self._index is None:
+                self._index = VectorIndex(vectors.shape[1])
+            first_id = len(self._chunks)
+            ids = list(range(first_id, first_id + len(records)))
+            self._chunks.extend(records)
+            self._index.add_many(ids, vectors)
+            if isinstance(self._index, VectorIndex) and len(self._index) > self.ann_threshold:
+                self._index = IVFIndex.from_index(self._index)
+
+        if persist and self.path is not None:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            with self._write_lock:
+                with self.path.open("a", encoding="utf-8") as f:
+                    for record in records:
+                        f.write(json.dumps(record, ensure_ascii=False) + "\n")
+                self._append_vectors(vectors)
+
+    def archive_turns(self, history: List[Dict[str, str]]) -> int:
+        """Архивирует реплики диалога. Возвращает число добавленных кусков."""
+        records = []
+        now = time.time()
+        for item in history:
+            role = "Пользователь" if item.get("role") == "user" else "Ассистент"
+            for piece in chunk_text(item.get("content", ""), self.chunk_tokens):
+                records.append({"kind": "turn", "text": f"{role}: {piece}", "ts": now})
+        self._add(records)
+        return len(records)
+
+    def archive_summary(self, summary: str) -> int:
+        """Архивирует сводку диалога (результат /compress)."""
+        records = [
+            {"kind": "summary", "text": f"Сводка: {piece}", "ts": time.time()}
+            for piece in chunk_text(summary, self.chunk_tokens)
+        ]
+        self._add(records)
+        return len(records)
+
+    def search(self, query: str, k: int = 5) -> List[Tuple[str, float]]:
+        """Top-k кусков архива по близости к запросу."""
+        if not self._chunks:
+            return []
+        vector = self.embedder.embed(query)
+        with self._lock:
+            hits = self._index.search(vector, k)
+            return [(self._chunks[i]["text"], score) for i, score in hits]
+
+    def select_snippets(
+        self,
+        query: str,
+        k: int = 5,
+        budget_tokens: int = 300,
+        min_score: float = 0.2,
+    ) -> List[str]:
+        """Релевантные куски для промпта: не больше ``k`` и ``budget_tokens`` суммарно."""
+        selected = []
+        used = 0
+        for text, score in self.search(query, k):
+            if score < min_score:
+                break
+            cost = estimate_tokens(text)
+            if used + cost > budget_tokens:
+                continue
+            selected.append(text)
+            used += cost
+        return selected
+
+
+_memories: Dict[str, ConversationMemory] = {}
+_memories_lock = threading.Lock()
+
+
+def get_memory(scope: str, base_dir: Optional[Path] = None) -> Optional[ConversationMemory]:
+    """Память для ``scope`` (профиль пользователя), если включён ``LONG_TERM_MEMORY=1``."""
+    if os.getenv("LONG_TERM_MEMORY", "0") != "1":
+        return None
+    with _memories_lock:
+        memory = _memories.get(scope)
+        if memory is None:
+            directory = base_dir or DEFAULT_MEMORY_DIR
+            memory = ConversationMemory(
+                path=directory / f"{scope}.jsonl",
+                chunk_tokens=int(os.getenv("LONG_TERM_MEMORY_CHUNK_TOKENS", "120")),
+            )
+            _memories[scope] = memory
+        return memory
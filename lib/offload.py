@@ -0,0 +1,248 @@
+"""Вынос CPU-тяжёлой работы из event loop в пул процессов.
+
+Все сессии Chainlit обслуживает один event loop, а ``asyncio.to_thread`` не
+спасает от CPU-работы: поток держит GIL, и loop всё равно ждёт. ``CpuOffload``
+отправляет назначенные функции (рендер дашборда по всей аналитике, нарезка
+длинной истории для ``/compress`` и т.п.) в ``ProcessPoolExecutor``:
+
+- маленький вход (``size < min_size``) считается сразу, в вызывающем потоке —
+  даже поток дороже самой работы;
+- в пуле не больше ``workers + max_queue`` задач; сверх этого и при
+  выключенном пуле (``OFFLOAD_WORKERS=0``) — ``asyncio.to_thread``, как раньше;
+- по каждой функции считаются вызовы по способам исполнения, время в очереди
+  пула (вместе с пересылкой аргументов), время исполнения в воркере и возврат
+  результата.
+
+В процесс имеет смысл отправлять то, где вход маленький, а работы много:
+разбор профиля на 1 MB (одна строка) в процессе быстрее, чем в потоке.
+Рендер дашборда по 100k записей, наоборот, в процессе в ~10 раз медленнее:
+pickle списка dict дороже рендера, и он держит GIL. Такие вызовы идут с
+``process=False`` — сразу или в потоке, с теми же метриками. Так же идёт
+нарезка истории для ``/compress``: подсчёт токенов там — ``str.split`` по
+репликам, и пересылка тысяч dict в воркер стоит дороже самого подсчёта.
+
+Функция и аргументы должны сериализоваться pickle: функции уровня модуля
+(или ``staticmethod`` класса), данные — dict/list/str. Воркеры запускаются
+все сразу и вне event loop (``start()`` при старте приложения или первый
+вызов), метод запуска — ``spawn``: воркеры не наследуют потоки и сокеты
+сервера.
+"""
+
+import asyncio
+import multiprocessing
+import os
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Any, Callable, Dict, Optional, Tuple
+
+
+def _timed_call(fn: Callable, args: Tuple) -> Tuple[Any, float, float]:
+    """Исполняется в воркере: результат, момент старта (wall clock) и время работы."""
+    started = time.time()
+    t0 = time.perf_counter()
+    result = fn(*args)
+    return result, started, time.perf_counter() - t0
+
+
+class _FunctionStats:
+    def __init__(self):
+        self.inline = 0
+        self.thread = 0
+        self.process = 0
+        self.overflow = 0
+        self.queue_total_s = 0.0
+        self.queue_max_s = 0.0
+        self.exec_total_s = 0.0
+        self.exec_max_s = 0.0
+        self.transfer_total_s = 0.0
+
+    @property
+    def calls(self) -> int:
+        return self.inline + self.thread + self.process
+
+    def record_exec(self, exec_s: float) -> None:
+        self.exec_total_s += exec_s
+        self.exec_max_s = max(self.exec_max_s, exec_s)
+
+    def snapshot(self) -> Dict[str, Any]:
+        def avg_ms(total: float, count: int) -> float:
+            return round(total / count * 1000, 2) if count else 0.0
+
+        return {
+            "calls": self.calls,
+            "inline": self.inline,
+            "thread": self.thread,
+            "process": self.process,
+            "overflow": self.overflow,
+            "queue_avg_ms": avg_ms(self.queue_total_s, self.process),
+            "queue_max_ms": round(self.queue_max_s * 1000, 2),
+            "exec_avg_ms": avg_ms(self.exec_total_s, self.calls),
+            "exec_max_ms": round(self.exec_max_s * 1000, 2),
+            "transfer_avg_ms": avg_ms(self.transfer_total_s, self.process),
+        }
+
+
+class CpuOffload:
+    """Пул процессов для CPU-работы из async-кода с очередью и метриками.
+
+    ``workers=0`` — пул выключен: большие входы идут в ``asyncio.to_thread``,
+    маленькие — сразу, метрики считаются так же.
+    """
+
+    def __init__(
+        self,
+        workers: int = 0,
+        max_queue: int = 16,
+        min_size: int = 5000,
+        start_method: str = "spawn",
+    ):
+        self.workers = workers
+        self.max_queue = max_queue
+        self.min_size = min_size
+        self.start_method = start_method
+
+        self._executor: Optional[ProcessPoolExecutor] = None
+        self._lock = threading.Lock()
+        self._pending = 0
+        self._functions: Dict[str, _FunctionStats] = {}
+        self.broken = 0
+
+    def _stats(self, fn: Callable) -> _FunctionStats:
+        name = getattr(fn, "__qualname__", repr(fn))
+        stats = self._functions.get(name)
+        if stats is None:
+            stats = self._functions[name] = _FunctionStats()
+        return stats
+
+    def _pool(self) -> ProcessPoolExecutor:
+        """Пул со всеми запущенными воркерами (блокирует: старт процессов — сотни мс)."""
+        with self._lock:
+            if self._executor is None:
+                executor = ProcessPoolExecutor(
+                    max_workers=self.workers,
+                    mp_context=multiprocessing.get_context(self.start_method),
+                )
+                # Воркеры запускаются по одному на submit без свободного воркера:
+                # запускаем все сразу, чтобы старт не пришёлся на submit из event loop
+                try:
+                    for future in [executor.submit(int) for _ in range(self.workers)]:
+                        future.result()
+                except BaseException:
+                    executor.shutdown(wait=False, cancel_futures=True)
+                    raise
+                self._executor = executor
+            return self._executor
+
+    @property
+    def started(self) -> bool:
+        return self._executor is not None
+
+    async def start(self) -> None:
+        """Запуск воркеров заранее, вне event loop (при старте приложения)."""
+        if self.workers > 0 and self._executor is None:
+            await asyncio.to_thread(self._pool)
+
+    async def run(
+        self,
+        fn: Callable,
+        *args: Any,
+        size: Optional[int] = None,
+        min_size: Optional[int] = None,
+        process: bool = True,
+    ) -> Any:
+        """Результат ``fn(*args)``: сразу, в потоке или в процессе пула.
+
+        ``size`` — размер входа в единицах ``min_size`` (записи, сообщения,
+        символы); без него вход считается большим. ``process=False`` — только
+        сразу или в потоке: для функций, у которых пересылка входа (тысячи
+        dict) дороже самой работы.
+        """
+        stats = self._stats(fn)
+        threshold = self.min_size if min_size is None else min_size
+        if size is not None and size < threshold:
+            stats.inline += 1
+            t0 = time.perf_counter()
+            try:
+                return fn(*args)
+            finally:
+                stats.record_exec(time.perf_counter() - t0)
+
+        if process and self.workers > 0:
+            if self._pending < self.workers + self.max_queue:
+                try:
+                    return await self._run_in_process(stats, fn, args)
+                except BrokenProcessPool:
+                    # Воркер упал (OOM, сигнал) — пул пересоздаётся при следующем вызове
+                    self.broken += 1
+            else:
+                stats.overflow += 1
+
+        stats.thread += 1
+        t0 = time.perf_counter()
+        try:
+            return await asyncio.to_thread(fn, *args)
+        finally:
+            stats.record_exec(time.perf_counter() - t0)
+
+    async def _run_in_process(self, stats: _FunctionStats, fn: Callable, args: Tuple) -> Any:
+        # Место в очереди занимается до ожидания старта пула
+        self._pending += 1
+        try:
+            pool = self._executor or await asyncio.to_thread(self._pool)
+            submitted = time.time()
+            t0 = time.perf_counter()
+            try:
+                result, started, exec_s = await asyncio.wrap_future(pool.submit(_timed_call, fn, args))
+            except BrokenProcessPool:
+                self._discard(pool)
+                raise
+        finally:
+            self._pending -= 1
+        total = time.perf_counter() - t0
+        queue_s = max(0.0, started - submitted)
+        stats.process += 1
+        stats.record_exec(exec_s)
+        stats.queue_total_s += queue_s
+        stats.queue_max_s = max(stats.queue_max_s, queue_s)
+        stats.transfer_total_s += max(0.0, total - queue_s - exec_s)
+        return result
+
+    def _discard(self, pool: ProcessPoolExecutor) -> None:
+        """Сломанный пул убирается и гасится: без ``shutdown`` его живые воркеры остаются висеть."""
+        with self._lock:
+            if self._executor is pool:
+                self._executor = None
+        pool.shutdown(wait=False, cancel_futures=True)
+
+    def shutdown(self) -> None:
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=True, cancel_futures=True)
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {
+            "workers": self.workers,
+            "pending": self._pending,
+            "max_pending": self.workers + self.max_queue if self.workers else 0,
+            "broken": self.broken,
+            "functions": {name: stats.snapshot() for name, stats in self._functions.items()},
+        }
+
+
+_cpu_offload: Optional[CpuOffload] = None
+
+
+def get_cpu_offload() -> CpuOffload:
+    """Общий на процесс пул (``OFFLOAD_WORKERS``, ``OFFLOAD_MAX_QUEUE``, ``OFFLOAD_MIN_SIZE``)."""
+    global _cpu_offload
+    if _cpu_offload is None:
+        _cpu_offload = CpuOffload(
+            workers=int(os.getenv("OFFLOAD_WORKERS", "0")),
+            max_queue=int(os.getenv("OFFLOAD_MAX_QUEUE", "16")),
+            min_size=int(os.getenv("OFFLOAD_MIN_SIZE", "5000")),
+            start_method=os.getenv("OFFLOAD_START_METHOD", "spawn"),
+        )
+    return _cpu_offload
@@ -0,0 +1,455 @@
+"""Запросы к Ollama API для локальных прогонов: размер контекста и память KV-кэша.
+
+Ollama выделяет KV-кэш под весь ``num_ctx`` сразу, поэтому фиксированные
+32768 на коротком промпте — лишние гигабайты памяти и медленная загрузка, а
+смена ``num_ctx`` между запросами — перезагрузка модели. ``ContextSizer``
+берёт наименьший размер из ``CTX_BUCKETS``, в который влезает промпт плюс
+бюджет ответа, и в пределах прогона только растёт (одна загрузка вместо
+перезагрузки на каждом запросе). Размер и оценка KV-кэша пишутся в лог.
+
+``ResidencyScheduler`` гоняет набор задач по нескольким моделям: группирует
+работу по модели, загружает модель заранее (время загрузки — отдельно от
+инференса) и, если хватает памяти, подгружает следующую, пока идёт текущая.
+
+Только стандартная библиотека: модуль импортируют скрипты прогонов
+(``docs/local-models/run_benchmark.py``, ``tasks/run_local_loop.py``).
+"""
+
+import json
+import logging
+import math
+import os
+import threading
+import time
+import urllib.request
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional, Tuple
+
+from lib.cassette import Cassette, get_cassette, request_key
+from lib.output_guard import REASON_STALL, OutputGuard
+
+logger = logging.getLogger(__name__)
+
+CTX_BUCKETS = (2048, 4096, 8192, 16384, 32768, 65536, 131072)
+
+# Консервативно: русский текст и код дают больше токенов, чем 4 символа на токен.
+# Недооценка опаснее переоценки — Ollama молча обрезает начало промпта.
+CHARS_PER_TOKEN = 3
+# Служебные токены шаблона чата на сообщение (роль, разделители)
+MESSAGE_OVERHEAD_TOKENS = 8
+
+# Байт на элемент KV-кэша по ``OLLAMA_KV_CACHE_TYPE``
+KV_CACHE_BYTES = {"f16": 2.0, "q8_0": 1.0, "q4_0": 0.5}
+
+
+def ollama_root_url(base_url: Optional[str] = None) -> str:
+    """Корень Ollama API (``http://host:11434``) из OpenAI-совместимого ``.../v1``."""
+    url = (base_url or os.getenv("OLLAMA_BASE_URL", "http://localhost:11434/v1")).rstrip("/")
+    return url[:-len("/v1")] if url.endswith("/v1") else url
+
+
+def estimate_tokens(text: str) -> int:
+    return math.ceil(len(text) / CHARS_PER_TOKEN)
+
+
+def estimate_messages_tokens(messages: List[Dict[str, str]]) -> int:
+    """Оценка токенов промпта чата (с запасом на шаблон)."""
+    return sum(estimate_tokens(m.get("content", "")) + MESSAGE_OVERHEAD_TOKENS for m in messages)
+
+
+def bucket_num_ctx(tokens: int, buckets: Iterable[int] = CTX_BUCKETS) -> int:
+    """Наименьший размер контекста из ``buckets``, вмещающий ``tokens`` (иначе наибольший)."""
+    ordered = sorted(buckets)
+    for size in ordered:
+        if size >= tokens:
+            return size
+    return ordered[-1]
+
+
+def _post(url: str, payload: Dict[str, Any], timeout: float) -> Dict[str, Any]:
+    data = json.dumps(payload).encode("utf-8")
+    req = urllib.request.Request(url, data=data, headers={"Content-Type": "application/json"})
+    with urllib.request.urlopen(req, timeout=timeout) as resp:
+        return json.loads(resp.read().decode("utf-8"))
+
+
+def _get(url: str, timeout: float) -> Dict[str, Any]:
+    with urllib.request.urlopen(url, timeout=timeout) as resp:
+        return json.loads(resp.read().decode("utf-8"))
+
+
+def model_info(model: str, root_url: Optional[str] = None, timeout: float = 30.0) -> Dict[str, Any]:
+    """Архитектура модели из ``/api/show`` (``model_info``); ``{}``, если Ollama не ответила."""
+    try:
+        body = _post(f"{root_url or ollama_root_url()}/api/show", {"model": model}, timeout)
+    except (OSError, ValueError):
+        return {}
+    return body.get("model_info") or {}
+
+
+def kv_cache_bytes(info: Dict[str, Any], num_ctx: int, cache_type: Optional[str] = None) -> Optional[int]:
+    """Размер KV-кэша на ``num_ctx`` токенов по ``model_info`` (``None``, если полей нет).
+
+    2 (K и V) x слои x ``num_ctx`` x KV-головы x размер головы x байт на элемент.
+    Окна sliding-window attention не учитываются — это оценка сверху.
+    """
+    arch = info.get("general.architecture")
+    if not arch:
+        return None
+    layers = info.get(f"{arch}.block_count")
+    heads = info.get(f"{arch}.attention.head_count")
+    kv_heads = info.get(f"{arch}.attention.head_count_kv", heads)
+    head_dim = info.get(f"{arch}.attention.key_length")
+    if head_dim is None and heads:
+        head_dim = info.get(f"{arch}.embedding_length", 0) // (max(heads) if isinstance(heads, list) else heads)
+    if not layers or not kv_heads or not head_dim:
+        return None
+    # У части моделей число KV-голов задано по слоям списком
+    kv_total = sum(kv_heads) if isinstance(kv_heads, list) else kv_heads * layers
+    per_element = KV_CACHE_BYTES.get(cache_type or os.getenv("OLLAMA_KV_CACHE_TYPE", "f16"), 2.0)
+    return int(2 * kv_total * num_ctx * head_dim * per_element)
+
+
+class ContextSizer:
+    """Выбор ``num_ctx`` для прогона: наименьший bucket, который только растёт.
+
+    ``reserve(prompts)`` заранее подбирает размер под все промпты прогона,
+    ``fit(model, messages)`` — под очередной запрос (если промпт больше
+    ожидаемого, размер растёт, но никогда не уменьшается).
+    """
+
+    def __init__(
+        self,
+        max_output_tokens: int = 2048,
+        buckets: Iterable[int] = CTX_BUCKETS,
+        root_url: Optional[str] = None,
+    ):
+        self.max_output_tokens = max_output_tokens
+        self.buckets = tuple(sorted(buckets))
+        self.root_url = root_url
+        self.num_ctx = 0
+        self._info: Dict[str, Dict[str, Any]] = {}
+        self._logged: Dict[str, int] = {}
+
+    def needed(self, messages: List[Dict[str, str]]) -> int:
+        return estimate_messages_tokens(messages) + self.max_output_tokens
+
+    def reserve(self, prompts: Iterable[List[Dict[str, str]]]) -> int:
+        """Подбирает размер сразу под все известные промпты прогона."""
+        for messages in prompts:
+            self.num_ctx = max(self.num_ctx, bucket_num_ctx(self.needed(messages), self.buckets))
+        return self.num_ctx
+
+    def fit(self, model: str, messages: List[Dict[str, str]]) -> int:
+        """``num_ctx`` для запроса; пишет в лог размер и KV-кэш при первом запросе модели и при росте."""
+        needed = self.needed(messages)
+        self.num_ctx = max(self.num_ctx, bucket_num_ctx(needed, self.buckets))
+        if needed > self.num_ctx:
+            logger.warning("prompt ~%d tokens + output budget exceed num_ctx %d", needed, self.num_ctx)
+        if self._logged.get(model) != self.num_ctx:
+            self._logged[model] = self.num_ctx
+            kv_mb = self.kv_cache_mb(model)
+            logger.info(
+                "%s: num_ctx=%d (prompt ~%d + output %d tokens), KV cache %s",
+                model, self.num_ctx, needed - self.max_output_tokens, self.max_output_tokens,
+                f"~{kv_mb} MB" if kv_mb is not None else "unknown",
+            )
+        return self.num_ctx
+
+    def kv_cache_mb(self, model: str) -> Optional[float]:
+        if model not in self._info:
+            self._info[model] = model_info(model, self.root_url)
+        size = kv_cache_bytes(self._info[model], self.num_ctx)
+        return round(size / 1024 / 1024, 1) if size is not None else None
+
+
+def chat_request(
+    model: str,
+    messages: List[Dict[str, str]],
+    num_ctx: int,
+    max_output_tokens: int,
+    temperature: float = 0.2,
+    top_p: float = 0.9,
+    stream: bool = False,
+) -> Dict[str, Any]:
+    """Тело ``POST /api/chat``: контекст по размеру промпта, ответ ограничен ``num_predict``."""
+    return {
+        "model": model,
+        "messages": messages,
+        "stream": stream,
+        "options": {
+            "temperature": temperature,
+            "top_p": top_p,
+            "num_ctx": num_ctx,
+            "num_predict": max_output_tokens,
+        },
+    }
+
+
+def chat(payload: Dict[str, Any], root_url: Optional[str] = None, timeout: float = 600.0) -> Dict[str, Any]:
+    """Синхронный нестриминговый ``/api/chat``."""
+    return _post(f"{root_url or ollama_root_url()}/api/chat", payload, timeout)
+
+
+def _stream_chunks(
+    req: urllib.request.Request, timeout: float, stall_s: Optional[float] = None
+) -> Iterator[Dict[str, Any]]:
+    """NDJSON-чанки ответа: ``timeout`` — на соединение и первый чанк, дальше ``stall_s``."""
+    with urllib.request.urlopen(req, timeout=timeout) as resp:
+        first = True
+        for line in resp:
+            if not line.strip():
+                continue
+            if first and stall_s:
+                # Первый токен пришёл: дальше сокет ждёт не дольше паузы стража
+                sock = getattr(getattr(resp.fp, "raw", None), "_sock", None)
+                if sock is not None:
+                    sock.settimeout(stall_s)
+            first = False
+            yield json.loads(line)
+
+
+def _replayed_chunks(cassette: Cassette, entry: Dict[str, Any]) -> Iterator[Dict[str, Any]]:
+    for piece in cassette.replay_sync(entry):
+        yield {"message": {"role": "assistant", "content": piece}, "done": False}
+    yield {**entry.get("final", {}), "done": True}
+
+
+def chat_stream(
+    payload: Dict[str, Any],
+    guard: Optional[OutputGuard] = None,
+    root_url: Optional[str] = None,
+    timeout: float = 600.0,
+    cassette: Optional[Cassette] = None,
+) -> Dict[str, Any]:
+    """Стриминговый ``/api/chat`` под стражем вывода; возвращает тело как у ``chat``.
+
+    ``timeout`` ограничивает соединение и ожидание первого чанка (загрузка
+    модели, prefill); после первого чанка пауза ограничена ``guard.stall_s``.
+    Если страж сработал (или сокет молчит дольше ``stall_s``),
+    соединение закрывается — Ollama прекращает генерацию, — в теле появляется
+    ``aborted`` с причиной, а ``eval_count``/``eval_duration`` оцениваются по
+    полученной части.
+
+    ``cassette`` (по умолчанию — из ``LLM_CASSETTE``) записывает стрим или
+    отдаёт записанный вместо запроса к Ollama (``lib/cassette.py``).
+    """
+    if cassette is None:
+        cassette = get_cassette()
+    key = request_key(
+        payload.get("model", ""),
+        payload.get("messages", []),
+        **{k: v for k, v in payload.items() if k not in ("model", "messages", "stream", "keep_alive")},
+    )
+    recording = None
+    if cassette is not None and cassette.replaying:
+        chunks = _replayed_chunks(cassette, cassette.play(key))
+    else:
+        data = json.dumps({**payload, "stream": True}).encode("utf-8")
+        req = urllib.request.Request(
+            f"{root_url or ollama_root_url()}/api/chat", data=data, headers={"Content-Type": "application/json"}
+        )
+        if cassette is not None:
+            recording = cassette.record(key)
+        chunks = _stream_chunks(req, timeout, guard.stall_s if guard is not None else None)
+
+    parts: List[str] = []
+    final: Dict[str, Any] = {}
+    aborted: Optional[str] = None
+    first_at: Optional[float] = None
+    try:
+        for chunk in chunks:
+            if chunk.get("done"):
+                final = chunk
+                break
+            piece = chunk.get("message", {}).get("content", "")
+            if first_at is None:
+                first_at = time.perf_counter()
+            if recording is not None:
+                recording.chunk(piece)
+            if guard is not None and guard.feed(piece):
+                aborted = guard.reason
+                break
+            parts.append(piece)
+    except TimeoutError:
+        if first_at is None:
+            raise
+        aborted = REASON_STALL
+    finally:
+        # Закрытие генератора закрывает соединение: Ollama прекращает генерацию
+        chunks.close()
+    if recording is not None:
+        recording.save(
+            model=payload.get("model"),
+            final={k: v for k, v in final.items() if k not in ("message", "done")},
+            complete=bool(final),
+        )
+
+    body = dict(final)
+    body["message"] = {"role": "assistant", "content": "".join(parts)}
+    if aborted is not None:
+        body["aborted"] = aborted
+        body["eval_count"] = guard.tokens if guard is not None else len(body["message"]["content"]) // 4
+        body["eval_duration"] = int((time.perf_counter() - (first_at or time.perf_counter())) * 1e9)
+    return body
+
+
+def preload(
+    model: str,
+    keep_alive: str = "30m",
+    options: Optional[Dict[str, Any]] = None,
+    root_url: Optional[str] = None,
+    timeout: float = 900.0,
+) -> float:
+    """Загружает модель в память (``/api/generate`` без prompt); возвращает время загрузки, с.
+
+    ``options`` должны совпадать с опциями запросов (``num_ctx``), иначе
+    Ollama перезагрузит модель на первом же запросе.
+    """
+    payload: Dict[str, Any] = {"model": model, "keep_alive": keep_alive}
+    if options:
+        payload["options"] = options
+    body = _post(f"{root_url or ollama_root_url()}/api/generate", payload, timeout)
+    return body.get("load_duration", 0) / 1e9
+
+
+def resident_models(root_url: Optional[str] = None, timeout: float = 10.0) -> Dict[str, int]:
+    """Загруженные сейчас модели и их размер в памяти (``/api/ps``); ``{}``, если Ollama не ответила."""
+    try:
+        body = _get(f"{root_url or ollama_root_url()}/api/ps", timeout)
+    except (OSError, ValueError):
+        return {}
+    return {m["name"]: m.get("size", 0) for m in body.get("models", [])}
+
+
+def installed_sizes(root_url: Optional[str] = None, timeout: float = 10.0) -> Dict[str, int]:
+    """Размеры скачанных моделей (``/api/tags``); ``{}``, если Ollama не ответила."""
+    try:
+        body = _get(f"{root_url or ollama_root_url()}/api/tags", timeout)
+    except (OSError, ValueError):
+        return {}
+    return {m["name"]: m.get("size", 0) for m in body.get("models", [])}
+
+
+class ResidencyScheduler:
+    """Прогон задач по нескольким моделям с учётом того, какая модель в памяти.
+
+    Задачи — пары ``(model, item)``, ``execute(model, item)`` возвращает dict
+    (если в нём есть ``load_s`` — модель пришлось загрузить внутри задачи).
+    Работа группируется по модели (первой идёт уже загруженная), модель
+    загружается до своих задач, а следующая подгружается в фоне, если
+    загруженные модели плюс следующая помещаются в ``memory_budget_bytes``
+    (0 — без подгрузки; Ollama должна держать несколько моделей,
+    ``OLLAMA_MAX_LOADED_MODELS``).
+
+    Отчёт сравнивает фактическое время с наивным порядком — задачи в порядке
+    подачи, в памяти одна модель, каждая смена модели стоит её загрузки.
+    """
+
+    def __init__(
+        self,
+        memory_budget_bytes: int = 0,
+        keep_alive: str = "30m",
+        options: Optional[Dict[str, Any]] = None,
+        root_url: Optional[str] = None,
+    ):
+        self.memory_budget_bytes = memory_budget_bytes
+        self.keep_alive = keep_alive
+        self.options = options
+        self.root_url = root_url
+        self._sizes: Dict[str, int] = {}
+
+    def plan(self, jobs: List[Tuple[str, Any]]) -> List[Tuple[str, List[Any]]]:
+        """Группы ``(model, items)`` в порядке первого появления; загруженная модель — первой."""
+        groups: Dict[str, List[Any]] = {}
+        for model, item in jobs:
+            groups.setdefault(model, []).append(item)
+        resident = resident_models(self.root_url)
+        return sorted(groups.items(), key=lambda group: group[0] not in resident)
+
+    def _load(self, model: str) -> float:
+        try:
+            return preload(model, self.keep_alive, self.options, self.root_url)
+        except (OSError, ValueError) as exc:
+            # Модель загрузится на первой задаче — время попадёт в её load_s
+            logger.warning("preload %s failed: %s", model, exc)
+            return 0.0
+
+    def _can_prefetch(self, model: str) -> bool:
+        if self.memory_budget_bytes <= 0:
+            return False
+        resident = resident_models(self.root_url)
+        self._sizes.update(resident)
+        if model not in self._sizes:
+            self._sizes.update(installed_sizes(self.root_url))
+        # Размер неизвестен (не скачана/нет /api/tags) — считаем как самую большую загруженную
+        needed = self._sizes.get(model) or max(resident.values(), default=0)
+        return sum(resident.values()) + needed <= self.memory_budget_bytes
+
+    def _prefetch(self, model: str) -> Tuple[threading.Thread, Dict[str, float]]:
+        box: Dict[str, float] = {}
+
+        def run() -> None:
+            box["load_s"] = self._load(model)
+
+        thread = threading.Thread(target=run, name=f"prefetch-{model}", daemon=True)
+        thread.start()
+        return thread, box
+
+    def run(
+        self,
+        jobs: Iterable[Tuple[str, Any]],
+        execute: Callable[[str, Any], Dict[str, Any]],
+    ) -> Dict[str, Any]:
+        """Выполняет задачи; возвращает отчёт по моделям и сэкономленное время."""
+        jobs = list(jobs)
+        started = time.perf_counter()
+        groups = self.plan(jobs)
+        models: Dict[str, Dict[str, Any]] = {}
+        prefetched: Optional[Tuple[str, threading.Thread, Dict[str, float]]] = None
+
+        for idx, (model, items) in enumerate(groups):
+            stats = models[model] = {
+                "jobs": len(items), "load_s": 0.0, "load_wait_s": 0.0,
+                "inference_s": 0.0, "prefetched": False,
+            }
+            t0 = time.perf_counter()
+            if prefetched is not None and prefetched[0] == model:
+                prefetched[1].join()
+                stats["prefetched"] = True
+                stats["load_s"] = prefetched[2].get("load_s", 0.0)
+            else:
+                stats["load_s"] = self._load(model)
+            stats["load_wait_s"] = time.perf_counter() - t0
+            prefetched = None
+
+            if idx + 1 < len(groups) and self._can_prefetch(groups[idx + 1][0]):
+                nxt = groups[idx + 1][0]
+                prefetched = (nxt, *self._prefetch(nxt))
+                logger.info("prefetching %s while %s runs", nxt, model)
+
+            for item in items:
+                t0 = time.perf_counter()
+                result = execute(model, item)
+                elapsed = time.perf_counter() - t0
+                job_load = result.get("load_s", 0.0)
+                stats["load_s"] += job_load
+                stats["inference_s"] += elapsed - job_load
+
+        wall_s = time.perf_counter() - started
+        naive_s = sum(s["inference_s"] for s in models.values())
+        current = None
+        for model, _ in jobs:
+            if model != current:
+                naive_s += models[model]["load_s"]
+                current = model
+        for stats in models.values():
+            for key in ("load_s", "load_wait_s", "inference_s"):
+                stats[key] = round(stats[key], 2)
+        return {
+            "order": [model for model, _ in groups],
+            "models": models,
+            "wall_s": round(wall_s, 2),
+            "load_s": round(sum(s["load_s"] for s in models.values()), 2),
+            "naive_s": round(naive_s, 2),
+            "saved_s": round(naive_s - wall_s, 2),
+        }
@@ -1,103 +1,855 @@
 """OpenRouter API клиент для God Agent."""
 
+import asyncio
+import heapq
+import itertools
 import os
-from typing import List, Dict, Any, Optional
+import random
+import time
+from collections.abc import Sequence
+from typing import List, Dict, Any, Optional, Union
 
+import openai
+from langchain_core.messages import AIMessage, BaseMessage, HumanMessage, SystemMessage
 from langchain_core.output_parsers import StrOutputParser
 from langchain_core.prompts import ChatPromptTemplate
 from langchain_openai import ChatOpenAI
 
+from lib.cassette import get_cassette, request_key
+from lib.ollama import ollama_root_url
+
+
+# ========================== ADMISSION CONTROL ==========================
+
+# Приоритеты очереди: меньше — раньше. Интерактивный чат обгоняет фоновые задачи (/compress).
+PRIORITY_INTERACTIVE = 0
+PRIORITY_BACKGROUND = 10
+
+
+class QueueFullError(RuntimeError):
+    """Очередь исходящих запросов к LLM переполнена."""
+
+
+class GenerationCancelled(Exception):
+    """Генерация остановлена по ``cancel_event`` (стоп или новое сообщение пользователя)."""
+
+
+def is_rate_limit_error(exc: Optional[BaseException]) -> bool:
+    """True, если исключение — ответ провайдера 429 (openai.RateLimitError и аналоги)."""
+    if exc is None:
+        return False
+    if getattr(exc, "status_code", None) == 429:
+        return True
+    response = getattr(exc, "response", None)
+    return getattr(response, "status_code", None) == 429
+
+
+class _ModelLimit:
+    """Состояние AIMD-лимита одной модели."""
+
+    def __init__(self, initial: float):
+        self.limit = initial
+        self.in_flight = 0
+        self.waiters: List = []  # heap: (priority, seq, future)
+        self.throttled = 0
+        self.completed = 0
+        # Сглаженная латентность успешных запросов (окно для 429) и время последнего уменьшения
+        self.rtt_s: Optional[float] = None
+        self.last_decrease = float("-inf")
+
+
+class AdmissionController:
+    """Процесс-широкий контроль допуска исходящих запросов к LLM.
+
+    Для каждой модели держит лимит одновременных запросов, который адаптируется
+    по AIMD: успех медленно поднимает лимит (+1/limit), ответ 429 режет его
+    в ``decrease_factor`` раз, медленный ответ (латентность выше
+    ``latency_target_s``) — мягко на 10%. Всплеск 429 от одной перегрузки
+    режет лимит один раз: 429 в пределах окна (сглаженная латентность модели,
+    не больше ``latency_target_s``) после уменьшения не учитываются. Запросы сверх лимита ждут в общей
+    ограниченной очереди с приоритетами; при переполнении — ``QueueFullError``.
+    """
+
+    def __init__(
+        self,
+        initial_limit: int = 4,
+        min_limit: int = 1,
+        max_limit: int = 32,
+        max_queue: int = 100,
+        latency_target_s: float = 20.0,
+        decrease_factor: float = 0.5,
+    ):
+        self.initial_limit = initial_limit
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.max_queue = max_queue
+        self.latency_target_s = latency_target_s
+        self.decrease_factor = decrease_factor
+
+        self._models: Dict[str, _ModelLimit] = {}
+        self._seq = itertools.count()
+        self._queued = 0
+
+        self.admitted = 0
+        self.rejected = 0
+        self.wait_count = 0
+        self.wait_total_s = 0.0
+        self.wait_max_s = 0.0
+
+    def _state(self, model: str) -> _ModelLimit:
+        state = self._models.get(model)
+        if state is None:
+            state = _ModelLimit(float(self.initial_limit))
+            self._models[model] = state
+        return state
+
+    async def acquire(self, model: str, priority: int = PRIORITY_INTERACTIVE) -> float:
+        """Ждёт свободный слот для ``model``. Возвращает время ожидания в секундах."""
+        state = self._state(model)
+        started = time.monotonic()
+
+        if not state.waiters and state.in_flight < int(state.limit):
+            state.in_flight += 1
+            self._record_wait(0.0)
+            return 0.0
+
+        if self._queued >= self.max_queue:
+            self.rejected += 1
+            raise QueueFullError(f"Очередь запросов к LLM переполнена ({self.max_queue})")
+
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(state.waiters, (priority, next(self._seq), future))
+        self._queued += 1
+        # Хвост кучи мог состоять из отменённых ожидающих — разбираем сразу.
+        self._dispatch(state)
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                # Слот уже выдан, но ожидающий ушёл — возвращаем без сигнала латентности.
+                self.release(model)
+            raise
+        finally:
+            self._queued -= 1
+
+        waited = time.monotonic() - started
+        self._record_wait(waited)
+        return waited
+
+    def release(
+        self,
+        model: str,
+        latency_s: Optional[float] = None,
+        rate_limited: bool = False,
+    ) -> None:
+        """Освобождает слот и корректирует лимит по исходу запроса.
+
+        ``latency_s`` успешного запроса — сигнал AIMD, у 429 — длина окна,
+        пока модель ещё не отвечала успешно.
+        """
+        state = self._state(model)
+        state.in_flight = max(0, state.in_flight - 1)
+
+        if rate_limited:
+            state.throttled += 1
+            now = time.monotonic()
+            # Без замеров успешных запросов окно — время ответа самого 429
+            window = state.rtt_s if state.rtt_s is not None else (latency_s or 0.0)
+            window = min(window, self.latency_target_s)
+            if now - state.last_decrease >= window:
+                state.limit = max(float(self.min_limit), state.limit * self.decrease_factor)
+                state.last_decrease = now
+        elif latency_s is not None:
+            state.completed += 1
+            state.rtt_s = latency_s if state.rtt_s is None else 0.8 * state.rtt_s + 0.2 * latency_s
+            if latency_s > self.latency_target_s:
+                state.limit = max(float(self.min_limit), state.limit * 0.9)
+            else:
+                state.limit = min(float(self.max_limit), state.limit + 1.0 / state.limit)
+
+        self._dispatch(state)
+
+    def _dispatch(self, state: _ModelLimit) -> None:
+        while state.waiters and state.in_flight < max(1, int(state.limit)):
+            _, _, future = heapq.heappop(state.waiters)
+            if future.done():
+                continue
+            state.in_flight += 1
+            future.set_result(None)
+
+    def _record_wait(self, waited: float) -> None:
+        self.admitted += 1
+        self.wait_count += 1
+        self.wait_total_s += waited
+        self.wait_max_s = max(self.wait_max_s, waited)
+
+    def slot(self, model: str, priority: int = PRIORITY_INTERACTIVE) -> "_AdmissionSlot":
+        """Async context manager: ``async with controller.slot(model) as slot: ...``."""
+        return _AdmissionSlot(self, model, priority)
+
+    def snapshot(self) -> Dict[str, Any]:
+        """Метрики очереди и лимитов для дашбордов и тестов."""
+        avg_ms = (self.wait_total_s / self.wait_count * 1000) if self.wait_count else 0.0
+        return {
+            "queued": self._queued,
+            "admitted": self.admitted,
+            "rejected": self.rejected,
+            "wait_avg_ms": round(avg_ms, 1),
+            "wait_max_ms": round(self.wait_max_s * 1000, 1),
+            "models": {
+                model: {
+                    "limit": round(state.limit, 2),
+                    "in_flight": state.in_flight,
+                    "queued": len(state.waiters),
+                    "throttled": state.throttled,
+                    "completed": state.completed,
+                }
+                for model, state in self._models.items()
+            },
+        }
+
+
+class _AdmissionSlot:
+    """Слот контроллера: держится на всё время запроса, в конце сообщает исход."""
+
+    def __init__(self, controller: AdmissionController, model: str, priority: int):
+        self.controller = controller
+        self.model = model
+        self.priority = priority
+        self.wait_s = 0.0
+        self.first_token_s: Optional[float] = None
+        self._started = 0.0
+
+    async def __aenter__(self) -> "_AdmissionSlot":
+        self.wait_s = await self.controller.acquire(self.model, self.priority)
+        self._started = time.monotonic()
+        return self
+
+    def mark_first_token(self) -> None:
+        """Фиксирует TTFT — для стрима это и есть сигнал латентности для AIMD."""
+        if self.first_token_s is None:
+            self.first_token_s = time.monotonic() - self._started
+
+    async def __aexit__(self, exc_type, exc, tb) -> bool:
+        if exc_type is not None and not issubclass(exc_type, Exception):
+            # Отмена/выход генератора — не сигнал о перегрузке провайдера.
+            self.controller.release(self.model)
+            return False
+
+        latency = self.first_token_s
+        if latency is None:
+            latency = time.monotonic() - self._started
+        rate_limited = is_rate_limit_error(exc)
+        self.controller.release(
+            self.model,
+            # У 429 латентность — не сигнал AIMD, а окно, в котором повторные 429 не режут лимит
+            latency_s=None if exc_type is not None and not rate_limited else latency,
+            rate_limited=rate_limited,
+        )
+        return False
+
+
+_admission_controller: Optional[AdmissionController] = None
+
+
+def get_admission_controller() -> AdmissionController:
+    """Общий на процесс контроллер (лениво, параметры из env)."""
+    global _admission_controller
+    if _admission_controller is None:
+        _admission_controller = AdmissionController(
+            initial_limit=int(os.getenv("LLM_MAX_CONCURRENCY", "4")),
+            max_limit=int(os.getenv("LLM_MAX_CONCURRENCY_CAP", "32")),
+            max_queue=int(os.getenv("LLM_MAX_QUEUE", "100")),
+            latency_target_s=float(os.getenv("LLM_LATENCY_TARGET_S", "20")),
+        )
+    return _admission_controller
+
+
+# ========================== RETRY / FALLBACK ==========================
+
+# Сбои сети и таймауты без HTTP-статуса (APITimeoutError — подкласс APIConnectionError)
+_TRANSIENT_ERRORS = (asyncio.TimeoutError, ConnectionError, openai.APIConnectionError)
+
+
+def _status_code(exc: BaseException) -> Optional[int]:
+    status = getattr(exc, "status_code", None)
+    if status is None:
+        status = getattr(getattr(exc, "response", None), "status_code", None)
+    return status
+
+
+def is_provider_error(exc: BaseException) -> bool:
+    """Ответ провайдера с HTTP-статусом или сбой соединения, а не ошибка в нашем коде.
+
+    Остальное (``TypeError``, ``KeyError``...) не повторяется и не уходит по
+    цепочке fallback — пробрасывается сразу.
+    """
+    return isinstance(exc, _TRANSIENT_ERRORS) or _status_code(exc) is not None
+
+
+def is_retryable_error(exc: BaseException) -> bool:
+    """Имеет ли смысл повторить запрос: 408/409/429/5xx, таймауты и сетевые ошибки.
+
+    4xx вроде 400/401/404 повторять бессмысленно — такая ошибка сразу
+    переводит запрос на следующую модель в цепочке fallback.
+    """
+    if isinstance(exc, _TRANSIENT_ERRORS):
+        return True
+    status = _status_code(exc)
+    return status is not None and (status in (408, 409, 429) or status >= 500)
+
+
+def backoff_delay(attempt: int, base_s: float, cap_s: float) -> float:
+    """Full jitter: случайная пауза в [0, min(cap, base * 2^attempt)]."""
+    return random.uniform(0, min(cap_s, base_s * (2 ** attempt)))
+
+
+def _make_llm(model: str, api_key: str, base_url: str) -> ChatOpenAI:
+    return ChatOpenAI(
+        model=model,
+        api_key=api_key,
+        base_url=base_url,
+        temperature=0.3,
+        streaming=True,
+        # Повторы делает сам клиент (до первого токена) — ретраи SDK
+        # прятали бы 429 от AdmissionController и удлиняли хвост латентности.
+        max_retries=int(os.getenv("OPENROUTER_SDK_MAX_RETRIES", "0")),
+    )
+
+
+class ModelRoute:
+    """Звено цепочки fallback: имя модели + её LLM-клиент."""
+
+    def __init__(self, model: str, llm: ChatOpenAI, local: bool = False):
+        self.model = model
+        self.llm = llm
+        self.local = local
+
+
+def parse_fallback_models(spec: str, api_key: str, base_url: str) -> List[ModelRoute]:
+    """Разбирает ``OPENROUTER_FALLBACK_MODELS``: ``"openai/gpt-4o-mini,ollama:gemma4:e4b"``.
+
+    Префикс ``ollama:`` — локальная модель через OpenAI-совместимый
+    endpoint Ollama (``OLLAMA_BASE_URL``, по умолчанию ``http://localhost:11434/v1``).
+    """
+    routes = []
+    ollama_url = os.getenv("OLLAMA_BASE_URL", "http://localhost:11434/v1")
+    for item in spec.split(","):
+        name = item.strip()
+        if not name:
+            continue
+        if name.startswith("ollama:"):
+            model = name[len("ollama:"):]
+            routes.append(ModelRoute(model, _make_llm(model, "ollama", ollama_url), local=True))
+        else:
+            routes.append(ModelRoute(name, _make_llm(name, api_key, base_url)))
+    return routes
+
+
+async def preload_ollama_model(model: str, keep_alive: str = "30m", base_url: Optional[str] = None) -> None:
+    """Просит Ollama загрузить модель в память заранее (``/api/generate`` без prompt)."""
+    import httpx
+
+    async with httpx.AsyncClient(timeout=300.0) as http:
+        response = await http.post(
+            f"{ollama_root_url(base_url)}/api/generate",
+            json={"model": model, "keep_alive": keep_alive},
+        )
+        response.raise_for_status()
+
+
+def to_langchain_message(msg: Dict[str, str]) -> BaseMessage:
+    """Конвертирует одно dict-сообщение в объект LangChain."""
+    role = msg.get("role", "user")
+    content = msg.get("content", "")
+    if role == "system":
+        return SystemMessage(content=content)
+    if role == "assistant":
+        return AIMessage(content=content)
+    return HumanMessage(content=content)
+
+
+def to_langchain_messages(messages: Union[List[Dict[str, str]], "MessageSequence"]) -> List[BaseMessage]:
+    """Конвертирует dict-сообщения в объекты LangChain.
+
+    ``MessageSequence`` отдаёт уже сконвертированные объекты без повторной конвертации.
+    """
+    if isinstance(messages, MessageSequence):
+        return messages.langchain()
+    return [to_langchain_message(msg) for msg in messages]
+
+
+# ========================== CLIENT ==========================
 
 class OpenRouterClient:
-    """Клиент для работы с OpenRouter API."""
+    """Клиент для работы с OpenRouter API.
 
-    def __init__(self):
-        self.api_key = os.getenv("OPENROUTER_API_KEY")
+    Устойчивость к сбоям провайдера (все параметры — из env):
+
+    - ``OPENROUTER_MAX_RETRIES`` — повторы на одну модель при ошибке до первого
+      токена, с full-jitter backoff (``OPENROUTER_RETRY_BASE_S``, ``OPENROUTER_RETRY_MAX_S``);
+    - ``OPENROUTER_TTFT_TIMEOUT_S`` — сколько ждать первый токен, прежде чем
+      считать попытку неудачной;
+    - ``OPENROUTER_HEDGE_AFTER_S`` — если первый токен не пришёл за это время,
+      параллельно стартует запрос к следующей модели цепочки; проигравший отменяется;
+    - ``OPENROUTER_FALLBACK_MODELS`` — упорядоченный список запасных моделей.
+
+    После первого токена стрим не перезапускается: ошибка уходит вызывающему.
+
+    ``cassette`` (``LLM_CASSETTE``, ``lib/cassette.py``) записывает стримы с
+    таймингами чанков или воспроизводит их без запроса к провайдеру.
+
+    ``model``/``base_url``/``api_key`` переопределяют env — так строится клиент
+    к локальной Ollama (``fallbacks`` тогда задаёт вызывающий, env не читается).
+    """
+
+    def __init__(
+        self,
+        limiter: Optional[AdmissionController] = None,
+        model: Optional[str] = None,
+        base_url: Optional[str] = None,
+        api_key: Optional[str] = None,
+    ):
+        self.api_key = api_key or os.getenv("OPENROUTER_API_KEY")
         if not self.api_key:
             raise RuntimeError("OPENROUTER_API_KEY не установлен")
 
-        self.model = os.getenv("OPENROUTER_MODEL", "anthropic/claude-3.5-sonnet")
-        self.base_url = os.getenv("OPENROUTER_BASE_URL", "https://openrouter.ai/api/v1")
+        self.model = model or os.getenv("OPENROUTER_MODEL", "anthropic/claude-3.5-sonnet")
+        self.base_url = base_url or os.getenv("OPENROUTER_BASE_URL", "https://openrouter.ai/api/v1")
+
+        self.llm = _make_llm(self.model, self.api_key, self.base_url)
+        self.limiter = limiter or get_admission_controller()
 
-        self.llm = ChatOpenAI(
-            model=self.model,
-            api_key=self.api_key,
-            base_url=self.base_url,
-            temperature=0.3,
-            streaming=True,
+        custom = model is not None or base_url is not None
+        self.fallbacks = [] if custom else parse_fallback_models(
+            os.getenv("OPENROUTER_FALLBACK_MODELS", ""), self.api_key, self.base_url
         )
+        self.max_retries = int(os.getenv("OPENROUTER_MAX_RETRIES", "2"))
+        self.retry_base_s = float(os.getenv("OPENROUTER_RETRY_BASE_S", "0.5"))
+        self.retry_max_s = float(os.getenv("OPENROUTER_RETRY_MAX_S", "8"))
+        self.ttft_timeout_s = float(os.getenv("OPENROUTER_TTFT_TIMEOUT_S", "30"))
+        self.hedge_after_s = float(os.getenv("OPENROUTER_HEDGE_AFTER_S", "0"))
+
+        # Основная модель — локальная Ollama (клиент из make_local_client).
+        self.local = False
+
+        # Модель, ответившая последней (после fallback/hedge может отличаться от self.model),
+        # и локальная ли она — по ней метрики маршрутов считают, кто ответил на самом деле.
+        self.last_model = self.model
+        self.last_local = False
+        self.stats = {"retries": 0, "fallbacks": 0, "hedges": 0, "hedge_wins": 0}
+        self.cassette = get_cassette()
+
+    def _routes(self) -> List[ModelRoute]:
+        # Основной маршрут собирается на лету: self.llm могут подменить (тесты, прогрев).
+        return [ModelRoute(self.model, self.llm, local=self.local)] + self.fallbacks
+
+    async def warmup(self, preload: bool = True, keep_alive: Optional[str] = None) -> Dict[str, Any]:
+        """Прогрев до первого сообщения: соединения с провайдерами и загрузка локальной модели.
+
+        Для облачных маршрутов — лёгкий GET через тот же HTTP-пул, что у
+        ChatOpenAI (DNS + TCP + TLS оплачиваются заранее; любой HTTP-ответ,
+        даже 404, значит соединение открыто). Если основная модель локальная
+        и ``preload=True``, Ollama загружает её в память с ``keep_alive``
+        (``OLLAMA_KEEP_ALIVE``); запасные локальные модели не грузятся.
+        Ошибки не пробрасываются: прогрев — оптимизация, а не условие работы.
+        """
+        import httpx
+        import openai
+
+        keep_alive = keep_alive or os.getenv("OLLAMA_KEEP_ALIVE", "30m")
+        started = time.perf_counter()
+        timings: Dict[str, float] = {}
+        failed: List[str] = []
+        seen = set()
+        for idx, route in enumerate(self._routes()):
+            t0 = time.perf_counter()
+            try:
+                if route.local:
+                    if idx > 0 or not preload:
+                        continue
+                    await preload_ollama_model(route.model, keep_alive)
+                else:
+                    root = getattr(route.llm, "root_async_client", None)
+                    if root is None or str(root.base_url) in seen:
+                        continue
+                    seen.add(str(root.base_url))
+                    try:
+                        response = await root.with_options(max_retries=0, timeout=10.0).get(
+                            f"/models/{route.model}", cast_to=httpx.Response
+                        )
+                        await response.aclose()
+                    except openai.APIStatusError:
+                        pass
+            except Exception:
+                failed.append(route.model)
+                continue
+            timings[route.model] = round((time.perf_counter() - t0) * 1000, 1)
+        return {
+            "warmup_ms": round((time.perf_counter() - started) * 1000, 1),
+            "routes": timings,
+            "failed": failed,
+        }
+
+    def _attempts(self, routes: List[ModelRoute]):
+        """План попыток: каждая модель цепочки по (1 + max_retries) раз, по порядку."""
+        for route in routes:
+            for attempt in range(self.max_retries + 1):
+                yield route, attempt
 
     async def chat_completion(
         self,
         messages: List[Dict[str, str]],
-        temperature: float = 0.3
+        temperature: float = 0.3,
+        priority: int = PRIORITY_INTERACTIVE
     ) -> Dict[str, Any]:
-        """Отправляет запрос и возвращает полный ответ."""
-        from langchain_core.messages import HumanMessage, SystemMessage, AIMessage
-
-        lc_messages = []
-        for msg in messages:
-            role = msg.get("role", "user")
-            content = msg.get("content", "")
-            if role == "system":
-                lc_messages.append(SystemMessage(content=content))
-            elif role == "assistant":
-                lc_messages.append(AIMessage(content=content))
-            else:
-                lc_messages.append(HumanMessage(content=content))
+        """Отправляет запрос и возвращает полный ответ (с повторами и fallback)."""
+        lc_messages = to_langchain_messages(messages)
 
-        response = await self.llm.bind(temperature=temperature).ainvoke(lc_messages)
+        last_error: Optional[BaseException] = None
+        previous: Optional[ModelRoute] = None
+        for route, attempt in self._attempts(self._routes()):
+            if last_error is not None and not is_retryable_error(last_error) \
+                    and previous is route:
+                continue
+            await self._before_attempt(route, attempt, previous)
+            previous = route
+            try:
+                async with self.limiter.slot(route.model, priority):
+                    response = await route.llm.bind(temperature=temperature).ainvoke(lc_messages)
+            except Exception as e:
+                if not is_provider_error(e):
+                    raise
+                last_error = e
+                continue
+            self.last_model = route.model
+            self.last_local = route.local
+            return {
+                "choices": [{"message": {"content": response.content}}],
+                "usage": getattr(response, "usage_metadata", {})
+            }
 
-        return {
-            "choices": [{"message": {"content": response.content}}],
-            "usage": getattr(response, "usage_metadata", {})
-        }
+        raise last_error
 
     async def get_completion_text(
         self,
         messages: List[Dict[str, str]],
-        temperature: float = 0.3
+        temperature: float = 0.3,
+        priority: int = PRIORITY_INTERACTIVE
     ) -> str:
         """Возвращает только текст ответа."""
-        result = await self.chat_completion(messages, temperature)
+        result = await self.chat_completion(messages, temperature, priority)
         return result["choices"][0]["message"]["content"]
 
     async def stream_completion(
         self,
         messages: List[Dict[str, str]],
-        temperature: float = 0.3
+        temperature: float = 0.3,
+        priority: int = PRIORITY_INTERACTIVE,
+        cancel_event: Optional[asyncio.Event] = None
     ):
-        """Генератор для streaming ответов."""
-        from langchain_core.messages import HumanMessage, SystemMessage, AIMessage
-
-        lc_messages = []
-        for msg in messages:
-            role = msg.get("role", "user")
-            content = msg.get("content", "")
-            if role == "system":
-                lc_messages.append(SystemMessage(content=content))
-            elif role == "assistant":
-                lc_messages.append(AIMessage(content=content))
-            else:
-                lc_messages.append(HumanMessage(content=content))
+        """Генератор для streaming ответов.
+
+        Если выставлен ``cancel_event``, стрим провайдера закрывается сразу
+        (до первого токена — не дожидаясь его, дальше — на ближайшем чанке)
+        и поднимается ``GenerationCancelled``.
+        """
+        recording = None
+        if self.cassette is not None:
+            key = request_key(self.model, messages, temperature=temperature)
+            if self.cassette.replaying:
+                # Файл кассеты читается и дописывается в потоке, не в event loop
+                entry = await asyncio.to_thread(self.cassette.play, key)
+                self.last_model = entry.get("model") or self.model
+                self.last_local = self.local and self.last_model == self.model
+                async for chunk in self.cassette.replay(entry):
+                    if cancel_event is not None and cancel_event.is_set():
+                        raise GenerationCancelled()
+                    yield chunk
+                return
+            recording = self.cassette.record(key)
+
+        lc_messages = to_langchain_messages(messages)
+
+        route, first, stream = await self._open_stream(
+            lc_messages, temperature, priority, cancel_event
+        )
+        self.last_model = route.model
+        self.last_local = route.local
+        complete = False
+        try:
+            if first is not None:
+                if recording is not None:
+                    recording.chunk(first)
+                yield first
+                async for chunk in stream:
+                    if cancel_event is not None and cancel_event.is_set():
+                        raise GenerationCancelled()
+                    if recording is not None:
+                        recording.chunk(chunk)
+                    yield chunk
+            complete = True
+        finally:
+            await stream.aclose()
+            if recording is not None:
+                await asyncio.to_thread(recording.save, model=route.model, complete=complete)
+
+    async def _before_attempt(
+        self, route: ModelRoute, attempt: int, previous: Optional[ModelRoute]
+    ) -> None:
+        if attempt > 0:
+            self.stats["retries"] += 1
+            await asyncio.sleep(backoff_delay(attempt - 1, self.retry_base_s, self.retry_max_s))
+        elif previous is not None:
+            self.stats["fallbacks"] += 1
+
+    async def _route_stream(self, route: ModelRoute, lc_messages, temperature: float, priority: int):
+        async with self.limiter.slot(route.model, priority) as slot:
+            async for chunk in route.llm.bind(temperature=temperature).astream(lc_messages):
+                if hasattr(chunk, "content") and chunk.content:
+                    slot.mark_first_token()
+                    yield chunk.content
+
+    async def _open_stream(
+        self,
+        lc_messages,
+        temperature: float,
+        priority: int,
+        cancel_event: Optional[asyncio.Event] = None,
+    ):
+        """Доводит стрим до первого токена: повторы, TTFT-таймаут, hedge, fallback.
+
+        Возвращает ``(route, first_chunk, stream)``; ``first_chunk is None`` —
+        модель ответила пустым стримом. Все проигравшие попытки закрыты.
+        """
+        routes = self._routes()
+        plan = self._attempts(routes)
+        pending: Dict[asyncio.Task, Any] = {}
+        last_error: Optional[BaseException] = None
+        previous: Optional[ModelRoute] = None
+        hedged = False
+        cancel_waiter = (
+            asyncio.ensure_future(cancel_event.wait()) if cancel_event is not None else None
+        )
+
+        def start(route: ModelRoute) -> None:
+            stream = self._route_stream(route, lc_messages, temperature, priority)
+            task = asyncio.ensure_future(stream.__anext__())
+            pending[task] = (route, stream, time.monotonic())
+
+        async def launch() -> bool:
+            nonlocal previous
+            for route, attempt in plan:
+                if attempt > 0 and last_error is not None and not is_retryable_error(last_error):
+                    continue
+                await self._before_attempt(route, attempt, previous)
+                previous = route
+                start(route)
+                return True
+            return False
+
+        async def drop(task: asyncio.Task) -> None:
+            _, stream, _ = pending.pop(task)
+            task.cancel()
+            try:
+                await task
+            except BaseException:
+                pass
+            await stream.aclose()
+
+        try:
+            if not await launch():
+                raise RuntimeError("Нет моделей для запроса")
+
+            while pending:
+                oldest = min(started for _, _, started in pending.values())
+                deadline = oldest + self.ttft_timeout_s
+                timeout = deadline - time.monotonic()
+                can_hedge = self.hedge_after_s > 0 and not hedged and len(pending) == 1 \
+                    and len(routes) > 1
+                if can_hedge:
+                    timeout = min(timeout, oldest + self.hedge_after_s - time.monotonic())
+
+                waiting = list(pending) + ([cancel_waiter] if cancel_waiter else [])
+                done, _ = await asyncio.wait(
+                    waiting, timeout=max(0.0, timeout), return_when=asyncio.FIRST_COMPLETED
+                )
+
+                if cancel_waiter is not None and cancel_waiter in done:
+                    raise GenerationCancelled()
+
+                if not done:
+                    if can_hedge and time.monotonic() < deadline:
+                        hedged = True
+                        # Hedge — следующая модель цепочки вне плана: повторы текущей не тратятся
+                        (current_route, _, _), = pending.values()
+                        later = routes[routes.index(current_route) + 1:]
+                        if later:
+                            start(later[0])
+                            self.stats["hedges"] += 1
+                        continue
+                    # TTFT-таймаут: закрываем все висящие попытки и идём дальше по плану.
+                    for task in list(pending):
+                        await drop(task)
+                    last_error = asyncio.TimeoutError(
+                        f"Нет первого токена за {self.ttft_timeout_s}s"
+                    )
+                    if not await launch():
+                        raise last_error
+                    continue
+
+                for task in done:
+                    if task not in pending:
+                        continue
+                    route, stream, _ = pending.pop(task)
+                    exc = task.exception()
+                    if exc is None or isinstance(exc, StopAsyncIteration):
+                        for other in list(pending):
+                            await drop(other)
+                        if hedged and route is not routes[0]:
+                            self.stats["hedge_wins"] += 1
+                        return route, (None if exc else task.result()), stream
+                    await stream.aclose()
+                    if not is_provider_error(exc):
+                        raise exc
+                    last_error = exc
 
-        async for chunk in self.llm.bind(temperature=temperature).astream(lc_messages):
-            if hasattr(chunk, "content") and chunk.content:
-                yield chunk.content
+                if not pending and not await launch():
+                    raise last_error
+        except BaseException:
+            for task in list(pending):
+                await drop(task)
+            raise
+        finally:
+            if cancel_waiter is not None:
+                cancel_waiter.cancel()
+
+        raise last_error or RuntimeError("Нет моделей для запроса")
 
 
 def build_messages(
     user_input: str,
     history: List[Dict[str, str]],
-    system_prompt: str = ""
+    system_prompt: str = "",
+    memory_snippets: Optional[List[str]] = None
 ) -> List[Dict[str, str]]:
-    """Собирает список сообщений для API."""
+    """Собирает список сообщений для API.
+
+    ``memory_snippets`` — куски из долгосрочной памяти (уже отобранные
+    под бюджет токенов); идут отдельным system-сообщением перед историей.
+    """
+    messages = _system_messages(system_prompt, memory_snippets)
+    messages.extend(history)
+    messages.append({"role": "user", "content": user_input})
+
+    return messages
+
+
+def _system_messages(system_prompt: str, memory_snippets: Optional[List[str]]) -> List[Dict[str, str]]:
     messages = []
 
     if system_prompt:
         messages.append({"role": "system", "content": system_prompt})
 
-    messages.extend(history)
-    messages.append({"role": "user", "content": user_input})
+    if memory_snippets:
+        memory_block = "\n".join(f"- {snippet}" for snippet in memory_snippets)
+        messages.append({
+            "role": "system",
+            "content": f"## Из прошлых разговоров (может пригодиться):\n{memory_block}",
+        })
 
     return messages
+
+
+class MessageSequence(Sequence):
+    """Сообщения сессии для LLM с кэшем уже сконвертированных объектов LangChain.
+
+    Замена ``build_messages`` для длинных диалогов: история конвертируется один
+    раз при добавлении реплики, system-сообщения переиспользуются, пока их
+    текст не меняется. ``prepare`` стоит O(новых реплик), а не O(всей истории).
+
+    Как последовательность ведёт себя как список dict-сообщений (system +
+    история + вопрос) — без копирования истории. ``OpenRouterClient`` берёт
+    готовые объекты через ``langchain()``.
+
+    История считается append-only: если список подменён (``/reset``,
+    ``/compress``) или укорочен (выгрузка сессии), кэш строится заново.
+    """
+
+    # Примерный размер одного объекта сообщения LangChain (замер tracemalloc)
+    MESSAGE_BYTES_ESTIMATE = 900
+
+    def __init__(self):
+        self._system: List[Dict[str, str]] = []
+        self._system_lc: List[BaseMessage] = []
+        self._history: List[Dict[str, str]] = []
+        self._history_lc: List[BaseMessage] = []
+        self._last_source: Optional[Dict[str, str]] = None
+        self._user: Dict[str, str] = {"role": "user", "content": ""}
+        self.conversions = 0
+
+    def prepare(
+        self,
+        user_input: str,
+        history: List[Dict[str, str]],
+        system_prompt: str = "",
+        memory_snippets: Optional[List[str]] = None,
+    ) -> "MessageSequence":
+        """Обновляет последовательность под новый вопрос (аргументы как у ``build_messages``)."""
+        system = _system_messages(system_prompt, memory_snippets)
+        cached = {m.content: m for m in self._system_lc}
+        self._system_lc = [cached.get(m["content"]) or to_langchain_message(m) for m in system]
+        self._system = system
+
+        converted = len(self._history_lc)
+        if (
+            history is not self._history
+            or converted > len(history)
+            or (converted and history[converted - 1] is not self._last_source)
+        ):
+            self._history_lc = []
+            converted = 0
+        for msg in history[converted:]:
+            self._history_lc.append(to_langchain_message(msg))
+            self.conversions += 1
+        self._history = history
+        self._last_source = history[-1] if history else None
+
+        self._user = {"role": "user", "content": user_input}
+        return self
+
+    def langchain(self) -> List[BaseMessage]:
+        """Объекты LangChain для запроса (новый список, объекты истории — из кэша)."""
+        return self._system_lc + self._history_lc + [HumanMessage(content=self._user["content"])]
+
+    def clear(self) -> None:
+        """Сбрасывает кэш (например, когда история сессии выгружена на диск)."""
+        self._history = []
+        self._history_lc = []
+        self._last_source = None
+
+    @property
+    def approx_bytes(self) -> int:
+        return len(self._history_lc) * self.MESSAGE_BYTES_ESTIMATE
+
+    def __len__(self) -> int:
+        return len(self._system) + len(self._history) + 1
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return list(self)[index]
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError(index)
+        if index < len(self._system):
+            return self._system[index]
+        index -= len(self._system)
+        if index < len(self._history):
+            return self._history[index]
+        return self._user
+
+    def __iter__(self):
+        yield from self._system
+        yield from self._history
+        yield self._user
@@ -0,0 +1,162 @@
+"""Страж вывода модели: досрочная остановка зациклившейся или бесконечной генерации.
+
+Три признака вырожденного ответа:
+
+- повторы — доля повторяющихся n-грамм слов в скользящем окне последних
+  ``window`` слов (модель крутит одну строку: ratio -> 1; обычный текст и код
+  с повторяющимися строками — заметно ниже порога);
+- лимит длины — больше ``max_tokens`` токенов ответа (оценка ~4 символа на
+  токен, как в Analytics), свой для каждой команды;
+- зависание — после первого токена нет чанков дольше ``stall_s``.
+
+``OutputGuard.feed(chunk)`` вызывается на каждый чанк стрима и возвращает
+причину остановки; ``guard_stream`` оборачивает любой async-стрим, закрывает
+его и поднимает ``GenerationAborted`` с причиной.
+
+Только стандартная библиотека: используется и в чате, и в скриптах бенчмарков.
+"""
+
+import asyncio
+import os
+import re
+from collections import Counter, deque
+from typing import AsyncIterator, Deque, Optional, Tuple
+
+REASON_REPETITION = "repetition"
+REASON_MAX_TOKENS = "max_tokens"
+REASON_STALL = "stall"
+
+# Пометка в ответе и дашборде
+REASON_LABELS = {
+    REASON_REPETITION: "зацикливание",
+    REASON_MAX_TOKENS: "лимит длины",
+    REASON_STALL: "модель перестала отвечать",
+}
+
+_WORD_RE = re.compile(r"\S+")
+
+
+class GenerationAborted(Exception):
+    """Генерация остановлена стражем вывода (``reason`` — повторы, лимит или зависание)."""
+
+    def __init__(self, reason: str):
+        super().__init__(f"генерация остановлена: {reason}")
+        self.reason = reason
+
+
+class OutputGuard:
+    """Следит за стримом ответа; ``feed`` возвращает причину остановки или ``None``."""
+
+    def __init__(
+        self,
+        max_tokens: int = 4096,
+        ngram: int = 6,
+        window: int = 240,
+        repeat_ratio: float = 0.6,
+        stall_s: float = 30.0,
+    ):
+        self.max_tokens = max_tokens
+        self.ngram = ngram
+        self.window = window
+        self.repeat_ratio = repeat_ratio
+        self.stall_s = stall_s
+
+        self.chars = 0
+        self.reason: Optional[str] = None
+        self._tail = ""
+        self._words: Deque[str] = deque(maxlen=window)
+        self._grams: Deque[Tuple[str, ...]] = deque()
+        self._counts: Counter = Counter()
+        self._repeats = 0
+
+    @property
+    def tokens(self) -> int:
+        return self.chars // 4
+
+    @property
+    def repetition(self) -> float:
+        """Доля повторяющихся n-грамм в окне (0 — все разные)."""
+        return self._repeats / len(self._grams) if self._grams else 0.0
+
+    def _push_word(self, word: str) -> None:
+        self._words.append(word)
+        if len(self._words) < self.ngram:
+            return
+        gram = tuple(self._words)[-self.ngram:]
+        if self._counts[gram]:
+            self._repeats += 1
+        self._counts[gram] += 1
+        self._grams.append(gram)
+        # В окне window слов помещается window - ngram + 1 n-грамм
+        if len(self._grams) > self.window - self.ngram + 1:
+            old = self._grams.popleft()
+            self._counts[old] -= 1
+            if self._counts[old]:
+                self._repeats -= 1
+            else:
+                del self._counts[old]
+
+    def feed(self, chunk: str) -> Optional[str]:
+        """Учитывает чанк ответа; возвращает причину остановки (и запоминает её) или ``None``."""
+        if self.reason is not None:
+            return self.reason
+        self.chars += len(chunk)
+        text = self._tail + chunk
+        words = _WORD_RE.findall(text)
+        # Последнее слово без пробела после него может продолжиться в следующем чанке
+        self._tail = words.pop() if words and not text[-1:].isspace() else ""
+        for word in words:
+            self._push_word(word)
+
+        if self.max_tokens and self.tokens > self.max_tokens:
+            self.reason = REASON_MAX_TOKENS
+        elif len(self._grams) > self.window - self.ngram and self.repetition >= self.repeat_ratio:
+            self.reason = REASON_REPETITION
+        return self.reason
+
+
+def make_output_guard(max_tokens: Optional[int] = None) -> Optional[OutputGuard]:
+    """Страж с настройками из env (``OUTPUT_GUARD=0`` — выключен).
+
+    ``max_tokens`` — лимит конкретной команды, иначе ``OUTPUT_MAX_TOKENS``.
+    """
+    if os.getenv("OUTPUT_GUARD", "1") != "1":
+        return None
+    return OutputGuard(
+        max_tokens=max_tokens or int(os.getenv("OUTPUT_MAX_TOKENS", "4096")),
+        repeat_ratio=float(os.getenv("OUTPUT_REPEAT_RATIO", "0.6")),
+        stall_s=float(os.getenv("OUTPUT_STALL_S", "30")),
+    )
+
+
+async def guard_stream(stream: AsyncIterator[str], guard: OutputGuard) -> AsyncIterator[str]:
+    """Стрим под надзором: чанки проходят насквозь, вырожденный ответ — ``GenerationAborted``.
+
+    Первого чанка ждём без ограничения (за него отвечает TTFT-таймаут клиента),
+    дальше пауза между чанками ограничена ``guard.stall_s``. Исходный стрим
+    закрывается в любом случае — провайдер прекращает генерацию.
+    """
+    iterator = stream.__aiter__()
+    first = True
+    try:
+        while True:
+            try:
+                if first or not guard.stall_s:
+                    chunk = await iterator.__anext__()
+                else:
+                    chunk = await asyncio.wait_for(iterator.__anext__(), guard.stall_s)
+            except StopAsyncIteration:
+                return
+            except asyncio.TimeoutError:
+                guard.reason = REASON_STALL
+                raise GenerationAborted(REASON_STALL) from None
+            first = False
+            reason = guard.feed(chunk)
+            # Чанк, на котором сработал страж, уже не отдаём
+            if reason is not None:
+                raise GenerationAborted(reason)
+            yield chunk
+    finally:
+        aclose = getattr(iterator, "aclose", None)
+        if aclose is not None:
+            await aclose()
@@ -0,0 +1,104 @@
+"""Ход диалога без Chainlit: system prompt, стрим ответа, история и аналитика.
+
+Общая часть ``on_message`` (app.py) и пакетного режима (``lib/batch.py``):
+всё, что не зависит от ``cl.user_session`` и ``cl.Message``. Куда идут токены
+ответа (в UI или в файл) и где хранится состояние, решает вызывающий код.
+"""
+
+import asyncio
+import time
+from contextlib import aclosing
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+from lib.analytics import Analytics
+from lib.output_guard import OutputGuard, guard_stream
+from lib.profile_registry import ProfileView
+
+BASE_SYSTEM_PROMPT = """Ты — God Agent, личный AI-помощник. Твоя задача — помогать пользователю, поддерживать и мотивировать.
+
+Отвечай:
+- По-русски
+- Дружелюбно и с заботой
+- Кратко (5-7 предложений, если не нужен код)
+- С учетом контекста о пользователе
+"""
+
+
+def build_system_prompt(
+    profile: ProfileView,
+    user_text: Optional[str] = None,
+    budget_tokens: int = 400,
+) -> str:
+    """System prompt с профилем: релевантные ``user_text`` секции в пределах бюджета."""
+    prompt = BASE_SYSTEM_PROMPT
+    if profile.loaded:
+        prompt += f"""
+
+## КОНТЕКСТ О ПОЛЬЗОВАТЕЛЕ:
+{profile.render(user_text, budget_tokens)}
+
+Обращайся к пользователю по имени: {profile.name}."""
+    return prompt
+
+
+class ReplyStream:
+    """Стрим ответа модели с замером TTFT и полной латентности.
+
+    Текст копится в ``text`` и после обрыва (отмена, ошибка провайдера,
+    ``GenerationAborted`` от ``guard``) — вызывающий код сохраняет частичный
+    ответ сам.
+    """
+
+    def __init__(
+        self,
+        client: Any,
+        messages: Any,
+        cancel_event: Optional[asyncio.Event] = None,
+        guard: Optional[OutputGuard] = None,
+    ):
+        self.client = client
+        self.messages = messages
+        self.cancel_event = cancel_event
+        self.guard = guard
+        self.text = ""
+        self.ttft_s: Optional[float] = None
+        self.latency_s = 0.0
+
+    async def run(self, on_token: Optional[Callable[[str], Awaitable[Any]]] = None) -> str:
+        started = time.perf_counter()
+        try:
+            # aclosing: при отмене задачи стрим провайдера закрывается сразу,
+            # а не когда сборщик мусора доберётся до генератора.
+            stream = self.client.stream_completion(self.messages, cancel_event=self.cancel_event)
+            if self.guard is not None:
+                stream = guard_stream(stream, self.guard)
+            async with aclosing(stream) as chunks:
+                async for chunk in chunks:
+                    if self.ttft_s is None:
+                        self.ttft_s = time.perf_counter() - started
+                    self.text += chunk
+                    if on_token is not None:
+                        await on_token(chunk)
+        finally:
+            self.latency_s = time.perf_counter() - started
+        return self.text
+
+
+def record_turn(
+    user_text: str,
+    response: str,
+    history: List[Dict],
+    usage_history: List[Dict],
+    ttft_s: Optional[float] = None,
+    latency_s: Optional[float] = None,
+) -> Dict[str, Any]:
+    """Дописывает завершённый ход в историю и аналитику; возвращает запись аналитики."""
+    history.append({"role": "user", "content": user_text})
+    history.append({"role": "assistant", "content": response})
+    Analytics.record_usage(user_text, response, None, usage_history)
+    record = usage_history[-1]
+    if ttft_s is not None:
+        record["ttft_ms"] = round(ttft_s * 1000, 1)
+    if latency_s is not None:
+        record["latency_ms"] = round(latency_s * 1000, 1)
+    return record
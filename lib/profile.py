@@ -1,11 +1,18 @@
 """Работа с профилем пользователя: загрузка, парсинг, саммари."""
 
+import math
 import re
+from collections import Counter
 from pathlib import Path
-from typing import List, Optional
+from typing import Iterable, List, Optional
+
+from lib.history import estimate_tokens
 
 DEFAULT_USER_NAME = "Пользователь"
 
+# Секции, которые уходят в промпт всегда (плюс секция со строкой имени).
+DEFAULT_ALWAYS_SECTIONS = ("Базовая информация", "Стиль общения")
+
 
 def truncate_preview(text: str, limit: int = 200) -> str:
     """Обрезает текст до ``limit`` символов и добавляет ``...`` если был срез.
@@ -71,3 +78,141 @@ def get_profile_summary(profile_content: str) -> str:
             lines.append(f"- {s}")
 
     return "\n".join(lines)
+
+
+# ========================== ВЫБОР СЕКЦИЙ ==========================
+
+_WORD_RE = re.compile(r"\w+", re.UNICODE)
+_HTML_COMMENT_RE = re.compile(r"<!--.*?-->", re.DOTALL)
+_RU_SUFFIXES = sorted(
+    "ами ями ого его ему ому ыми ими ой ей ий ый ая яя ое ее ые ие ов ев ах ях ам ям ом ем "
+    "а я о е ы и у ю ь".split(),
+    key=len,
+    reverse=True,
+)
+
+
+def _stem(word: str) -> str:
+    """Очень грубый стемминг: срезает частое окончание и обрезает до 6 символов."""
+    for suffix in _RU_SUFFIXES:
+        if word.endswith(suffix) and len(word) - len(suffix) >= 3:
+            word = word[: -len(suffix)]
+            break
+    return word[:6]
+
+
+def _terms(text: str) -> List[str]:
+    return [_stem(w) for w in _WORD_RE.findall(text.lower()) if len(w) > 2]
+
+
+class ProfileSection:
+    """Секция профиля (``## Заголовок`` + тело) с предрасчётом для BM25."""
+
+    def __init__(self, title: str, body: str):
+        self.title = title
+        self.body = body.strip()
+        self.text = f"## {title}\n{self.body}".strip()
+        self.tokens = estimate_tokens(self.text)
+        self.term_counts = Counter(_terms(f"{title} {self.body}"))
+        self.length = sum(self.term_counts.values())
+
+
+class ParsedProfile:
+    """Профиль, разобранный один раз: имя, вводная часть и секции ``## ``."""
+
+    def __init__(self, content: str):
+        self.content = content
+        self.name = extract_name(content)
+        self.preamble = ""
+        self.sections: List[ProfileSection] = []
+
+        preamble_lines: List[str] = []
+        title: Optional[str] = None
+        body: List[str] = []
+        for line in _HTML_COMMENT_RE.sub("", content).splitlines():
+            if line.startswith("## "):
+                if title is not None:
+                    self.sections.append(ProfileSection(title, "\n".join(body)))
+                title, body = line[3:].strip(), []
+            elif title is None:
+                if not line.startswith("# "):
+                    preamble_lines.append(line)
+            else:
+                body.append(line)
+        if title is not None:
+            self.sections.append(ProfileSection(title, "\n".join(body)))
+        self.preamble = "\n".join(preamble_lines).strip()
+
+        self.doc_freq: Counter = Counter()
+        for section in self.sections:
+            self.doc_freq.update(section.term_counts.keys())
+        self.avg_length = (
+            sum(s.length for s in self.sections) / len(self.sections) if self.sections else 0.0
+        )
+
+    def score(self, query: str, k1: float = 1.5, b: float = 0.75) -> List[float]:
+        """BM25-оценка каждой секции относительно запроса."""
+        query_terms = set(_terms(query))
+        n = len(self.sections)
+        scores = []
+        for section in self.sections:
+            total = 0.0
+            for term in query_terms:
+                tf = section.term_counts.get(term, 0)
+                if not tf:
+                    continue
+                df = self.doc_freq[term]
+                idf = math.log(1 + (n - df + 0.5) / (df + 0.5))
+                norm = 1 - b + b * section.length / (self.avg_length or 1)
+                total += idf * tf * (k1 + 1) / (tf + k1 * norm)
+            scores.append(total)
+        return scores
+
+    def select_sections(
+        self,
+        query: str,
+        budget_tokens: int = 400,
+        always: Iterable[str] = DEFAULT_ALWAYS_SECTIONS,
+    ) -> List[ProfileSection]:
+        """Секции для промпта: обязательные + самые релевантные запросу в пределах бюджета.
+
+        Обязательные (``always`` и секция со строкой имени) включаются всегда,
+        даже сверх бюджета. Порядок результата — как в файле профиля.
+        """
+        always_titles = set(always)
+        chosen = set()
+        used = 0
+        for idx, section in enumerate(self.sections):
+            if section.title in always_titles or "**Имя:**" in section.body:
+                chosen.add(idx)
+                used += section.tokens
+
+        scores = self.score(query)
+        ranked = sorted(
+            (i for i in range(len(self.sections)) if scores[i] > 0 and i not in chosen),
+            key=lambda i: scores[i],
+            reverse=True,
+        )
+        for idx in ranked:
+            cost = self.sections[idx].tokens
+            if used + cost > budget_tokens:
+                continue
+            chosen.add(idx)
+            used += cost
+
+        return [self.sections[i] for i in sorted(chosen)]
+
+    def render(self, query: Optional[str] = None, budget_tokens: int = 400) -> str:
+        """Фрагмент профиля для system prompt. ``query=None`` — профиль целиком."""
+        if query is None:
+            sections = self.sections
+        else:
+            sections = self.select_sections(query, budget_tokens)
+        parts = [self.preamble] if self.preamble else []
+        parts += [section.text for section in sections]
+        return "\n\n".join(parts)
+
+
+def parse_profile(profile_content: str) -> ParsedProfile:
+    """Разбирает профиль в индексированную структуру секций (см. ``ParsedProfile``)."""
+    return ParsedProfile(profile_content)
@@ -0,0 +1,191 @@
+"""Реестр профилей: свой профиль на каждого пользователя в одном процессе.
+
+Профиль ищется как ``config/profiles/<user_id>.md``, иначе — общий
+``config/profile.md``. Разобранный результат (имя, секции, рендер) хранится
+в ограниченном LRU и перечитывается, только если у файла сменился mtime/размер.
+"""
+
+import asyncio
+import os
+import re
+import threading
+import time
+from collections import OrderedDict
+from pathlib import Path
+from typing import Any, Dict, Optional, Tuple
+
+from lib.offload import get_cpu_offload
+from lib.profile import ParsedProfile, parse_profile
+
+DEFAULT_PROFILE_USER = "default"
+
+# Профиль меньше этого (символов) разбирается сразу: ~1 мс, дешевле потока
+PROFILE_INLINE_CHARS = int(os.getenv("PROFILE_INLINE_CHARS", "4000"))
+
+_SAFE_ID_RE = re.compile(r"[^\w.@-]+", re.UNICODE)
+
+
+class ProfileView:
+    """Неизменяемый снимок профиля пользователя для сессии."""
+
+    def __init__(self, user_id: str, path: Optional[Path], parsed: ParsedProfile):
+        self.user_id = user_id
+        self.path = path
+        self.parsed = parsed
+        self.content = parsed.content
+        self.name = parsed.name
+        self.loaded = bool(parsed.content)
+
+    def render(self, query: Optional[str] = None, budget_tokens: int = 400) -> str:
+        return self.parsed.render(query, budget_tokens)
+
+
+class _Entry:
+    def __init__(self, view: ProfileView, signature: Optional[Tuple[int, int]], checked: float):
+        self.view = view
+        self.signature = signature
+        self.checked = checked
+
+
+class ProfileRegistry:
+    """LRU-кэш разобранных профилей с инвалидацией по изменению файла.
+
+    ``recheck_s`` — как часто сверять mtime файла; между проверками профиль
+    отдаётся из памяти без системных вызовов.
+    """
+
+    def __init__(
+        self,
+        base_dir: Optional[Path] = None,
+        profiles_dir: str = "config/profiles",
+        default_path: str = "config/profile.md",
+        max_entries: int = 128,
+        recheck_s: float = 2.0,
+    ):
+        self.base_dir = base_dir or Path(__file__).parent.parent
+        self.profiles_dir = self.base_dir / profiles_dir
+        self.default_path = self.base_dir / default_path
+        self.max_entries = max_entries
+        self.recheck_s = recheck_s
+
+        self._entries: "OrderedDict[str, _Entry]" = OrderedDict()
+        self._lock = threading.Lock()
+
+        self.hits = 0
+        self.loads = 0
+        self.reloads = 0
+        self.evictions = 0
+
+    def path_for(self, user_id: str) -> Path:
+        """Путь к профилю пользователя (персональный или общий)."""
+        safe_id = _SAFE_ID_RE.sub("_", user_id).strip("._") or DEFAULT_PROFILE_USER
+        personal = self.profiles_dir / f"{safe_id}.md"
+        return personal if personal.exists() else self.default_path
+
+    @staticmethod
+    def _signature(path: Path) -> Optional[Tuple[int, int]]:
+        try:
+            stat = path.stat()
+        except OSError:
+            return None
+        return stat.st_mtime_ns, stat.st_size
+
+    def _fresh(self, user_id: str) -> Optional[ProfileView]:
+        """Профиль из кэша без обращения к диску, если проверка ещё не нужна."""
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is None or time.monotonic() - entry.checked > self.recheck_s:
+                return None
+            self._entries.move_to_end(user_id)
+            self.hits += 1
+            return entry.view
+
+    def _read(self, user_id: str) -> Tuple[Optional[ProfileView], Path, Optional[Tuple[int, int]], str]:
+        """Кэш по mtime или текст файла для разбора (блокирующий I/O)."""
+        path = self.path_for(user_id)
+        signature = self._signature(path)
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is not None and entry.signature == signature and entry.view.path == path:
+                entry.checked = time.monotonic()
+                self._entries.move_to_end(user_id)
+                self.hits += 1
+                return entry.view, path, signature, ""
+
+        content = ""
+        if signature is not None:
+            try:
+                content = path.read_text(encoding="utf-8")
+            except OSError:
+                content = ""
+        return None, path, signature, content
+
+    def _store(
+        self,
+        user_id: str,
+        path: Path,
+        signature: Optional[Tuple[int, int]],
+        parsed: ParsedProfile,
+    ) -> ProfileView:
+        view = ProfileView(user_id, path if signature is not None else None, parsed)
+        with self._lock:
+            if user_id in self._entries:
+                self.reloads += 1
+            else:
+                self.loads += 1
+            self._entries[user_id] = _Entry(view, signature, time.monotonic())
+            self._entries.move_to_end(user_id)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+        return view
+
+    def get_sync(self, user_id: str = DEFAULT_PROFILE_USER) -> ProfileView:
+        """Возвращает профиль, при необходимости перечитывая файл (блокирующий I/O)."""
+        view = self._fresh(user_id)
+        if view is not None:
+            return view
+        cached, path, signature, content = self._read(user_id)
+        if cached is not None:
+            return cached
+        return self._store(user_id, path, signature, parse_profile(content))
+
+    async def get(self, user_id: str = DEFAULT_PROFILE_USER) -> ProfileView:
+        """Async-вариант: из кэша — сразу, чтение файла — в пуле потоков.
+
+        Разбор — через ``CpuOffload``: большой профиль в пуле процессов (вход —
+        одна строка, пересылка дешевле разбора), иначе в потоке.
+        """
+        view = self._fresh(user_id)
+        if view is not None:
+            return view
+        cached, path, signature, content = await asyncio.to_thread(self._read, user_id)
+        if cached is not None:
+            return cached
+        parsed = await get_cpu_offload().run(
+            parse_profile, content, size=len(content), min_size=PROFILE_INLINE_CHARS
+        )
+        return self._store(user_id, path, signature, parsed)
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "hits": self.hits,
+                "loads": self.loads,
+                "reloads": self.reloads,
+                "evictions": self.evictions,
+            }
+
+
+_profile_registry: Optional[ProfileRegistry] = None
+
+
+def get_profile_registry() -> ProfileRegistry:
+    """Общий на процесс реестр профилей (размер LRU — ``PROFILE_CACHE_SIZE``)."""
+    global _profile_registry
+    if _profile_registry is None:
+        _profile_registry = ProfileRegistry(
+            max_entries=int(os.getenv("PROFILE_CACHE_SIZE", "128")),
+        )
+    return _profile_registry
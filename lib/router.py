@@ -0,0 +1,156 @@
+"""Маршрутизация запросов: простые реплики — в локальную модель, сложные — в облако.
+
+Классификатор — крошечная логистическая регрессия с вручную подобранными
+весами по признакам реплики (длина, код, «сложные» и «разговорные» слова,
+глубина истории). Никаких моделей и сети: решение за микросекунды.
+
+Opt-in через env ``LOCAL_ROUTING=1``; локальная модель — ``LOCAL_MODEL``
+через OpenAI-совместимый endpoint Ollama (``OLLAMA_BASE_URL``).
+"""
+
+import math
+import os
+import re
+import threading
+from typing import Any, Dict, List, Optional
+
+from lib.openrouter_client import AdmissionController, ModelRoute, OpenRouterClient
+
+ROUTE_LOCAL = "local"
+ROUTE_CLOUD = "cloud"
+ROUTE_AUTO = "auto"
+
+_WORD_RE = re.compile(r"\w+", re.UNICODE)
+_CODE_RE = re.compile(r"```|`[^`]+`|\b(def|class|import|return|async|await|fun|val)\b|[{};]\s*$|=>|->", re.M)
+
+CHITCHAT_WORDS = {
+    "привет", "здравствуй", "здравствуйте", "спасибо", "благодарю", "ок", "окей", "ага",
+    "пока", "да", "нет", "понял", "поняла", "круто", "отлично", "hi", "hello", "thanks", "ok",
+}
+HARD_WORDS = {
+    "почему", "объясни", "сравни", "реализуй", "напиши", "код", "архитектура", "архитектуру",
+    "оптимизируй", "докажи", "рефакторинг", "ошибка", "ошибку", "баг", "стектрейс", "алгоритм",
+    "спроектируй", "проанализируй", "план", "debug", "implement", "explain", "why",
+}
+
+# Веса логистической регрессии: P(облако) = sigmoid(bias + sum(w_i * x_i)).
+WEIGHTS = {
+    "bias": -1.6,
+    "log_words": 0.9,
+    "has_code": 3.0,
+    "hard_words": 1.4,
+    "chitchat": -2.0,
+    "question": 0.2,
+    "history_depth": 0.15,
+}
+
+
+def turn_features(text: str, history_len: int = 0) -> Dict[str, float]:
+    """Признаки реплики для классификатора."""
+    words = [w.lower() for w in _WORD_RE.findall(text)]
+    word_set = set(words)
+    return {
+        "log_words": math.log1p(len(words)),
+        "has_code": 1.0 if _CODE_RE.search(text) else 0.0,
+        "hard_words": float(len(word_set & HARD_WORDS)),
+        "chitchat": 1.0 if words and len(words) <= 6 and word_set & CHITCHAT_WORDS else 0.0,
+        "question": 1.0 if "?" in text else 0.0,
+        "history_depth": min(history_len, 20) / 2,
+    }
+
+
+def cloud_probability(text: str, history_len: int = 0) -> float:
+    """Вероятность того, что реплике нужна облачная модель."""
+    features = turn_features(text, history_len)
+    z = WEIGHTS["bias"] + sum(WEIGHTS[name] * value for name, value in features.items())
+    return 1.0 / (1.0 + math.exp(-z))
+
+
+def choose_route(
+    text: str,
+    history_len: int = 0,
+    override: str = ROUTE_AUTO,
+    threshold: float = 0.5,
+) -> str:
+    """Маршрут для реплики: ручной override (``/route``) или решение классификатора."""
+    if override in (ROUTE_LOCAL, ROUTE_CLOUD):
+        return override
+    return ROUTE_CLOUD if cloud_probability(text, history_len) >= threshold else ROUTE_LOCAL
+
+
+class RouteMetrics:
+    """Счётчики по маршрутам: запросы, TTFT, полная латентность, оценка стоимости."""
+
+    def __init__(self, cloud_price_per_1k: float = 0.009, local_price_per_1k: float = 0.0):
+        self.prices = {ROUTE_CLOUD: cloud_price_per_1k, ROUTE_LOCAL: local_price_per_1k}
+        self._lock = threading.Lock()
+        self._stats: Dict[str, Dict[str, float]] = {}
+
+    def record(self, route: str, ttft_s: Optional[float], total_s: float, tokens: int) -> None:
+        with self._lock:
+            stats = self._stats.setdefault(route, {
+                "requests": 0, "ttft_total_s": 0.0, "ttft_count": 0,
+                "latency_total_s": 0.0, "tokens": 0, "cost_usd": 0.0,
+            })
+            stats["requests"] += 1
+            if ttft_s is not None:
+                stats["ttft_total_s"] += ttft_s
+                stats["ttft_count"] += 1
+            stats["latency_total_s"] += total_s
+            stats["tokens"] += tokens
+            stats["cost_usd"] += tokens / 1000 * self.prices.get(route, 0.0)
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._lock:
+            result = {}
+            for route, stats in self._stats.items():
+                requests = stats["requests"] or 1
+                ttft_count = stats["ttft_count"] or 1
+                result[route] = {
+                    "requests": stats["requests"],
+                    "ttft_avg_ms": round(stats["ttft_total_s"] / ttft_count * 1000, 1),
+                    "latency_avg_ms": round(stats["latency_total_s"] / requests * 1000, 1),
+                    "tokens": stats["tokens"],
+                    "cost_usd": round(stats["cost_usd"], 4),
+                }
+            return result
+
+
+def make_local_client(
+    cloud: OpenRouterClient,
+    limiter: Optional[AdmissionController] = None,
+) -> Optional[OpenRouterClient]:
+    """Клиент к локальной Ollama, если включён ``LOCAL_ROUTING=1``.
+
+    Если Ollama недоступна, запрос уходит по цепочке облачного клиента.
+    """
+    if os.getenv("LOCAL_ROUTING", "0") != "1":
+        return None
+    local = OpenRouterClient(
+        limiter=limiter or cloud.limiter,
+        model=os.getenv("LOCAL_MODEL", "gemma4:e4b"),
+        base_url=os.getenv("OLLAMA_BASE_URL", "http://localhost:11434/v1"),
+        api_key="ollama",
+    )
+    local.max_retries = 0
+    local.local = True
+    local.fallbacks = [ModelRoute(cloud.model, cloud.llm)] + cloud.fallbacks
+    return local
+
+
+_route_metrics: Optional[RouteMetrics] = None
+
+
+def get_route_metrics() -> RouteMetrics:
+    """Общие на процесс метрики маршрутов (цена облака — ``CLOUD_PRICE_PER_1K_TOKENS``)."""
+    global _route_metrics
+    if _route_metrics is None:
+        _route_metrics = RouteMetrics(
+            cloud_price_per_1k=float(os.getenv("CLOUD_PRICE_PER_1K_TOKENS", "0.009")),
+        )
+    return _route_metrics
+
+
+def estimate_prompt_tokens(messages: List[Dict[str, str]]) -> int:
+    """Грубая оценка токенов промпта (как в Analytics: ~4 символа на токен)."""
+    return sum(len(m.get("content", "")) for m in messages) // 4
@@ -0,0 +1,190 @@
+"""Семантический кэш ответов: похожий вопрос — готовый ответ без запроса к LLM.
+
+Opt-in через env ``SEMANTIC_CACHE=1``. Кэш общий на процесс, но записи
+разделены по ``scope`` (профиль пользователя + модель), так что ответ,
+персонализированный под одного пользователя, не достаётся другому.
+Имеет смысл только для независимых вопросов — вызывающий проверяет
+``is_cacheable(history)`` перед lookup/store.
+
+Хеширующий эмбеддер лексический: «как установить docker на ubuntu» и «как
+удалить docker на ubuntu» у него почти совпадают, хотя смысл
+противоположный. Поэтому с ним порог выше и, кроме близости, слова вопроса
+должны совпасть с сохранённым (без учёта регистра, пунктуации и порядка).
+"""
+
+import hashlib
+import os
+import re
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional
+
+from lib.embeddings import get_embedder
+from lib.vector_index import VectorIndex
+
+# Порог близости по умолчанию: для модели эмбеддингов и для хеширующего эмбеддера
+DEFAULT_THRESHOLD = 0.9
+LEXICAL_THRESHOLD = 0.95
+
+_WORD_RE = re.compile(r"\w+", re.UNICODE)
+
+
+def _terms(text: str) -> frozenset:
+    return frozenset(_WORD_RE.findall(text.lower()))
+
+
+def make_scope(*parts: str) -> str:
+    """Короткий стабильный идентификатор области кэша (профиль, модель, ...)."""
+    return hashlib.sha1("\x00".join(parts).encode("utf-8")).hexdigest()[:16]
+
+
+class _Entry:
+    def __init__(self, scope: str, question: str, answer: str, created: float):
+        self.scope = scope
+        self.question = question
+        self.terms = _terms(question)
+        self.answer = answer
+        self.created = created
+        self.hits = 0
+
+
+class SemanticCache:
+    """Кэш «вопрос → ответ» с поиском ближайшего соседа по эмбеддингу.
+
+    Вытеснение: записи старше ``ttl_s`` и самые старые сверх ``max_entries``.
+    Потокобезопасен (методы можно звать через ``asyncio.to_thread``).
+
+    ``threshold=None`` — ``LEXICAL_THRESHOLD`` для лексического эмбеддера,
+    иначе ``DEFAULT_THRESHOLD``. ``exact_terms=None`` — требовать совпадения
+    слов только для лексического эмбеддера.
+    """
+
+    def __init__(
+        self,
+        embedder=None,
+        threshold: Optional[float] = None,
+        max_entries: int = 1000,
+        ttl_s: float = 24 * 3600,
+        max_history: int = 2,
+        exact_terms: Optional[bool] = None,
+    ):
+        self.embedder = embedder or get_embedder()
+        lexical = getattr(self.embedder, "lexical", False)
+        if threshold is None:
+            threshold = LEXICAL_THRESHOLD if lexical else DEFAULT_THRESHOLD
+        self.threshold = threshold
+        self.exact_terms = lexical if exact_terms is None else exact_terms
+        self.max_entries = max_entries
+        self.ttl_s = ttl_s
+        self.max_history = max_history
+
+        self._entries: "OrderedDict[int, _Entry]" = OrderedDict()
+        self._indexes: Dict[str, VectorIndex] = {}
+        self._next_id = 0
+        self._lock = threading.Lock()
+
+        self.lookups = 0
+        self.hits = 0
+        self.evictions = 0
+        self.lookup_total_s = 0.0
+
+    def is_cacheable(self, history: List[Dict]) -> bool:
+        """Короткая история — вопрос почти наверняка не зависит от контекста диалога."""
+        return len(history) <= self.max_history
+
+    def lookup(self, question: str, scope: str) -> Optional[str]:
+        """Возвращает кэшированный ответ на близкий вопрос или None."""
+        started = time.perf_counter()
+        vector = self.embedder.embed(question)
+        terms = _terms(question) if self.exact_terms else None
+        with self._lock:
+            self.lookups += 1
+            self._evict_expired(time.time())
+            answer = None
+            index = self._indexes.get(scope)
+            if index is not None:
+                # Несколько соседей: ближайший может не пройти проверку слов
+                for entry_id, score in index.search(vector, k=5 if terms is not None else 1):
+                    if score < self.threshold:
+                        break
+                    entry = self._entries[entry_id]
+                    if terms is not None and entry.terms != terms:
+                        continue
+                    entry.hits += 1
+                    self.hits += 1
+                    answer = entry.answer
+                    break
+            self.lookup_total_s += time.perf_counter() - started
+        return answer
+
+    def store(self, question: str, answer: str, scope: str) -> None:
+        """Кладёт ответ в кэш; пустые ответы не кэшируются."""
+        if not answer.strip():
+            return
+        vector = self.embedder.embed(question)
+        now = time.time()
+        with self._lock:
+            self._evict_expired(now)
+            entry_id = self._next_id
+            self._next_id += 1
+            self._entries[entry_id] = _Entry(scope, question, answer, now)
+            index = self._indexes.get(scope)
+            if index is None:
+                index = VectorIndex(len(vector))
+                self._indexes[scope] = index
+            index.add(entry_id, vector)
+            while len(self._entries) > self.max_entries:
+                self._evict_oldest()
+
+    def _evict_oldest(self) -> None:
+        entry_id, entry = self._entries.popitem(last=False)
+        index = self._indexes[entry.scope]
+        index.remove(entry_id)
+        if not len(index):
+            del self._indexes[entry.scope]
+        self.evictions += 1
+
+    def _evict_expired(self, now: float) -> None:
+        # Записи упорядочены по времени создания — просроченные всегда в начале.
+        while self._entries:
+            entry = next(iter(self._entries.values()))
+            if now - entry.created <= self.ttl_s:
+                break
+            self._evict_oldest()
+
+    def snapshot(self) -> Dict[str, Any]:
+        """Метрики кэша для /metrics."""
+        with self._lock:
+            hit_rate = self.hits / self.lookups if self.lookups else 0.0
+            avg_ms = self.lookup_total_s / self.lookups * 1000 if self.lookups else 0.0
+            return {
+                "entries": len(self._entries),
+                "scopes": len(self._indexes),
+                "lookups": self.lookups,
+                "hits": self.hits,
+                "hit_rate": round(hit_rate, 3),
+                "lookup_avg_ms": round(avg_ms, 2),
+                "evictions": self.evictions,
+                "embedder": self.embedder.name,
+            }
+
+
+_semantic_cache: Optional[SemanticCache] = None
+
+
+def get_semantic_cache() -> Optional[SemanticCache]:
+    """Общий на процесс кэш, если включён ``SEMANTIC_CACHE=1``; иначе None."""
+    global _semantic_cache
+    if os.getenv("SEMANTIC_CACHE", "0") != "1":
+        return None
+    if _semantic_cache is None:
+        _semantic_cache = SemanticCache(
+            threshold=float(os.environ["SEMANTIC_CACHE_THRESHOLD"])
+            if os.getenv("SEMANTIC_CACHE_THRESHOLD")
+            else None,
+            max_entries=int(os.getenv("SEMANTIC_CACHE_MAX_ENTRIES", "1000")),
+            ttl_s=float(os.getenv("SEMANTIC_CACHE_TTL_S", str(24 * 3600))),
+            max_history=int(os.getenv("SEMANTIC_CACHE_MAX_HISTORY", "2")),
+        )
+    return _semantic_cache
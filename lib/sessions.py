@@ -0,0 +1,286 @@
+"""Учёт памяти сессий и выгрузка простаивающих сессий на диск.
+
+Каждая сессия Chainlit держит в ``cl.user_session`` свой клиент, историю
+диалога и список аналитики, а брошенная вкладка держит их, пока Chainlit не
+закроет сессию. ``SessionRegistry`` считает примерный объём каждой сессии и,
+если включён бюджет (``SESSION_MEMORY_BUDGET_MB``) или порог простоя
+(``SESSION_IDLE_EVICT_S``), выгружает историю и аналитику давно неактивных
+сессий в ``data/sessions/<id>.json``. Списки очищаются на месте (сессия держит
+те же объекты), при следующем сообщении сессии они заполняются обратно.
+"""
+
+import asyncio
+import json
+import os
+import re
+import sys
+import threading
+import time
+from pathlib import Path
+from typing import Any, Dict, Iterator, List, Optional, Sequence, Tuple
+
+DEFAULT_SESSIONS_DIR = Path(__file__).parent.parent / "data" / "sessions"
+
+# OpenRouterClient + ChatOpenAI на сессию, замер tracemalloc (~8 KB)
+CLIENT_BYTES_ESTIMATE = 8 * 1024
+
+_SAFE_ID_RE = re.compile(r"[^\w.-]+")
+
+
+def estimate_records_bytes(records: List[Dict[str, Any]]) -> int:
+    """Примерный размер списка dict-записей (история, аналитика) в байтах."""
+    total = sys.getsizeof(records)
+    for record in records:
+        total += sys.getsizeof(record)
+        for key, value in record.items():
+            total += sys.getsizeof(key) + sys.getsizeof(value)
+    return total
+
+
+class _SessionState:
+    def __init__(self, history: List[Dict], usage_history: List[Dict]):
+        self.history = history
+        self.usage_history = usage_history
+        # Производные от истории кэши (``clear()`` + ``approx_bytes``), например MessageSequence
+        self.caches: Sequence[Any] = ()
+        self.history_bytes = 0
+        self.usage_bytes = 0
+        self.last_active = time.monotonic()
+        # Ходы, которые идут сейчас (от resume до touch): такую сессию не выгружаем
+        self.in_flight = 0
+        self.evicted = False
+        # Выгруженные данные, пока они пишутся на диск (чтобы вернуть без чтения файла)
+        self.pending: Optional[Dict[str, List[Dict]]] = None
+        # Списки, очищенные при выгрузке: восстанавливаются только они, а не замена
+        self.evicted_from: Optional[Tuple[List[Dict], List[Dict]]] = None
+
+    @property
+    def bytes(self) -> int:
+        return self.history_bytes + self.usage_bytes + CLIENT_BYTES_ESTIMATE
+
+
+class SessionRegistry:
+    """Учёт памяти сессий, бюджет и выгрузка простаивающих на диск.
+
+    ``budget_bytes=0`` и ``idle_s=0`` — только учёт, без выгрузки.
+    """
+
+    def __init__(
+        self,
+        store_dir: Optional[Path] = None,
+        budget_bytes: int = 0,
+        idle_s: float = 0.0,
+    ):
+        self.store_dir = store_dir or DEFAULT_SESSIONS_DIR
+        self.budget_bytes = budget_bytes
+        self.idle_s = idle_s
+
+        self._sessions: Dict[str, _SessionState] = {}
+        self._lock = threading.Lock()
+
+        self.evictions = 0
+        self.restores = 0
+
+    def _path(self, session_id: str) -> Path:
+        return self.store_dir / f"{_SAFE_ID_RE.sub('_', session_id)}.json"
+
+    def touch(
+        self,
+        session_id: str,
+        history: List[Dict],
+        usage_history: List[Dict],
+        caches: Sequence[Any] = (),
+    ) -> None:
+        """Отмечает активность сессии и пересчитывает её объём (после каждого сообщения).
+
+        ``caches`` — производные от истории структуры с ``clear()`` и
+        ``approx_bytes``: учитываются в объёме и сбрасываются при выгрузке.
+        """
+        with self._lock:
+            state = self._sessions.get(session_id)
+            if state is None:
+                state = self._sessions[session_id] = _SessionState(history, usage_history)
+            state.history = history
+            state.usage_history = usage_history
+            state.caches = tuple(caches)
+            state.history_bytes = estimate_records_bytes(history)
+            state.history_bytes += sum(cache.approx_bytes for cache in state.caches)
+            state.usage_bytes = estimate_records_bytes(usage_history)
+            state.last_active = time.monotonic()
+            state.in_flight = max(0, state.in_flight - 1)
+
+    async def resume(self, session_id: str) -> bool:
+        """Начало сообщения: вернуть выгруженную историю сессии и выгрузить лишние.
+
+        Сессия считается занятой до ``touch`` в конце хода: выгрузка из
+        ``resume`` другой сессии не очистит её историю посреди ответа.
+        Возвращает ``True``, если история сессии была восстановлена с диска.
+        """
+        with self._lock:
+            state = self._sessions.get(session_id)
+            if state is not None:
+                state.in_flight += 1
+                state.last_active = time.monotonic()
+        restored = await self.restore(session_id)
+        await self.enforce(exclude=session_id)
+        return restored
+
+    async def restore(self, session_id: str) -> bool:
+        """Возвращает выгруженную историю сессии в её списки (если сессия была выгружена)."""
+        with self._lock:
+            state = self._sessions.get(session_id)
+            if state is None or not state.evicted:
+                return False
+            payload = state.pending
+        if payload is None:
+            payload = await asyncio.to_thread(self._read, session_id)
+        with self._lock:
+            # Списки — те же объекты, что лежат в cl.user_session. Если пока сессия
+            # была выгружена, список заменили (/compress, /reset), новый вытесняет
+            # выгруженный: иначе старая история вернулась бы перед сводкой.
+            history, usage_history = state.evicted_from or (state.history, state.usage_history)
+            if state.history is history:
+                state.history[:0] = payload.get("history", [])
+            if state.usage_history is usage_history:
+                state.usage_history[:0] = payload.get("usage_history", [])
+            state.evicted = False
+            state.evicted_from = None
+            state.pending = None
+            state.last_active = time.monotonic()
+            self.restores += 1
+        return True
+
+    def _victims(self, exclude: Optional[str]) -> List[str]:
+        now = time.monotonic()
+        with self._lock:
+            resident = sorted(
+                (
+                    s for s in self._sessions.items()
+                    if not s[1].evicted and not s[1].in_flight and s[0] != exclude
+                ),
+                key=lambda item: item[1].last_active,
+            )
+            total = sum(state.bytes for _, state in self._sessions.items() if not state.evicted)
+            victims = []
+            for session_id, state in resident:
+                idle = self.idle_s and now - state.last_active > self.idle_s
+                over = self.budget_bytes and total > self.budget_bytes
+                if not (idle or over):
+                    continue
+                victims.append(session_id)
+                total -= state.history_bytes + state.usage_bytes
+            return victims
+
+    async def enforce(self, exclude: Optional[str] = None) -> int:
+        """Выгружает простаивающие сессии и самые давние сверх бюджета. Возвращает их число."""
+        if not (self.budget_bytes or self.idle_s):
+            return 0
+        evicted = 0
+        for session_id in self._victims(exclude):
+            with self._lock:
+                state = self._sessions[session_id]
+                if state.evicted or not (state.history or state.usage_history):
+                    continue
+                payload = {"history": list(state.history), "usage_history": list(state.usage_history)}
+                state.history.clear()
+                state.usage_history.clear()
+                for cache in state.caches:
+                    cache.clear()
+                state.evicted = True
+                state.evicted_from = (state.history, state.usage_history)
+                state.pending = payload
+                state.history_bytes = state.usage_bytes = 0
+                self.evictions += 1
+            await asyncio.to_thread(self._write, session_id, payload)
+            with self._lock:
+                restored = not state.evicted
+                if state.pending is payload:
+                    state.pending = None
+            if restored:
+                # Сессия вернулась, пока шла запись: файл уже не нужен
+                self._path(session_id).unlink(missing_ok=True)
+            evicted += 1
+        return evicted
+
+    def _write(self, session_id: str, payload: Dict[str, List[Dict]]) -> None:
+        self.store_dir.mkdir(parents=True, exist_ok=True)
+        path = self._path(session_id)
+        tmp = path.with_suffix(".tmp")
+        tmp.write_text(json.dumps(payload, ensure_ascii=False), encoding="utf-8")
+        tmp.replace(path)
+
+    def _read(self, session_id: str) -> Dict[str, List[Dict]]:
+        path = self._path(session_id)
+        try:
+            payload = json.loads(path.read_text(encoding="utf-8"))
+        except (OSError, ValueError):
+            return {}
+        path.unlink(missing_ok=True)
+        return payload
+
+    def iter_usage(self) -> Iterator[Tuple[str, Dict]]:
+        """Аналитика всех сессий процесса по одной сессии за раз (для выгрузки).
+
+        Выгруженные сессии читаются с диска без восстановления в память; файл
+        остаётся на месте.
+        """
+        with self._lock:
+            session_ids = list(self._sessions)
+        for session_id in session_ids:
+            with self._lock:
+                state = self._sessions.get(session_id)
+                if state is None:
+                    continue
+                if not state.evicted:
+                    records = list(state.usage_history)
+                elif state.pending is not None:
+                    records = list(state.pending.get("usage_history", []))
+                else:
+                    records = None
+            if records is None:
+                try:
+                    payload = json.loads(self._path(session_id).read_text(encoding="utf-8"))
+                except (OSError, ValueError):
+                    continue
+                records = payload.get("usage_history", [])
+            for record in records:
+                yield session_id, record
+
+    def forget(self, session_id: str) -> None:
+        """Конец сессии: убрать учёт и выгруженный файл."""
+        with self._lock:
+            self._sessions.pop(session_id, None)
+        self._path(session_id).unlink(missing_ok=True)
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._lock:
+            resident = [s for s in self._sessions.values() if not s.evicted]
+            history_bytes = sum(s.history_bytes for s in resident)
+            usage_bytes = sum(s.usage_bytes for s in resident)
+            client_bytes = CLIENT_BYTES_ESTIMATE * len(self._sessions)
+            return {
+                "sessions": len(self._sessions),
+                "resident": len(resident),
+                "evicted": len(self._sessions) - len(resident),
+                "history_kb": round(history_bytes / 1024, 1),
+                "usage_kb": round(usage_bytes / 1024, 1),
+                "clients_kb": round(client_bytes / 1024, 1),
+                "total_kb": round((history_bytes + usage_bytes + client_bytes) / 1024, 1),
+                "budget_kb": round(self.budget_bytes / 1024, 1),
+                "evictions": self.evictions,
+                "restores": self.restores,
+            }
+
+
+_session_registry: Optional[SessionRegistry] = None
+
+
+def get_session_registry() -> SessionRegistry:
+    """Общий на процесс учёт сессий (``SESSION_MEMORY_BUDGET_MB``, ``SESSION_IDLE_EVICT_S``)."""
+    global _session_registry
+    if _session_registry is None:
+        _session_registry = SessionRegistry(
+            budget_bytes=int(float(os.getenv("SESSION_MEMORY_BUDGET_MB", "0")) * 1024 * 1024),
+            idle_s=float(os.getenv("SESSION_IDLE_EVICT_S", "0")),
+        )
+    return _session_registry
@@ -0,0 +1,504 @@
+"""Локальный stub LLM-сервер для офлайн-тестов и замеров производительности.
+
+Говорит на двух протоколах:
+
+- OpenAI chat-completions (``POST /v1/chat/completions``) — как OpenRouter,
+  обычным JSON или SSE-стримом (``stream: true``), с блоком ``usage``;
+- Ollama (``POST /api/chat``) — как ``ollama serve``, NDJSON-стрим или JSON
+  с ``eval_count``/``eval_duration``/``load_duration``; ``POST /api/generate``
+  без prompt — предзагрузка модели, ``GET /api/ps`` — загруженные модели.
+
+Поведение детерминировано и настраивается: задержка до первого токена (TTFT),
+скорость генерации (токенов/с), размер чанка, имитация загрузки модели,
+инъекция 429 и 5xx (доля запросов или первые N), лимит одновременных запросов.
+
+Только стандартная библиотека (asyncio), без внешних зависимостей.
+
+Запуск отдельным процессом (например, вместо Ollama для run_benchmark.py):
+    python3 -m lib.stub_llm --port 11434 --ttft 0.3 --tps 40
+"""
+
+import argparse
+import asyncio
+import json
+import random
+import re
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import Dict, Iterator, List, Optional, Set
+
+_TOKEN_RE = re.compile(r"\S+\s*|\s+")
+
+_REASONS = {
+    200: "OK",
+    404: "Not Found",
+    429: "Too Many Requests",
+    500: "Internal Server Error",
+    502: "Bad Gateway",
+    503: "Service Unavailable",
+}
+
+
+def split_tokens(text: str) -> List[str]:
+    """Режет текст на «токены» (слово + пробелы после него); склейка даёт исходный текст."""
+    return _TOKEN_RE.findall(text)
+
+
+def _estimate_prompt_tokens(messages: List[Dict]) -> int:
+    return max(1, sum(len(str(m.get("content", ""))) for m in messages) // 4)
+
+
+class StubLLMServer:
+    """Минимальный HTTP-сервер, совместимый с OpenAI SDK и Ollama API.
+
+    ``base_url`` — для OpenAI-клиентов (``.../v1``), ``root_url`` — для Ollama
+    (``root_url + "/api/chat"``).
+
+    ``delay_s`` — пауза до заголовков ответа (очередь провайдера), ``ttft_s`` —
+    до первого чанка, дальше чанки по ``chunk_tokens`` токенов со скоростью
+    ``tokens_per_s`` (0 — без пауз). ``stall_after`` > 0 — после стольких
+    чанков сервер замолкает на ``stall_s`` (зависшая генерация). ``load_s`` добавляется, когда запрос
+    приходит к модели, которой нет среди загруженных (как смена модели в Ollama);
+    одновременно загружено не больше ``max_loaded`` моделей
+    (``OLLAMA_MAX_LOADED_MODELS``), каждая занимает ``model_bytes``.
+    """
+
+    def __init__(
+        self,
+        reply: str = "ok",
+        delay_s: float = 0.0,
+        max_concurrency: Optional[int] = None,
+        host: str = "127.0.0.1",
+        port: int = 0,
+        ttft_s: float = 0.0,
+        tokens_per_s: float = 0.0,
+        chunk_tokens: int = 1,
+        stall_after: int = 0,
+        stall_s: float = 0.0,
+        load_s: float = 0.0,
+        rate_limit_rate: float = 0.0,
+        error_rate: float = 0.0,
+        error_status: int = 500,
+        fail_first: int = 0,
+        stream_usage: bool = False,
+        seed: int = 0,
+        max_loaded: int = 1,
+        model_bytes: int = 2 * 1024 ** 3,
+    ):
+        self.reply = reply
+        self.delay_s = delay_s
+        self.max_concurrency = max_concurrency
+        self.host = host
+        self.port = port
+        self.ttft_s = ttft_s
+        self.tokens_per_s = tokens_per_s
+        self.chunk_tokens = max(1, chunk_tokens)
+        self.stall_after = stall_after
+        self.stall_s = stall_s
+        self.load_s = load_s
+        self.rate_limit_rate = rate_limit_rate
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.fail_first = fail_first
+        self.stream_usage = stream_usage
+        self.max_loaded = max(1, max_loaded)
+        self.model_bytes = model_bytes
+        self.base_url = ""
+        self.root_url = ""
+
+        self.requests = 0
+        self.rate_limited = 0
+        self.errors = 0
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.tokens_sent = 0
+        self.loads = 0
+        self.loaded_model: Optional[str] = None
+        # Загруженные модели в порядке последнего использования (вытесняется первая)
+        self.resident: "OrderedDict[str, None]" = OrderedDict()
+
+        self._rng = random.Random(seed)
+        self._server: Optional[asyncio.base_events.Server] = None
+        self._handlers: Set[asyncio.Task] = set()
+
+    async def start(self) -> str:
+        """Запускает сервер и возвращает base_url вида ``http://host:port/v1``."""
+        self._server = await asyncio.start_server(self._handle, self.host, self.port)
+        port = self._server.sockets[0].getsockname()[1]
+        self.root_url = f"http://{self.host}:{port}"
+        self.base_url = f"{self.root_url}/v1"
+        return self.base_url
+
+    async def stop(self) -> None:
+        if self._server is not None:
+            self._server.close()
+            # Зависшие ответы (stall_s) не держат остановку сервера
+            for task in list(self._handlers):
+                task.cancel()
+            await asyncio.gather(*self._handlers, return_exceptions=True)
+            await self._server.wait_closed()
+            self._server = None
+
+    async def __aenter__(self) -> "StubLLMServer":
+        await self.start()
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb) -> None:
+        await self.stop()
+
+    def snapshot(self) -> Dict[str, int]:
+        return {
+            "requests": self.requests,
+            "rate_limited": self.rate_limited,
+            "errors": self.errors,
+            "max_in_flight": self.max_in_flight,
+            "tokens_sent": self.tokens_sent,
+            "loads": self.loads,
+        }
+
+    # ---------------------------------------------------------------- HTTP
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        task = asyncio.current_task()
+        self._handlers.add(task)
+        try:
+            request = await self._read_request(reader)
+            if request is None:
+                return
+            path, body = request
+            await self._dispatch(path, body, writer)
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            self._handlers.discard(task)
+            writer.close()
+
+    @staticmethod
+    async def _read_request(reader: asyncio.StreamReader):
+        head = await reader.readuntil(b"\r\n\r\n")
+        lines = head.decode("latin-1").split("\r\n")
+        parts = lines[0].split(" ")
+        if len(parts) < 2:
+            return None
+        headers = {}
+        for line in lines[1:]:
+            if ":" in line:
+                key, value = line.split(":", 1)
+                headers[key.strip().lower()] = value.strip()
+        length = int(headers.get("content-length", "0") or 0)
+        raw = await reader.readexactly(length) if length else b""
+        body = json.loads(raw.decode("utf-8")) if raw else {}
+        return parts[1], body
+
+    async def _dispatch(self, path: str, body: Dict, writer: asyncio.StreamWriter) -> None:
+        self.requests += 1
+        path = path.split("?", 1)[0].rstrip("/")
+        if path.endswith("/chat/completions"):
+            protocol = "openai"
+        elif path == "/api/chat":
+            protocol = "ollama"
+        elif path == "/api/generate" and not body.get("prompt"):
+            # Запрос без prompt — предзагрузка модели (``keep_alive``), как в Ollama
+            await self._ollama_load(writer, body.get("model", "stub"))
+            return
+        elif path == "/api/ps":
+            await self._send_json(writer, 200, {"models": [
+                {"name": name, "model": name, "size": self.model_bytes, "size_vram": self.model_bytes}
+                for name in self.resident
+            ]})
+            return
+        else:
+            await self._send_json(writer, 404, {"error": {"message": "not found"}})
+            return
+
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        try:
+            status = self._injected_status()
+            if status is not None:
+                message = "Rate limit exceeded" if status == 429 else "Injected error"
+                await self._send_json(writer, status, {"error": {"message": message, "code": status}})
+                return
+
+            if self.delay_s:
+                await asyncio.sleep(self.delay_s)
+
+            model = body.get("model", "stub")
+            load_s = self._use_model(model)
+
+            messages = body.get("messages", [])
+            if protocol == "ollama":
+                # В Ollama стрим включён по умолчанию
+                await self._ollama_chat(writer, model, messages, body.get("stream", True), load_s)
+            elif body.get("stream"):
+                include_usage = self.stream_usage or bool(
+                    (body.get("stream_options") or {}).get("include_usage")
+                )
+                await asyncio.sleep(load_s)
+                await self._send_stream(writer, model, messages, include_usage)
+            else:
+                await asyncio.sleep(load_s)
+                await self._generate(None)
+                await self._send_json(writer, 200, self._completion(model, messages))
+        finally:
+            self.in_flight -= 1
+
+    def _use_model(self, model: str) -> float:
+        """Отмечает использование модели; возвращает время загрузки, если её не было в памяти."""
+        self.loaded_model = model
+        if model in self.resident:
+            self.resident.move_to_end(model)
+            return 0.0
+        self.resident[model] = None
+        while len(self.resident) > self.max_loaded:
+            self.resident.popitem(last=False)
+        self.loads += 1
+        return self.load_s
+
+    async def _ollama_load(self, writer: asyncio.StreamWriter, model: str) -> None:
+        load_s = self._use_model(model)
+        await asyncio.sleep(load_s)
+        await self._send_json(writer, 200, {
+            "model": model,
+            "created_at": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+            "response": "",
+            "done": True,
+            "done_reason": "load",
+            "load_duration": int(load_s * 1e9),
+        })
+
+    def _injected_status(self) -> Optional[int]:
+        """Статус ошибки, если этот запрос должен упасть, иначе ``None``."""
+        if self.max_concurrency is not None and self.in_flight > self.max_concurrency:
+            self.rate_limited += 1
+            return 429
+        if self.requests <= self.fail_first:
+            self.errors += 1
+            return self.error_status
+        if self.rate_limit_rate and self._rng.random() < self.rate_limit_rate:
+            self.rate_limited += 1
+            return 429
+        if self.error_rate and self._rng.random() < self.error_rate:
+            self.errors += 1
+            return self.error_status
+        return None
+
+    def _chunks(self) -> List[str]:
+        tokens = split_tokens(self.reply) or [""]
+        step = self.chunk_tokens
+        return ["".join(tokens[i:i + step]) for i in range(0, len(tokens), step)]
+
+    async def _generate(self, emit) -> int:
+        """Отдаёт чанки ответа в ``emit`` с паузами TTFT/скорости; возвращает число токенов."""
+        tokens = 0
+        for idx, piece in enumerate(self._chunks()):
+            if idx == 0:
+                delay = self.ttft_s
+            elif self.tokens_per_s:
+                delay = self.chunk_tokens / self.tokens_per_s
+            else:
+                delay = 0.0
+            if self.stall_after and idx == self.stall_after:
+                delay += self.stall_s
+            if delay:
+                await asyncio.sleep(delay)
+            count = len(split_tokens(piece))
+            tokens += count
+            self.tokens_sent += count
+            if emit is not None:
+                await emit(piece)
+        return tokens
+
+    def _usage(self, messages: List[Dict]) -> Dict[str, int]:
+        prompt = _estimate_prompt_tokens(messages)
+        completion = len(split_tokens(self.reply))
+        return {"prompt_tokens": prompt, "completion_tokens": completion, "total_tokens": prompt + completion}
+
+    def _completion(self, model: str, messages: List[Dict]) -> Dict:
+        return {
+            "id": "chatcmpl-stub",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": model,
+            "choices": [{
+                "index": 0,
+                "message": {"role": "assistant", "content": self.reply},
+                "finish_reason": "stop",
+            }],
+            "usage": self._usage(messages),
+        }
+
+    @staticmethod
+    async def _send_json(writer: asyncio.StreamWriter, status: int, payload: Dict) -> None:
+        data = json.dumps(payload).encode("utf-8")
+        extra = "Retry-After: 1\r\n" if status == 429 else ""
+        writer.write(
+            f"HTTP/1.1 {status} {_REASONS.get(status, 'Error')}\r\n"
+            "Content-Type: application/json\r\n"
+            f"{extra}"
+            f"Content-Length: {len(data)}\r\n"
+            "Connection: close\r\n\r\n".encode("latin-1")
+            + data
+        )
+        await writer.drain()
+
+    @staticmethod
+    def _start_stream(writer: asyncio.StreamWriter, content_type: str) -> None:
+        writer.write(
+            b"HTTP/1.1 200 OK\r\n"
+            b"Content-Type: " + content_type.encode("latin-1") + b"\r\n"
+            b"Cache-Control: no-cache\r\n"
+            b"Connection: close\r\n\r\n"
+        )
+
+    async def _send_stream(
+        self,
+        writer: asyncio.StreamWriter,
+        model: str,
+        messages: List[Dict],
+        include_usage: bool,
+    ) -> None:
+        self._start_stream(writer, "text/event-stream")
+        await writer.drain()
+
+        def event(choices: List[Dict], usage: Optional[Dict] = None) -> bytes:
+            chunk = {
+                "id": "chatcmpl-stub",
+                "object": "chat.completion.chunk",
+                "created": int(time.time()),
+                "model": model,
+                "choices": choices,
+            }
+            if usage is not None:
+                chunk["usage"] = usage
+            return f"data: {json.dumps(chunk)}\n\n".encode("utf-8")
+
+        async def emit(piece: str) -> None:
+            writer.write(event([{"index": 0, "delta": {"content": piece}, "finish_reason": None}]))
+            await writer.drain()
+
+        await self._generate(emit)
+        writer.write(event([{"index": 0, "delta": {}, "finish_reason": "stop"}]))
+        if include_usage:
+            writer.write(event([], self._usage(messages)))
+        writer.write(b"data: [DONE]\n\n")
+        await writer.drain()
+
+    async def _ollama_chat(
+        self,
+        writer: asyncio.StreamWriter,
+        model: str,
+        messages: List[Dict],
+        stream: bool,
+        load_s: float,
+    ) -> None:
+        started = time.perf_counter()
+        await asyncio.sleep(load_s)
+
+        def message(content: str, done: bool) -> Dict:
+            return {
+                "model": model,
+                "created_at": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+                "message": {"role": "assistant", "content": content},
+                "done": done,
+            }
+
+        if stream:
+            self._start_stream(writer, "application/x-ndjson")
+
+            async def emit(piece: str) -> None:
+                writer.write((json.dumps(message(piece, False)) + "\n").encode("utf-8"))
+                await writer.drain()
+        else:
+            emit = None
+
+        eval_started = time.perf_counter()
+        eval_count = await self._generate(emit)
+        final = message("" if stream else self.reply, True)
+        final.update({
+            "done_reason": "stop",
+            "total_duration": int((time.perf_counter() - started) * 1e9),
+            "load_duration": int(load_s * 1e9),
+            "prompt_eval_count": _estimate_prompt_tokens(messages),
+            "prompt_eval_duration": 0,
+            "eval_count": eval_count,
+            "eval_duration": max(1, int((time.perf_counter() - eval_started) * 1e9)),
+        })
+        if stream:
+            writer.write((json.dumps(final) + "\n").encode("utf-8"))
+            await writer.drain()
+        else:
+            await self._send_json(writer, 200, final)
+
+
+@contextmanager
+def serve_in_thread(server: StubLLMServer) -> Iterator[StubLLMServer]:
+    """Запускает сервер в фоновом потоке со своим event loop.
+
+    Нужен синхронным клиентам (``urllib`` в бенчмарках) и тестам, которые
+    сами вызывают ``asyncio.run``.
+    """
+    loop = asyncio.new_event_loop()
+    thread = threading.Thread(target=loop.run_forever, name="stub-llm", daemon=True)
+    thread.start()
+    try:
+        asyncio.run_coroutine_threadsafe(server.start(), loop).result()
+        yield server
+    finally:
+        asyncio.run_coroutine_threadsafe(server.stop(), loop).result()
+        loop.call_soon_threadsafe(loop.stop)
+        thread.join()
+        loop.close()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Stub LLM-сервер (OpenAI + Ollama протоколы)")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8099)
+    parser.add_argument("--reply", default="Это ответ stub-сервера. " * 20)
+    parser.add_argument("--delay", type=float, default=0.0, help="пауза до заголовков, с")
+    parser.add_argument("--ttft", type=float, default=0.2, help="время до первого чанка, с")
+    parser.add_argument("--tps", type=float, default=50.0, help="токенов в секунду (0 — без пауз)")
+    parser.add_argument("--chunk", type=int, default=1, help="токенов в чанке")
+    parser.add_argument("--load", type=float, default=0.0, help="имитация загрузки модели при смене, с")
+    parser.add_argument("--max-loaded", type=int, default=1, help="моделей в памяти одновременно")
+    parser.add_argument("--max-concurrency", type=int, default=None)
+    parser.add_argument("--rate-limit-rate", type=float, default=0.0, help="доля ответов 429")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="доля ответов 5xx")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    server = StubLLMServer(
+        reply=args.reply,
+        delay_s=args.delay,
+        max_concurrency=args.max_concurrency,
+        host=args.host,
+        port=args.port,
+        ttft_s=args.ttft,
+        tokens_per_s=args.tps,
+        chunk_tokens=args.chunk,
+        load_s=args.load,
+        max_loaded=args.max_loaded,
+        rate_limit_rate=args.rate_limit_rate,
+        error_rate=args.error_rate,
+        seed=args.seed,
+    )
+
+    async def run() -> None:
+        await server.start()
+        print(f"OpenAI: {server.base_url}  Ollama: {server.root_url}/api/chat", flush=True)
+        try:
+            await asyncio.Event().wait()
+        finally:
+            await server.stop()
+
+    try:
+        asyncio.run(run())
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
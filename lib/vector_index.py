@@ -0,0 +1,190 @@
+"""Локальные векторные индексы на NumPy.
+
+- ``VectorIndex`` — точный brute-force косинусный поиск, до ~100k векторов;
+- ``IVFIndex`` — приближённый (ANN) inverted-file индекс: k-means разбивает
+  пространство на ``nlist`` кластеров, поиск смотрит только ``nprobe`` ближайших.
+"""
+
+from typing import Dict, Hashable, List, Sequence, Tuple
+
+import numpy as np
+
+
+class VectorIndex:
+    """In-memory индекс нормированных векторов с удалением по ключу.
+
+    Векторы лежат в одной матрице с запасом ёмкости (удвоение при росте),
+    удаление — перестановкой последней строки на место удалённой, O(1).
+    Поиск — одно матричное умножение + ``argpartition`` для top-k.
+    """
+
+    def __init__(self, dim: int, capacity: int = 64):
+        self.dim = dim
+        self._matrix = np.zeros((capacity, dim), dtype=np.float32)
+        self._keys: List[Hashable] = []
+        self._positions: Dict[Hashable, int] = {}
+
+    def __len__(self) -> int:
+        return len(self._keys)
+
+    def __contains__(self, key: Hashable) -> bool:
+        return key in self._positions
+
+    def add(self, key: Hashable, vector: np.ndarray) -> None:
+        """Добавляет или заменяет вектор ключа."""
+        if key in self._positions:
+            self._matrix[self._positions[key]] = vector
+            return
+        size = len(self._keys)
+        if size == self._matrix.shape[0]:
+            grown = np.zeros((max(1, size * 2), self.dim), dtype=np.float32)
+            grown[:size] = self._matrix[:size]
+            self._matrix = grown
+        self._matrix[size] = vector
+        self._keys.append(key)
+        self._positions[key] = size
+
+    def add_many(self, keys: Sequence[Hashable], vectors: np.ndarray) -> None:
+        """Пакетное добавление новых ключей (без проверки на дубликаты — для bulk-загрузки)."""
+        size = len(self._keys)
+        needed = size + len(keys)
+        if needed > self._matrix.shape[0]:
+            grown = np.zeros((max(needed, size * 2), self.dim), dtype=np.float32)
+            grown[:size] = self._matrix[:size]
+            self._matrix = grown
+        self._matrix[size:needed] = vectors
+        for offset, key in enumerate(keys):
+            self._positions[key] = size + offset
+        self._keys.extend(keys)
+
+    def vectors(self) -> Tuple[List[Hashable], np.ndarray]:
+        """Ключи и матрица векторов (view, без копии)."""
+        return self._keys, self._matrix[:len(self._keys)]
+
+    def remove(self, key: Hashable) -> None:
+        pos = self._positions.pop(key, None)
+        if pos is None:
+            return
+        last = len(self._keys) - 1
+        if pos != last:
+            last_key = self._keys[last]
+            self._matrix[pos] = self._matrix[last]
+            self._keys[pos] = last_key
+            self._positions[last_key] = pos
+        self._keys.pop()
+
+    def search(self, vector: np.ndarray, k: int = 5) -> List[Tuple[Hashable, float]]:
+        """Top-k ключей по косинусной близости (векторы уже нормированы), по убыванию."""
+        size = len(self._keys)
+        if size == 0 or k <= 0:
+            return []
+        scores = self._matrix[:size] @ vector
+        k = min(k, size)
+        if k < size:
+            top = np.argpartition(-scores, k - 1)[:k]
+        else:
+            top = np.arange(size)
+        top = top[np.argsort(-scores[top])]
+        return [(self._keys[i], float(scores[i])) for i in top]
+
+
+def _normalize_rows(matrix: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return matrix / norms
+
+
+class IVFIndex:
+    """Приближённый индекс: сферический k-means + inverted lists из ``VectorIndex``.
+
+    Перед добавлением нужно обучить центроиды (``train``) на выборке векторов.
+    Точность регулируется ``nprobe``: больше кластеров — выше recall и медленнее.
+    """
+
+    def __init__(self, dim: int, nlist: int = 256, nprobe: int = 16):
+        self.dim = dim
+        self.nlist = nlist
+        self.nprobe = nprobe
+        self.centroids = np.zeros((0, dim), dtype=np.float32)
+        self._lists: List[VectorIndex] = []
+        self._assignment: Dict[Hashable, int] = {}
+
+    def __len__(self) -> int:
+        return len(self._assignment)
+
+    def __contains__(self, key: Hashable) -> bool:
+        return key in self._assignment
+
+    @property
+    def trained(self) -> bool:
+        return len(self.centroids) > 0
+
+    def train(self, sample: np.ndarray, iterations: int = 10, seed: int = 0) -> None:
+        """Обучает центроиды на выборке (несколько итераций k-means по косинусу)."""
+        rng = np.random.default_rng(seed)
+        nlist = min(self.nlist, len(sample))
+        centroids = sample[rng.choice(len(sample), nlist, replace=False)].copy()
+        for _ in range(iterations):
+            labels = self._nearest(sample, centroids)
+            sums = np.zeros_like(centroids)
+            np.add.at(sums, labels, sample)
+            empty = ~sums.any(axis=1)
+            sums[empty] = centroids[empty]
+            centroids = _normalize_rows(sums).astype(np.float32)
+        self.centroids = centroids
+        self._lists = [VectorIndex(self.dim, capacity=16) for _ in range(nlist)]
+
+    @staticmethod
+    def _nearest(vectors: np.ndarray, centroids: np.ndarray, batch: int = 65536) -> np.ndarray:
+        labels = np.empty(len(vectors), dtype=np.int64)
+        for start in range(0, len(vectors), batch):
+            part = vectors[start:start + batch]
+            labels[start:start + batch] = np.argmax(part @ centroids.T, axis=1)
+        return labels
+
+    def add(self, key: Hashable, vector: np.ndarray) -> None:
+        if key in self._assignment:
+            self.remove(key)
+        list_id = int(np.argmax(self.centroids @ vector))
+        self._lists[list_id].add(key, vector)
+        self._assignment[key] = list_id
+
+    def add_many(self, keys: Sequence[Hashable], vectors: np.ndarray) -> None:
+        labels = self._nearest(vectors, self.centroids)
+        order = np.argsort(labels, kind="stable")
+        bounds = np.searchsorted(labels[order], np.arange(len(self._lists) + 1))
+        for list_id in range(len(self._lists)):
+            rows = order[bounds[list_id]:bounds[list_id + 1]]
+            if len(rows):
+                list_keys = [keys[i] for i in rows]
+                self._lists[list_id].add_many(list_keys, vectors[rows])
+                for key in list_keys:
+                    self._assignment[key] = list_id
+
+    def remove(self, key: Hashable) -> None:
+        list_id = self._assignment.pop(key, None)
+        if list_id is not None:
+            self._lists[list_id].remove(key)
+
+    def search(self, vector: np.ndarray, k: int = 5) -> List[Tuple[Hashable, float]]:
+        if not self._assignment or k <= 0:
+            return []
+        nprobe = min(self.nprobe, len(self.centroids))
+        probes = np.argpartition(-(self.centroids @ vector), nprobe - 1)[:nprobe]
+        candidates: List[Tuple[Hashable, float]] = []
+        for list_id in probes:
+            candidates.extend(self._lists[list_id].search(vector, k))
+        candidates.sort(key=lambda item: item[1], reverse=True)
+        return candidates[:k]
+
+    @classmethod
+    def from_index(cls, index: VectorIndex, nlist: int = 0, nprobe: int = 16) -> "IVFIndex":
+        """Строит IVF из brute-force индекса; ``nlist`` по умолчанию ~ sqrt(N)."""
+        keys, matrix = index.vectors()
+        nlist = nlist or max(1, int(len(keys) ** 0.5))
+        ivf = cls(index.dim, nlist=nlist, nprobe=nprobe)
+        sample_size = min(len(keys), max(nlist * 40, 10000))
+        sample = matrix[np.random.default_rng(0).choice(len(keys), sample_size, replace=False)]
+        ivf.train(sample)
+        ivf.add_many(list(keys), matrix)
+        return ivf
@@ -14,22 +14,32 @@
     python3 tasks/run_local_loop.py              # все 18 задач
     python3 tasks/run_local_loop.py T-01 T-05    # подмножество
 
+Размер контекста (``num_ctx``) — наименьший из ``lib/ollama.py``, в который
+влезает самый длинный промпт прогона плюс бюджет ответа; один на весь прогон.
+
 Требует `ollama serve` и `ollama pull gemma4:e4b` (9.6 GB).
 """
 
 import json
+import logging
 import re
 import sys
 import time
-import urllib.request
 from pathlib import Path
 
 ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+
+from lib.ollama import ContextSizer, chat_request, chat_stream  # noqa: E402
+from lib.output_guard import OutputGuard  # noqa: E402
+
 BACKLOG_PATH = ROOT / "tasks" / "backlog.md"
 OUT_DIR = ROOT / "tasks" / "runs" / "run-local"
 STATS_PATH = OUT_DIR / "stats.json"
-OLLAMA_URL = "http://localhost:11434/api/chat"
 MODEL = "gemma4:e4b"
+# Ответы — полные файлы с кодом; самые длинные в прошлых прогонах ~8k токенов
+MAX_OUTPUT_TOKENS = 8192
+SIZER = ContextSizer(max_output_tokens=MAX_OUTPUT_TOKENS)
 
 CODE_FILES = [
     "app.py",
@@ -111,23 +121,20 @@ def build_user_prompt(task: dict, code_ctx: str) -> str:
     )
 
 
+def _messages(system: str, user: str) -> list[dict]:
+    return [
+        {"role": "system", "content": system},
+        {"role": "user", "content": user},
+    ]
+
+
 def ask(model: str, system: str, user: str) -> dict:
-    payload = {
-        "model": model,
-        "messages": [
-            {"role": "system", "content": system},
-            {"role": "user", "content": user},
-        ],
-        "stream": False,
-        "options": {"temperature": 0.2, "top_p": 0.9, "num_ctx": 32768},
-    }
-    data = json.dumps(payload).encode("utf-8")
-    req = urllib.request.Request(
-        OLLAMA_URL, data=data, headers={"Content-Type": "application/json"}
-    )
+    messages = _messages(system, user)
+    num_ctx = SIZER.fit(model, messages)
+    payload = chat_request(model, messages, num_ctx, MAX_OUTPUT_TOKENS)
     t0 = time.time()
-    with urllib.request.urlopen(req, timeout=900) as resp:
-        body = json.loads(resp.read().decode("utf-8"))
+    # Стрим под стражем: зациклившийся ответ обрывается, а не крутится до num_predict
+    body = chat_stream(payload, OutputGuard(max_tokens=MAX_OUTPUT_TOKENS), timeout=900)
     wall = time.time() - t0
     content = body["message"]["content"]
     eval_count = body.get("eval_count", 0)
@@ -138,11 +145,14 @@ def ask(model: str, system: str, user: str) -> dict:
         "wall_s": round(wall, 2),
         "eval_count": eval_count,
         "tok_per_s": round(tok_per_s, 1),
+        "num_ctx": num_ctx,
+        **({"aborted": body["aborted"]} if "aborted" in body else {}),
     }
 
 
 def save_task(task: dict, out: dict, prompt: str) -> None:
     path = OUT_DIR / f"{task['id']}.md"
+    aborted = f"- **Остановлен стражем вывода:** {out['aborted']}\n" if out.get("aborted") else ""
     path.write_text(
         f"# {task['id']} — {task['type']}\n\n"
         f"**Описание:** {task['desc']}\n\n"
@@ -150,13 +160,15 @@ def save_task(task: dict, out: dict, prompt: str) -> None:
         f"- Модель: **{MODEL}**\n"
         f"- Время (wall): **{out['wall_s']}s**\n"
         f"- Токенов в ответе: **{out['eval_count']}**\n"
-        f"- Скорость: **{out['tok_per_s']} tok/s**\n\n"
+        f"- Скорость: **{out['tok_per_s']} tok/s**\n"
+        f"{aborted}\n"
         f"## Ответ модели\n\n{out['content']}\n",
         encoding="utf-8",
     )
 
 
 def main() -> None:
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
     OUT_DIR.mkdir(parents=True, exist_ok=True)
     all_tasks = parse_backlog()
     argv_ids = {a for a in sys.argv[1:] if a.startswith("T-")}
@@ -166,7 +178,8 @@ def main() -> None:
         sys.exit(1)
 
     code_ctx = load_code_context()
-    print(f"Контекст проекта: {len(code_ctx)} символов", flush=True)
+    num_ctx = SIZER.reserve(_messages(SYSTEM_PROMPT, build_user_prompt(t, code_ctx)) for t in tasks)
+    print(f"Контекст проекта: {len(code_ctx)} символов, num_ctx {num_ctx}", flush=True)
 
     if STATS_PATH.exists():
         stats = json.loads(STATS_PATH.read_text(encoding="utf-8"))
@@ -189,10 +202,13 @@ def main() -> None:
             "wall_s": r["wall_s"],
             "eval_count": r["eval_count"],
             "tok_per_s": r["tok_per_s"],
+            "num_ctx": r["num_ctx"],
+            **({"aborted": r["aborted"]} if "aborted" in r else {}),
         }
         total_wall += r["wall_s"]
         print(
-            f"  -> {r['wall_s']}s, {r['tok_per_s']} tok/s, tokens={r['eval_count']}",
+            f"  -> {r['wall_s']}s, {r['tok_per_s']} tok/s, tokens={r['eval_count']}"
+            + (f", остановлен: {r['aborted']}" if r.get("aborted") else ""),
             flush=True,
         )
         STATS_PATH.write_text(json.dumps(stats, indent=2), encoding="utf-8")
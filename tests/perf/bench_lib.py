@@ -0,0 +1,320 @@
+#!/usr/bin/env python3
+"""Микробенчмарки горячих функций lib/ с сохранённым baseline.
+
+Каждый случай — функция и ряд размеров входа (история на 10k сообщений,
+аналитика на 100k записей, профиль на 1 MB). На каждом размере: прогрев,
+повторные замеры (``min`` и медиана), пик аллокаций через ``tracemalloc``
+отдельным прогоном. По минимумам на всех размерах считается наклон
+``log(время) / log(размер)`` — показатель сложности: ~0 у O(1), ~1 у O(n),
+~2 у O(n²). Он почти не зависит от машины, поэтому регрессия сложности
+ловится и на другом железе, а абсолютное время сравнивается с большим
+допуском.
+
+Сравнение с baseline (``tests/perf/baselines/bench_lib.json``):
+
+- наклон вырос больше чем на ``SLOPE_TOLERANCE``;
+- время на наибольшем размере больше baseline в ``--time-tolerance`` раз;
+- пик памяти на наибольшем размере больше baseline в ``MEMORY_TOLERANCE`` раз.
+
+Работает офлайн, весь набор — меньше минуты.
+
+Запуск:
+    python3 -m tests.perf.bench_lib                         # сравнение с baseline
+    python3 -m tests.perf.bench_lib --cases analytics       # только часть случаев
+    python3 -m tests.perf.bench_lib --update                # перезаписать baseline
+"""
+
+import argparse
+import json
+import platform
+import statistics
+import sys
+import time
+import tracemalloc
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+from lib.analytics import Analytics, UsageSummary
+from lib.compress import format_history
+from lib.history import chunk_history, trim_history
+from lib.openrouter_client import MessageSequence, build_messages
+from lib.output_guard import OutputGuard
+from lib.profile import extract_name, parse_profile
+from lib.router import turn_features
+
+BASELINE_PATH = Path(__file__).parent / "baselines" / "bench_lib.json"
+
+SLOPE_TOLERANCE = 0.35
+TIME_TOLERANCE = 3.0
+MEMORY_TOLERANCE = 2.0
+# Пики меньше этого — шум аллокатора, не регрессия
+MEMORY_FLOOR_KB = 64.0
+
+# Замер одного размера: не меньше MIN_ROUNDS повторов, дальше — пока не истёк бюджет
+MIN_ROUNDS = 5
+MAX_ROUNDS = 200
+ROUND_BUDGET_S = 0.25
+
+# factory(size) -> (prepare, run): prepare() вне замера готовит аргумент run
+# (свежая копия для функций, меняющих вход на месте)
+Factory = Callable[[int], Tuple[Callable[[], Any], Callable[[Any], Any]]]
+CASES: Dict[str, Tuple[Sequence[int], Factory]] = {}
+
+
+def case(name: str, sizes: Sequence[int]):
+    def register(factory: Factory) -> Factory:
+        CASES[name] = (tuple(sizes), factory)
+        return factory
+    return register
+
+
+REPLY = "Ответ ассистента с кодом и пояснениями, чтобы было что резать. " * 4
+
+
+def _dialog(messages: int) -> List[Dict[str, str]]:
+    history = [{"role": "system", "content": "Ты — личный AI-помощник."}]
+    for i in range(messages // 2):
+        history.append({"role": "user", "content": f"Вопрос номер {i}: как это сделать?"})
+        history.append({"role": "assistant", "content": REPLY})
+    return history
+
+
+def _usage(records: int) -> List[Dict[str, Any]]:
+    usage: List[Dict[str, Any]] = []
+    for i in range(records):
+        Analytics.record_usage(f"вопрос {i} " * 3, "ответ " * (i % 50), None, usage)
+        usage[-1]["ttft_ms"] = 100.0 + i % 7
+    return usage
+
+
+def _profile(size_bytes: int) -> str:
+    section = "## Раздел {i}\n- Интересы: программирование, бег, книги про {i}\n" + "Заметка о целях. " * 10 + "\n"
+    parts = []
+    total = 0
+    while total < size_bytes:
+        parts.append(section.format(i=len(parts)))
+        total += len(parts[-1].encode("utf-8"))
+    # Имя в конце — худший случай для поиска по всему файлу
+    return "# Профиль\n" + "".join(parts) + "- **Имя:** Иван\n"
+
+
+@case("history.trim_history", (100, 1_000, 10_000))
+def _trim_history(size):
+    dialog = _dialog(size)
+    limit = sum(len(m["content"].split()) for m in dialog) // 2
+    return (lambda: list(dialog)), (lambda messages: trim_history(messages, limit))
+
+
+@case("history.chunk_history", (1_000, 10_000, 50_000))
+def _chunk_history(size):
+    dialog = _dialog(size)
+    return (lambda: dialog), (lambda messages: chunk_history(messages, 1500))
+
+
+@case("compress.format_history", (1_000, 10_000, 50_000))
+def _format_history(size):
+    dialog = _dialog(size)[1:]
+    return (lambda: dialog), format_history
+
+
+@case("openrouter_client.build_messages", (100, 1_000, 10_000))
+def _build_messages(size):
+    dialog = _dialog(size)[1:]
+    return (lambda: dialog), (lambda history: build_messages("новый вопрос", history, "system"))
+
+
+@case("openrouter_client.MessageSequence.prepare", (100, 1_000, 10_000))
+def _sequence_prepare(size):
+    dialog = _dialog(size)[1:]
+    sequence = MessageSequence()
+    sequence.prepare("прогрев", dialog, "system")
+    return (lambda: dialog), (lambda history: sequence.prepare("новый вопрос", history, "system"))
+
+
+@case("analytics.format_dashboard", (1_000, 10_000, 100_000))
+def _format_dashboard(size):
+    usage = _usage(size)
+    return (lambda: usage), Analytics.format_dashboard
+
+
+@case("analytics.get_stats", (1_000, 10_000, 100_000))
+def _get_stats(size):
+    usage = _usage(size)
+    return (lambda: usage), Analytics.get_stats
+
+
+@case("analytics.UsageSummary.render", (1_000, 10_000, 100_000))
+def _summary_render(size):
+    usage = _usage(size)
+    summary = UsageSummary()
+    summary.render(usage)
+    extra = _usage(1)[0]
+
+    def run(records):
+        # Новый ход и /summary: досчитать одну запись и отрендерить страницу
+        records.append(extra)
+        return summary.render(records)
+    return (lambda: usage), run
+
+
+@case("profile.extract_name", (1_000, 100_000, 1_000_000))
+def _extract_name(size):
+    content = _profile(size)
+    return (lambda: content), extract_name
+
+
+@case("profile.parse_profile", (1_000, 100_000, 1_000_000))
+def _parse_profile(size):
+    content = _profile(size)
+    return (lambda: content), parse_profile
+
+
+@case("router.turn_features", (1_000, 10_000, 100_000))
+def _turn_features(size):
+    text = ("Напиши функцию на Python, которая сортирует список. " * (size // 50 + 1))[:size]
+    return (lambda: text), turn_features
+
+
+@case("output_guard.OutputGuard.feed", (1_000, 10_000, 100_000))
+def _guard_feed(size):
+    text = " ".join(f"Обычный ответ модели номер {i}." for i in range(size // 20 + 1))[:size]
+    chunks = [text[i:i + 8] for i in range(0, len(text), 8)]
+
+    def run(_):
+        guard = OutputGuard(max_tokens=0)
+        for chunk in chunks:
+            guard.feed(chunk)
+    return (lambda: None), run
+
+
+def measure(size: int, factory: Factory, warmup: int = 1) -> Dict[str, float]:
+    """Прогрев, повторы до бюджета времени и отдельный прогон под tracemalloc."""
+    prepare, run = factory(size)
+    for _ in range(warmup):
+        run(prepare())
+
+    samples: List[float] = []
+    spent = 0.0
+    while len(samples) < MIN_ROUNDS or (spent < ROUND_BUDGET_S and len(samples) < MAX_ROUNDS):
+        arg = prepare()
+        t0 = time.perf_counter()
+        run(arg)
+        elapsed = time.perf_counter() - t0
+        samples.append(elapsed)
+        spent += elapsed
+
+    arg = prepare()
+    tracemalloc.start()
+    try:
+        run(arg)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    return {
+        "rounds": len(samples),
+        "min_us": round(min(samples) * 1e6, 2),
+        "median_us": round(statistics.median(samples) * 1e6, 2),
+        "peak_kb": round(peak / 1024, 1),
+    }
+
+
+def _slope(sizes: Sequence[int], values: Sequence[float]) -> float:
+    """Наклон log-log прямой: показатель степени роста."""
+    floor = 1e-3  # 1 нс (в мкс/KB) — нули не ломают логарифм
+    xs = np.log([float(s) for s in sizes])
+    ys = np.log([max(float(v), floor) for v in values])
+    return round(float(np.polyfit(xs, ys, 1)[0]), 2)
+
+
+def run_case(name: str) -> Dict[str, Any]:
+    sizes, factory = CASES[name]
+    points = {str(size): measure(size, factory) for size in sizes}
+    return {
+        "sizes": points,
+        "time_slope": _slope(sizes, [p["min_us"] for p in points.values()]),
+        "memory_slope": _slope(sizes, [p["peak_kb"] for p in points.values()]),
+    }
+
+
+def compare(
+    current: Dict[str, Any],
+    baseline: Dict[str, Any],
+    time_tolerance: float = TIME_TOLERANCE,
+) -> List[str]:
+    """Регрессии ``current`` относительно ``baseline`` (по случаю на строку)."""
+    problems = []
+    for name, result in current.items():
+        base = baseline.get(name)
+        if base is None:
+            continue
+        if result["time_slope"] > base["time_slope"] + SLOPE_TOLERANCE:
+            problems.append(
+                f"{name}: сложность выросла, наклон {base['time_slope']} -> {result['time_slope']}"
+            )
+        largest = max(result["sizes"], key=int)
+        now, was = result["sizes"][largest], base["sizes"].get(largest)
+        if was is None:
+            continue
+        if now["min_us"] > was["min_us"] * time_tolerance:
+            problems.append(
+                f"{name}[{largest}]: {was['min_us']} -> {now['min_us']} мкс "
+                f"(x{now['min_us'] / was['min_us']:.1f})"
+            )
+        if now["peak_kb"] > max(was["peak_kb"] * MEMORY_TOLERANCE, MEMORY_FLOOR_KB):
+            problems.append(f"{name}[{largest}]: пик памяти {was['peak_kb']} -> {now['peak_kb']} KB")
+    return problems
+
+
+def load_baseline(path: Path = BASELINE_PATH) -> Dict[str, Any]:
+    try:
+        return json.loads(path.read_text(encoding="utf-8"))
+    except (OSError, ValueError):
+        return {}
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--cases", nargs="+", default=[], help="префиксы имён случаев (по умолчанию все)")
+    parser.add_argument("--baseline", type=Path, default=BASELINE_PATH)
+    parser.add_argument("--update", action="store_true", help="записать результаты как новый baseline")
+    parser.add_argument("--time-tolerance", type=float, default=TIME_TOLERANCE)
+    args = parser.parse_args(argv)
+
+    names = [n for n in CASES if not args.cases or any(n.startswith(p) for p in args.cases)]
+    started = time.perf_counter()
+    results = {}
+    for name in names:
+        results[name] = run_case(name)
+        largest = max(results[name]["sizes"], key=int)
+        print(json.dumps({
+            "case": name,
+            "time_slope": results[name]["time_slope"],
+            "memory_slope": results[name]["memory_slope"],
+            "largest": int(largest),
+            **results[name]["sizes"][largest],
+        }, ensure_ascii=False), flush=True)
+    print(f"{len(names)} случаев за {time.perf_counter() - started:.1f} с", flush=True)
+
+    baseline = load_baseline(args.baseline)
+    if args.update:
+        cases = {**baseline.get("cases", {}), **results}
+        args.baseline.parent.mkdir(parents=True, exist_ok=True)
+        args.baseline.write_text(json.dumps({
+            "python": platform.python_version(),
+            "machine": platform.machine(),
+            "cases": cases,
+        }, indent=2, ensure_ascii=False) + "\n", encoding="utf-8")
+        print(f"baseline -> {args.baseline}")
+        return 0
+
+    problems = compare(results, baseline.get("cases", {}), args.time_tolerance)
+    for problem in problems:
+        print(f"РЕГРЕССИЯ {problem}", file=sys.stderr)
+    return 1 if problems else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
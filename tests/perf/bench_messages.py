@@ -0,0 +1,84 @@
+#!/usr/bin/env python3
+"""Бенчмарк подготовки сообщений на ход: build_messages vs MessageSequence.
+
+Старый путь каждый ход копирует историю в новый список (``build_messages``)
+и заново создаёт объекты LangChain для всех реплик (``to_langchain_messages``).
+``MessageSequence`` конвертирует только добавленные реплики. Замеряется
+полная подготовка одного хода (добавить пару реплик + собрать сообщения для
+клиента) на диалогах разной длины.
+
+Запуск:
+    python3 -m tests.perf.bench_messages                  # 10, 100, 1000 ходов
+    python3 -m tests.perf.bench_messages --turns 10 5000
+"""
+
+import argparse
+import json
+import time
+
+import numpy as np
+
+from lib.openrouter_client import MessageSequence, build_messages, to_langchain_messages
+
+SYSTEM_PROMPT = "Ты — личный AI-помощник. " * 40
+REPLY = "Ответ ассистента с кодом и пояснениями. " * 20
+
+
+def _dialog(turns: int):
+    history = []
+    for i in range(turns):
+        history.append({"role": "user", "content": f"Вопрос номер {i}: как это сделать?"})
+        history.append({"role": "assistant", "content": REPLY})
+    return history
+
+
+def _percentile_us(samples, q):
+    return round(float(np.percentile(samples, q)) * 1e6, 1)
+
+
+def bench(turns: int, rounds: int) -> dict:
+    legacy_history = _dialog(turns)
+    seq_history = _dialog(turns)
+    sequence = MessageSequence()
+    sequence.prepare("прогрев", seq_history, SYSTEM_PROMPT)
+
+    legacy, cached = [], []
+    for i in range(rounds):
+        question = f"Новый вопрос {i}"
+
+        t0 = time.perf_counter()
+        to_langchain_messages(build_messages(question, legacy_history, SYSTEM_PROMPT))
+        legacy.append(time.perf_counter() - t0)
+
+        t0 = time.perf_counter()
+        to_langchain_messages(sequence.prepare(question, seq_history, SYSTEM_PROMPT))
+        cached.append(time.perf_counter() - t0)
+
+        # Ход завершён: в историю добавляется пара реплик, как в on_message
+        for history in (legacy_history, seq_history):
+            history.append({"role": "user", "content": question})
+            history.append({"role": "assistant", "content": REPLY})
+
+    return {
+        "turns": turns,
+        "messages": 2 * turns + 2,
+        "build_messages_p50_us": _percentile_us(legacy, 50),
+        "build_messages_p99_us": _percentile_us(legacy, 99),
+        "sequence_p50_us": _percentile_us(cached, 50),
+        "sequence_p99_us": _percentile_us(cached, 99),
+        "speedup_p50": round(float(np.median(legacy) / np.median(cached)), 1),
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--turns", type=int, nargs="+", default=[10, 100, 1000])
+    parser.add_argument("--rounds", type=int, default=50)
+    args = parser.parse_args()
+
+    for turns in args.turns:
+        print(json.dumps(bench(turns, args.rounds)), flush=True)
+
+
+if __name__ == "__main__":
+    main()
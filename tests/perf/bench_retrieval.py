@@ -0,0 +1,99 @@
+#!/usr/bin/env python3
+"""Бенчмарк поиска долгосрочной памяти: brute-force vs IVF (ANN).
+
+Векторы — синтетические: точки вокруг случайных «тем» (кластеров), как
+у реальных эмбеддингов диалогов. Эмбеддинг миллиона текстов занял бы дольше
+самого замера, а латентность поиска от содержимого не зависит. На равномерно
+случайных векторах (без кластеров) recall IVF заметно ниже — это худший случай.
+Для каждого размера: время построения, p50/p99 латентности поиска top-k,
+recall@k IVF относительно точного поиска.
+
+Запуск:
+    python3 -m tests.perf.bench_retrieval                       # 10k и 1M, dim=256
+    python3 -m tests.perf.bench_retrieval --sizes 10000 --dim 64
+
+Память: 1M x 256 float32 ~ 1 GB на brute-force индекс (+ столько же на IVF).
+"""
+
+import argparse
+import json
+import time
+
+import numpy as np
+
+from lib.vector_index import IVFIndex, VectorIndex
+
+
+def _percentile_ms(samples, q):
+    return round(float(np.percentile(samples, q)) * 1000, 3)
+
+
+def _timed_search(index, queries, k):
+    samples = []
+    results = []
+    for q in queries:
+        t0 = time.perf_counter()
+        results.append({key for key, _ in index.search(q, k)})
+        samples.append(time.perf_counter() - t0)
+    return samples, results
+
+
+def bench(size: int, dim: int, queries: int, k: int, nprobe: int) -> dict:
+    rng = np.random.default_rng(0)
+    topics = rng.standard_normal((max(1, size // 200), dim), dtype=np.float32)
+    data = topics[rng.integers(0, len(topics), size)]
+    data += 0.6 * rng.standard_normal((size, dim), dtype=np.float32)
+    data /= np.linalg.norm(data, axis=1, keepdims=True)
+    # Запросы — зашумлённые копии реальных точек, как «похожий вопрос».
+    picks = rng.choice(size, queries, replace=False)
+    noisy = data[picks] + 0.3 * rng.standard_normal((queries, dim), dtype=np.float32) / np.sqrt(dim)
+    noisy /= np.linalg.norm(noisy, axis=1, keepdims=True)
+
+    t0 = time.perf_counter()
+    brute = VectorIndex(dim, capacity=size)
+    brute.add_many(list(range(size)), data)
+    brute_build = time.perf_counter() - t0
+
+    t0 = time.perf_counter()
+    ivf = IVFIndex.from_index(brute, nprobe=nprobe)
+    ivf_build = time.perf_counter() - t0
+
+    brute_lat, exact = _timed_search(brute, noisy, k)
+    ivf_lat, approx = _timed_search(ivf, noisy, k)
+    recall = sum(len(e & a) for e, a in zip(exact, approx)) / (k * queries)
+
+    return {
+        "size": size,
+        "dim": dim,
+        "k": k,
+        "brute": {
+            "build_s": round(brute_build, 2),
+            "p50_ms": _percentile_ms(brute_lat, 50),
+            "p99_ms": _percentile_ms(brute_lat, 99),
+        },
+        "ivf": {
+            "nlist": ivf.nlist,
+            "nprobe": nprobe,
+            "build_s": round(ivf_build, 2),
+            "p50_ms": _percentile_ms(ivf_lat, 50),
+            "p99_ms": _percentile_ms(ivf_lat, 99),
+            "recall": round(recall, 3),
+        },
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10_000, 1_000_000])
+    parser.add_argument("--dim", type=int, default=256)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--k", type=int, default=5)
+    parser.add_argument("--nprobe", type=int, default=16)
+    args = parser.parse_args()
+
+    for size in args.sizes:
+        print(json.dumps(bench(size, args.dim, args.queries, args.k, args.nprobe)), flush=True)
+
+
+if __name__ == "__main__":
+    main()
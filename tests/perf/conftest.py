@@ -0,0 +1,20 @@
+"""Фикстуры perf-сьюта: stub LLM-сервер вместо OpenRouter/Ollama."""
+
+from contextlib import ExitStack
+
+import pytest
+
+from lib.stub_llm import StubLLMServer, serve_in_thread
+
+
+@pytest.fixture
+def stub_server():
+    """Фабрика stub-серверов: ``stub_server(ttft_s=0.1, ...)`` -> запущенный сервер.
+
+    Сервер живёт в отдельном потоке, поэтому с ним работают и ``asyncio.run``,
+    и синхронный ``urllib``. Все серверы останавливаются в конце теста.
+    """
+    with ExitStack() as stack:
+        def start(**kwargs) -> StubLLMServer:
+            return stack.enter_context(serve_in_thread(StubLLMServer(**kwargs)))
+        yield start
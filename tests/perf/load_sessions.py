@@ -0,0 +1,306 @@
+#!/usr/bin/env python3
+"""Нагрузочный прогон чата: N одновременных пользователей против stub LLM.
+
+Каждый симулированный пользователь проходит ``on_chat_start`` и затем
+``--turns`` сообщений через ``on_message`` из ``app.py`` — тот же путь, что и
+в Chainlit, но без websocket: ``cl.user_session`` подменяется на сессию,
+привязанную к contextvar своей asyncio-задачи, ``cl.Message`` — на заглушку,
+которая засекает первый токен. Вопросы берутся из реальных прогонов
+``tasks/runs/run-local/T-*.md``, ответ stub-сервера — начало ответа модели оттуда же.
+
+Метрики: пропускная способность (сообщений/с), p50/p99 end-to-end и TTFT
+``on_message``, лаг event loop (p50/p99/max), удерживаемая память на сессию
+(отдельная фаза под tracemalloc, чтобы не искажать латентность).
+
+Запуск:
+    python3 -m tests.perf.load_sessions                          # 50 пользователей x 4 сообщения
+    python3 -m tests.perf.load_sessions --users 200 --ttft 0.5 --tps 60
+    python3 -m tests.perf.load_sessions --compare data/perf/load-<commit>.json
+
+Результат пишется в ``data/perf/load-<commit>.json`` — файлы разных коммитов
+сравниваются через ``--compare``.
+"""
+
+import argparse
+import asyncio
+import contextvars
+import gc
+import json
+import os
+import re
+import subprocess
+import time
+import tracemalloc
+from pathlib import Path
+from types import SimpleNamespace
+from typing import Any, Dict, List, Optional
+
+import numpy as np
+
+from lib.stub_llm import StubLLMServer, split_tokens
+
+ROOT = Path(__file__).resolve().parent.parent.parent
+TRANSCRIPTS_DIR = ROOT / "tasks" / "runs" / "run-local"
+OUT_DIR = ROOT / "data" / "perf"
+
+_DESC_RE = re.compile(r"\*\*Описание:\*\*\s*(.+)")
+_ANSWER_MARK = "## Ответ модели"
+
+_session: contextvars.ContextVar = contextvars.ContextVar("load_session")
+_first_token: contextvars.ContextVar = contextvars.ContextVar("load_first_token")
+
+
+class ContextSession:
+    """``cl.user_session`` для нагрузки: отдельный dict в контексте каждой задачи."""
+
+    def get(self, key, default=None):
+        return _session.get().get(key, default)
+
+    def set(self, key, value):
+        _session.get()[key] = value
+
+
+class ProbeMessage:
+    """Заглушка ``cl.Message``: копит текст и засекает время первого токена."""
+
+    def __init__(self, content: str = "", **_kwargs):
+        self.content = content
+
+    async def send(self):
+        return self
+
+    async def update(self):
+        return self
+
+    async def stream_token(self, token: str):
+        probe = _first_token.get(None)
+        if probe is not None and probe[0] is None:
+            probe[0] = time.perf_counter()
+        self.content += token
+
+
+def load_transcripts(directory: Path = TRANSCRIPTS_DIR) -> List[Dict[str, str]]:
+    """Вопросы и ответы из прогонов ``T-NN.md`` (описание задачи + ответ модели)."""
+    transcripts = []
+    for path in sorted(directory.glob("T-*.md")):
+        text = path.read_text(encoding="utf-8")
+        desc = _DESC_RE.search(text)
+        answer = text.split(_ANSWER_MARK, 1)[1].strip() if _ANSWER_MARK in text else ""
+        if desc:
+            transcripts.append({"id": path.stem, "question": desc.group(1).strip(), "answer": answer})
+    if not transcripts:
+        transcripts.append({"id": "synthetic", "question": "Привет! Как дела?", "answer": "Всё хорошо."})
+    return transcripts
+
+
+def _percentile_ms(samples: List[float], q: float) -> float:
+    return round(float(np.percentile(samples, q)) * 1000, 1) if samples else 0.0
+
+
+async def _sample_loop_lag(stop: asyncio.Event, samples: List[float], interval_s: float = 0.01) -> None:
+    loop = asyncio.get_running_loop()
+    while not stop.is_set():
+        expected = loop.time() + interval_s
+        await asyncio.sleep(interval_s)
+        samples.append(max(0.0, loop.time() - expected))
+
+
+async def _simulate_user(app, user_idx: int, questions: List[str], turns: int, results: Dict[str, list]) -> Dict:
+    state: Dict[str, Any] = {"user": SimpleNamespace(identifier=f"load-{user_idx}")}
+    _session.set(state)
+    await app.on_chat_start()
+    for turn in range(turns):
+        question = questions[(user_idx + turn) % len(questions)]
+        probe: List[Optional[float]] = [None]
+        _first_token.set(probe)
+        started = time.perf_counter()
+        await app.on_message(SimpleNamespace(content=question))
+        finished = time.perf_counter()
+        results["latency"].append(finished - started)
+        if probe[0] is not None:
+            results["ttft"].append(probe[0] - started)
+    return state
+
+
+async def _run_users(app, users: int, turns: int, questions: List[str], ramp_s: float) -> Dict[str, Any]:
+    results: Dict[str, list] = {"latency": [], "ttft": []}
+    lag: List[float] = []
+    stop = asyncio.Event()
+    sampler = asyncio.create_task(_sample_loop_lag(stop, lag))
+
+    async def start_user(idx: int):
+        if ramp_s:
+            await asyncio.sleep(ramp_s * idx / users)
+        return await _simulate_user(app, idx, questions, turns, results)
+
+    started = time.perf_counter()
+    # Каждая задача получает свою копию контекста — как отдельная сессия Chainlit
+    sessions = await asyncio.gather(*(start_user(i) for i in range(users)))
+    wall = time.perf_counter() - started
+    stop.set()
+    await sampler
+    return {"wall": wall, "sessions": sessions, "lag": lag, **results}
+
+
+def _measure_memory(app, users: int, turns: int, questions: List[str]) -> Dict[str, float]:
+    """Память, которую удерживают сессии после диалога (отдельный прогон под tracemalloc)."""
+    gc.collect()
+    tracemalloc.start()
+    try:
+        baseline, _ = tracemalloc.get_traced_memory()
+        run = asyncio.run(_run_users(app, users, turns, questions, 0.0))
+        gc.collect()
+        current, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    del run
+    return {
+        "retained_kb_per_session": round((current - baseline) / users / 1024, 1),
+        "peak_kb_per_session": round((peak - baseline) / users / 1024, 1),
+    }
+
+
+def _git_commit() -> str:
+    try:
+        out = subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, capture_output=True, text=True, check=True
+        )
+        return out.stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def _configure_app(base_url: str, max_concurrency: int, warmup: bool = True):
+    """Импортирует app и направляет его клиентов на stub (после load_dotenv внутри app)."""
+    import app
+    from lib import openrouter_client
+
+    os.environ.update({
+        "OPENROUTER_API_KEY": "stub",
+        "OPENROUTER_BASE_URL": base_url,
+        "OPENROUTER_MODEL": "stub-model",
+        "OPENROUTER_FALLBACK_MODELS": "",
+        "OPENROUTER_MAX_RETRIES": "0",
+        "LLM_MAX_CONCURRENCY": str(max_concurrency),
+        "LLM_MAX_CONCURRENCY_CAP": str(max_concurrency),
+        "LLM_MAX_QUEUE": "100000",
+        "LOCAL_ROUTING": "0",
+        "SEMANTIC_CACHE": "0",
+        "LONG_TERM_MEMORY": "0",
+    })
+    openrouter_client._admission_controller = None
+    app.cl.user_session = ContextSession()
+    app.cl.Message = ProbeMessage
+    app.WARMUP_ENABLED = warmup
+    return app
+
+
+def run_load(
+    users: int = 50,
+    turns: int = 4,
+    ttft_s: float = 0.2,
+    tokens_per_s: float = 200.0,
+    chunk_tokens: int = 4,
+    reply_tokens: int = 200,
+    ramp_s: float = 0.0,
+    max_concurrency: int = 1000,
+    memory: bool = True,
+    warmup: bool = True,
+) -> Dict[str, Any]:
+    """Прогон нагрузки целиком: stub в фоне, пользователи в текущем потоке."""
+    from lib.stub_llm import serve_in_thread
+
+    transcripts = load_transcripts()
+    questions = [t["question"] for t in transcripts]
+    answer = next((t["answer"] for t in transcripts if t["answer"]), "ok")
+    reply = "".join(split_tokens(answer)[:reply_tokens])
+
+    server = StubLLMServer(reply=reply, ttft_s=ttft_s, tokens_per_s=tokens_per_s, chunk_tokens=chunk_tokens)
+    with serve_in_thread(server):
+        app = _configure_app(server.base_url, max_concurrency, warmup)
+        run = asyncio.run(_run_users(app, users, turns, questions, ramp_s))
+        stub_requests = server.requests
+        mem = _measure_memory(app, users, turns, questions) if memory else {}
+
+    messages = len(run["latency"])
+    return {
+        "commit": _git_commit(),
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "config": {
+            "users": users,
+            "turns": turns,
+            "ttft_s": ttft_s,
+            "tokens_per_s": tokens_per_s,
+            "chunk_tokens": chunk_tokens,
+            "reply_tokens": len(split_tokens(reply)),
+            "ramp_s": ramp_s,
+            "max_concurrency": max_concurrency,
+            "warmup": warmup,
+        },
+        "results": {
+            "messages": messages,
+            "wall_s": round(run["wall"], 2),
+            "throughput_msg_s": round(messages / run["wall"], 1) if run["wall"] else 0.0,
+            "latency_p50_ms": _percentile_ms(run["latency"], 50),
+            "latency_p99_ms": _percentile_ms(run["latency"], 99),
+            "ttft_p50_ms": _percentile_ms(run["ttft"], 50),
+            "ttft_p99_ms": _percentile_ms(run["ttft"], 99),
+            "loop_lag_p50_ms": _percentile_ms(run["lag"], 50),
+            "loop_lag_p99_ms": _percentile_ms(run["lag"], 99),
+            "loop_lag_max_ms": round(max(run["lag"], default=0.0) * 1000, 1),
+            "stub_requests": stub_requests,
+            **mem,
+        },
+    }
+
+
+def compare(current: Dict[str, Any], baseline: Dict[str, Any]) -> Dict[str, str]:
+    """Изменение каждой метрики относительно baseline (в процентах)."""
+    diff = {}
+    for key, value in current["results"].items():
+        before = baseline.get("results", {}).get(key)
+        if isinstance(value, (int, float)) and isinstance(before, (int, float)) and before:
+            diff[key] = f"{before} -> {value} ({(value - before) / before * 100:+.1f}%)"
+    return diff
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--users", type=int, default=50)
+    parser.add_argument("--turns", type=int, default=4)
+    parser.add_argument("--ttft", type=float, default=0.2)
+    parser.add_argument("--tps", type=float, default=200.0)
+    parser.add_argument("--chunk", type=int, default=4)
+    parser.add_argument("--reply-tokens", type=int, default=200)
+    parser.add_argument("--ramp", type=float, default=0.0, help="растянуть старт пользователей на N секунд")
+    parser.add_argument("--max-concurrency", type=int, default=1000, help="LLM_MAX_CONCURRENCY на время прогона")
+    parser.add_argument("--no-memory", action="store_true", help="пропустить фазу замера памяти")
+    parser.add_argument("--no-warmup", action="store_true", help="без прогрева соединений на старте чата")
+    parser.add_argument("--out", type=Path, default=None)
+    parser.add_argument("--compare", type=Path, default=None, help="JSON прошлого прогона")
+    args = parser.parse_args()
+
+    report = run_load(
+        users=args.users,
+        turns=args.turns,
+        ttft_s=args.ttft,
+        tokens_per_s=args.tps,
+        chunk_tokens=args.chunk,
+        reply_tokens=args.reply_tokens,
+        ramp_s=args.ramp,
+        max_concurrency=args.max_concurrency,
+        memory=not args.no_memory,
+        warmup=not args.no_warmup,
+    )
+    out = args.out or OUT_DIR / f"load-{report['commit']}.json"
+    out.parent.mkdir(parents=True, exist_ok=True)
+    out.write_text(json.dumps(report, indent=2, ensure_ascii=False), encoding="utf-8")
+    print(json.dumps(report, indent=2, ensure_ascii=False))
+    if args.compare:
+        baseline = json.loads(args.compare.read_text(encoding="utf-8"))
+        print(json.dumps(compare(report, baseline), indent=2, ensure_ascii=False))
+    print(f"\nСохранено в {out}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,50 @@
+"""Проверки харнесса микробенчмарков: baseline актуален, регрессии распознаются."""
+
+import copy
+
+from tests.perf.bench_lib import CASES, MIN_ROUNDS, _slope, compare, load_baseline, measure, run_case
+
+
+def test_baseline_covers_every_case_and_size():
+    baseline = load_baseline()["cases"]
+    assert set(baseline) == set(CASES)
+    for name, (sizes, _) in CASES.items():
+        assert set(baseline[name]["sizes"]) == {str(size) for size in sizes}, name
+
+
+def test_slope_recognizes_complexity():
+    sizes = [100, 1000, 10000]
+    assert _slope(sizes, [5, 5, 5]) == 0.0
+    assert _slope(sizes, [1, 10, 100]) == 1.0
+    assert _slope(sizes, [1, 100, 10000]) == 2.0
+
+
+def test_compare_flags_slope_time_and_memory_regressions():
+    baseline = {"f": {
+        "sizes": {"10": {"min_us": 1.0, "peak_kb": 10.0}, "1000": {"min_us": 100.0, "peak_kb": 100.0}},
+        "time_slope": 1.0,
+        "memory_slope": 0.5,
+    }}
+    assert compare(copy.deepcopy(baseline), baseline) == []
+
+    quadratic = copy.deepcopy(baseline)
+    quadratic["f"]["time_slope"] = 2.0
+    quadratic["f"]["sizes"]["1000"] = {"min_us": 10000.0, "peak_kb": 500.0}
+    problems = compare(quadratic, baseline)
+    assert len(problems) == 3
+    assert "сложность" in problems[0] and "x100.0" in problems[1] and "пик памяти" in problems[2]
+    # Неизвестный baseline случай не сравнивается
+    assert compare(quadratic, {}) == []
+
+
+def test_measure_reports_rounds_and_allocations():
+    sizes, factory = CASES["analytics.UsageSummary.render"]
+    point = measure(sizes[0], factory)
+    assert point["rounds"] >= MIN_ROUNDS
+    assert 0 < point["min_us"] <= point["median_us"]
+    assert point["peak_kb"] > 0
+
+
+def test_incremental_summary_stays_constant_time():
+    # Пересчёт /summary по всей истории дал бы наклон ~1
+    assert run_case("analytics.UsageSummary.render")["time_slope"] < 0.5
@@ -0,0 +1,32 @@
+"""Smoke нагрузочного прогона: маленькая нагрузка, проверка формы отчёта."""
+
+import os
+
+from lib import openrouter_client
+from tests.perf import load_sessions
+
+
+def test_load_run_reports_comparable_metrics(monkeypatch):
+    app = __import__("app")
+    monkeypatch.setattr(os, "environ", dict(os.environ))
+    monkeypatch.setattr(openrouter_client, "_admission_controller", None)
+    monkeypatch.setattr(app.cl, "user_session", app.cl.user_session)
+    monkeypatch.setattr(app.cl, "Message", app.cl.Message)
+
+    report = load_sessions.run_load(users=3, turns=2, ttft_s=0.0, tokens_per_s=0, reply_tokens=20, memory=False, warmup=False)
+
+    results = report["results"]
+    assert results["messages"] == 6
+    assert results["stub_requests"] == 6
+    assert results["latency_p99_ms"] >= results["latency_p50_ms"] > 0
+    assert results["ttft_p50_ms"] <= results["latency_p50_ms"]
+    assert report["config"]["users"] == 3
+
+    diff = load_sessions.compare(report, {"results": {"messages": 3}})
+    assert diff["messages"].endswith("(+100.0%)")
+
+
+def test_transcripts_come_from_task_runs():
+    transcripts = load_sessions.load_transcripts()
+    assert len(transcripts) > 1
+    assert all(t["question"] for t in transcripts)
@@ -0,0 +1,152 @@
+"""Perf-сьют стриминга на stub-сервере: TTFT, скорость, конкурентность, ретраи.
+
+Работает офлайн и детерминированно: задержки задаёт stub, границы в
+проверках — с запасом на шум планировщика.
+"""
+
+import asyncio
+import json
+import time
+import urllib.error
+import urllib.request
+
+from lib.openrouter_client import AdmissionController, OpenRouterClient
+from lib.stub_llm import split_tokens
+
+REPLY = "раз два три четыре пять шесть семь восемь девять десять"
+
+
+def _client(server, **settings) -> OpenRouterClient:
+    client = OpenRouterClient(
+        limiter=AdmissionController(initial_limit=16, max_limit=64),
+        model="stub-model",
+        base_url=server.base_url,
+        api_key="stub",
+    )
+    client.retry_base_s = 0.0
+    for key, value in settings.items():
+        setattr(client, key, value)
+    return client
+
+
+async def _timed_stream(client):
+    started = time.perf_counter()
+    ttft = None
+    text = ""
+    async for chunk in client.stream_completion([{"role": "user", "content": "q"}]):
+        if ttft is None:
+            ttft = time.perf_counter() - started
+        text += chunk
+    return ttft, time.perf_counter() - started, text
+
+
+def test_stream_ttft_and_token_rate(stub_server):
+    server = stub_server(reply=REPLY, ttft_s=0.15, tokens_per_s=100, chunk_tokens=2)
+    ttft, total, text = asyncio.run(_timed_stream(_client(server)))
+
+    assert text == REPLY
+    assert 0.15 <= ttft < 0.5
+    # 10 токенов по 2 в чанке: TTFT + 4 паузы по 20 мс
+    assert 0.23 <= total < 0.8
+
+
+def test_concurrent_streams_overlap(stub_server):
+    server = stub_server(reply=REPLY, ttft_s=0.2)
+    client = _client(server)
+
+    async def run():
+        started = time.perf_counter()
+        results = await asyncio.gather(*(_timed_stream(client) for _ in range(8)))
+        return time.perf_counter() - started, results
+
+    wall, results = asyncio.run(run())
+    assert all(text == REPLY for _, _, text in results)
+    assert server.max_in_flight == 8
+    assert wall < 8 * 0.2 / 2
+
+
+def test_injected_errors_are_retried(stub_server):
+    server = stub_server(reply=REPLY, fail_first=1, error_status=503)
+    client = _client(server, max_retries=1)
+
+    _, _, text = asyncio.run(_timed_stream(client))
+    assert text == REPLY
+    assert client.stats["retries"] == 1
+    assert server.snapshot()["errors"] == 1
+
+
+def _post(url, payload):
+    req = urllib.request.Request(
+        url, data=json.dumps(payload).encode("utf-8"), headers={"Content-Type": "application/json"}
+    )
+    with urllib.request.urlopen(req, timeout=10) as resp:
+        return resp.read().decode("utf-8")
+
+
+def test_openai_stream_usage_block(stub_server):
+    server = stub_server(reply=REPLY)
+    raw = _post(f"{server.base_url}/chat/completions", {
+        "model": "m",
+        "stream": True,
+        "stream_options": {"include_usage": True},
+        "messages": [{"role": "user", "content": "12345678"}],
+    })
+    events = [json.loads(line[6:]) for line in raw.splitlines() if line.startswith("data: {")]
+    assert "".join(e["choices"][0]["delta"].get("content", "") for e in events if e["choices"]) == REPLY
+    assert events[-1]["usage"] == {"prompt_tokens": 2, "completion_tokens": 10, "total_tokens": 12}
+
+
+def test_ollama_chat_protocol_and_model_load(stub_server):
+    server = stub_server(reply=REPLY, tokens_per_s=200, load_s=0.05)
+    url = f"{server.root_url}/api/chat"
+
+    body = json.loads(_post(url, {"model": "a", "stream": False, "messages": []}))
+    assert body["message"]["content"] == REPLY
+    assert body["eval_count"] == len(split_tokens(REPLY))
+    assert body["load_duration"] == int(0.05 * 1e9)
+
+    lines = [json.loads(line) for line in _post(url, {"model": "a", "messages": []}).splitlines()]
+    assert "".join(line["message"]["content"] for line in lines) == REPLY
+    assert lines[-1]["done"] is True
+    assert lines[-1]["load_duration"] == 0
+
+    _post(url, {"model": "b", "stream": False, "messages": []})
+    assert server.loads == 2
+
+
+def test_rate_limit_injection_is_deterministic(stub_server):
+    first = stub_server(rate_limit_rate=0.5, seed=7)
+    second = stub_server(rate_limit_rate=0.5, seed=7)
+
+    def statuses(server):
+        out = []
+        for _ in range(10):
+            try:
+                _post(f"{server.base_url}/chat/completions", {"model": "m", "messages": []})
+                out.append(200)
+            except urllib.error.HTTPError as exc:
+                out.append(exc.code)
+        return out
+
+    observed = statuses(first)
+    assert observed == statuses(second)
+    assert 429 in observed and 200 in observed
+
+
+def test_warmup_opens_connection_and_preloads_local_model(stub_server, monkeypatch):
+    server = stub_server(reply=REPLY, load_s=0.05)
+    cloud = _client(server)
+    warm = asyncio.run(cloud.warmup())
+    # GET /models/<id> у stub нет (404), но соединение уже открыто — это и есть прогрев
+    assert warm["routes"].keys() == {"stub-model"} and not warm["failed"]
+    assert server.loads == 0
+
+    monkeypatch.setenv("OLLAMA_BASE_URL", server.base_url)
+    local = _client(server)
+    local.local = True
+    asyncio.run(local.warmup())
+    assert server.loaded_model == "stub-model" and server.loads == 1
+
+    # Повторный прогрев без preload модель не перезагружает
+    asyncio.run(local.warmup(preload=False))
+    assert server.loads == 1
@@ -1,6 +1,6 @@
 """Тесты для lib/analytics.py."""
 
-from lib.analytics import Analytics
+from lib.analytics import Analytics, UsageSummary
 
 
 def test_record_usage_creates_new_list_when_none():
@@ -89,3 +89,95 @@ def test_get_stats_aggregates():
     assert stats["total_tokens"] == 40
     assert stats["avg_tokens"] == 20
     assert stats["max_tokens"] == 30
+
+
+def test_format_metrics_renders_nested_sections():
+    out = Analytics.format_metrics({
+        "Очередь": {"queued": 2, "models": {"m": {"limit": 3.5, "in_flight": 1}}},
+        "Пусто": {},
+    })
+    assert "**Очередь:**" in out
+    assert "queued: `2`" in out
+    assert "limit=`3.5`" in out
+    assert "нет данных" in out
+
+
+def test_record_cancelled_estimates_tokens_saved():
+    records = Analytics.record_usage("q", "x" * 400, None, None)  # 100 completion tokens
+    Analytics.record_cancelled("q2", "x" * 40, records)  # 10 из ~100
+
+    assert records[-1]["cancelled"] is True
+    assert records[-1]["tokens_saved"] == 90
+
+    stats = Analytics.get_stats(records)
+    assert stats["cancelled_count"] == 1
+    assert stats["tokens_saved"] == 90
+    assert "Прервано генераций: `1`" in Analytics.format_dashboard(records)
+
+
+def test_record_cancelled_without_history_saves_zero():
+    records = Analytics.record_cancelled("q", "partial", None)
+    assert records[0]["tokens_saved"] == 0
+
+
+def test_format_dashboard_shows_first_message_ttft_and_warmup():
+    records = [
+        {"total_tokens": 10, "input_preview": "a", "ttft_ms": 900.0, "warmup_ms": 350.0},
+        {"total_tokens": 10, "input_preview": "b", "ttft_ms": 300.0},
+        {"total_tokens": 10, "input_preview": "c", "ttft_ms": 200.0},
+    ]
+    out = Analytics.format_dashboard(records)
+    assert "первое сообщение `900` мс, остальные в среднем `250` мс" in out
+    assert "Прогрев при открытии чата: `350` мс" in out
+    assert "Прогрев" not in Analytics.format_dashboard(records[1:])
+
+
+def test_format_dashboard_counts_guard_aborts():
+    records = [
+        {"total_tokens": 10, "input_preview": "a", "aborted": "repetition"},
+        {"total_tokens": 10, "input_preview": "b", "aborted": "repetition"},
+        {"total_tokens": 10, "input_preview": "c", "aborted": "stall"},
+        {"total_tokens": 10, "input_preview": "d"},
+    ]
+    out = Analytics.format_dashboard(records)
+    assert "Остановлено стражем вывода: `3` (repetition: 2, stall: 1)" in out
+    assert "стражем" not in Analytics.format_dashboard(records[3:])
+
+
+def _usage(n, start=0):
+    return [
+        {"total_tokens": 10 + i, "prompt_tokens": 6, "completion_tokens": 4 + i, "input_preview": f"q{i}"}
+        for i in range(start, start + n)
+    ]
+
+
+def test_usage_summary_counts_only_new_records_and_caches_page():
+    records = _usage(45)
+    summary = UsageSummary(page_size=20)
+    page = summary.render(records)
+    assert summary.pages == 3 and "страница 3 из 3, сообщения 41–45 из 45" in page
+    assert summary.total_tokens == sum(r["total_tokens"] for r in records)
+    assert summary.render(records) is page
+
+    # Итоги досчитываются по новой записи, кэш страницы сбрасывается
+    expected = sum(r["total_tokens"] for r in records) + 55
+    records[0]["total_tokens"] += 1000  # старые записи заново не суммируются
+    records.extend(_usage(1, start=45))
+    page = summary.render(records)
+    assert summary.total_tokens == expected
+    assert "| 46 | q45 | 55 |" in page
+
+
+def test_usage_summary_page_shows_running_totals_and_rebuilds_on_new_list():
+    records = _usage(25)
+    summary = UsageSummary(page_size=10)
+    page = summary.render(records, 2)
+    running = sum(r["total_tokens"] for r in records[:11])
+    assert f"| 11 | q10 | 20 | {running} |" in page
+    assert page.count("\n| ") == 1 + 10  # заголовок + строки страницы
+
+    summary.render([])
+    assert summary.count == 0 and summary.total_tokens == 0
+    restored = _usage(3)
+    summary.update(restored)
+    assert summary.total_tokens == 33
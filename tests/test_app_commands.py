@@ -30,6 +30,9 @@ def test_app_module_exposes_command_handlers():
         "handle_help_command",
         "format_help",
         "handle_version_command",
+        "handle_metrics_command",
+        "handle_route_command",
+        "handle_more_command",
     ):
         assert hasattr(app, name), f"app.py должен экспортировать {name}"
 
@@ -56,7 +59,7 @@ def test_format_help_contains_all_commands():
     import importlib
     app = importlib.import_module("app")
     help_text = app.format_help()
-    for cmd in ("/help", "/compress", "/summary", "/dashboard", "/profile", "/reset"):
+    for cmd in ("/help", "/compress", "/summary", "/dashboard", "/metrics", "/route", "/profile", "/reset"):
         assert cmd in help_text, f"В справке нет {cmd}"
 
 
@@ -130,3 +133,416 @@ def test_handle_summary_command_empty_history(monkeypatch):
 
     assert len(sent_messages) == 1
     assert "нет данных" in sent_messages[0].lower()
+
+
+def test_handle_summary_command_paginates_long_history(monkeypatch):
+    app = importlib.import_module("app")
+    sent_messages = []
+
+    class FakeMessage:
+        def __init__(self, content=""):
+            self.content = content
+
+        async def send(self):
+            sent_messages.append(self.content)
+
+    monkeypatch.setattr(app.cl, "Message", FakeMessage)
+    usage_history = [{"total_tokens": 1, "input_preview": f"m{i}"} for i in range(500)]
+    summary = app.UsageSummary()
+
+    asyncio.run(app.handle_summary_command(usage_history, "/summary", summary))
+    asyncio.run(app.handle_summary_command(usage_history, "/summary 2", summary))
+    asyncio.run(app.handle_summary_command(usage_history, "/summary 99", summary))
+
+    last, second, bad = sent_messages
+    assert "| 500 | m499 | 1 | 500 |" in last and "| m0 |" not in last
+    assert "| 21 | m20 | 1 | 21 |" in second
+    assert last.count("\n| ") == second.count("\n| ") == 1 + 20
+    assert "**Всего:** 500 токенов" in second
+    assert bad.startswith("Использование")
+
+
+def test_handle_export_command_writes_session_csv(monkeypatch, tmp_path):
+    app = importlib.import_module("app")
+    sent_messages = []
+
+    class FakeMessage:
+        def __init__(self, content=""):
+            self.content = content
+
+        async def send(self):
+            sent_messages.append(self.content)
+
+    monkeypatch.setattr(app.cl, "Message", FakeMessage)
+    monkeypatch.setattr(app.cl, "user_session", FakeSession(id="sess-1"))
+    monkeypatch.setattr(app, "EXPORT_DIR", tmp_path)
+    usage_history = [{"total_tokens": 7, "model": "m", "latency_ms": 12.5}] * 3
+
+    asyncio.run(app.handle_export_command(usage_history, "/export"))
+    asyncio.run(app.handle_export_command(usage_history, "/export csv all"))
+    asyncio.run(app.handle_export_command(usage_history, "/export xlsx"))
+
+    (path,) = tmp_path.glob("sess-1-*.csv")
+    assert path.read_text(encoding="utf-8").count("sess-1,") == 3
+    assert "`3` записей" in sent_messages[0]
+    assert "EXPORT_SERVER_WIDE" in sent_messages[1]
+    assert sent_messages[2].startswith("Использование")
+
+
+class FakeSession:
+    """Заглушка cl.user_session на dict."""
+
+    def __init__(self, **values):
+        self.values = dict(values)
+
+    def get(self, key, default=None):
+        return self.values.get(key, default)
+
+    def set(self, key, value):
+        self.values[key] = value
+
+
+class FakeStreamMessage:
+    def __init__(self, content=""):
+        self.content = content
+
+    async def send(self):
+        return self
+
+    async def stream_token(self, token):
+        self.content += token
+
+
+def test_on_message_stop_saves_partial_answer_with_marker(monkeypatch):
+    """Отмена задачи (стоп в UI) закрывает стрим и сохраняет частичный ответ с пометкой."""
+    app = importlib.import_module("app")
+    closed = []
+
+    class SlowClient:
+        async def stream_completion(self, _messages, cancel_event=None):
+            try:
+                yield "частичный"
+                await asyncio.sleep(10)
+                yield "никогда"
+            finally:
+                closed.append(True)
+
+    session = FakeSession(client=SlowClient(), history=[], usage_history=[])
+    monkeypatch.setattr(app.cl, "user_session", session)
+    monkeypatch.setattr(app.cl, "Message", FakeStreamMessage)
+
+    async def run():
+        from types import SimpleNamespace
+        task = asyncio.create_task(app.on_message(SimpleNamespace(content="вопрос")))
+        await asyncio.sleep(0.05)
+        task.cancel()
+        try:
+            await task
+        except asyncio.CancelledError:
+            pass
+
+    asyncio.run(run())
+
+    history = session.get("history")
+    assert closed == [True]
+    assert history[-1]["content"].startswith("частичный")
+    assert app.CANCELLED_MARKER in history[-1]["content"]
+    assert session.get("usage_history")[-1]["cancelled"] is True
+
+
+def test_on_message_guard_stops_looping_answer(monkeypatch):
+    app = importlib.import_module("app")
+    line = "Я всегда рядом с тобой, ты можешь на меня положиться.\n"
+
+    class LoopingClient:
+        async def stream_completion(self, _messages, cancel_event=None):
+            for _ in range(500):
+                yield line
+
+    session = FakeSession(client=LoopingClient(), history=[], usage_history=[])
+    monkeypatch.setattr(app.cl, "user_session", session)
+    monkeypatch.setattr(app.cl, "Message", FakeStreamMessage)
+
+    from types import SimpleNamespace
+    asyncio.run(app.on_message(SimpleNamespace(content="поддержи")))
+
+    answer = session.get("history")[-1]["content"]
+    assert answer.endswith(app.ABORTED_MARKER.format("зацикливание"))
+    assert len(answer) < len(line) * 50
+    assert session.get("usage_history")[-1]["aborted"] == "repetition"
+
+
+def test_new_message_cancels_previous_generation(monkeypatch):
+    app = importlib.import_module("app")
+    previous = asyncio.Event()
+    monkeypatch.setattr(app.cl, "user_session", FakeSession(cancel_event=previous))
+
+    class QuickClient:
+        async def stream_completion(self, _messages, cancel_event=None):
+            yield "ok"
+
+    app.cl.user_session.set("client", QuickClient())
+    monkeypatch.setattr(app.cl, "Message", FakeStreamMessage)
+
+    from types import SimpleNamespace
+    asyncio.run(app.on_message(SimpleNamespace(content="новое")))
+
+    assert previous.is_set()
+    assert app.cl.user_session.get("cancel_event") is None
+
+
+def test_on_message_routes_simple_turn_to_local_client(monkeypatch):
+    app = importlib.import_module("app")
+
+    class NamedClient:
+        def __init__(self, name):
+            self.last_model = name
+            self.calls = 0
+
+        async def stream_completion(self, _messages, cancel_event=None):
+            self.calls += 1
+            yield self.last_model
+
+    cloud, local = NamedClient("cloud-model"), NamedClient("local-model")
+    session = FakeSession(client=cloud, local_client=local, history=[], usage_history=[])
+    monkeypatch.setattr(app.cl, "user_session", session)
+    monkeypatch.setattr(app.cl, "Message", FakeStreamMessage)
+
+    from types import SimpleNamespace
+    asyncio.run(app.on_message(SimpleNamespace(content="привет")))
+    session.set("route_override", "cloud")
+    asyncio.run(app.on_message(SimpleNamespace(content="привет")))
+
+    assert (local.calls, cloud.calls) == (1, 1)
+    usage = session.get("usage_history")
+    assert [u["route"] for u in usage] == ["local", "cloud"]
+    assert [u["model"] for u in usage] == ["local-model", "cloud-model"]
+
+
+def test_route_metrics_count_cloud_fallback_of_local_client(monkeypatch):
+    app = importlib.import_module("app")
+    from types import SimpleNamespace
+
+    from lib.router import RouteMetrics
+
+    class FallingBackLocal:
+        model = "local-model"
+        last_local = True
+
+        async def stream_completion(self, _messages, cancel_event=None):
+            # Ollama недоступна: ответила облачная модель из цепочки
+            self.last_model, self.last_local = "cloud-model", False
+            yield "ответ облака"
+
+    metrics = RouteMetrics()
+    monkeypatch.setattr(app, "get_route_metrics", lambda: metrics)
+    session = FakeSession(
+        client=SimpleNamespace(model="cloud-model"), local_client=FallingBackLocal(),
+        history=[], usage_history=[], route_override="local",
+    )
+    monkeypatch.setattr(app.cl, "user_session", session)
+    monkeypatch.setattr(app.cl, "Message", FakeStreamMessage)
+
+    asyncio.run(app.on_message(SimpleNamespace(content="привет")))
+
+    assert list(metrics.snapshot()) == ["cloud"]
+    assert session.get("usage_history")[-1]["route"] == "cloud"
+
+
+def test_semantic_cache_scoped_by_routed_and_answering_model(monkeypatch):
+    app = importlib.import_module("app")
+    from lib.embeddings import HashingEmbedder
+    from lib.semantic_cache import SemanticCache
+
+    class NamedClient:
+        def __init__(self, model, answered_by=None):
+            self.model = model
+            self.answered_by = answered_by or model
+            self.last_model = None
+            self.calls = 0
+
+        async def stream_completion(self, _messages, cancel_event=None):
+            self.calls += 1
+            self.last_model = self.answered_by
+            yield f"ответ {self.answered_by}"
+
+    cache = SemanticCache(embedder=HashingEmbedder(), max_history=100)
+    monkeypatch.setattr(app, "get_semantic_cache", lambda: cache)
+    # Облачный клиент отвечает запасной моделью (fallback)
+    cloud, local = NamedClient("cloud-model", "fallback-model"), NamedClient("local-model")
+    session = FakeSession(client=cloud, local_client=local, history=[], usage_history=[])
+    monkeypatch.setattr(app.cl, "user_session", session)
+    monkeypatch.setattr(app.cl, "Message", FakeStreamMessage)
+
+    from types import SimpleNamespace
+
+    def ask(route):
+        session.set("route_override", route)
+        asyncio.run(app.on_message(SimpleNamespace(content="привет")))
+        return session.get("history")[-1]["content"]
+
+    assert ask("local") == "ответ local-model"
+    # Ответ локальной модели не отдаётся на облачном маршруте
+    assert ask("cloud") == "ответ fallback-model"
+    assert ask("local") == "ответ local-model"
+    # Ответ fallback закэширован под fallback, а не под основную модель облака
+    assert ask("cloud") == "ответ fallback-model"
+    assert (local.calls, cloud.calls) == (1, 2)
+
+
+def test_on_message_restores_evicted_history(monkeypatch, tmp_path):
+    app = importlib.import_module("app")
+    from lib import sessions
+
+    registry = sessions.SessionRegistry(store_dir=tmp_path, idle_s=0.01)
+    monkeypatch.setattr(sessions, "_session_registry", registry)
+
+    class EchoClient:
+        async def stream_completion(self, messages, cancel_event=None):
+            seen = [m["content"] for m in messages if m["role"] == "user"]
+            yield " + ".join(seen)
+
+    session = FakeSession(id="s1", client=EchoClient(), history=[], usage_history=[])
+    monkeypatch.setattr(app.cl, "user_session", session)
+    monkeypatch.setattr(app.cl, "Message", FakeStreamMessage)
+
+    from types import SimpleNamespace
+    asyncio.run(app.on_message(SimpleNamespace(content="первый")))
+    assert registry.snapshot()["sessions"] == 1
+
+    async def evict():
+        await asyncio.sleep(0.05)
+        await registry.enforce()
+
+    asyncio.run(evict())
+    assert session.get("history") == []
+
+    asyncio.run(app.on_message(SimpleNamespace(content="второй")))
+    history = session.get("history")
+    assert [m["content"] for m in history[::2]] == ["первый", "второй"]
+    assert history[-1]["content"] == "первый + второй"
+    assert registry.snapshot()["restores"] == 1
+
+
+def test_evict_compress_resume_keeps_only_summary(monkeypatch, tmp_path):
+    app = importlib.import_module("app")
+    from lib import sessions
+
+    registry = sessions.SessionRegistry(store_dir=tmp_path, idle_s=0.01)
+    monkeypatch.setattr(sessions, "_session_registry", registry)
+    prompts = []
+
+    class SummaryClient:
+        async def get_completion_text(self, messages, temperature=0.3, priority=0):
+            prompts.append(messages[0]["content"])
+            # Сообщение другой сессии во время сжатия: занятую сессию не выгружает
+            await asyncio.sleep(0.05)
+            await registry.enforce()
+            return "сводка"
+
+        async def stream_completion(self, messages, cancel_event=None):
+            yield f"видно {len(messages)} сообщений"
+
+    history = [{"role": "user", "content": f"реплика {i}"} for i in range(6)]
+    session = FakeSession(id="s1", client=SummaryClient(), history=history, usage_history=[])
+    registry.touch("s1", history, [])
+    monkeypatch.setattr(app.cl, "user_session", session)
+    monkeypatch.setattr(app.cl, "Message", FakeStreamMessage)
+
+    async def evict():
+        await asyncio.sleep(0.05)
+        await registry.enforce()
+
+    asyncio.run(evict())
+    assert history == []
+
+    from types import SimpleNamespace
+    asyncio.run(app.on_message(SimpleNamespace(content="/compress")))
+    assert "реплика 5" in prompts[0]
+    assert registry.snapshot()["evictions"] == 1
+
+    asyncio.run(app.on_message(SimpleNamespace(content="дальше")))
+    contents = [m["content"] for m in session.get("history")]
+    assert contents[0] == "[Сводка предыдущего диалога] сводка"
+    assert contents[1:] == ["дальше", "видно 3 сообщений"]
+
+
+def test_chat_end_archives_only_turns_after_compress(monkeypatch, tmp_path):
+    app = importlib.import_module("app")
+    from lib.embeddings import HashingEmbedder
+    from lib.memory import ConversationMemory
+
+    memory = ConversationMemory(path=tmp_path / "mem.jsonl", embedder=HashingEmbedder())
+    monkeypatch.setattr(app, "get_memory", lambda scope: memory)
+
+    class Client:
+        async def get_completion_text(self, messages, temperature=0.3, priority=0):
+            return "сводка"
+
+        async def stream_completion(self, messages, cancel_event=None):
+            yield "ответ"
+
+    history = [{"role": "user", "content": f"реплика {i}"} for i in range(4)]
+    session = FakeSession(client=Client(), history=history, usage_history=[])
+    monkeypatch.setattr(app.cl, "user_session", session)
+    monkeypatch.setattr(app.cl, "Message", FakeStreamMessage)
+
+    from types import SimpleNamespace
+    for text in ("/compress", "дальше", "/compress", "ещё"):
+        asyncio.run(app.on_message(SimpleNamespace(content=text)))
+    asyncio.run(app.on_chat_end())
+
+    texts = [chunk["text"] for chunk in memory._chunks]
+    assert sorted(t for t in texts if t.startswith("Пользователь: реплика")) == [
+        f"Пользователь: реплика {i}" for i in range(4)
+    ]
+    assert texts.count("Пользователь: дальше") == 1 and texts.count("Пользователь: ещё") == 1
+    assert texts.count("Сводка: сводка") == 2
+    assert not any("[Сводка предыдущего диалога]" in t for t in texts)
+
+
+def test_on_message_keeps_large_paste_and_files_out_of_history(monkeypatch, tmp_path):
+    app = importlib.import_module("app")
+    monkeypatch.setattr(app, "INGEST_DIR", tmp_path)
+    monkeypatch.setattr(app, "INGEST_MIN_CHARS", 5000)
+    monkeypatch.setattr(app, "INGEST_BUDGET_TOKENS", 300)
+    prompts = []
+
+    class RecordingClient:
+        async def stream_completion(self, messages, cancel_event=None):
+            prompts.append(messages[-1]["content"])
+            yield "ok"
+
+    session = FakeSession(id="s1", client=RecordingClient(), history=[], usage_history=[])
+    sent = []
+    monkeypatch.setattr(app.cl, "user_session", session)
+    monkeypatch.setattr(app.cl, "Message", FakeStreamMessage)
+    original_send = FakeStreamMessage.send
+
+    async def send(self):
+        sent.append(self.content)
+        return await original_send(self)
+    monkeypatch.setattr(FakeStreamMessage, "send", send)
+
+    log = "".join(f"INFO request {i} ok\n" for i in range(5000)) + "ERROR disk full on /var\n"
+    uploaded = tmp_path / "notes.txt"
+    uploaded.write_text("план: переписать парсер\n" * 10, encoding="utf-8")
+
+    from types import SimpleNamespace
+    asyncio.run(app.on_message(SimpleNamespace(content=f"Почему упал сервис, где ERROR?\n\n{log}")))
+    asyncio.run(app.on_message(SimpleNamespace(
+        content="что в заметках?", elements=[SimpleNamespace(name="notes.txt", path=str(uploaded))],
+    )))
+    asyncio.run(app.on_message(SimpleNamespace(content="/more")))
+
+    history = session.get("history")
+    assert history[0]["content"].startswith("Почему упал сервис, где ERROR?\n[вложение №1 «вставка»")
+    assert history[2]["content"].startswith("что в заметках?\n[вложение №2 «notes.txt»")
+    assert sum(len(m["content"]) for m in history) < 1000
+    # В промпт — найденный фрагмент, а не весь лог
+    assert "ERROR disk full" in prompts[0] and len(prompts[0]) < len(log) / 10
+    assert "переписать парсер" in prompts[1]
+    assert "Фрагмент 1/" in sent[-1] and "добавлены к следующему вопросу" in sent[-1]
+
+    asyncio.run(app.handle_reset_command())
+    assert session.get("ingest") is None and not (tmp_path / "s1").exists()
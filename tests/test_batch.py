@@ -0,0 +1,92 @@
+"""Тесты пакетного режима: потоковое чтение JSONL, конкурентность, диалоги."""
+
+import asyncio
+import io
+import json
+
+from lib.batch import BatchRunner, iter_jsonl, run_batch
+
+
+class CountingClient:
+    """Отвечает числом сообщений в промпте и считает одновременные запросы."""
+
+    model = "fake-model"
+
+    def __init__(self, delay_s: float = 0.01, fail_on: str = ""):
+        self.delay_s = delay_s
+        self.fail_on = fail_on
+        self.in_flight = 0
+        self.max_in_flight = 0
+
+    async def stream_completion(self, messages, cancel_event=None):
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        try:
+            await asyncio.sleep(self.delay_s)
+            last = messages[-1]["content"]
+            if self.fail_on and self.fail_on in last:
+                raise RuntimeError("provider down")
+            yield f"{len(messages)} "
+            yield f"ответ на {last}"
+        finally:
+            self.in_flight -= 1
+
+
+def _write_jsonl(path, rows):
+    path.write_text("\n".join(r if isinstance(r, str) else json.dumps(r, ensure_ascii=False) for r in rows))
+
+
+def test_iter_jsonl_reports_bad_lines(tmp_path):
+    path = tmp_path / "in.jsonl"
+    _write_jsonl(path, [{"prompt": "a"}, "{oops", "", {"id": 3}])
+    items = list(iter_jsonl(path))
+    assert items[0] == (1, {"prompt": "a"}, None)
+    assert items[1][0] == 2 and items[1][2].startswith("invalid JSON")
+    assert items[2] == (4, None, "no prompt")
+
+
+def test_batch_bounds_concurrency_and_writes_every_item(tmp_path):
+    src, dst = tmp_path / "in.jsonl", tmp_path / "out" / "results.jsonl"
+    _write_jsonl(src, [{"id": f"q{i}", "prompt": f"вопрос {i}"} for i in range(20)])
+    client = CountingClient()
+
+    summary = asyncio.run(run_batch(src, dst, client, concurrency=3))
+
+    results = [json.loads(line) for line in dst.read_text(encoding="utf-8").splitlines()]
+    assert summary["items"] == 20 and summary["errors"] == 0
+    assert client.max_in_flight == 3
+    assert sorted(r["line"] for r in results) == list(range(1, 21))
+    first = next(r for r in results if r["id"] == "q0")
+    assert first["response"].endswith("ответ на вопрос 0")
+    assert first["usage"]["total_tokens"] > 0 and first["latency_ms"] >= first["ttft_ms"] > 0
+
+
+def test_batch_session_turns_share_history_in_order(tmp_path):
+    src = tmp_path / "in.jsonl"
+    _write_jsonl(src, [
+        {"session": "s", "prompt": "первый"},
+        {"prompt": "одиночный"},
+        {"session": "s", "prompt": "второй"},
+        {"session": "s", "prompt": "третий"},
+    ])
+    out = io.StringIO()
+    asyncio.run(BatchRunner(CountingClient(), concurrency=4).run(iter_jsonl(src), out))
+
+    by_line = {r["line"]: r for r in map(json.loads, out.getvalue().splitlines())}
+    count = lambda line: int(by_line[line]["response"].split()[0])  # noqa: E731
+    # Каждый следующий ход видит предыдущие (user + assistant), одиночный — только себя
+    assert count(3) == count(1) + 2
+    assert count(4) == count(3) + 2
+    assert count(2) == count(1)
+
+
+def test_batch_records_provider_error_and_continues(tmp_path):
+    src = tmp_path / "in.jsonl"
+    _write_jsonl(src, [{"prompt": "ok"}, {"prompt": "сломай"}, "not json"])
+    out = io.StringIO()
+    summary = asyncio.run(BatchRunner(CountingClient(fail_on="сломай")).run(iter_jsonl(src), out))
+
+    results = {r["line"]: r for r in map(json.loads, out.getvalue().splitlines())}
+    assert summary["items"] == 3 and summary["errors"] == 2
+    assert results[2]["error"] == "provider down"
+    assert "response" in results[1]
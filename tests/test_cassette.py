@@ -0,0 +1,137 @@
+"""Тесты кассет: запись стримов с таймингами и воспроизведение без провайдера."""
+
+import asyncio
+import gzip
+import json
+import threading
+import time
+
+import pytest
+
+from lib.cassette import Cassette, CassetteMiss, request_key
+from lib.ollama import chat_request, chat_stream
+from lib.openrouter_client import AdmissionController, GenerationCancelled, OpenRouterClient
+from lib.stub_llm import StubLLMServer, serve_in_thread
+
+REPLY = "раз два три четыре пять шесть семь восемь"
+MESSAGES = [{"role": "user", "content": "считай"}]
+
+
+def _client(server_url: str, cassette: Cassette) -> OpenRouterClient:
+    client = OpenRouterClient(
+        limiter=AdmissionController(initial_limit=4),
+        model="stub-model",
+        base_url=server_url,
+        api_key="stub",
+    )
+    client.cassette = cassette
+    return client
+
+
+async def _collect(client, messages=MESSAGES):
+    started = time.perf_counter()
+    ttft, chunks = None, []
+    async for chunk in client.stream_completion(messages):
+        if ttft is None:
+            ttft = time.perf_counter() - started
+        chunks.append(chunk)
+    return ttft, time.perf_counter() - started, chunks
+
+
+def test_request_key_depends_on_model_messages_and_params():
+    key = request_key("m", MESSAGES, temperature=0.3)
+    assert key == request_key("m", [dict(MESSAGES[0])], temperature=0.3)
+    assert key != request_key("m2", MESSAGES, temperature=0.3)
+    assert key != request_key("m", MESSAGES, temperature=0.7)
+    assert key != request_key("m", [{"role": "user", "content": "другое"}], temperature=0.3)
+
+
+def test_client_stream_recorded_and_replayed_offline(tmp_path):
+    path = tmp_path / "openrouter.jsonl.gz"
+    with serve_in_thread(StubLLMServer(reply=REPLY, ttft_s=0.2, tokens_per_s=40)) as server:
+        recorded = asyncio.run(_collect(_client(server.base_url, Cassette(path, mode="record"))))
+
+    (entry,) = [json.loads(line) for line in gzip.open(path, "rt", encoding="utf-8")]
+    assert entry["model"] == "stub-model" and entry["complete"] is True
+    assert "".join(entry["chunks"]) == REPLY and entry["gaps_ms"][0] >= 180
+
+    # Сервер остановлен: ответ целиком из кассеты, с той же формой стрима
+    client = _client("http://127.0.0.1:9/v1", Cassette(path))
+    ttft, total, chunks = asyncio.run(_collect(client))
+    assert chunks == recorded[2]
+    assert 0.15 <= ttft <= recorded[0] + 0.15 and total >= recorded[1] * 0.7
+    assert client.last_model == "stub-model"
+
+    fast = _client("http://127.0.0.1:9/v1", Cassette(path, speed=10))
+    _, fast_total, fast_chunks = asyncio.run(_collect(fast))
+    assert fast_chunks == chunks and fast_total < total / 4
+
+
+def test_client_cassette_file_io_runs_off_event_loop(tmp_path, monkeypatch):
+    threads = []
+    for name in ("append", "play"):
+        original = getattr(Cassette, name)
+
+        def spy(self, *args, _original=original, **kwargs):
+            threads.append(threading.current_thread())
+            return _original(self, *args, **kwargs)
+
+        monkeypatch.setattr(Cassette, name, spy)
+
+    path = tmp_path / "c.jsonl"
+    with serve_in_thread(StubLLMServer(reply=REPLY)) as server:
+        asyncio.run(_collect(_client(server.base_url, Cassette(path, mode="record"))))
+    asyncio.run(_collect(_client("http://127.0.0.1:9/v1", Cassette(path, speed=0))))
+
+    assert len(threads) == 2
+    assert threading.main_thread() not in threads
+
+
+def test_replay_cycles_entries_and_misses_are_errors(tmp_path):
+    cassette = Cassette(tmp_path / "c.jsonl", mode="record")
+    key = request_key("stub-model", MESSAGES, temperature=0.3)
+    for text in ("первый", "второй"):
+        recording = cassette.record(key)
+        recording.chunk(text)
+        recording.save(model="stub-model")
+
+    replay = Cassette(tmp_path / "c.jsonl", speed=0)
+    client = _client("http://127.0.0.1:9/v1", replay)
+    answers = [asyncio.run(_collect(client))[2] for _ in range(3)]
+    assert answers == [["первый"], ["второй"], ["первый"]]
+    with pytest.raises(CassetteMiss):
+        asyncio.run(_collect(client, [{"role": "user", "content": "не записано"}]))
+    assert replay.snapshot()["replayed"] == 3
+
+
+def test_replay_honours_cancel_event(tmp_path):
+    cassette = Cassette(tmp_path / "c.jsonl", mode="record")
+    recording = cassette.record(request_key("stub-model", MESSAGES, temperature=0.3))
+    for piece in ("a", "b", "c"):
+        recording.chunk(piece)
+    recording.save(model="stub-model")
+    client = _client("http://127.0.0.1:9/v1", Cassette(tmp_path / "c.jsonl", speed=0))
+
+    async def run():
+        cancel = asyncio.Event()
+        seen = []
+        with pytest.raises(GenerationCancelled):
+            async for chunk in client.stream_completion(MESSAGES, cancel_event=cancel):
+                seen.append(chunk)
+                cancel.set()
+        return seen
+
+    assert asyncio.run(run()) == ["a"]
+
+
+def test_ollama_chat_stream_records_final_and_replays(tmp_path):
+    path = tmp_path / "ollama.jsonl"
+    payload = chat_request("stub-model", MESSAGES, num_ctx=2048, max_output_tokens=64)
+    with serve_in_thread(StubLLMServer(reply=REPLY, ttft_s=0.1, tokens_per_s=50)) as server:
+        live = chat_stream(payload, root_url=server.root_url, cassette=Cassette(path, mode="record"))
+
+    started = time.perf_counter()
+    replayed = chat_stream(payload, root_url="http://127.0.0.1:9", cassette=Cassette(path))
+    assert time.perf_counter() - started >= 0.1
+    assert replayed["message"] == live["message"]
+    assert replayed["eval_count"] == live["eval_count"] and replayed["done"] is True
@@ -0,0 +1,91 @@
+"""Тесты для lib/compress.py (map-reduce сжатие истории)."""
+
+import asyncio
+
+from lib.compress import MAP_PROMPT, REDUCE_PROMPT, summarize_history
+from lib.openrouter_client import PRIORITY_BACKGROUND
+
+
+class FakeClient:
+    """Считает запросы и пиковый параллелизм, отвечает коротким текстом."""
+
+    def __init__(self, delay: float = 0.01):
+        self.delay = delay
+        self.prompts = []
+        self.priorities = []
+        self.active = 0
+        self.peak = 0
+
+    async def get_completion_text(self, messages, temperature=0.3, priority=0):
+        self.prompts.append(messages[0]["content"])
+        self.priorities.append(priority)
+        self.active += 1
+        self.peak = max(self.peak, self.active)
+        await asyncio.sleep(self.delay)
+        self.active -= 1
+        return f"сводка {len(self.prompts)}"
+
+
+def _history(n, words=50):
+    return [
+        {"role": "user" if i % 2 == 0 else "assistant", "content": " ".join([f"w{i}"] * words)}
+        for i in range(n)
+    ]
+
+
+def test_short_history_single_call():
+    client = FakeClient()
+    summary = asyncio.run(summarize_history(client, _history(4), chunk_tokens=1000))
+
+    assert summary == "сводка 1"
+    assert len(client.prompts) == 1
+    assert client.priorities == [PRIORITY_BACKGROUND]
+
+
+def test_long_history_map_reduce_with_bounded_parallelism():
+    client = FakeClient()
+    progress = []
+
+    async def on_progress(step):
+        progress.append(step)
+
+    asyncio.run(summarize_history(
+        client, _history(20), chunk_tokens=100, parallelism=3, on_progress=on_progress
+    ))
+
+    map_calls = [p for p in client.prompts if p.startswith(MAP_PROMPT)]
+    reduce_calls = [p for p in client.prompts if p.startswith(REDUCE_PROMPT)]
+    assert len(map_calls) == 10
+    assert len(reduce_calls) == 1
+    assert client.peak <= 3
+    assert "Фрагмент 10/10 сжат" in progress
+    assert progress[-1] == "Собираю итоговую сводку"
+
+
+def test_map_chunks_keep_global_numbering():
+    client = FakeClient()
+    asyncio.run(summarize_history(client, _history(4), chunk_tokens=100))
+    map_calls = sorted(p for p in client.prompts if p.startswith(MAP_PROMPT))
+    assert any("\n3. Пользователь:" in p for p in map_calls)
+
+
+def test_reduce_runs_in_levels_when_partials_overflow():
+    class VerboseClient(FakeClient):
+        async def get_completion_text(self, messages, temperature=0.3, priority=0):
+            await super().get_completion_text(messages, temperature, priority)
+            return " ".join(["факт"] * 40)
+
+    client = VerboseClient()
+    asyncio.run(summarize_history(client, _history(16), chunk_tokens=100, parallelism=4))
+
+    reduce_calls = [p for p in client.prompts if p.startswith(REDUCE_PROMPT)]
+    assert len(reduce_calls) > 1
+
+
+def test_chunks_sized_by_truncated_text_sent_to_model():
+    # Реплики по 2000 слов обрезаются до 200 символов: 20 таких влезают в один промпт
+    client = FakeClient()
+    asyncio.run(summarize_history(client, _history(20, words=2000), chunk_tokens=1500))
+
+    assert len(client.prompts) == 1
+    assert client.prompts[0].count("...") == 20
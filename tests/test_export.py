@@ -0,0 +1,101 @@
+"""Тесты выгрузки аналитики: схема, пачки, источники (сессии, JSONL, реестр)."""
+
+import asyncio
+import csv
+import json
+import sys
+
+import pytest
+
+from lib.export import COLUMNS, export_usage, iter_paths, to_row
+from lib.sessions import SessionRegistry
+
+
+def _record(i, **extra):
+    return {
+        "timestamp": f"2026-01-01T00:00:{i:02d}",
+        "prompt_tokens": 6,
+        "completion_tokens": i,
+        "total_tokens": 6 + i,
+        "input_preview": f"q{i}",
+        **extra,
+    }
+
+
+def _read_csv(path):
+    with open(path, encoding="utf-8", newline="") as f:
+        return list(csv.DictReader(f))
+
+
+def test_to_row_follows_schema_and_fills_missing():
+    row = dict(zip((name for name, _ in COLUMNS), to_row("s1", _record(3, ttft_ms=120.5, cached=True))))
+    assert row["session"] == "s1" and row["total_tokens"] == 9 and row["ttft_ms"] == 120.5
+    assert row["cached"] is True and row["cancelled"] is False
+    assert row["model"] is None and row["latency_ms"] is None
+
+
+def test_export_csv_streams_in_batches(tmp_path, monkeypatch):
+    from lib import export
+
+    written = []
+    original = export._CsvSink.write
+    monkeypatch.setattr(export._CsvSink, "write", lambda self, rows: written.append(len(rows)) or original(self, rows))
+
+    def records():
+        for i in range(25):
+            yield "s", _record(i, model="m")
+
+    path = tmp_path / "out" / "usage.csv"
+    assert export_usage(records(), path, batch_size=10) == 25
+    assert written == [10, 10, 5]
+    rows = _read_csv(path)
+    assert len(rows) == 25 and rows[24]["completion_tokens"] == "24" and rows[0]["model"] == "m"
+
+
+def test_iter_paths_reads_session_dumps_and_batch_results(tmp_path):
+    sessions = tmp_path / "sessions"
+    sessions.mkdir()
+    (sessions / "abc.json").write_text(json.dumps({"history": [], "usage_history": [_record(1), _record(2)]}))
+    results = tmp_path / "results.jsonl"
+    results.write_text("\n".join([
+        json.dumps({"line": 1, "session": "b1", "response": "ответ",
+                    "usage": {"prompt_tokens": 3, "completion_tokens": 2, "total_tokens": 5},
+                    "ttft_ms": 10.0, "latency_ms": 30.0}),
+        json.dumps({"line": 2, "error": "provider down"}),
+    ]))
+
+    items = list(iter_paths([sessions, results]))
+    assert [session for session, _ in items] == ["abc", "abc", "b1"]
+    batch_row = dict(zip((name for name, _ in COLUMNS), to_row(*items[2])))
+    assert batch_row["total_tokens"] == 5 and batch_row["latency_ms"] == 30.0 and batch_row["response_length"] == 5
+
+
+def test_registry_iter_usage_includes_evicted_sessions(tmp_path):
+    registry = SessionRegistry(store_dir=tmp_path, idle_s=0.01)
+    registry.touch("old", [{"role": "user", "content": "x"}], [_record(1)])
+    asyncio.run(asyncio.sleep(0.02))
+    registry.touch("new", [], [_record(2), _record(3)])
+    assert asyncio.run(registry.enforce(exclude="new")) == 1
+
+    assert sorted((s, r["input_preview"]) for s, r in registry.iter_usage()) == [
+        ("new", "q2"), ("new", "q3"), ("old", "q1"),
+    ]
+    # Чтение для выгрузки не восстанавливает сессию и не удаляет файл
+    assert (tmp_path / "old.json").exists()
+
+
+def test_columnar_export_without_pyarrow_is_clear_error(tmp_path, monkeypatch):
+    monkeypatch.setitem(sys.modules, "pyarrow", None)
+    with pytest.raises(RuntimeError, match="pyarrow"):
+        export_usage(iter([("s", _record(1))]), tmp_path / "usage.parquet")
+    with pytest.raises(ValueError):
+        export_usage(iter([]), tmp_path / "usage.xlsx")
+
+
+def test_parquet_round_trip(tmp_path):
+    pq = pytest.importorskip("pyarrow.parquet")
+    path = tmp_path / "usage.parquet"
+    assert export_usage((("s", _record(i, ttft_ms=1.5)) for i in range(7)), path, batch_size=3) == 7
+    table = pq.read_table(path)
+    assert table.num_rows == 7 and table.schema.names == [name for name, _ in COLUMNS]
+    assert table.column("ttft_ms").to_pylist() == [1.5] * 7
@@ -58,3 +58,30 @@ def test_trim_keeps_system_when_max_tokens_zero():
     assert [m["role"] for m in result] == ["system"], (
         f"При max_tokens=0 должен остаться только system. Получили: {result}"
     )
+
+
+def test_chunk_text_splits_by_token_budget():
+    from lib.history import chunk_text
+
+    chunks = chunk_text("a b c d e f g", max_tokens=3)
+    assert chunks == ["a b c", "d e f", "g"]
+    assert chunk_text("   ", max_tokens=3) == []
+
+
+def test_chunk_history_groups_messages_under_budget():
+    from lib.history import chunk_history
+
+    messages = [{"role": "user", "content": "a b c"} for _ in range(5)]
+    chunks = chunk_history(messages, max_tokens=7)
+    assert [len(c) for c in chunks] == [2, 2, 1]
+
+
+def test_chunk_history_oversized_message_alone():
+    from lib.history import chunk_history
+
+    messages = [
+        {"role": "user", "content": "a"},
+        {"role": "user", "content": "b " * 20},
+        {"role": "user", "content": "c"},
+    ]
+    assert [len(c) for c in chunk_history(messages, max_tokens=5)] == [1, 1, 1]
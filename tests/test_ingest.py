@@ -0,0 +1,129 @@
+"""Тесты приёма больших вставок и файлов: нарезка, хранение вне памяти, выбор фрагментов."""
+
+import io
+import threading
+
+import pytest
+
+from lib.ingest import IngestStore, iter_chunks, iter_lines, split_question
+
+
+def _log(lines, error_at=None):
+    out = []
+    for i in range(lines):
+        out.append(f"12:00:{i % 60:02d} INFO worker-{i % 4} processed request id={100000 + i}\n")
+        if i == error_at:
+            out.append("12:01:00 ERROR database connection refused after timeout\n")
+    return "".join(out)
+
+
+def test_chunks_keep_lines_and_respect_budget():
+    text = _log(50)
+    chunks = list(iter_chunks(iter_lines(io.StringIO(text), 1000), 40))
+    assert all(len(chunk.split()) <= 40 for _, _, chunk in chunks)
+    # Строки не режутся и не теряются, номера строк идут подряд
+    assert "\n".join(chunk for _, _, chunk in chunks) == text.rstrip("\n")
+    assert chunks[0][0] == 1 and chunks[-1][1] == 50
+    assert all(prev[1] + 1 == cur[0] for prev, cur in zip(chunks, chunks[1:]))
+
+
+def test_long_lines_are_bounded():
+    # Одна строка на 100k символов без пробелов и строка из 500 слов
+    blob = "x" * 100_000 + "\n" + "слово " * 500 + "\n"
+    chunks = list(iter_chunks(iter_lines(io.StringIO(blob), 200 * 8), 200))
+    assert max(len(chunk) for _, _, chunk in chunks) <= 200 * 8
+    assert max(len(chunk.split()) for _, _, chunk in chunks) <= 200
+    assert {first for first, _, _ in chunks} == {1, 2}
+
+
+def test_split_question_takes_short_first_or_last_paragraph():
+    body = "строка лога\n" * 1000
+    assert split_question(f"Что здесь не так?\n\n{body}") == ("Что здесь не так?", body)
+    question, rest = split_question(f"{body}\nПочему упало?")
+    assert question == "Почему упало?" and rest == body.rstrip("\n")
+    assert split_question(body) == ("", body)
+
+
+def test_ingest_file_stores_chunks_on_disk_and_finds_relevant(tmp_path):
+    path = tmp_path / "app.log"
+    path.write_text(_log(3000, error_at=2100), encoding="utf-8")
+    store = IngestStore(tmp_path / "ingest", chunk_tokens=60)
+
+    attachment = store.ingest_file("app.log", path)
+    assert attachment.lines == 3001 and len(attachment) > 100
+    assert "«app.log»" in attachment.reference() and "3001 строк" in attachment.reference()
+
+    keys = store.select("почему database connection refused?", budget_tokens=200, k=3)
+    assert keys and keys[0][0] == 1
+    context = store.context("почему database connection refused?", budget_tokens=200, k=3)
+    assert "ERROR database connection refused" in context
+    # В промпт — только бюджет, а не весь файл
+    assert len(context.split()) < 300
+
+
+def test_no_relevant_chunks_falls_back_to_head_and_tail(tmp_path):
+    store = IngestStore(tmp_path, chunk_tokens=60)
+    attachment = store.ingest_text("вставка", _log(500))
+    keys = store.select("", budget_tokens=1000)
+    assert keys == [(1, 0), (1, len(attachment) - 1)]
+
+
+def test_more_continues_in_order_and_pins_for_next_prompt(tmp_path):
+    store = IngestStore(tmp_path, chunk_tokens=60)
+    store.ingest_text("вставка", _log(500))
+
+    first = store.more(budget_tokens=120)
+    second = store.more(budget_tokens=120)
+    assert first == [(1, 0), (1, 1)] and second == [(1, 2), (1, 3)]
+    # Показанное через /more уходит в следующий промпт один раз
+    assert store.select("", budget_tokens=1000)[:2] == second
+    assert (1, 2) not in store.select("", budget_tokens=1000)
+
+    found = store.more("ERROR", budget_tokens=1000)
+    assert found == []
+    assert "Фрагмент 3/" in store.render(second) and "строки" in store.render(second)
+
+
+def test_search_during_ingest_does_not_break_indexing(tmp_path):
+    # Поиск (сообщение, /more) идёт, пока в другом потоке читается большое вложение
+    store = IngestStore(tmp_path, chunk_tokens=20)
+    store.ingest_text("первое", _log(200, error_at=100))
+    errors = []
+
+    def ingest():
+        try:
+            store.ingest_text("второе", _log(20000))
+        except Exception as e:
+            errors.append(e)
+
+    thread = threading.Thread(target=ingest)
+    thread.start()
+    while thread.is_alive():
+        store.select("database connection worker", budget_tokens=200)
+    thread.join()
+
+    assert errors == []
+    assert len(store) == 2
+    assert len(store._owners) == store.attachments[-1].start + len(store.attachments[-1])
+
+
+def test_binary_and_oversized_files_are_rejected(tmp_path):
+    store = IngestStore(tmp_path / "ingest", max_bytes=1000)
+    binary = tmp_path / "image.png"
+    binary.write_bytes(b"\x89PNG\0\0\0" + b"\0" * 100)
+    big = tmp_path / "big.txt"
+    big.write_text("a" * 2000)
+    with pytest.raises(ValueError, match="двоичный"):
+        store.ingest_file("image.png", binary)
+    with pytest.raises(ValueError, match="больше"):
+        store.ingest_file("big.txt", big)
+    assert len(store) == 0
+
+
+def test_close_removes_chunks(tmp_path):
+    store = IngestStore(tmp_path / "ingest")
+    store.ingest_text("вставка", "строка\n" * 10)
+    assert any((tmp_path / "ingest").iterdir())
+    store.close()
+    assert not (tmp_path / "ingest").exists() and len(store) == 0
+    assert store.select("строка") == []
@@ -0,0 +1,60 @@
+"""Тесты для lib/loop_monitor: лаг event loop и снимки стека при блокировке."""
+
+import asyncio
+import time
+
+from lib import loop_monitor
+from lib.loop_monitor import LoopMonitor
+
+
+def _blocking_profile_read():
+    time.sleep(0.3)
+
+
+def test_blocking_call_is_caught_with_stack():
+    monitor = LoopMonitor(interval_s=0.02, threshold_s=0.1)
+
+    async def run():
+        monitor.start()
+        await asyncio.sleep(0.05)
+        _blocking_profile_read()
+        await asyncio.sleep(0.05)
+        await monitor.stop()
+
+    asyncio.run(run())
+
+    snap = monitor.snapshot()
+    assert snap["lag_max_ms"] >= 200
+    assert snap["slow_samples"] >= 1
+    assert snap["stalls"] >= 1
+    assert any("_blocking_profile_read" in line for line in monitor.stalls[0]["stack"])
+    assert "last_stall" in snap
+
+
+def test_idle_loop_has_no_stalls():
+    monitor = LoopMonitor(interval_s=0.01, threshold_s=0.2)
+
+    async def run():
+        monitor.start()
+        monitor.start()  # повторный старт — no-op
+        await asyncio.sleep(0.15)
+        await monitor.stop()
+
+    asyncio.run(run())
+
+    snap = monitor.snapshot()
+    assert snap["samples"] >= 5
+    assert snap["stalls"] == 0
+    assert snap["lag_max_ms"] < 200
+
+
+def test_get_loop_monitor_is_opt_in(monkeypatch):
+    monkeypatch.setattr(loop_monitor, "_loop_monitor", None)
+    monkeypatch.delenv("LOOP_MONITOR", raising=False)
+    assert loop_monitor.get_loop_monitor() is None
+
+    monkeypatch.setenv("LOOP_MONITOR", "1")
+    monkeypatch.setenv("LOOP_LAG_THRESHOLD_MS", "250")
+    monitor = loop_monitor.get_loop_monitor()
+    assert monitor.threshold_s == 0.25
+    assert loop_monitor.get_loop_monitor() is monitor
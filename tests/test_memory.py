@@ -0,0 +1,93 @@
+"""Тесты для lib/memory.py."""
+
+from lib.embeddings import HashingEmbedder
+from lib.memory import ConversationMemory, get_memory
+from lib.vector_index import IVFIndex
+
+
+def _memory(tmp_path=None, **kwargs):
+    path = tmp_path / "mem.jsonl" if tmp_path is not None else None
+    return ConversationMemory(path=path, embedder=HashingEmbedder(), **kwargs)
+
+
+def test_archive_and_search_finds_relevant_turn():
+    memory = _memory()
+    memory.archive_turns([
+        {"role": "user", "content": "Мой сервер на Ubuntu 22.04 с PostgreSQL 15"},
+        {"role": "assistant", "content": "Понял, запомню про PostgreSQL"},
+        {"role": "user", "content": "Люблю кататься на велосипеде по выходным"},
+    ])
+
+    top_text, _ = memory.search("какая версия PostgreSQL на сервере", k=1)[0]
+    assert "PostgreSQL 15" in top_text
+    assert top_text.startswith("Пользователь:")
+
+
+def test_long_turn_is_chunked():
+    memory = _memory(chunk_tokens=10)
+    added = memory.archive_turns([{"role": "user", "content": " ".join(["слово"] * 35)}])
+    assert added == 4
+    assert len(memory) == 4
+
+
+def test_select_snippets_respects_budget_and_k():
+    memory = _memory(chunk_tokens=50)
+    for i in range(10):
+        memory.archive_summary(f"проект альфа этап {i} " + "детали " * 20)
+
+    snippets = memory.select_snippets("проект альфа этап", k=5, budget_tokens=60, min_score=0.0)
+    assert 1 <= len(snippets) <= 2
+    assert all(s.startswith("Сводка:") for s in snippets)
+
+
+def test_select_snippets_empty_memory():
+    assert _memory().select_snippets("что угодно") == []
+
+
+def test_memory_persists_between_instances(tmp_path):
+    first = _memory(tmp_path)
+    first.archive_summary("Пользователь переезжает в Берлин в марте")
+
+    second = _memory(tmp_path)
+    assert len(second) == 1
+    assert "Берлин" in second.search("куда переезжает", k=1)[0][0]
+
+
+def test_memory_reuses_saved_vectors_and_embeds_only_new(tmp_path):
+    class CountingEmbedder(HashingEmbedder):
+        def __init__(self):
+            super().__init__()
+            self.embedded = 0
+
+        def embed_many(self, texts):
+            self.embedded += len(texts)
+            return super().embed_many(texts)
+
+    first = ConversationMemory(path=tmp_path / "mem.jsonl", embedder=HashingEmbedder())
+    first.archive_turns([{"role": "user", "content": f"факт {i}"} for i in range(10)])
+    # Сбой между записями: в архиве запись есть, вектора нет
+    with (tmp_path / "mem.jsonl").open("a", encoding="utf-8") as f:
+        f.write('{"kind": "turn", "text": "Пользователь: кот Барсик", "ts": 0}\n')
+
+    embedder = CountingEmbedder()
+    second = ConversationMemory(path=tmp_path / "mem.jsonl", embedder=embedder)
+    assert len(second) == 11 and embedder.embedded == 1
+    assert "Барсик" in second.search("кот Барсик", k=1)[0][0]
+
+    embedder = CountingEmbedder()
+    third = ConversationMemory(path=tmp_path / "mem.jsonl", embedder=embedder)
+    assert embedder.embedded == 0
+    assert third.search("факт 3", k=1)[0][0] == "Пользователь: факт 3"
+
+
+def test_memory_switches_to_ann_index_when_large():
+    memory = _memory(ann_threshold=50)
+    memory.archive_turns([{"role": "user", "content": f"факт номер {i} про тему {i % 7}"} for i in range(80)])
+
+    assert isinstance(memory._index, IVFIndex)
+    assert len(memory.search("факт номер 42", k=3)) == 3
+
+
+def test_get_memory_is_opt_in(monkeypatch, tmp_path):
+    monkeypatch.delenv("LONG_TERM_MEMORY", raising=False)
+    assert get_memory("scope", base_dir=tmp_path) is None
@@ -0,0 +1,132 @@
+"""Тесты выноса CPU-работы: инлайн для малого входа, поток, процесс, переполнение."""
+
+import asyncio
+import os
+import threading
+import time
+
+import pytest
+
+from lib.analytics import Analytics
+from lib.offload import CpuOffload
+
+
+def _sleep_pid(seconds: float) -> int:
+    time.sleep(seconds)
+    return os.getpid()
+
+
+def test_small_input_runs_inline_and_large_in_thread_when_pool_disabled():
+    offload = CpuOffload(workers=0, min_size=100)
+    caller = threading.get_ident()
+
+    async def run():
+        small = await offload.run(threading.get_ident, size=10)
+        large = await offload.run(threading.get_ident, size=1000)
+        return small, large
+
+    small, large = asyncio.run(run())
+    assert small == caller and large != caller
+    stats = offload.snapshot()["functions"]["get_ident"]
+    assert (stats["inline"], stats["thread"], stats["process"]) == (1, 1, 0)
+
+
+def _crash_in_worker(parent_pid: int) -> int:
+    """В воркере роняет процесс (как OOM-killer), в родителе — просто работает."""
+    if os.getpid() != parent_pid:
+        os._exit(1)
+    return os.getpid()
+
+
+def test_broken_pool_is_shut_down_and_call_falls_back_to_thread():
+    offload = CpuOffload(workers=2, min_size=0)
+    try:
+        async def run():
+            await offload.start()
+            broken = offload._executor
+            processes = list(broken._processes.values())
+            pid = await offload.run(_crash_in_worker, os.getpid())
+            return broken, processes, pid
+        broken, processes, pid = asyncio.run(run())
+
+        assert pid == os.getpid() and offload.broken == 1
+        assert offload._executor is None
+        # Сломанный пул закрыт: ни воркеры, ни его очереди (дескрипторы) не остаются висеть
+        assert broken._processes is None and broken._call_queue is None
+        for process in processes:
+            process.join(timeout=5)
+        assert not any(process.is_alive() for process in processes)
+        # Следующий вызов поднимает новый пул
+        assert asyncio.run(offload.run(_sleep_pid, 0.0)) != os.getpid()
+    finally:
+        offload.shutdown()
+
+    stats = offload.snapshot()["functions"]["_crash_in_worker"]
+    assert (stats["process"], stats["thread"]) == (0, 1)
+
+
+def test_process_pool_runs_work_in_worker_and_reports_timings():
+    offload = CpuOffload(workers=1, min_size=0)
+    records = [{"total_tokens": i, "input_preview": f"q{i}"} for i in range(1000)]
+    try:
+        async def run():
+            pid = await offload.run(_sleep_pid, 0.05)
+            dashboard = await offload.run(Analytics.format_dashboard, records, size=len(records))
+            return pid, dashboard
+        pid, dashboard = asyncio.run(run())
+    finally:
+        offload.shutdown()
+
+    assert pid != os.getpid()
+    assert dashboard == Analytics.format_dashboard(records)
+    stats = offload.snapshot()["functions"]["_sleep_pid"]
+    assert stats["process"] == 1 and stats["exec_avg_ms"] >= 50
+    # Старт воркера (spawn) приходится на первую задачу — он в очереди, а не в исполнении
+    assert stats["queue_max_ms"] + stats["transfer_avg_ms"] > 0
+
+
+def test_full_queue_falls_back_to_thread_and_errors_propagate():
+    offload = CpuOffload(workers=1, max_queue=0, min_size=0)
+    try:
+        async def run():
+            return await asyncio.gather(offload.run(_sleep_pid, 0.3), offload.run(_sleep_pid, 0.0))
+        in_pool, overflowed = asyncio.run(run())
+        with pytest.raises(ValueError):
+            asyncio.run(offload.run(int, "не число"))
+    finally:
+        offload.shutdown()
+
+    assert in_pool != os.getpid() and overflowed == os.getpid()
+    stats = offload.snapshot()["functions"]["_sleep_pid"]
+    assert (stats["process"], stats["thread"], stats["overflow"]) == (1, 1, 1)
+
+
+def test_process_false_keeps_transfer_heavy_work_in_thread():
+    offload = CpuOffload(workers=1, min_size=0)
+
+    async def run():
+        return await offload.run(_sleep_pid, 0.0, process=False)
+
+    assert asyncio.run(run()) == os.getpid()
+    assert not offload.started
+    assert offload.snapshot()["functions"]["_sleep_pid"]["thread"] == 1
+
+
+def test_profile_registry_parses_large_profile_in_pool(tmp_path, monkeypatch):
+    from lib import profile_registry
+
+    offload = CpuOffload(workers=1)
+    monkeypatch.setattr(profile_registry, "get_cpu_offload", lambda: offload)
+    (tmp_path / "config").mkdir()
+    (tmp_path / "config" / "profile.md").write_text(
+        "## О себе\n- **Имя:** Анна\n" + "## Заметки\nТекст заметки. \n" * 500, encoding="utf-8"
+    )
+    try:
+        registry = profile_registry.ProfileRegistry(base_dir=tmp_path)
+        view = asyncio.run(registry.get("anna"))
+    finally:
+        offload.shutdown()
+
+    assert view.name == "Анна" and view.render("заметки")
+    assert offload.snapshot()["functions"]["parse_profile"]["process"] == 1
+    assert registry.get_sync("anna") is view
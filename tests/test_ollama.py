@@ -0,0 +1,131 @@
+"""Тесты подбора num_ctx, оценки KV-кэша и планировщика загрузки моделей Ollama."""
+
+from lib import ollama
+from lib.ollama import (
+    ContextSizer,
+    ResidencyScheduler,
+    bucket_num_ctx,
+    chat,
+    chat_request,
+    kv_cache_bytes,
+    ollama_root_url,
+    resident_models,
+)
+from lib.stub_llm import StubLLMServer, serve_in_thread
+
+GEMMA_INFO = {
+    "general.architecture": "gemma3",
+    "gemma3.block_count": 26,
+    "gemma3.attention.head_count": 4,
+    "gemma3.attention.head_count_kv": 1,
+    "gemma3.attention.key_length": 256,
+    "gemma3.embedding_length": 1152,
+}
+
+
+def _messages(chars: int):
+    return [{"role": "system", "content": "s" * chars}, {"role": "user", "content": "вопрос"}]
+
+
+def test_bucket_num_ctx_picks_smallest_fitting():
+    assert bucket_num_ctx(100) == 2048
+    assert bucket_num_ctx(2048) == 2048
+    assert bucket_num_ctx(2049) == 4096
+    assert bucket_num_ctx(10**9) == 131072
+
+
+def test_kv_cache_bytes_from_model_info():
+    # 2 (K+V) x 26 слоёв x 1 KV-голова x 256 x 2 байта = 26 KB на токен
+    assert kv_cache_bytes(GEMMA_INFO, 8192) == 2 * 26 * 256 * 2 * 8192
+    assert kv_cache_bytes(GEMMA_INFO, 8192, cache_type="q8_0") == 26 * 256 * 2 * 8192
+    assert kv_cache_bytes({}, 8192) is None
+
+
+def test_kv_cache_bytes_per_layer_heads_and_missing_key_length():
+    info = {
+        "general.architecture": "x",
+        "x.block_count": 2,
+        "x.attention.head_count": 8,
+        "x.attention.head_count_kv": [2, 4],
+        "x.embedding_length": 512,
+    }
+    # head_dim = 512 / 8 = 64, KV-голов суммарно 6
+    assert kv_cache_bytes(info, 1000) == 2 * 6 * 64 * 2 * 1000
+
+
+def test_context_sizer_grows_but_never_shrinks(monkeypatch):
+    monkeypatch.setattr(ollama, "model_info", lambda model, root_url=None: GEMMA_INFO)
+    sizer = ContextSizer(max_output_tokens=1024)
+
+    assert sizer.fit("m", _messages(100)) == 2048
+    # Длинный промпт (~4000 токенов) + 1024 на ответ -> 8192
+    assert sizer.fit("m", _messages(12000)) == 8192
+    # Короткий после длинного остаётся в том же bucket — без перезагрузки модели
+    assert sizer.fit("m", _messages(100)) == 8192
+    assert sizer.kv_cache_mb("m") == 208.0
+
+
+def test_context_sizer_reserve_sizes_whole_run_upfront(monkeypatch):
+    monkeypatch.setattr(ollama, "model_info", lambda model, root_url=None: {})
+    sizer = ContextSizer(max_output_tokens=1024)
+    assert sizer.reserve([_messages(100), _messages(12000)]) == 8192
+    assert sizer.fit("m", _messages(100)) == 8192
+    assert sizer.kv_cache_mb("m") is None
+
+
+def test_chat_request_sets_context_and_output_budget():
+    payload = chat_request("m", _messages(10), num_ctx=4096, max_output_tokens=512)
+    assert payload["options"]["num_ctx"] == 4096
+    assert payload["options"]["num_predict"] == 512
+    assert payload["stream"] is False
+
+
+def test_ollama_root_url_strips_openai_suffix(monkeypatch):
+    monkeypatch.setenv("OLLAMA_BASE_URL", "http://gpu-box:11434/v1/")
+    assert ollama_root_url() == "http://gpu-box:11434"
+    assert ollama_root_url("http://localhost:11434") == "http://localhost:11434"
+
+
+def _ask(root_url):
+    def execute(model, item):
+        body = chat(chat_request(model, _messages(10), 2048, 64), root_url=root_url)
+        return {"item": item, "load_s": body.get("load_duration", 0) / 1e9}
+    return execute
+
+
+def test_scheduler_groups_jobs_per_model_and_separates_load_time():
+    # Порядок «задача x модель»: наивно 6 смен модели, с группировкой — 3 загрузки
+    jobs = [(model, task) for task in ("t1", "t2") for model in ("a", "b", "c")]
+    with serve_in_thread(StubLLMServer(load_s=0.1)) as server:
+        scheduler = ResidencyScheduler(root_url=server.root_url)
+        report = scheduler.run(jobs, _ask(server.root_url))
+
+    assert server.loads == 3
+    assert report["order"] == ["a", "b", "c"]
+    for stats in report["models"].values():
+        assert stats["jobs"] == 2 and stats["load_s"] >= 0.1 and not stats["prefetched"]
+        # Загрузка прошла до задач, в инференс не попала
+        assert stats["inference_s"] < 0.1
+    assert report["naive_s"] >= report["wall_s"] + 0.25
+    assert report["saved_s"] > 0
+
+
+def test_scheduler_starts_with_resident_model():
+    with serve_in_thread(StubLLMServer()) as server:
+        ollama.preload("b", root_url=server.root_url)
+        assert resident_models(server.root_url).keys() == {"b"}
+        plan = ResidencyScheduler(root_url=server.root_url).plan([("a", 1), ("b", 2), ("a", 3)])
+    assert plan == [("b", [2]), ("a", [1, 3])]
+
+
+def test_scheduler_prefetches_next_model_within_memory_budget():
+    with serve_in_thread(StubLLMServer(load_s=0.1, max_loaded=2, model_bytes=1000)) as server:
+        scheduler = ResidencyScheduler(memory_budget_bytes=2000, root_url=server.root_url)
+        report = scheduler.run([("a", 1), ("b", 2)], _ask(server.root_url))
+        tight = ResidencyScheduler(memory_budget_bytes=1500, root_url=server.root_url)
+        tight_report = tight.run([("c", 1), ("d", 2)], _ask(server.root_url))
+
+    assert report["models"]["b"]["prefetched"]
+    assert report["models"]["b"]["load_s"] >= 0.1
+    # Вторая модель не влезает в бюджет — грузится только после первой
+    assert not tight_report["models"]["d"]["prefetched"]
@@ -4,6 +4,8 @@ import asyncio
 from types import SimpleNamespace
 from unittest.mock import AsyncMock, MagicMock, patch
 
+import pytest
+
 from lib.openrouter_client import OpenRouterClient, build_messages
 
 
@@ -101,3 +103,494 @@ def test_stream_completion_passes_temperature_to_llm(monkeypatch):
 
     client.llm.bind.assert_called_once_with(temperature=0.9)
     assert chunks == ["a", "b"]
+
+
+# ========================== ADMISSION CONTROL ==========================
+
+from lib.openrouter_client import (
+    AdmissionController,
+    PRIORITY_BACKGROUND,
+    PRIORITY_INTERACTIVE,
+    QueueFullError,
+)
+from lib.stub_llm import StubLLMServer
+
+
+def test_admission_limits_concurrency_per_model():
+    controller = AdmissionController(initial_limit=2)
+    peak = {"now": 0, "max": 0}
+
+    async def job():
+        async with controller.slot("m"):
+            peak["now"] += 1
+            peak["max"] = max(peak["max"], peak["now"])
+            await asyncio.sleep(0.01)
+            peak["now"] -= 1
+
+    async def run():
+        await asyncio.gather(*(job() for _ in range(6)))
+
+    asyncio.run(run())
+    assert peak["max"] <= 3  # лимит 2 + аддитивный рост после успехов
+    assert controller.snapshot()["admitted"] == 6
+
+
+def test_admission_interactive_overtakes_background():
+    controller = AdmissionController(initial_limit=1)
+    order = []
+
+    async def job(name, priority):
+        async with controller.slot("m", priority):
+            order.append(name)
+
+    async def run():
+        await controller.acquire("m")  # занимаем единственный слот
+        tasks = [
+            asyncio.create_task(job("bg", PRIORITY_BACKGROUND)),
+            asyncio.create_task(job("chat", PRIORITY_INTERACTIVE)),
+        ]
+        await asyncio.sleep(0)
+        controller.release("m")
+        await asyncio.gather(*tasks)
+
+    asyncio.run(run())
+    assert order == ["chat", "bg"]
+
+
+def test_admission_rejects_when_queue_full():
+    controller = AdmissionController(initial_limit=1, max_queue=1)
+
+    async def run():
+        await controller.acquire("m")
+        waiter = asyncio.create_task(controller.acquire("m"))
+        await asyncio.sleep(0)
+        try:
+            await controller.acquire("m")
+        except QueueFullError:
+            rejected = True
+        else:
+            rejected = False
+        waiter.cancel()
+        return rejected
+
+    assert asyncio.run(run()) is True
+    assert controller.snapshot()["rejected"] == 1
+
+
+def test_admission_aimd_decrease_on_429_and_increase_on_success():
+    controller = AdmissionController(initial_limit=8, min_limit=1)
+
+    async def run():
+        await controller.acquire("m")
+        controller.release("m", rate_limited=True)
+        after_429 = controller.snapshot()["models"]["m"]["limit"]
+        await controller.acquire("m")
+        controller.release("m", latency_s=0.1)
+        return after_429, controller.snapshot()["models"]["m"]["limit"]
+
+    after_429, after_success = asyncio.run(run())
+    assert after_429 == 4.0
+    assert after_success > after_429
+
+
+def test_admission_burst_of_429_decreases_once_per_window():
+    controller = AdmissionController(initial_limit=16, min_limit=1)
+
+    async def run():
+        for _ in range(8):
+            await controller.acquire("m")
+        # Восемь одновременных запросов получили 429 от одной перегрузки
+        for _ in range(8):
+            controller.release("m", latency_s=0.05, rate_limited=True)
+        after_burst = controller.snapshot()["models"]["m"]["limit"]
+        await asyncio.sleep(0.06)
+        await controller.acquire("m")
+        controller.release("m", latency_s=0.05, rate_limited=True)
+        return after_burst, controller.snapshot()["models"]["m"]
+
+    after_burst, stats = asyncio.run(run())
+    assert after_burst == 8.0
+    assert stats["limit"] == 4.0 and stats["throttled"] == 9
+
+
+def test_admission_slow_response_shrinks_limit():
+    controller = AdmissionController(initial_limit=10, latency_target_s=1.0)
+
+    async def run():
+        await controller.acquire("m")
+        controller.release("m", latency_s=5.0)
+
+    asyncio.run(run())
+    assert controller.snapshot()["models"]["m"]["limit"] == 9.0
+
+
+def test_admission_adapts_to_stub_server_rate_limits(monkeypatch):
+    """Сервер пускает 2 запроса одновременно, остальным — 429. Лимит должен сойтись."""
+    monkeypatch.setenv("OPENROUTER_API_KEY", "test-key")
+    monkeypatch.setenv("OPENROUTER_SDK_MAX_RETRIES", "0")
+    monkeypatch.setenv("OPENROUTER_MAX_RETRIES", "0")
+
+    async def run():
+        async with StubLLMServer(reply="pong", delay_s=0.05, max_concurrency=2) as server:
+            monkeypatch.setenv("OPENROUTER_BASE_URL", server.base_url)
+            controller = AdmissionController(initial_limit=8)
+            client = OpenRouterClient(limiter=controller)
+            msgs = [{"role": "user", "content": "ping"}]
+
+            first = await asyncio.gather(
+                *(client.get_completion_text(msgs) for _ in range(8)),
+                return_exceptions=True,
+            )
+            # Следующая перегрузка — позже окна: 429 в пределах окна лимит повторно не режут
+            await asyncio.sleep(0.1)
+            second = await asyncio.gather(
+                *(client.get_completion_text(msgs) for _ in range(6)),
+                return_exceptions=True,
+            )
+            return server, controller, client.model, first, second
+
+    server, controller, model, first, second = asyncio.run(run())
+
+    assert server.rate_limited > 0
+    assert any(isinstance(r, Exception) for r in first)
+    model_stats = controller.snapshot()["models"][model]
+    assert model_stats["throttled"] > 0
+    # После сжатия лимита 429 остаются только на аддитивном «прощупывании» вверх.
+    first_errors = sum(isinstance(r, Exception) for r in first)
+    second_errors = sum(isinstance(r, Exception) for r in second)
+    assert second_errors < first_errors
+    assert sum(str(r).strip() == "pong" for r in second) >= 4
+
+
+# ========================== RETRY / HEDGE / FALLBACK ==========================
+
+from lib.openrouter_client import ModelRoute, backoff_delay, parse_fallback_models
+
+
+class _StatusError(Exception):
+    def __init__(self, status_code):
+        super().__init__(f"HTTP {status_code}")
+        self.status_code = status_code
+
+
+class FakeRouteLLM:
+    """Поддельный ChatOpenAI: сценарий на каждый вызов astream/ainvoke."""
+
+    def __init__(self, scenarios):
+        self.scenarios = list(scenarios)
+        self.calls = 0
+        self.closed = 0
+
+    def bind(self, **_kwargs):
+        return self
+
+    def _next(self):
+        self.calls += 1
+        return self.scenarios.pop(0) if len(self.scenarios) > 1 else self.scenarios[0]
+
+    async def astream(self, _messages):
+        delay, error, pieces = self._next()
+        try:
+            await asyncio.sleep(delay)
+            if error is not None:
+                raise error
+            for piece in pieces:
+                yield SimpleNamespace(content=piece)
+        finally:
+            self.closed += 1
+
+    async def ainvoke(self, _messages):
+        delay, error, pieces = self._next()
+        await asyncio.sleep(delay)
+        if error is not None:
+            raise error
+        return SimpleNamespace(content="".join(pieces), usage_metadata={})
+
+
+def _resilient_client(monkeypatch, primary, fallbacks=(), **settings):
+    client, _ = _make_client(monkeypatch)
+    client.limiter = AdmissionController()
+    client.llm = primary
+    client.fallbacks = [ModelRoute(f"fb-{i}", llm) for i, llm in enumerate(fallbacks)]
+    client.retry_base_s = 0.0
+    for key, value in settings.items():
+        setattr(client, key, value)
+    return client
+
+
+def _collect(client):
+    async def run():
+        return [c async for c in client.stream_completion([{"role": "user", "content": "q"}])]
+    return asyncio.run(run())
+
+
+def test_stream_retries_before_first_token(monkeypatch):
+    primary = FakeRouteLLM([(0, _StatusError(503), []), (0, None, ["ok"])])
+    client = _resilient_client(monkeypatch, primary, max_retries=1)
+
+    assert _collect(client) == ["ok"]
+    assert primary.calls == 2
+    assert client.stats["retries"] == 1
+
+
+def test_stream_falls_back_on_non_retryable_error(monkeypatch):
+    primary = FakeRouteLLM([(0, _StatusError(400), [])])
+    backup = FakeRouteLLM([(0, None, ["from", " backup"])])
+    client = _resilient_client(monkeypatch, primary, [backup], max_retries=3)
+
+    assert _collect(client) == ["from", " backup"]
+    assert primary.calls == 1, "400 не должен повторяться на той же модели"
+    assert client.last_model == "fb-0"
+    assert client.stats["fallbacks"] == 1
+
+
+def test_stream_hedges_slow_primary_and_cancels_loser(monkeypatch):
+    primary = FakeRouteLLM([(5.0, None, ["slow"])])
+    backup = FakeRouteLLM([(0, None, ["fast"])])
+    client = _resilient_client(monkeypatch, primary, [backup], hedge_after_s=0.05)
+
+    assert _collect(client) == ["fast"]
+    assert client.stats["hedges"] == 1
+    assert client.stats["hedge_wins"] == 1
+    assert primary.closed == 1, "проигравший стрим должен быть закрыт"
+    assert client.limiter.snapshot()["models"]["anthropic/claude-3.5-sonnet"]["in_flight"] == 0
+
+
+def test_hedge_does_not_use_up_primary_retries(monkeypatch):
+    # Основная модель отвечает 503 уже после старта hedge, запасная падает с 400
+    primary = FakeRouteLLM([(0.1, _StatusError(503), []), (0, None, ["ok"])])
+    backup = FakeRouteLLM([(0, _StatusError(400), [])])
+    client = _resilient_client(monkeypatch, primary, [backup], max_retries=1, hedge_after_s=0.05)
+
+    assert _collect(client) == ["ok"]
+    assert client.stats["hedges"] == 1
+    assert primary.calls == 2 and backup.calls == 1
+    assert client.last_model == "anthropic/claude-3.5-sonnet"
+
+
+def test_local_primary_falling_back_to_cloud_reports_cloud(monkeypatch):
+    primary = FakeRouteLLM([(0, ConnectionRefusedError(), [])])
+    backup = FakeRouteLLM([(0, None, ["ok"])])
+    client = _resilient_client(monkeypatch, primary, [backup], max_retries=0, local=True)
+
+    assert _collect(client) == ["ok"]
+    assert client.last_model == "fb-0" and client.last_local is False
+
+
+def test_stream_ttft_timeout_moves_to_fallback(monkeypatch):
+    primary = FakeRouteLLM([(5.0, None, ["never"])])
+    backup = FakeRouteLLM([(0, None, ["ok"])])
+    client = _resilient_client(monkeypatch, primary, [backup], max_retries=0, ttft_timeout_s=0.05)
+
+    assert _collect(client) == ["ok"]
+    assert primary.closed == 1
+
+
+def test_stream_error_after_first_token_is_not_retried(monkeypatch):
+    class Broken(FakeRouteLLM):
+        async def astream(self, _messages):
+            self.calls += 1
+            yield SimpleNamespace(content="part")
+            raise _StatusError(502)
+
+    primary = Broken([None])
+    client = _resilient_client(monkeypatch, primary, max_retries=2)
+
+    async def run():
+        got = []
+        try:
+            async for chunk in client.stream_completion([{"role": "user", "content": "q"}]):
+                got.append(chunk)
+        except _StatusError:
+            return got, True
+        return got, False
+
+    got, raised = asyncio.run(run())
+    assert got == ["part"] and raised
+    assert primary.calls == 1
+
+
+def test_stream_raises_last_error_when_chain_exhausted(monkeypatch):
+    primary = FakeRouteLLM([(0, _StatusError(500), [])])
+    backup = FakeRouteLLM([(0, _StatusError(500), [])])
+    client = _resilient_client(monkeypatch, primary, [backup], max_retries=1)
+
+    try:
+        _collect(client)
+    except _StatusError as e:
+        assert e.status_code == 500
+    else:
+        raise AssertionError("ожидали ошибку после исчерпания цепочки")
+    assert primary.calls == 2 and backup.calls == 2
+
+
+def test_chat_completion_falls_back(monkeypatch):
+    primary = FakeRouteLLM([(0, _StatusError(429), [])])
+    backup = FakeRouteLLM([(0, None, ["fine"])])
+    client = _resilient_client(monkeypatch, primary, [backup], max_retries=1)
+
+    text = asyncio.run(client.get_completion_text([{"role": "user", "content": "q"}]))
+    assert text == "fine"
+    assert primary.calls == 2
+
+
+def test_programming_errors_are_not_retried_or_sent_down_the_chain(monkeypatch):
+    from lib.openrouter_client import is_retryable_error
+
+    assert is_retryable_error(asyncio.TimeoutError()) and is_retryable_error(ConnectionResetError())
+    assert not is_retryable_error(TypeError("bad argument"))
+
+    for error in (TypeError("bad argument"), KeyError("choices")):
+        primary = FakeRouteLLM([(0, error, [])])
+        backup = FakeRouteLLM([(0, None, ["never"])])
+        client = _resilient_client(monkeypatch, primary, [backup], max_retries=2)
+        with pytest.raises(type(error)):
+            _collect(client)
+        with pytest.raises(type(error)):
+            asyncio.run(client.get_completion_text([{"role": "user", "content": "q"}]))
+        assert primary.calls == 2 and backup.calls == 0
+
+
+def test_parse_fallback_models_supports_ollama(monkeypatch):
+    monkeypatch.setenv("OLLAMA_BASE_URL", "http://localhost:11434/v1")
+    with patch("lib.openrouter_client.ChatOpenAI") as mock_chat:
+        routes = parse_fallback_models(" openai/gpt-4o-mini, ollama:gemma4:e4b ,", "key", "https://or")
+    assert [r.model for r in routes] == ["openai/gpt-4o-mini", "gemma4:e4b"]
+    assert [r.local for r in routes] == [False, True]
+    assert mock_chat.call_args_list[1].kwargs["base_url"] == "http://localhost:11434/v1"
+
+
+def test_backoff_delay_bounded_by_cap():
+    for attempt in range(10):
+        assert 0 <= backoff_delay(attempt, 0.5, 2.0) <= 2.0
+
+
+# ========================== CANCELLATION ==========================
+
+from lib.openrouter_client import GenerationCancelled
+
+
+def test_stream_cancel_event_closes_provider_stream(monkeypatch):
+    primary = FakeRouteLLM([(0, None, ["a", "b", "c", "d"])])
+    client = _resilient_client(monkeypatch, primary)
+
+    async def run():
+        cancel = asyncio.Event()
+        got = []
+        try:
+            async for chunk in client.stream_completion(
+                [{"role": "user", "content": "q"}], cancel_event=cancel
+            ):
+                got.append(chunk)
+                if len(got) == 2:
+                    cancel.set()
+        except GenerationCancelled:
+            return got, True
+        return got, False
+
+    got, cancelled = asyncio.run(run())
+    assert cancelled and got == ["a", "b"]
+    assert primary.closed == 1
+    assert client.limiter.snapshot()["models"]["anthropic/claude-3.5-sonnet"]["in_flight"] == 0
+
+
+def test_stream_cancel_event_before_first_token(monkeypatch):
+    primary = FakeRouteLLM([(5.0, None, ["late"])])
+    client = _resilient_client(monkeypatch, primary)
+
+    async def run():
+        cancel = asyncio.Event()
+        asyncio.get_running_loop().call_later(0.05, cancel.set)
+        try:
+            async for _ in client.stream_completion(
+                [{"role": "user", "content": "q"}], cancel_event=cancel
+            ):
+                pass
+        except GenerationCancelled:
+            return True
+        return False
+
+    assert asyncio.run(asyncio.wait_for(run(), timeout=2)) is True
+    assert primary.closed == 1
+
+
+def test_build_messages_injects_memory_snippets_after_system():
+    messages = build_messages(
+        "q", [{"role": "user", "content": "h"}], "sys", memory_snippets=["факт 1", "факт 2"]
+    )
+    assert messages[0]["content"] == "sys"
+    assert messages[1]["role"] == "system"
+    assert "- факт 1\n- факт 2" in messages[1]["content"]
+    assert [m["content"] for m in messages[2:]] == ["h", "q"]
+
+
+def test_build_messages_without_snippets_unchanged():
+    assert build_messages("q", [], "sys", memory_snippets=[]) == build_messages("q", [], "sys")
+
+
+def test_explicit_model_and_base_url_skip_env_fallbacks(monkeypatch):
+    monkeypatch.setenv("OPENROUTER_API_KEY", "test-key")
+    monkeypatch.setenv("OPENROUTER_FALLBACK_MODELS", "openai/gpt-4o-mini")
+    with patch("lib.openrouter_client.ChatOpenAI") as mock_chat:
+        client = OpenRouterClient(model="gemma4:e4b", base_url="http://localhost:11434/v1", api_key="ollama")
+    assert client.model == "gemma4:e4b"
+    assert client.fallbacks == []
+    assert mock_chat.call_args.kwargs["base_url"] == "http://localhost:11434/v1"
+
+
+def _dialog(turns):
+    history = []
+    for i in range(turns):
+        history.append({"role": "user", "content": f"q{i}"})
+        history.append({"role": "assistant", "content": f"a{i}"})
+    return history
+
+
+def test_message_sequence_matches_build_messages():
+    from lib.openrouter_client import MessageSequence
+
+    history = _dialog(3)
+    seq = MessageSequence().prepare("новый", history, "sys", ["факт"])
+    expected = build_messages("новый", history, "sys", ["факт"])
+
+    assert list(seq) == expected
+    assert len(seq) == len(expected)
+    assert seq[0] == expected[0] and seq[-1] == expected[-1] and seq[3] == expected[3]
+    lc = seq.langchain()
+    assert [type(m).__name__ for m in lc[:3]] == ["SystemMessage", "SystemMessage", "HumanMessage"]
+    assert [m.content for m in lc] == [m["content"] for m in expected]
+
+
+def test_message_sequence_converts_only_new_turns():
+    from lib.openrouter_client import MessageSequence, to_langchain_messages
+
+    history = _dialog(50)
+    seq = MessageSequence()
+    first = to_langchain_messages(seq.prepare("q50", history, "sys"))
+    assert seq.conversions == 100
+
+    history += [{"role": "user", "content": "q50"}, {"role": "assistant", "content": "a50"}]
+    second = to_langchain_messages(seq.prepare("q51", history, "sys"))
+
+    assert seq.conversions == 102
+    assert second[0] is first[0]
+    assert second[1] is first[1]
+    assert second[-1].content == "q51"
+
+
+def test_message_sequence_rebuilds_when_history_replaced_or_shrunk():
+    from lib.openrouter_client import MessageSequence
+
+    history = _dialog(5)
+    seq = MessageSequence()
+    seq.prepare("x", history)
+
+    seq.prepare("x", _dialog(1))
+    assert seq.conversions == 12
+
+    shrunk = _dialog(5)
+    seq.prepare("x", shrunk)
+    shrunk.clear()
+    shrunk.extend(_dialog(2))
+    seq.prepare("x", shrunk)
+    assert [m.content for m in seq.langchain()] == ["q0", "a0", "q1", "a1", "x"]
@@ -0,0 +1,126 @@
+"""Тесты стража вывода: повторы, лимит длины, зависание стрима."""
+
+import asyncio
+import io
+import json
+import time
+
+import pytest
+
+from lib.batch import BatchRunner, iter_jsonl
+from lib.ollama import chat_request, chat_stream
+from lib.output_guard import (
+    REASON_MAX_TOKENS,
+    REASON_REPETITION,
+    REASON_STALL,
+    GenerationAborted,
+    OutputGuard,
+    guard_stream,
+)
+from lib.stub_llm import StubLLMServer, serve_in_thread
+
+LOOP = "* Ты можешь положиться на меня, я всегда рядом с тобой.\n"
+PROSE = " ".join(f"слово{i} связка{i % 7} пример{i * 3}" for i in range(400))
+
+
+def _feed_all(guard, text, size=7):
+    for start in range(0, len(text), size):
+        reason = guard.feed(text[start:start + size])
+        if reason:
+            return reason, start
+    return None, len(text)
+
+
+def test_repetition_triggers_on_looping_output():
+    reason, at = _feed_all(OutputGuard(max_tokens=0), LOOP * 200)
+    assert reason == REASON_REPETITION
+    # Окно в 240 слов — ~25 повторов строки, а не весь ответ
+    assert at < len(LOOP) * 30
+
+
+def test_normal_text_and_repeated_code_lines_pass():
+    guard = OutputGuard(max_tokens=0)
+    code = "".join(f"    result.append(item_{i})\n    total += 1\n" for i in range(150))
+    assert _feed_all(guard, PROSE + code)[0] is None
+    assert guard.repetition < 0.6
+
+
+def test_max_tokens_caps_length():
+    guard = OutputGuard(max_tokens=100)
+    assert _feed_all(guard, PROSE)[0] == REASON_MAX_TOKENS
+    assert guard.feed("ещё") == REASON_MAX_TOKENS
+
+
+def test_words_split_across_chunks_count_once():
+    guard = OutputGuard(ngram=2)
+    for chunk in ("при", "вет ми", "р ", "привет"):
+        guard.feed(chunk)
+    assert list(guard._words) == ["привет", "мир"]
+
+
+async def _collect(stream):
+    return [chunk async for chunk in stream]
+
+
+def test_guard_stream_aborts_stalled_stream_and_closes_source():
+    closed = []
+
+    async def stalled():
+        try:
+            yield "начало "
+            await asyncio.sleep(10)
+            yield "никогда"
+        finally:
+            closed.append(True)
+
+    guard = OutputGuard(stall_s=0.05)
+    with pytest.raises(GenerationAborted) as exc:
+        asyncio.run(_collect(guard_stream(stalled(), guard)))
+    assert exc.value.reason == REASON_STALL and guard.reason == REASON_STALL
+    assert closed == [True]
+
+
+def test_ollama_chat_stream_stops_looping_model():
+    with serve_in_thread(StubLLMServer(reply=LOOP * 200)) as server:
+        payload = chat_request("m", [{"role": "user", "content": "?"}], num_ctx=2048, max_output_tokens=8192)
+        body = chat_stream(payload, OutputGuard(max_tokens=8192), root_url=server.root_url)
+        clean = chat_stream(payload, None, root_url=server.root_url)
+
+    assert body["aborted"] == REASON_REPETITION
+    assert 0 < len(body["message"]["content"]) < len(LOOP) * 30
+    assert body["eval_count"] > 0
+    assert "aborted" not in clean and clean["message"]["content"] == LOOP * 200
+
+
+def test_ollama_chat_stream_aborts_stall_after_first_chunk():
+    # Первый чанк пришёл, дальше сервер молчит: ждём stall_s, а не общий timeout
+    stub = StubLLMServer(reply="раз два три", stall_after=1, stall_s=3.0)
+    with serve_in_thread(stub) as server:
+        payload = chat_request("m", [{"role": "user", "content": "?"}], num_ctx=2048, max_output_tokens=64)
+        started = time.perf_counter()
+        body = chat_stream(payload, OutputGuard(stall_s=0.2), root_url=server.root_url, timeout=600)
+        elapsed = time.perf_counter() - started
+
+    assert body["aborted"] == REASON_STALL
+    assert body["message"]["content"] == "раз "
+    assert elapsed < 2
+
+
+class LoopingClient:
+    model = "loop-model"
+
+    async def stream_completion(self, messages, cancel_event=None):
+        for _ in range(200):
+            yield LOOP
+
+
+def test_batch_marks_aborted_item_and_keeps_partial_answer(tmp_path):
+    src = tmp_path / "in.jsonl"
+    src.write_text(json.dumps({"prompt": "поддержи меня"}, ensure_ascii=False))
+    out = io.StringIO()
+    summary = asyncio.run(BatchRunner(LoopingClient()).run(iter_jsonl(src), out))
+
+    result = json.loads(out.getvalue())
+    assert summary["aborted"] == 1 and summary["errors"] == 0
+    assert result["aborted"] == REASON_REPETITION
+    assert result["response"].startswith(LOOP) and len(result["response"]) < len(LOOP) * 30
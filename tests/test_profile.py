@@ -82,3 +82,86 @@ def test_get_profile_summary_has_name_and_sections():
     assert "Цели" in out
     assert "Интересы" in out
     assert "2" in out
+
+
+PROFILE = """# Профиль пользователя
+<!-- инструкция, не для модели -->
+
+## Базовая информация
+
+- **Имя:** Иван
+- **Профессия:** Android-разработчик
+
+## Цели и интересы
+
+- Выучить немецкий язык к лету
+- Пробежать марафон
+
+## Здоровье и спорт
+
+- Бегаю по утрам 3 раза в неделю, готовлюсь к марафону
+
+## Работа
+
+- Пишу на Kotlin, проект на Jetpack Compose
+
+## Стиль общения
+
+- Коротко и по делу
+"""
+
+
+def test_parse_profile_builds_sections():
+    from lib.profile import parse_profile
+
+    parsed = parse_profile(PROFILE)
+    assert parsed.name == "Иван"
+    assert [s.title for s in parsed.sections] == [
+        "Базовая информация", "Цели и интересы", "Здоровье и спорт", "Работа", "Стиль общения",
+    ]
+    assert "инструкция" not in parsed.render()
+    assert parsed.preamble == ""
+
+
+def test_select_sections_keeps_core_and_relevant_only():
+    from lib.profile import parse_profile
+
+    parsed = parse_profile(PROFILE)
+    titles = [s.title for s in parsed.select_sections("как подготовиться к марафону?")]
+
+    assert "Базовая информация" in titles
+    assert "Стиль общения" in titles
+    assert "Здоровье и спорт" in titles
+    assert "Работа" not in titles
+
+
+def test_select_sections_matches_word_forms():
+    from lib.profile import parse_profile
+
+    parsed = parse_profile(PROFILE)
+    titles = [s.title for s in parsed.select_sections("проблема с compose в проекте")]
+    assert "Работа" in titles
+
+
+def test_select_sections_respects_budget():
+    from lib.profile import parse_profile
+
+    parsed = parse_profile(PROFILE)
+    core = sum(s.tokens for s in parsed.select_sections("", budget_tokens=0))
+    tight = parsed.select_sections("марафон немецкий kotlin", budget_tokens=core)
+    assert [s.title for s in tight] == ["Базовая информация", "Стиль общения"]
+
+
+def test_render_keeps_document_order():
+    from lib.profile import parse_profile
+
+    out = parse_profile(PROFILE).render("немецкий язык")
+    assert out.index("Базовая информация") < out.index("Цели и интересы") < out.index("Стиль общения")
+
+
+def test_parse_profile_empty():
+    from lib.profile import parse_profile
+
+    parsed = parse_profile("")
+    assert parsed.sections == []
+    assert parsed.render("что угодно") == ""
@@ -0,0 +1,85 @@
+"""Тесты для lib/profile_registry.py."""
+
+import asyncio
+import os
+
+from lib.profile_registry import ProfileRegistry
+
+
+def _write(path, text, mtime=None):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_text(text, encoding="utf-8")
+    if mtime is not None:
+        os.utime(path, ns=(mtime, mtime))
+
+
+def test_personal_profile_overrides_default(tmp_path):
+    _write(tmp_path / "config" / "profile.md", "- **Имя:** Общий")
+    _write(tmp_path / "config" / "profiles" / "anna.md", "- **Имя:** Анна")
+    registry = ProfileRegistry(base_dir=tmp_path)
+
+    assert registry.get_sync("anna").name == "Анна"
+    assert registry.get_sync("boris").name == "Общий"
+
+
+def test_missing_profile_is_not_loaded(tmp_path):
+    view = ProfileRegistry(base_dir=tmp_path).get_sync("nobody")
+    assert not view.loaded
+    assert view.name == "Пользователь"
+
+
+def test_cached_profile_is_not_reparsed(tmp_path):
+    _write(tmp_path / "config" / "profile.md", "- **Имя:** Иван")
+    registry = ProfileRegistry(base_dir=tmp_path, recheck_s=60)
+
+    first = registry.get_sync("u")
+    second = registry.get_sync("u")
+    assert first is second
+    assert registry.snapshot()["loads"] == 1
+    assert registry.snapshot()["hits"] == 1
+
+
+def test_file_change_invalidates_cache(tmp_path):
+    path = tmp_path / "config" / "profile.md"
+    _write(path, "- **Имя:** Иван", mtime=1_000_000_000)
+    registry = ProfileRegistry(base_dir=tmp_path, recheck_s=0)
+    assert registry.get_sync("u").name == "Иван"
+
+    _write(path, "- **Имя:** Пётр", mtime=2_000_000_000)
+    assert registry.get_sync("u").name == "Пётр"
+    assert registry.snapshot()["reloads"] == 1
+
+
+def test_unchanged_file_revalidated_without_reload(tmp_path):
+    _write(tmp_path / "config" / "profile.md", "- **Имя:** Иван")
+    registry = ProfileRegistry(base_dir=tmp_path, recheck_s=0)
+    first = registry.get_sync("u")
+    assert registry.get_sync("u") is first
+    assert registry.snapshot()["reloads"] == 0
+
+
+def test_lru_evicts_least_recent(tmp_path):
+    registry = ProfileRegistry(base_dir=tmp_path, max_entries=2, recheck_s=60)
+    registry.get_sync("a")
+    registry.get_sync("b")
+    registry.get_sync("a")
+    registry.get_sync("c")
+
+    stats = registry.snapshot()
+    assert stats["entries"] == 2 and stats["evictions"] == 1
+    registry.get_sync("b")
+    assert registry.snapshot()["loads"] == 4
+
+
+def test_user_id_is_sanitized(tmp_path):
+    registry = ProfileRegistry(base_dir=tmp_path)
+    path = registry.path_for("../../etc/passwd")
+    assert path == tmp_path / "config" / "profile.md"
+
+
+def test_async_get_returns_view(tmp_path):
+    _write(tmp_path / "config" / "profile.md", "- **Имя:** Иван\n## Работа\nkotlin")
+    registry = ProfileRegistry(base_dir=tmp_path)
+    view = asyncio.run(registry.get("u"))
+    assert view.loaded and view.name == "Иван"
+    assert "Работа" in view.render()
@@ -0,0 +1,75 @@
+"""Тесты для lib/router: классификатор реплик, override, метрики, локальный клиент."""
+
+from unittest.mock import patch
+
+from lib.router import (
+    ROUTE_CLOUD,
+    ROUTE_LOCAL,
+    RouteMetrics,
+    choose_route,
+    cloud_probability,
+    make_local_client,
+)
+
+
+def test_chitchat_goes_local():
+    for text in ("привет", "спасибо!", "ок, понял", "как дела?"):
+        assert choose_route(text) == ROUTE_LOCAL, text
+
+
+def test_code_and_hard_questions_go_cloud():
+    assert choose_route("почему падает ```def f(): return x[0]```?") == ROUTE_CLOUD
+    assert choose_route("напиши функцию, которая сравнивает два списка и объясни сложность") == ROUTE_CLOUD
+    assert choose_route(
+        "спроектируй архитектуру сервиса уведомлений с очередью, ретраями и дедупликацией, "
+        "распиши план миграции со старой системы"
+    ) == ROUTE_CLOUD
+
+
+def test_longer_history_pushes_towards_cloud():
+    assert cloud_probability("а дальше?", history_len=20) > cloud_probability("а дальше?", history_len=0)
+
+
+def test_override_wins_over_classifier():
+    assert choose_route("привет", override=ROUTE_CLOUD) == ROUTE_CLOUD
+    assert choose_route("напиши код сортировки", override=ROUTE_LOCAL) == ROUTE_LOCAL
+
+
+def test_route_metrics_cost_and_averages():
+    metrics = RouteMetrics(cloud_price_per_1k=0.01)
+    metrics.record(ROUTE_CLOUD, 0.2, 1.0, 2000)
+    metrics.record(ROUTE_CLOUD, None, 3.0, 1000)
+    metrics.record(ROUTE_LOCAL, 0.1, 0.5, 5000)
+    snap = metrics.snapshot()
+    assert snap[ROUTE_CLOUD]["requests"] == 2
+    assert snap[ROUTE_CLOUD]["ttft_avg_ms"] == 200.0
+    assert snap[ROUTE_CLOUD]["latency_avg_ms"] == 2000.0
+    assert snap[ROUTE_CLOUD]["cost_usd"] == 0.03
+    assert snap[ROUTE_LOCAL]["cost_usd"] == 0.0
+
+
+def _cloud_client(monkeypatch):
+    from lib.openrouter_client import OpenRouterClient
+
+    monkeypatch.setenv("OPENROUTER_API_KEY", "test-key")
+    monkeypatch.delenv("OPENROUTER_FALLBACK_MODELS", raising=False)
+    with patch("lib.openrouter_client.ChatOpenAI"):
+        return OpenRouterClient()
+
+
+def test_make_local_client_is_opt_in(monkeypatch):
+    cloud = _cloud_client(monkeypatch)
+    monkeypatch.delenv("LOCAL_ROUTING", raising=False)
+    assert make_local_client(cloud) is None
+
+
+def test_make_local_client_falls_back_to_cloud(monkeypatch):
+    cloud = _cloud_client(monkeypatch)
+    monkeypatch.setenv("LOCAL_ROUTING", "1")
+    monkeypatch.setenv("LOCAL_MODEL", "gemma4:e4b")
+    with patch("lib.openrouter_client.ChatOpenAI"):
+        local = make_local_client(cloud)
+    assert local.model == "gemma4:e4b"
+    assert local.limiter is cloud.limiter
+    assert [route.model for route in local.fallbacks] == [cloud.model]
+    assert local.fallbacks[0].llm is cloud.llm
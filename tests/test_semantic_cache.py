@@ -0,0 +1,95 @@
+"""Тесты для lib/semantic_cache.py и lib/embeddings.py."""
+
+import numpy as np
+
+from lib.embeddings import HashingEmbedder, get_embedder
+from lib.semantic_cache import SemanticCache, get_semantic_cache, make_scope
+
+
+def test_hashing_embedder_is_normalized_and_stable():
+    embedder = HashingEmbedder(dim=64)
+    a = embedder.embed("Привет, что ты умеешь?")
+    b = HashingEmbedder(dim=64).embed("Привет, что ты умеешь?")
+    assert a.shape == (64,)
+    assert abs(float(np.linalg.norm(a)) - 1.0) < 1e-5
+    assert np.allclose(a, b)
+
+
+def test_hashing_embedder_similar_texts_closer_than_unrelated():
+    embedder = HashingEmbedder()
+    base = embedder.embed("что ты умеешь делать")
+    near = embedder.embed("что ты умеешь делать?")
+    far = embedder.embed("как настроить docker compose для postgres")
+    assert float(base @ near) > float(base @ far)
+
+
+def test_get_embedder_defaults_to_hashing(monkeypatch):
+    monkeypatch.delenv("EMBEDDING_MODEL", raising=False)
+    assert isinstance(get_embedder(), HashingEmbedder)
+
+
+def test_cache_hit_for_near_duplicate_question():
+    cache = SemanticCache(embedder=HashingEmbedder(), threshold=0.8)
+    cache.store("Что ты умеешь?", "Многое!", "s1")
+
+    assert cache.lookup("что ты умеешь", "s1") == "Многое!"
+    assert cache.lookup("расскажи про квантовую физику", "s1") is None
+    stats = cache.snapshot()
+    assert stats["lookups"] == 2 and stats["hits"] == 1
+    assert stats["hit_rate"] == 0.5
+
+
+def test_hashing_cache_misses_near_duplicate_with_opposite_meaning():
+    question = (
+        "как {} docker engine и docker compose на ubuntu 22.04 через apt из официального "
+        "репозитория docker без snap, с настройкой прав пользователя, автозапуска systemd "
+        "и проверкой hello-world"
+    )
+    embedder = HashingEmbedder()
+    install, remove = question.format("установить"), question.format("удалить")
+    # Лексически вопросы почти одинаковы: порог близости их не различает
+    assert float(embedder.embed(install) @ embedder.embed(remove)) > 0.95
+
+    cache = SemanticCache(embedder=embedder)
+    cache.store(install, "apt install docker-ce", "s")
+    assert cache.exact_terms and cache.threshold == 0.95
+    assert cache.lookup(remove, "s") is None
+    assert cache.lookup(install.upper() + "?", "s") == "apt install docker-ce"
+
+
+def test_cache_is_scoped():
+    cache = SemanticCache(embedder=HashingEmbedder(), threshold=0.8)
+    cache.store("привет", "Привет, Иван!", make_scope("profile-ivan", "m"))
+    assert cache.lookup("привет", make_scope("profile-anna", "m")) is None
+
+
+def test_cache_evicts_by_size():
+    cache = SemanticCache(embedder=HashingEmbedder(), threshold=0.99, max_entries=2)
+    cache.store("первый вопрос", "1", "s")
+    cache.store("второй вопрос", "2", "s")
+    cache.store("третий вопрос", "3", "s")
+
+    assert cache.lookup("первый вопрос", "s") is None
+    assert cache.lookup("третий вопрос", "s") == "3"
+    assert cache.snapshot()["evictions"] == 1
+
+
+def test_cache_evicts_by_age(monkeypatch):
+    cache = SemanticCache(embedder=HashingEmbedder(), ttl_s=10)
+    now = [1000.0]
+    monkeypatch.setattr("lib.semantic_cache.time.time", lambda: now[0])
+    cache.store("вопрос", "ответ", "s")
+    now[0] += 11
+    assert cache.lookup("вопрос", "s") is None
+    assert cache.snapshot()["entries"] == 0
+
+
+def test_cache_only_for_short_history():
+    cache = SemanticCache(embedder=HashingEmbedder(), max_history=2)
+    assert cache.is_cacheable([])
+    assert not cache.is_cacheable([{}, {}, {}])
+
+
+def test_get_semantic_cache_is_opt_in(monkeypatch):
+    monkeypatch.delenv("SEMANTIC_CACHE", raising=False)
+    assert get_semantic_cache() is None
@@ -0,0 +1,130 @@
+"""Тесты для lib/sessions: учёт памяти сессий, выгрузка и возврат истории."""
+
+import asyncio
+
+from lib.sessions import CLIENT_BYTES_ESTIMATE, SessionRegistry, estimate_records_bytes
+
+
+def _history(n, size=500):
+    return [{"role": "user", "content": "x" * size} for _ in range(n)]
+
+
+def test_estimate_records_bytes_grows_with_content():
+    small = estimate_records_bytes(_history(2, 10))
+    large = estimate_records_bytes(_history(2, 10_000))
+    assert large - small >= 2 * (10_000 - 10)
+
+
+def test_accounting_only_by_default(tmp_path):
+    registry = SessionRegistry(store_dir=tmp_path)
+    registry.touch("a", _history(10), [])
+    registry.touch("b", _history(5), [{"total_tokens": 3}])
+
+    assert asyncio.run(registry.enforce()) == 0
+    snap = registry.snapshot()
+    assert snap["sessions"] == 2
+    assert snap["evicted"] == 0
+    assert snap["history_kb"] > 7
+    assert snap["clients_kb"] == round(2 * CLIENT_BYTES_ESTIMATE / 1024, 1)
+
+
+def test_over_budget_evicts_least_recent_and_restores_in_place(tmp_path):
+    registry = SessionRegistry(store_dir=tmp_path, budget_bytes=40_000)
+    old_history, old_usage = _history(40), [{"total_tokens": 10}]
+    registry.touch("old", old_history, old_usage)
+    registry.touch("new", _history(40), [])
+
+    restored = asyncio.run(registry.resume("new"))
+
+    assert restored is False
+    assert old_history == [] and old_usage == []
+    assert (tmp_path / "old.json").exists()
+    assert registry.snapshot()["evicted"] == 1
+
+    assert asyncio.run(registry.restore("old")) is True
+    assert len(old_history) == 40
+    assert old_usage == [{"total_tokens": 10}]
+    assert not (tmp_path / "old.json").exists()
+    assert registry.snapshot()["restores"] == 1
+
+
+def test_history_replaced_while_evicted_is_not_merged_on_resume(tmp_path):
+    registry = SessionRegistry(store_dir=tmp_path, idle_s=0.01)
+    history, usage = _history(6), [{"total_tokens": 10}]
+    registry.touch("s", history, usage)
+
+    async def evict():
+        await asyncio.sleep(0.05)
+        await registry.enforce()
+
+    # /compress идёт, сессия в это время выгружается, затем сессия получает сводку
+    asyncio.run(evict())
+    assert history == []
+    summary = [{"role": "assistant", "content": "[Сводка предыдущего диалога] ..."}]
+    registry.touch("s", summary, usage)
+
+    assert asyncio.run(registry.resume("s")) is True
+    assert summary == [{"role": "assistant", "content": "[Сводка предыдущего диалога] ..."}]
+    assert usage == [{"total_tokens": 10}]
+    assert not (tmp_path / "s.json").exists()
+    assert registry.snapshot()["evicted"] == 0
+
+
+def test_session_in_turn_is_not_evicted_by_other_resume(tmp_path):
+    registry = SessionRegistry(store_dir=tmp_path, idle_s=0.05)
+    a_history, b_history = _history(3), _history(3)
+    registry.touch("a", a_history, [])
+    registry.touch("b", b_history, [])
+
+    async def run():
+        await asyncio.sleep(0.1)
+        # Ход сессии a начался, следом пришло сообщение сессии b
+        await registry.resume("a")
+        await registry.resume("b")
+
+    asyncio.run(run())
+    assert len(a_history) == 3
+    assert registry.snapshot()["evicted"] == 0
+
+    # Ход a закончился: после простоя её снова можно выгрузить
+    registry.touch("a", a_history, [])
+    registry.touch("b", b_history, [])
+
+    async def later():
+        await asyncio.sleep(0.1)
+        await registry.resume("b")
+
+    asyncio.run(later())
+    assert a_history == []
+
+
+def test_idle_sessions_are_evicted(tmp_path):
+    registry = SessionRegistry(store_dir=tmp_path, idle_s=0.01)
+    idle_history = _history(3)
+    registry.touch("idle", idle_history, [])
+    registry.touch("active", _history(3), [])
+
+    async def run():
+        await asyncio.sleep(0.05)
+        return await registry.resume("active")
+
+    asyncio.run(run())
+
+    assert idle_history == []
+    assert registry.snapshot()["evictions"] == 1
+
+
+def test_forget_removes_offloaded_file(tmp_path):
+    registry = SessionRegistry(store_dir=tmp_path, idle_s=0.001)
+    registry.touch("gone", _history(2), [])
+
+    async def run():
+        await asyncio.sleep(0.01)
+        await registry.enforce()
+
+    asyncio.run(run())
+    assert (tmp_path / "gone.json").exists()
+
+    registry.forget("gone")
+    assert not (tmp_path / "gone.json").exists()
+    assert registry.snapshot()["sessions"] == 0
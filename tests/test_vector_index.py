@@ -0,0 +1,85 @@
+"""Тесты для lib/vector_index.py."""
+
+import numpy as np
+
+from lib.vector_index import VectorIndex
+
+
+def _unit(*values):
+    v = np.array(values, dtype=np.float32)
+    return v / np.linalg.norm(v)
+
+
+def test_search_returns_nearest_first():
+    index = VectorIndex(dim=2)
+    index.add("x", _unit(1, 0))
+    index.add("y", _unit(0, 1))
+    index.add("xy", _unit(1, 1))
+
+    result = index.search(_unit(1, 0.1), k=2)
+    assert [key for key, _ in result] == ["x", "xy"]
+    assert result[0][1] > result[1][1]
+
+
+def test_search_empty_index():
+    assert VectorIndex(dim=3).search(_unit(1, 0, 0)) == []
+
+
+def test_grows_beyond_initial_capacity():
+    index = VectorIndex(dim=2, capacity=1)
+    for i in range(10):
+        index.add(i, _unit(1, i))
+    assert len(index) == 10
+    assert index.search(_unit(1, 9), k=1)[0][0] == 9
+
+
+def test_remove_keeps_other_keys_searchable():
+    index = VectorIndex(dim=2)
+    index.add("a", _unit(1, 0))
+    index.add("b", _unit(0, 1))
+    index.add("c", _unit(-1, 0))
+    index.remove("a")
+
+    assert "a" not in index and len(index) == 2
+    assert index.search(_unit(-1, 0), k=1)[0][0] == "c"
+    assert index.search(_unit(0, 1), k=1)[0][0] == "b"
+
+
+def test_add_existing_key_replaces_vector():
+    index = VectorIndex(dim=2)
+    index.add("a", _unit(1, 0))
+    index.add("a", _unit(0, 1))
+    assert len(index) == 1
+    assert index.search(_unit(0, 1), k=1)[0][1] > 0.99
+
+
+def test_ivf_recall_close_to_brute_force():
+    from lib.vector_index import IVFIndex
+
+    rng = np.random.default_rng(1)
+    data = rng.standard_normal((2000, 16)).astype(np.float32)
+    data /= np.linalg.norm(data, axis=1, keepdims=True)
+
+    brute = VectorIndex(dim=16)
+    brute.add_many(list(range(len(data))), data)
+    ivf = IVFIndex.from_index(brute, nlist=20, nprobe=6)
+    assert len(ivf) == 2000
+
+    hits = 0
+    for q in data[:50]:
+        exact = {k for k, _ in brute.search(q, k=5)}
+        approx = {k for k, _ in ivf.search(q, k=5)}
+        hits += len(exact & approx)
+    assert hits / 250 >= 0.8
+
+
+def test_ivf_add_and_remove():
+    from lib.vector_index import IVFIndex
+
+    ivf = IVFIndex(dim=2, nlist=2, nprobe=2)
+    ivf.train(np.stack([_unit(1, 0), _unit(0, 1), _unit(1, 0.1), _unit(0.1, 1)]))
+    ivf.add("a", _unit(1, 0))
+    ivf.add("b", _unit(0, 1))
+    ivf.remove("a")
+    assert "a" not in ivf
+    assert ivf.search(_unit(1, 0), k=1)[0][0] == "b"